@@ -0,0 +1,336 @@
+"""
+Binaries and release tarballs, downloaded once on the operator machine.
+
+Every node used to ``wget`` the same etcd, kubernetes, containerd, runc,
+crictl and CNI releases from GitHub and GCS, hundreds of MB per node and as
+slow as the slowest mirror. The cache keeps each download once, content
+addressed (``blobs/<sha256>``, with ``index.json`` mapping URLs to hashes),
+checks it against its pinned hash in ``artifacts.sha256``, and packs the files a role needs into one uncompressed tarball that is pushed
+to every node in parallel. With ``offline`` set nothing is downloaded, so a
+run can be made against a pre-seeded cache directory.
+
+A release without a pin is refused, so a changed version can't be installed
+unchecked: ``pin`` records the hashes of the releases that have none from a
+sha256sum file the operator got from the release or made on a trusted
+machine (never from the download it is meant to check), and with
+``unpinned`` set they are used without one.
+"""
+import hashlib
+import json
+import os
+import posixpath
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import urlopen
+
+import snapshot
+import transfer
+
+settings = {
+    'path': '.artifacts',
+    'checksums': 'artifacts.sha256',
+    'offline': False,
+    # use releases that have no pin in the checksums file, unverified
+    'unpinned': False,
+    'remote_dir': '/var/cache/hardway',
+    'parallel': 4,
+    'timeout': 60,
+}
+
+CHUNK = 1 << 20
+ARCHIVES = ('.tar.gz', '.tgz', '.tar')
+
+CHECKSUMS_HEADER = '''# sha256 of every release the setup installs, as sha256sum prints them. After
+# changing a version in versions.yaml, pin the new releases with their
+# published hashes: fab pin_artifacts:sums=<sha256sum file>
+'''
+
+_lock = threading.Lock()
+_bundle_lock = threading.Lock()
+_index = None
+_verified = set()
+
+
+class ArtifactError(Exception):
+    pass
+
+
+def _flag(value):
+    return str(value).lower() in ('1', 'true', 'yes', 'y')
+
+
+def configure(path=None, offline=None, checksums=None, unpinned=None):
+    global _index
+    with _lock:
+        if path is not None:
+            settings['path'] = path
+            _index = None
+            _verified.clear()
+        if offline is not None:
+            settings['offline'] = _flag(offline)
+        if checksums is not None:
+            settings['checksums'] = checksums
+        if unpinned is not None:
+            settings['unpinned'] = _flag(unpinned)
+
+
+def _index_path():
+    return os.path.join(settings['path'], 'index.json')
+
+
+def blob_path(digest):
+    return os.path.join(settings['path'], 'blobs', digest)
+
+
+def index():
+    """
+    The URL to sha256 map of the cache; the caller holds _lock
+    """
+    global _index
+    if _index is None:
+        _index = {}
+        if os.path.exists(_index_path()):
+            with open(_index_path()) as f:
+                _index = json.load(f)
+    return _index
+
+
+def _record(url, digest):
+    with _lock:
+        index()[url] = digest
+        snapshot.save(_index_path(), index())
+
+
+def pinned():
+    """
+    Hashes from the checksums file, lines of '<sha256>  <url>' like sha256sum
+    prints them
+    """
+    pins = {}
+    if not os.path.exists(settings['checksums']):
+        return pins
+    with open(settings['checksums']) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                digest, url = line.split(None, 1)
+                pins[url.strip()] = digest.lower()
+    return pins
+
+
+def expected(url):
+    """
+    The pinned sha256 of url; without a pin, None if unpinned releases are
+    allowed, ArtifactError otherwise
+    """
+    digest = pinned().get(url)
+    if digest is None and not settings['unpinned']:
+        raise ArtifactError('{0} has no pin in {1}; pin it with fab pin_artifacts:sums=<sha256sum file>, or use it '
+                            'unverified with fab artifact_cache:unpinned=yes'.format(url, settings['checksums']))
+    return digest
+
+
+def read_sums(path):
+    """
+    {url or file name: sha256} from a file of sha256sum lines
+    """
+    sums = {}
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.split(None, 1)
+            digest = fields[0].lower()
+            if len(fields) != 2 or len(digest) != 64 or any(c not in '0123456789abcdef' for c in digest):
+                raise ArtifactError('{0}:{1}: not a sha256sum line: {2}'.format(path, number, line))
+            # sha256sum -b marks binary files with *
+            sums[fields[1].strip().lstrip('*')] = digest
+    return sums
+
+
+def pin(urls, sums):
+    """
+    Pin those of urls the checksums file has no hash for to their hash in
+    sums ({url or file name: sha256}), so the releases of each project can be
+    pinned from its own sums file. A file name only counts for the one url
+    ending in it. Nothing is downloaded; a cached copy that doesn't match its
+    new pin is an error. Returns {url: sha256} of the new pins.
+    """
+    pins = pinned()
+    names = {}
+    for url in urls:
+        names.setdefault(filename(url), []).append(url)
+    added = {}
+    for url in sorted(set(urls) - set(pins)):
+        digest = sums.get(url)
+        if digest is None and len(names[filename(url)]) == 1:
+            digest = sums.get(filename(url))
+        if digest is not None:
+            added[url] = digest.lower()
+    for url, digest in sorted(added.items()):
+        with _lock:
+            have = index().get(url)
+        if have is not None and have != digest:
+            raise ArtifactError('{0}: the cached copy has sha256 {1}, not {2}'.format(url, have, digest))
+    if added:
+        pins.update(added)
+        with open(settings['checksums'], 'w') as f:
+            f.write(CHECKSUMS_HEADER)
+            for url in sorted(pins):
+                f.write('{0}  {1}\n'.format(pins[url], url))
+    return added
+
+
+def sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _store(url, src, digest, expected):
+    if expected and digest != expected:
+        os.remove(src)
+        raise ArtifactError('{0}: sha256 is {1}, expected {2}'.format(url, digest, expected))
+    os.rename(src, blob_path(digest))
+    _record(url, digest)
+    _verified.add(digest)
+    return blob_path(digest)
+
+
+def _tempfile():
+    directory = os.path.join(settings['path'], 'blobs')
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, path = tempfile.mkstemp(dir=directory, prefix='.download-')
+    return os.fdopen(fd, 'wb'), path
+
+
+def download(url, expected=None):
+    """
+    Download url into the cache, hashing it on the way
+    """
+    h = hashlib.sha256()
+    f, path = _tempfile()
+    try:
+        with f, urlopen(url, timeout=settings['timeout']) as response:
+            for chunk in iter(lambda: response.read(CHUNK), b''):
+                h.update(chunk)
+                f.write(chunk)
+    except Exception:
+        os.remove(path)
+        raise
+    return _store(url, path, h.hexdigest(), expected)
+
+
+def add(url, path):
+    """
+    Put a local copy of url into the cache, e.g. one fetched on another machine
+    """
+    digest = expected(url)
+    f, tmp_path = _tempfile()
+    with f, open(path, 'rb') as src:
+        shutil.copyfileobj(src, f, CHUNK)
+    return _store(url, tmp_path, sha256(tmp_path), digest)
+
+
+def cached(url, expected=None):
+    """
+    Path of the cached copy of url, or None if there is no good one
+    """
+    with _lock:
+        digest = index().get(url)
+    if digest is None or (expected and digest != expected):
+        return None
+    path = blob_path(digest)
+    if not os.path.exists(path):
+        return None
+    if digest not in _verified:
+        if sha256(path) != digest:
+            os.remove(path)
+            return None
+        _verified.add(digest)
+    return path
+
+
+def fetch(url):
+    """
+    Path of a verified copy of url, downloaded only if the cache has none
+    """
+    digest = expected(url)
+    path = cached(url, digest)
+    if path is not None:
+        return path
+    if settings['offline']:
+        raise ArtifactError('{0} is not in the artifact cache {1} and downloads are off'.format(url, settings['path']))
+    return download(url, digest)
+
+
+def fetch_all(urls):
+    """
+    fetch() every url, several downloads at a time; returns {url: path}
+    """
+    urls = sorted(set(urls))
+    with ThreadPoolExecutor(max_workers=int(settings['parallel'])) as pool:
+        return dict(zip(urls, pool.map(fetch, urls)))
+
+
+def seed(directory, urls):
+    """
+    Add the files in directory named like the last part of one of urls
+    """
+    added = []
+    for url in urls:
+        path = os.path.join(directory, filename(url))
+        if os.path.isfile(path):
+            add(url, path)
+            added.append(url)
+    return added
+
+
+def filename(url):
+    return posixpath.basename(url.split('?')[0])
+
+
+def remote_path(url):
+    """
+    Where a pushed artifact lands on the node
+    """
+    return posixpath.join(settings['remote_dir'], filename(url))
+
+
+def entries(urls):
+    paths = fetch_all(urls)
+    result = []
+    for url in sorted(paths):
+        mode = 0o644 if filename(url).endswith(ARCHIVES) else 0o755
+        result.append(transfer.Entry(paths[url], remote_path(url), mode))
+    return result
+
+
+def bundle(urls):
+    """
+    A tarball of urls for transfer.install_command, built once for each set
+    of artifacts and kept in the cache. The releases are already compressed,
+    so the tarball is not.
+    """
+    # hosts set up concurrently mostly ask for the same bundle
+    with _bundle_lock:
+        manifest = entries(urls)
+        h = hashlib.sha256()
+        for entry in manifest:
+            h.update('{0} {1}\n'.format(os.path.basename(entry.src), entry.destination).encode('utf-8'))
+        directory = os.path.join(settings['path'], 'bundles')
+        path = os.path.join(directory, h.hexdigest()[:16] + '.tar')
+        if not os.path.exists(path):
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.bundle-')
+            os.close(fd)
+            transfer.pack(manifest, path=tmp_path, compress=False)
+            os.rename(tmp_path, path)
+        return path
@@ -0,0 +1,415 @@
+"""
+Who calls the API servers, how often, and how long they wait, from their
+audit logs.
+
+Every API server writes an audit event per request to
+``/var/log/audit.log``, rotated into ``audit-<time>.log`` files, and nothing
+read them. ``fetch`` streams the new part of every log of every controller at
+once, gzipped over ssh; ``read`` does the same for local copies. Lines are
+parsed one at a time as they arrive, so memory stays flat however many GB go
+through: each user, verb, resource and (user, verb, resource) caller keeps a
+count, error counts and a latency ``Sketch``, whose quantiles are within 1%
+of the exact ones. How far every file was read, keyed by inode so a rotated
+file keeps its place, is saved with the stats, so the next run reads only
+what was written since and reports over everything.
+"""
+import calendar
+import gzip
+import json
+import math
+import os
+import subprocess
+import threading
+
+import profiler
+import snapshot
+
+settings = {
+    'path': '.audit-state.json',
+    'logs': '/var/log/audit*.log',
+    # relative accuracy of the latency quantiles
+    'accuracy': 0.01,
+}
+
+GROUPS = ('caller', 'user', 'verb', 'resource')
+QUANTILES = (0.5, 0.9, 0.99)
+
+# the stages that end a request; others (RequestReceived) would count it twice
+FINAL_STAGES = (b'"ResponseComplete"', b'"Panic"')
+
+
+class AuditLogError(Exception):
+    pass
+
+
+### quantile sketch ############################################################
+
+class Sketch(object):
+    """
+    Quantiles of a stream of positive numbers in bounded memory: values are
+    counted in buckets whose bounds grow by a factor of gamma, so any quantile
+    is off by at most ``accuracy`` relative to the exact one, and two sketches
+    merge by adding their buckets
+    """
+    # values under this are counted as zero
+    MIN = 1e-3
+
+    def __init__(self, accuracy=None, buckets=None, zeros=0, count=0, maximum=0.0):
+        self.accuracy = accuracy or settings['accuracy']
+        self.gamma = (1 + self.accuracy) / (1 - self.accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = buckets or {}
+        self.zeros = zeros
+        self.count = count
+        self.maximum = maximum
+
+    def add(self, value):
+        self.count += 1
+        if value > self.maximum:
+            self.maximum = value
+        if value <= self.MIN:
+            self.zeros += 1
+            return
+        index = int(math.ceil(math.log(value) / self.log_gamma))
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def merge(self, other):
+        if other.accuracy != self.accuracy:
+            raise AuditLogError('can not merge sketches of accuracy {0} and {1}'.format(self.accuracy, other.accuracy))
+        for index, n in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + n
+        self.zeros += other.zeros
+        self.count += other.count
+        self.maximum = max(self.maximum, other.maximum)
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                # the middle of the bucket, within accuracy of anything in it
+                return min(2 * self.gamma ** index / (self.gamma + 1), self.maximum)
+        return self.maximum
+
+    def to_dict(self):
+        return {'accuracy': self.accuracy, 'buckets': dict((str(i), n) for i, n in self.buckets.items()),
+                'zeros': self.zeros, 'count': self.count, 'maximum': self.maximum}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['accuracy'], dict((int(i), n) for i, n in data['buckets'].items()),
+                   data['zeros'], data['count'], data['maximum'])
+
+
+### stats ######################################################################
+
+class Stats(object):
+    """
+    Requests of one user, verb, resource or caller: how many, how many failed
+    (5xx) or were throttled (429), and their latency in ms
+    """
+    def __init__(self, count=0, errors=0, throttled=0, latency=None):
+        self.count = count
+        self.errors = errors
+        self.throttled = throttled
+        self.latency = latency or Sketch()
+
+    def add(self, latency, code):
+        self.count += 1
+        if code >= 500:
+            self.errors += 1
+        elif code == 429:
+            self.throttled += 1
+        if latency is not None:
+            self.latency.add(latency)
+
+    def merge(self, other):
+        self.count += other.count
+        self.errors += other.errors
+        self.throttled += other.throttled
+        self.latency.merge(other.latency)
+
+    def to_dict(self):
+        return {'count': self.count, 'errors': self.errors, 'throttled': self.throttled,
+                'latency': self.latency.to_dict()}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['count'], data['errors'], data['throttled'], Sketch.from_dict(data['latency']))
+
+
+_minutes = {}
+
+
+def timestamp(text):
+    """
+    Seconds since the epoch of an RFC 3339 UTC time like
+    2018-05-01T12:00:00.123456Z; strptime is too slow for a line at a time
+    """
+    minute = text[:16]
+    base = _minutes.get(minute)
+    if base is None:
+        if len(_minutes) > 10000:
+            _minutes.clear()
+        base = _minutes[minute] = calendar.timegm((int(text[0:4]), int(text[5:7]), int(text[8:10]),
+                                                   int(text[11:13]), int(text[14:16]), 0))
+    return base + float(text[17:].rstrip('Z'))
+
+
+class Analyzer(object):
+    def __init__(self):
+        self.groups = dict((group, {}) for group in GROUPS)
+        self.first = None
+        self.last = None
+        self.lines = 0
+        self.skipped = 0
+
+    def add_line(self, line):
+        """
+        Count one line of an audit log; lines that aren't the end of a request
+        are only counted as lines
+        """
+        self.lines += 1
+        if not any(stage in line for stage in FINAL_STAGES):
+            return
+        try:
+            event = json.loads(line.decode('utf-8'))
+        except ValueError:
+            self.skipped += 1
+            return
+        self.add_event(event)
+
+    def add_event(self, event):
+        try:
+            received = timestamp(event['requestReceivedTimestamp'])
+            finished = timestamp(event['stageTimestamp'])
+        except (KeyError, ValueError):
+            self.skipped += 1
+            return
+        user = (event.get('user') or {}).get('username', '-')
+        verb = event.get('verb', '-')
+        resource = (event.get('objectRef') or {}).get('resource') or event.get('requestURI', '-').split('?')[0]
+        code = (event.get('responseStatus') or {}).get('code', 0)
+        latency = max(finished - received, 0) * 1000
+        for group, key in (('caller', ' '.join((user, verb, resource))), ('user', user), ('verb', verb),
+                           ('resource', resource)):
+            stats = self.groups[group].get(key)
+            if stats is None:
+                stats = self.groups[group][key] = Stats()
+            stats.add(latency, code)
+        if self.first is None or received < self.first:
+            self.first = received
+        if self.last is None or finished > self.last:
+            self.last = finished
+
+    def merge(self, other):
+        for group in GROUPS:
+            mine = self.groups[group]
+            for key, stats in other.groups[group].items():
+                if key in mine:
+                    mine[key].merge(stats)
+                else:
+                    mine[key] = stats
+        for value in (other.first, other.last):
+            if value is not None:
+                self.first = value if self.first is None else min(self.first, value)
+                self.last = value if self.last is None else max(self.last, value)
+        self.lines += other.lines
+        self.skipped += other.skipped
+
+    @property
+    def window(self):
+        """
+        Seconds between the first and the last request seen
+        """
+        if self.first is None:
+            return 0.0
+        return max(self.last - self.first, 1.0)
+
+    def to_dict(self):
+        return {'groups': dict((group, dict((key, stats.to_dict()) for key, stats in self.groups[group].items()))
+                               for group in GROUPS),
+                'first': self.first, 'last': self.last, 'lines': self.lines, 'skipped': self.skipped}
+
+    @classmethod
+    def from_dict(cls, data):
+        analyzer = cls()
+        for group in GROUPS:
+            analyzer.groups[group] = dict((key, Stats.from_dict(stats))
+                                          for key, stats in data['groups'].get(group, {}).items())
+        analyzer.first = data['first']
+        analyzer.last = data['last']
+        analyzer.lines = data['lines']
+        analyzer.skipped = data['skipped']
+        return analyzer
+
+
+### reading ####################################################################
+
+def consume(stream, analyzer):
+    """
+    Feed the complete lines of a binary stream to analyzer; returns the
+    number of bytes they took, so a line still being written is read again
+    next time
+    """
+    used = 0
+    for line in stream:
+        if not line.endswith(b'\n'):
+            break
+        analyzer.add_line(line)
+        used += len(line)
+    return used
+
+
+class State(object):
+    """
+    The stats so far and, per host, how many bytes of each log (by inode)
+    went into them
+    """
+    def __init__(self, analyzer=None, offsets=None):
+        self.analyzer = analyzer or Analyzer()
+        self.offsets = offsets or {}
+        self._lock = threading.Lock()
+
+    def update(self, host, offsets, analyzer):
+        with self._lock:
+            self.offsets[host] = offsets
+            self.analyzer.merge(analyzer)
+
+    def save(self, path=None):
+        snapshot.save(path or settings['path'], {'analyzer': self.analyzer.to_dict(), 'offsets': self.offsets})
+
+    @classmethod
+    def load(cls, path=None):
+        path = path or settings['path']
+        if not os.path.exists(path):
+            return cls()
+        with open(path) as f:
+            data = json.load(f)
+        return cls(Analyzer.from_dict(data['analyzer']), data['offsets'])
+
+
+def _files(paths):
+    """
+    (inode, size, path) of every file, oldest rotation first: audit.log
+    sorts after audit-<time>.log
+    """
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            found.extend(os.path.join(path, name) for name in os.listdir(path)
+                         if name.startswith('audit') and name.endswith('.log'))
+        else:
+            found.append(path)
+    result = []
+    for path in sorted(found, key=os.path.basename):
+        info = os.stat(path)
+        result.append((str(info.st_ino), info.st_size, path))
+    return result
+
+
+def read(paths, state, host='local'):
+    """
+    Read what is new in the local audit logs (files, or directories of
+    them) into state, as if they came from host
+    """
+    done = state.offsets.get(host, {})
+    offsets = {}
+    analyzer = Analyzer()
+    for inode, size, path in _files(paths):
+        start = done.get(inode, 0)
+        if start > size:
+            # a new file with a recycled inode
+            start = 0
+        with open(path, 'rb') as f:
+            f.seek(start)
+            offsets[inode] = start + consume(f, analyzer)
+    state.update(host, offsets, analyzer)
+    return analyzer
+
+
+def list_command():
+    return 'sudo stat -c "%i %s %n" {0} 2>/dev/null; true'.format(settings['logs'])
+
+
+def parse_listing(output):
+    result = []
+    for line in (output or '').splitlines():
+        words = line.split(None, 2)
+        if len(words) == 3 and words[0].isdigit() and words[1].isdigit():
+            result.append((words[0], int(words[1]), words[2]))
+    return sorted(result, key=lambda item: os.path.basename(item[2]))
+
+
+def stream_command(path, start):
+    return 'sudo tail -c +{0} {1} | gzip -1'.format(start + 1, path)
+
+
+def fetch(host, state, list_logs):
+    """
+    Stream what is new in the audit logs of host into state; list_logs(host)
+    returns the output of list_command on host
+    """
+    done = state.offsets.get(host, {})
+    offsets = {}
+    analyzer = Analyzer()
+    for inode, size, path in parse_listing(list_logs(host)):
+        start = done.get(inode, 0)
+        if start > size:
+            start = 0
+        offsets[inode] = start
+        if start == size:
+            continue
+        command = ['gcloud', 'compute', 'ssh', host, '--command', stream_command(path, start)]
+        with profiler.span(' '.join(command), kind='ssh', host=host) as info:
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stdin=subprocess.DEVNULL)
+            try:
+                with gzip.GzipFile(fileobj=process.stdout) as stream:
+                    used = consume(stream, analyzer)
+            finally:
+                process.stdout.close()
+                status = process.wait()
+            info['status'] = status
+            info['size'] = used
+        if status:
+            raise AuditLogError('streaming {0} from {1} failed with exit {2}'.format(path, host, status))
+        offsets[inode] = start + used
+    state.update(host, offsets, analyzer)
+    return analyzer
+
+
+### reporting ##################################################################
+
+def _ms(value):
+    return '-' if value is None else '{0:.1f}'.format(value)
+
+
+def report(analyzer, top=20):
+    """
+    The top callers, users, verbs and resources by requests, with their rate
+    over the whole window, latency quantiles in ms, 5xx and 429 counts
+    """
+    if analyzer.first is None:
+        return 'no requests in {0} lines'.format(analyzer.lines)
+    window = analyzer.window
+    requests = sum(stats.count for stats in analyzer.groups['verb'].values())
+    lines = ['{0} requests in {1:.0f}s ({2:.1f}/s), {3} lines, {4} unreadable'.format(
+        requests, window, requests / window, analyzer.lines, analyzer.skipped)]
+    headers = ['requests', 'rate/s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', '5xx', '429']
+    for group in GROUPS:
+        rows = []
+        for key, stats in sorted(analyzer.groups[group].items(), key=lambda item: (-item[1].count, item[0]))[:int(top)]:
+            rows.append([key, stats.count, '{0:.2f}'.format(stats.count / window)] +
+                        [_ms(stats.latency.quantile(q)) for q in QUANTILES] +
+                        [_ms(stats.latency.maximum), stats.errors, stats.throttled])
+        widths = [max(len(str(row[i])) for row in rows + [[group] + headers]) for i in range(len(headers) + 1)]
+        lines.append('')
+        for row in [[group] + headers] + rows:
+            lines.append('  '.join([str(row[0]).ljust(widths[0])] +
+                                   [str(v).rjust(w) for v, w in zip(row[1:], widths[1:])]).rstrip())
+    return '\n'.join(lines)
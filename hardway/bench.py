@@ -0,0 +1,541 @@
+"""
+Benchmark the setup without a cloud.
+
+Changes to the deploy tool could only be measured against a real GCP project.
+``run`` puts fake ``gcloud``, ``cfssl``, ``cfssljson``, ``kubectl`` and
+``install`` executables first on PATH: each sleeps a configurable latency for
+its kind of call (ssh, scp, describe, ...), fails at a configurable rate,
+answers the calls the tasks parse (instance lists, operation status, session
+markers, nodes) for a cluster of the configured size, and appends every
+invocation to a log. Every ``step_0N`` then runs in order in a scratch copy of
+this directory, and ``deploy`` in another, for each node count. The result
+per step is its wall time, how many processes it spawned and how many remote
+round trips (ssh and scp) it made, written as JSON to compare runs across
+changes.
+
+The fake hosts keep state, so a run that skips work shows up: archives
+unpack into their files, stamps and units are kept, probes report them, a
+unit without a unit file doesn't start and health checks and ``etcdctl
+member list`` only pass for running units. After the steps and after deploy,
+``EXPECTED`` says what every node must have running and installed.
+
+The fakes are this file run as a script: ``python bench.py shim gcloud ...``.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import posixpath
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+import drift
+import versions
+
+settings = {
+    'nodes': [3, 10, 50, 200],
+    'steps': ['step_0{0}'.format(i) for i in range(1, 9)],
+    'deploy': True,
+    'controllers': 3,
+    # seconds a fake call of each kind takes
+    'latency': {
+        'ssh': 0.3,
+        'scp': 0.5,
+        'describe': 0.2,
+        'gcloud': 0.5,
+        'kubectl': 0.1,
+        'cfssl': 0.05,
+        'local': 0.01,
+    },
+    'failure_rate': 0.0,
+    'timeout': 3600,
+}
+
+TOOLS = ('gcloud', 'cfssl', 'cfssljson', 'kubectl', 'install')
+PUBLIC_IP = '203.0.113.10'
+PACKAGE_UNITS = '/lib/systemd/system/'
+# the units and install stamps nodes have once the step (or deploy) ran
+EXPECTED = {
+    'step_06': {'controller': (['etcd'], ['etcd'])},
+    'step_07': {'controller': (['kube-apiserver', 'kube-controller-manager', 'kube-scheduler'],
+                               ['kubernetes-control-plane'])},
+    'step_08': {'worker': (['containerd', 'kubelet', 'kube-proxy'], ['kubernetes-node', 'containerd'])},
+}
+# left behind by earlier runs, or rebuilt by the steps anyway
+SKIP = ('.artifacts', 'rendered', '__pycache__', '.journal.jsonl', '.inventory.json', '.cluster-facts.json')
+
+
+def kind(tool, args):
+    line = ' '.join(args)
+    if tool == 'gcloud':
+        if 'compute ssh' in line:
+            return 'ssh'
+        if 'compute scp' in line:
+            return 'scp'
+        if re.search(r' (describe|list)\b|get-value', ' ' + line):
+            return 'describe'
+        return 'gcloud'
+    if tool in ('cfssl', 'cfssljson'):
+        return 'cfssl'
+    if tool == 'kubectl':
+        return 'kubectl'
+    return 'local'
+
+
+### the fake executables ######################################################
+
+def _nodes(config):
+    return (['controller-{0}'.format(i) for i in range(config['controllers'])] +
+            ['worker-{0}'.format(i) for i in range(config['workers'])])
+
+
+class Host(object):
+    """
+    What a fake host has: the files put in place ({path: sha256}), the files
+    scp'd to its home directory, the state of its units, how often each was
+    restarted and the install stamps. It lives in a JSON file per host, locked while a fake call uses it.
+    """
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = os.path.join(directory, name + '.json')
+
+    def __enter__(self):
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._file = open(self.path, 'a+')
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        self._file.seek(0)
+        data = json.loads(self._file.read() or '{}')
+        self.files = data.get('files', {})
+        self.home = data.get('home', {})
+        self.units = data.get('units', {})
+        self.stamps = data.get('stamps', {})
+        self.restarts = data.get('restarts', {})
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self._file.seek(0)
+                self._file.truncate()
+                self._file.write(json.dumps({'files': self.files, 'home': self.home, 'units': self.units,
+                                             'stamps': self.stamps, 'restarts': self.restarts}, sort_keys=True))
+        finally:
+            self._file.close()
+        return False
+
+    @staticmethod
+    def load(directory, name):
+        with Host(directory, name) as host:
+            return host
+
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _scp(args, config):
+    """
+    Note what lands in the host's home directory: the members of a hardway
+    archive, the hash of any other file
+    """
+    sources, target = args[2:-1], args[-1]
+    host_name, remote = target.split(':', 1)
+    with Host(config['state'], host_name) as host:
+        for source in sources:
+            name = posixpath.basename(remote.rstrip('/')) if not remote.endswith('/') else os.path.basename(source)
+            if tarfile.is_tarfile(source):
+                with tarfile.open(source) as archive:
+                    host.home[name] = dict(('/' + member.name, _sha256(archive.extractfile(member).read()))
+                                           for member in archive.getmembers() if member.isfile())
+            else:
+                with open(source, 'rb') as f:
+                    host.home[name] = _sha256(f.read())
+    return 0
+
+
+def _ssh_one(host, command, config):
+    """
+    Run one command against a fake host: (output, exit code)
+    """
+    lines = []
+    match = re.match(r'sudo tar --same-owner --same-permissions -x?z?f (\S+) -C /', command)
+    if match:
+        entries = host.home.pop(match.group(1), None)
+        if not isinstance(entries, dict):
+            return 'tar: {0}: Cannot open'.format(match.group(1)), 2
+        host.files.update(entries)
+        return '', 0
+    match = re.match(r'sudo sha256sum (.*?) 2>/dev/null; for s in (.*?); do echo', command)
+    if match:
+        for path in match.group(1).split():
+            if path in host.files:
+                lines.append('{0}  {1}'.format(host.files[path], path))
+        for service in match.group(2).split():
+            lines.append('service {0} {1}'.format(service, host.units.get(service, 'inactive')))
+        return '\n'.join(lines), 0
+    match = re.match(r'for f in (\S+)/\*; do .*echo "== current"; sha256sum (.*?) 2>/dev/null', command)
+    if match:
+        for path, (version, binaries) in sorted(host.stamps.items()):
+            lines.append('== ' + path)
+            lines.append('version ' + version)
+            lines.extend('{0}  {1}'.format(digest, binary) for binary, digest in sorted(binaries.items()))
+        lines.append('== current')
+        lines.extend('{0}  {1}'.format(host.files[path], path) for path in match.group(2).split() if path in host.files)
+        return '\n'.join(lines), 0
+    match = re.search(r'echo "version (\S+)"; sha256sum (.*?); \} \| sudo tee (\S+)', command)
+    if match:
+        version, binaries = match.group(1), match.group(2).split()
+        for binary in binaries:
+            # what the install commands before put there
+            host.files[binary] = _sha256('{0} {1}'.format(binary, version).encode('utf-8'))
+        host.stamps[match.group(3)] = [version, dict((binary, host.files[binary]) for binary in binaries)]
+        return '', 0
+    for name in re.findall(r'apt-get install -y ([\w .-]+)', command):
+        for package in name.split():
+            # packages bring their own units
+            host.files[PACKAGE_UNITS + package + '.service'] = _sha256(package.encode('utf-8'))
+    for action, names in re.findall(r'systemctl (start|restart|try-restart|stop)((?: [\w@.-]+)+)', command):
+        for name in names.split():
+            unit = name + '.service'
+            if action == 'try-restart' and host.units.get(name) != 'active':
+                continue
+            if action != 'stop' and drift.UNIT_DIRECTORY + unit not in host.files and PACKAGE_UNITS + unit not in host.files:
+                return 'Failed to {0} {1}.service: Unit {1}.service not found.'.format(action, name), 5
+            if action in ('restart', 'try-restart'):
+                host.restarts[name] = host.restarts.get(name, 0) + 1
+            host.units[name] = 'inactive' if action == 'stop' else 'active'
+    match = re.match(r'systemctl is-active (\S+)', command)
+    if match:
+        return host.units.get(match.group(1), 'inactive'), 0
+    for service, check in drift.HEALTH_CHECKS.items():
+        if check in command:
+            if host.units.get(service) == 'active':
+                return '', 0
+            return '{0} is not healthy'.format(service), 1
+    if 'member list' in command:
+        members = [name for name in _nodes(config) if name.startswith('controller-') and
+                   (name == host.name and host.units or Host.load(config['state'], name).units).get('etcd') == 'active']
+        for name in members:
+            i = int(name.split('-')[1])
+            lines.append('{0:x}, started, {1}, https://10.240.0.{2}:2380, https://10.240.0.{2}:2379'.format(
+                i + 1, name, 10 + i))
+        return '\n'.join(lines), 0 if members else 1
+    if 'fsync-probe' in command or 'base64 -d | sudo python3' in command:
+        return 'fsync-probe 200 0.800 2.500 4.000', 0
+    if 'get nodes' in command:
+        return _nodes_ready(config), 0
+    return '', 0
+
+
+def _ssh(args, config, stdin):
+    host_name = args[2]
+    command = args[args.index('--command') + 1] if '--command' in args else ''
+    with Host(config['state'], host_name) as host:
+        if command.strip() != 'bash -s':
+            output, status = _ssh_one(host, command, config)
+            if output:
+                print(output)
+            return status
+        # a session script: run the commands in order up to the first failure
+        for marker, index, command in re.findall(
+                r"echo '(\S+) begin (\d+)'\n\( (.*?)\n\) </dev/null 2>&1\nrc=\$\?", stdin, re.S):
+            output, status = _ssh_one(host, command, config)
+            print('{0} begin {1}'.format(marker, index))
+            if output:
+                print(output)
+            print('{0} end {1} {2}'.format(marker, index, status))
+            if status:
+                break
+    return 0
+
+
+def _gcloud(args, config, stdin):
+    line = ' '.join(args)
+    if 'compute ssh' in line:
+        return _ssh(args, config, stdin)
+    if 'compute scp' in line:
+        return _scp(args, config)
+    if 'instances list' in line:
+        print(json.dumps([{
+            'name': name, 'status': 'RUNNING',
+            'networkInterfaces': [{'networkIP': '10.240.0.{0}'.format(2 + i), 'accessConfigs': [{'natIP': PUBLIC_IP}]}],
+        } for i, name in enumerate(_nodes(config))]))
+    elif 'operations list' in line:
+        match = re.search(r'/\(([^)]*)\)\$', line)
+        for name in (match.group(1).split('|') if match else []):
+            print('{0}\tDONE\t'.format(name))
+    elif 'addresses describe' in line:
+        print(PUBLIC_IP)
+    elif 'get-value compute/region' in line:
+        print('us-west1')
+    elif 'get-value compute/zone' in line:
+        print('us-west1-c')
+    return 0
+
+
+def _nodes_ready(config):
+    """
+    kubectl get nodes: the workers whose kubelet runs
+    """
+    return '\n'.join('{0}   Ready    <none>   1m   v1.10.2'.format(name) for name in _nodes(config)
+                     if name.startswith('worker-') and Host.load(config['state'], name).units.get('kubelet') == 'active')
+
+
+def _kubectl(args, config, stdin):
+    if 'get' in args and 'nodes' in args:
+        print(_nodes_ready(config))
+    return 0
+
+
+def _cfssl(args, config, stdin):
+    print(json.dumps({'cert': 'CERT', 'key': 'KEY', 'csr': 'CSR'}))
+    return 0
+
+
+def _cfssljson(args, config, stdin):
+    if '-bare' in args:
+        name = args[args.index('-bare') + 1]
+        for suffix in ('.pem', '-key.pem', '.csr'):
+            with open(name + suffix, 'w') as f:
+                f.write('fake\n')
+    return 0
+
+
+FAKES = {
+    'gcloud': _gcloud,
+    'kubectl': _kubectl,
+    'cfssl': _cfssl,
+    'cfssljson': _cfssljson,
+    'install': lambda args, config, stdin: 0,
+}
+
+
+def shim(tool, args):
+    """
+    Run as the fake tool: answer, sleep the latency of the call, maybe fail,
+    and log the invocation
+    """
+    with open(os.environ['HARDWAY_BENCH_CONFIG']) as f:
+        config = json.load(f)
+    config['state'] = os.environ['HARDWAY_BENCH_STATE']
+    started = time.time()
+    # the tasks run with stdin closed, a session script comes in on stdin
+    stdin = '' if sys.stdin is None or sys.stdin.isatty() else sys.stdin.read()
+    call = kind(tool, args)
+    time.sleep(config['latency'].get(call, 0))
+    status = 1 if random.random() < config['failure_rate'] else None
+    if status:
+        sys.stderr.write('bench: simulated failure of {0} {1}\n'.format(tool, ' '.join(args)))
+    else:
+        status = FAKES[tool](args, config, stdin)
+    entry = json.dumps({'tool': tool, 'kind': call, 'args': ' '.join(args)[:200], 'start': started,
+                        'duration': time.time() - started, 'status': status, 'stdin': len(stdin)})
+    # one write per line, so concurrent fakes don't interleave
+    fd = os.open(config['log'], os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (entry + '\n').encode('utf-8'))
+    finally:
+        os.close(fd)
+    return status
+
+
+### running the steps #########################################################
+
+def _install_fakes(directory, config):
+    bin_dir = os.path.join(directory, 'bin')
+    os.makedirs(bin_dir)
+    for tool in TOOLS:
+        path = os.path.join(bin_dir, tool)
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\nexec "{0}" "{1}" shim {2} "$@"\n'.format(sys.executable, os.path.abspath(__file__), tool))
+        os.chmod(path, 0o755)
+    with open(os.path.join(directory, 'bench-config.json'), 'w') as f:
+        json.dump(config, f)
+    return bin_dir
+
+
+def _seed(directory, urls):
+    """
+    A release file of a few bytes for every one of urls, pinned in
+    seed.sha256 next to them
+    """
+    seed = os.path.join(directory, 'seed')
+    os.makedirs(seed)
+    files = {}
+    with open(seed + '.sha256', 'w') as pins:
+        for url in urls:
+            # kubectl for darwin and linux share a file name, and so a file
+            name = url.split('?')[0].rsplit('/', 1)[-1]
+            if name not in files:
+                files[name] = os.urandom(64)
+                with open(os.path.join(seed, name), 'wb') as f:
+                    f.write(files[name])
+            pins.write('{0}  {1}\n'.format(hashlib.sha256(files[name]).hexdigest(), url))
+    return seed
+
+
+def _sandbox(root, name, workers):
+    """
+    A scratch copy of this directory laid out for workers workers
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    path = os.path.join(root, name)
+    shutil.copytree(here, path, ignore=shutil.ignore_patterns(*SKIP))
+    with open(os.path.join(path, 'bench-cluster.json'), 'w') as f:
+        json.dump({'controllers': settings['controllers'], 'workers': workers}, f)
+    return path
+
+
+def _state_dir(path):
+    """
+    Where the fake hosts of the sandbox at path keep their state
+    """
+    return path + '-hosts'
+
+
+def _verify(result, path, config, steps):
+    problems = missing(_state_dir(path), config, steps)
+    if problems and result['ok']:
+        result['ok'] = False
+        result['error'] = '{0} problems, first: {1}'.format(len(problems), problems[0])
+    return result
+
+
+def _read_log(path, offset):
+    with open(path) as f:
+        f.seek(offset)
+        entries = [json.loads(line) for line in f if line.strip()]
+        return entries, f.tell()
+
+
+def _measure(calls, wall, ok, error=None):
+    by_tool = {}
+    by_kind = {}
+    for call in calls:
+        by_tool[call['tool']] = by_tool.get(call['tool'], 0) + 1
+        entry = by_kind.setdefault(call['kind'], {'calls': 0, 'seconds': 0.0})
+        entry['calls'] += 1
+        entry['seconds'] = round(entry['seconds'] + call['duration'], 3)
+    result = {
+        'ok': ok,
+        'wall': round(wall, 3),
+        'spawns': len(calls),
+        'round_trips': sum(1 for call in calls if call['kind'] in ('ssh', 'scp')),
+        'failed_calls': sum(1 for call in calls if call['status']),
+        'by_tool': by_tool,
+        'by_kind': by_kind,
+    }
+    if error:
+        result['error'] = error
+    return result
+
+
+def missing(state, config, steps):
+    """
+    What the fake hosts lack that steps should have set up
+    """
+    problems = []
+    for step in steps:
+        for role, (units, stamps) in sorted(EXPECTED.get(step, {}).items()):
+            for name in _nodes(config):
+                if not name.startswith(role + '-'):
+                    continue
+                host = Host.load(state, name)
+                problems.extend('{0}: {1} is not running'.format(name, unit)
+                                for unit in units if host.units.get(unit) != 'active')
+                problems.extend('{0}: {1} is not installed'.format(name, component) for component in stamps
+                                if posixpath.join(versions.settings['state_dir'], component) not in host.stamps)
+    return problems
+
+
+def _run_task(path, bin_dir, config_path, log, offset, task, cache, seed):
+    code = ('import fabfile as f; f.artifact_cache(path={0!r}, offline="yes", checksums={1!r}); '
+            'f.seed_artifacts({2!r}); f.use_topology(path="bench-cluster.json"); f.{3}()').format(
+                cache, seed + '.sha256', seed, task)
+    env = dict(os.environ, PATH=bin_dir + os.pathsep + os.environ.get('PATH', ''), HARDWAY_BENCH_CONFIG=config_path,
+               HARDWAY_BENCH_STATE=_state_dir(path))
+    started = time.time()
+    process = subprocess.run([sys.executable, '-W', 'ignore', '-c', code], cwd=path, env=env,
+                             stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=settings['timeout'])
+    wall = time.time() - started
+    calls, offset = _read_log(log, offset)
+    output = process.stdout.decode('utf-8', 'replace')
+    error = None if process.returncode == 0 else output.strip().splitlines()[-1:] or ['exit {0}'.format(process.returncode)]
+    return _measure(calls, wall, process.returncode == 0, error and error[0]), offset
+
+
+def run(urls, nodes=None, steps=None, deploy=None, latency=None, failure_rate=None, progress=None):
+    """
+    Benchmark steps, and deploy if set, for every node count (of workers),
+    with the artifact cache seeded with fakes of urls; returns the results as
+    a dict ready for json
+    """
+    nodes = nodes or settings['nodes']
+    steps = settings['steps'] if steps is None else steps
+    deploy = settings['deploy'] if deploy is None else deploy
+    latency = dict(settings['latency'], **(latency or {}))
+    failure_rate = settings['failure_rate'] if failure_rate is None else float(failure_rate)
+    progress = progress or (lambda text: None)
+    results = {'started': time.strftime('%Y-%m-%dT%H:%M:%S'), 'revision': _revision(),
+               'latency': latency, 'failure_rate': failure_rate, 'runs': []}
+    root = tempfile.mkdtemp(prefix='hardway-bench-')
+    try:
+        cache = os.path.join(root, 'artifacts')
+        seed = _seed(root, urls)
+        for workers in nodes:
+            directory = os.path.join(root, 'n{0}'.format(workers))
+            os.makedirs(directory)
+            log = os.path.join(directory, 'calls.jsonl')
+            config = {'log': log, 'latency': latency, 'failure_rate': failure_rate,
+                      'controllers': settings['controllers'], 'workers': workers}
+            bin_dir = _install_fakes(directory, config)
+            config_path = os.path.join(directory, 'bench-config.json')
+            open(log, 'w').close()
+            offset = 0
+            run_result = {'workers': workers, 'controllers': settings['controllers'], 'steps': {}}
+            path = _sandbox(directory, 'steps', workers)
+            for i, step in enumerate(steps):
+                progress('{0} workers: {1}'.format(workers, step))
+                result, offset = _run_task(path, bin_dir, config_path, log, offset, step, cache, seed)
+                run_result['steps'][step] = _verify(result, path, config, steps[:i + 1])
+            if deploy:
+                progress('{0} workers: deploy'.format(workers))
+                path = _sandbox(directory, 'deploy', workers)
+                result, offset = _run_task(path, bin_dir, config_path, log, offset, 'deploy', cache, seed)
+                run_result['deploy'] = _verify(result, path, config, sorted(EXPECTED))
+            results['runs'].append(run_result)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+def _revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(results):
+    lines = ['{0:>7}  {1:<10} {2:>4} {3:>9} {4:>7} {5:>12}'.format('workers', 'step', 'ok', 'wall', 'spawns', 'round trips')]
+    for run_result in results['runs']:
+        steps = sorted(run_result['steps'].items())
+        if 'deploy' in run_result:
+            steps.append(('deploy', run_result['deploy']))
+        for step, result in steps:
+            lines.append('{0:>7}  {1:<10} {2:>4} {3:>8.1f}s {4:>7} {5:>12}'.format(
+                run_result['workers'], step, 'yes' if result['ok'] else 'NO', result['wall'],
+                result['spawns'], result['round_trips']))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__' and len(sys.argv) > 2 and sys.argv[1] == 'shim':
+    sys.exit(shim(sys.argv[2], sys.argv[3:]))
@@ -0,0 +1,150 @@
+"""
+How workers move Service and pod traffic.
+
+kube-proxy was pinned to iptables mode, which walks a rule chain per packet
+that grows with every Service, and the bridge CNI config and containerd's
+config had no MTU, hairpin or download settings. A data-plane profile picks
+the proxy mode (``iptables``, as before, or ``ipvs`` with a choice of IPVS
+scheduler), the bridge MTU and hairpin mode, and how many layers containerd
+pulls at once, and lists the kernel modules the workers need loaded for it.
+``check_kube_proxy`` and ``check_bridge`` check that a rendered config carries
+the profile.
+"""
+import json
+
+import yaml
+
+settings = {
+    'profile': 'iptables',
+}
+
+PROFILES = {
+    # what the workers ran before there were profiles
+    'iptables': {
+        'mode': 'iptables',
+        'scheduler': None,
+        'sync_period': '30s',
+        'min_sync_period': '0s',
+        'mtu': None,
+        'hairpin': False,
+        'max_concurrent_downloads': 3,
+        'modules': ['br_netfilter'],
+    },
+    'ipvs': {
+        'mode': 'ipvs',
+        'scheduler': 'rr',
+        'sync_period': '30s',
+        'min_sync_period': '5s',
+        # GCE networks carry 1460 byte packets
+        'mtu': 1460,
+        'hairpin': True,
+        'max_concurrent_downloads': 10,
+        'modules': ['br_netfilter', 'ip_vs', 'nf_conntrack_ipv4'],
+    },
+}
+
+# IPVS schedulers kube-proxy accepts, and the kernel module of each
+SCHEDULERS = {
+    'rr': 'ip_vs_rr', 'wrr': 'ip_vs_wrr', 'lc': 'ip_vs_lc', 'wlc': 'ip_vs_wlc',
+    'sh': 'ip_vs_sh', 'dh': 'ip_vs_dh', 'sed': 'ip_vs_sed', 'nq': 'ip_vs_nq',
+}
+
+# the packages the ipvs mode needs on top of socat, conntrack and ipset
+PACKAGES = {
+    'iptables': [],
+    'ipvs': ['ipvsadm'],
+}
+
+_overrides = {}
+
+
+class DataPlaneError(ValueError):
+    pass
+
+
+class DataPlane(object):
+    def __init__(self, name, values):
+        self.name = name
+        self.values = values
+        self.mode = values['mode']
+        self.scheduler = values['scheduler']
+        self.mtu = values['mtu']
+        self.hairpin = values['hairpin']
+        self.modules = values['modules']
+
+    @property
+    def kernel_modules(self):
+        modules = list(self.modules)
+        if self.mode == 'ipvs':
+            modules.append(SCHEDULERS[self.scheduler])
+        return modules
+
+    @property
+    def packages(self):
+        return PACKAGES[self.mode]
+
+    def fingerprint(self):
+        """
+        The profile's values, for input hashes
+        """
+        return [self.name, sorted((k, str(v)) for k, v in self.values.items())]
+
+
+def validate(values):
+    if values['mode'] not in PACKAGES:
+        raise DataPlaneError('mode must be one of {0}, got {1!r}'.format(', '.join(sorted(PACKAGES)), values['mode']))
+    if values['mode'] == 'ipvs' and values['scheduler'] not in SCHEDULERS:
+        raise DataPlaneError('scheduler must be one of {0}, got {1!r}'.format(
+            ', '.join(sorted(SCHEDULERS)), values['scheduler']))
+    if values['mtu'] is not None and not 576 <= values['mtu'] <= 9000:
+        raise DataPlaneError('mtu must be between 576 and 9000, got {0}'.format(values['mtu']))
+    if not 1 <= values['max_concurrent_downloads'] <= 100:
+        raise DataPlaneError('max_concurrent_downloads must be between 1 and 100, got {0}'.format(
+            values['max_concurrent_downloads']))
+
+
+def use(profile=None, scheduler=None, mtu=None, downloads=None):
+    """
+    Switch to the named profile, optionally with another IPVS scheduler, MTU
+    or number of concurrent layer downloads
+    """
+    if profile is not None:
+        if profile not in PROFILES:
+            raise DataPlaneError('unknown data-plane profile {0!r}, use one of {1}'.format(
+                profile, ', '.join(sorted(PROFILES))))
+        settings['profile'] = profile
+        _overrides.clear()
+    if scheduler is not None:
+        _overrides['scheduler'] = scheduler
+    if mtu is not None:
+        _overrides['mtu'] = int(mtu)
+    if downloads is not None:
+        _overrides['max_concurrent_downloads'] = int(downloads)
+    return current()
+
+
+def current():
+    values = dict(PROFILES[settings['profile']])
+    values.update(_overrides)
+    validate(values)
+    return DataPlane(settings['profile'], values)
+
+
+def check_kube_proxy(text, plane):
+    config = yaml.safe_load(text) or {}
+    if config.get('mode') != plane.mode:
+        raise DataPlaneError('kube-proxy mode is {0!r}, the profile wants {1!r}'.format(config.get('mode'), plane.mode))
+    if plane.mode == 'ipvs':
+        scheduler = (config.get('ipvs') or {}).get('scheduler')
+        if scheduler != plane.scheduler:
+            raise DataPlaneError('kube-proxy IPVS scheduler is {0!r}, the profile wants {1!r}'.format(
+                scheduler, plane.scheduler))
+
+
+def check_bridge(text, plane):
+    config = json.loads(text)
+    if config.get('mtu') != plane.mtu:
+        raise DataPlaneError('bridge MTU is {0!r}, the profile wants {1!r}'.format(config.get('mtu'), plane.mtu))
+    if config.get('hairpinMode', False) != plane.hairpin:
+        raise DataPlaneError('bridge hairpinMode is {0!r}, the profile wants {1!r}'.format(
+            config.get('hairpinMode', False), plane.hairpin))
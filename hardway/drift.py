@@ -0,0 +1,179 @@
+"""
+Push only the configs that changed and restart only the services they
+belong to.
+
+The setup tasks used to copy every unit and config and end with
+``systemctl daemon-reload && enable && start`` whether anything changed or
+not, so a changed config was never picked up by a running daemon, and
+restarting meant restarting everything. Here every file a host should have is
+hashed locally and compared with the hashes the host reports in one call,
+together with the state of its services. Only the files that differ are
+pushed; the services they belong to are restarted (after a daemon-reload if a
+unit changed) and services that are not running are started. A health check
+can follow each restart, so a control plane rolled one node at a time stops
+at the first node that doesn't come back.
+"""
+import hashlib
+import os
+import threading
+
+import transfer
+
+UNIT_DIRECTORY = '/etc/systemd/system/'
+
+# commands that exit 0 once a service is serving again, run on its host
+HEALTH_CHECKS = {
+    'etcd': 'sudo ETCDCTL_API=3 etcdctl endpoint health --endpoints=https://127.0.0.1:2379 '
+            '--cacert=/etc/etcd/ca.pem --cert=/etc/etcd/kubernetes.pem --key=/etc/etcd/kubernetes-key.pem',
+    'kube-apiserver': 'curl -sf --max-time 2 --cacert /var/lib/kubernetes/ca.pem https://127.0.0.1:6443/healthz',
+    'kube-controller-manager': 'curl -sf --max-time 2 http://127.0.0.1:10252/healthz',
+    'kube-scheduler': 'curl -sf --max-time 2 http://127.0.0.1:10251/healthz',
+    'nginx': 'curl -sf --max-time 2 -H "Host: kubernetes.default.svc.cluster.local" http://127.0.0.1/healthz',
+}
+
+settings = {
+    'health_retries': 30,
+    'health_delay': 2,
+}
+
+_lock = threading.Lock()
+_digests = {}
+
+
+class Managed(transfer.Entry):
+    """
+    A file that should be on a host, and the services that have to restart
+    when it changes. Services in notify read the file too but are set up by
+    another task: they are restarted with it if they run, never started.
+    """
+    def __init__(self, src, destination, services=(), mode=None, owner=None, notify=()):
+        transfer.Entry.__init__(self, src, destination, mode, owner)
+        self.services = list(services)
+        self.notify = [s for s in notify if s not in self.services]
+
+    @property
+    def unit(self):
+        return self.destination.startswith(UNIT_DIRECTORY)
+
+
+def manifest(files):
+    """
+    Normalize (src, destination[, services[, mode[, owner]]]) tuples or
+    Managed objects into Managed objects, one per destination with the
+    services of every entry for it
+    """
+    result = []
+    by_destination = {}
+    for f in files:
+        f = f if isinstance(f, Managed) else Managed(*f)
+        first = by_destination.get(f.destination)
+        if first is None:
+            by_destination[f.destination] = f
+            result.append(f)
+            continue
+        if first.src != f.src:
+            raise ValueError('{0} comes from both {1} and {2}'.format(f.destination, first.src, f.src))
+        merged = Managed(first.src, first.destination, sorted(set(first.services + f.services)), first.mode,
+                         first.owner, first.notify + f.notify)
+        result[result.index(first)] = by_destination[f.destination] = merged
+    return result
+
+
+def digest(path):
+    """
+    sha256 of a local file, hashed once per version of the file
+    """
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    with _lock:
+        if key in _digests:
+            return _digests[key]
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        h.update(f.read())
+    with _lock:
+        _digests[key] = h.hexdigest()
+    return _digests[key]
+
+
+def services_of(files, services=(), notify=True):
+    return sorted(set(list(services) + [s for f in files for s in f.services + (f.notify if notify else [])]))
+
+
+def probe_command(files, services=()):
+    """
+    One command that prints the hash of every file and the state of every
+    service on the host
+    """
+    return ('sudo sha256sum {0} 2>/dev/null; for s in {1}; do echo "service $s $(systemctl is-active $s)"; done; '
+            'true').format(' '.join(f.destination for f in files), ' '.join(services_of(files, services)))
+
+
+def parse_probe(output):
+    """
+    ({path: sha256}, {service: state}) from the output of probe_command
+    """
+    hashes = {}
+    states = {}
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) == 3 and fields[0] == 'service':
+            states[fields[1]] = fields[2]
+        elif len(fields) == 2:
+            hashes[fields[1]] = fields[0]
+    return hashes, states
+
+
+class Plan(object):
+    """
+    What it takes to bring a host in line: files to push, services to restart
+    and services to start. Services in restart are restarted even if none of
+    their files changed, e.g. after their binaries were replaced.
+    """
+    def __init__(self, files, services, output, restart=()):
+        hashes, states = parse_probe(output)
+        self.changed = [f for f in files if hashes.get(f.destination) != digest(f.src)]
+        self.reload = any(f.unit for f in self.changed)
+        self.restart = [s for s in services_of(self.changed, restart) if states.get(s) == 'active']
+        wanted = services_of(files, list(services) + list(restart), notify=False)
+        self.start = [s for s in wanted if s not in self.restart and states.get(s) != 'active']
+
+    @property
+    def empty(self):
+        return not (self.changed or self.restart or self.start)
+
+    def commands(self, gate=False):
+        """
+        systemctl commands for the plan, each followed by a health check of
+        the service if gate is set and there is one for it
+        """
+        commands = []
+        if self.reload:
+            commands.append('sudo systemctl daemon-reload')
+        for action, names in (('restart', self.restart), ('start', self.start)):
+            for name in names:
+                commands.append('sudo systemctl enable {0} && sudo systemctl {1} {0}'.format(name, action))
+                if gate and name in HEALTH_CHECKS:
+                    commands.append(health_command(name))
+        return commands
+
+    def describe(self):
+        if self.empty:
+            return 'no drift'
+        parts = []
+        if self.changed:
+            parts.append('changed ' + ', '.join(f.destination for f in self.changed))
+        if self.restart:
+            parts.append('restarting ' + ', '.join(self.restart))
+        if self.start:
+            parts.append('starting ' + ', '.join(self.start))
+        return '; '.join(parts)
+
+
+def health_command(service):
+    """
+    Command that waits until service passes its health check, failing after
+    settings['health_retries'] tries
+    """
+    return 'for i in $(seq {0}); do {1} >/dev/null && exit 0; sleep {2}; done; echo "{3} is not healthy"; exit 1'.format(
+        settings['health_retries'], HEALTH_CHECKS[service], settings['health_delay'], service)
@@ -18,9 +18,12 @@ ExecStart=/usr/local/bin/etcd \
   --listen-client-urls https://${internal_ip}:2379,https://127.0.0.1:2379 \
   --advertise-client-urls https://${internal_ip}:2379 \
   --initial-cluster-token etcd-cluster-0 \
-  --initial-cluster controller-0=https://10.240.0.10:2380,controller-1=https://10.240.0.11:2380,controller-2=https://10.240.0.12:2380 \
+  --initial-cluster ${initial_cluster} \
   --initial-cluster-state new \
-  --data-dir=/var/lib/etcd
+% for flag, value in etcd_flags:
+  --${flag}=${value} \
+% endfor
+  --data-dir=${data_dir}
 Restart=on-failure
 RestartSec=5
 
@@ -0,0 +1,256 @@
+"""
+etcd's timeouts, quota, compaction and disk, and a check of the disk first.
+
+etcd ran with its default heartbeat, election timeout, snapshot count and
+backend quota, with no compaction, on the boot disk everything else writes
+to. Every write waits for an fsync of etcd's log, so a slow or busy disk
+shows up as leader elections and slow API responses. A profile (``default``,
+what ran before, or ``tuned``) sets those flags and where the data lives;
+with ``data_disk`` set the controllers get their own SSD for it.
+
+Before etcd is installed on a controller, ``probe`` writes etcd-sized blocks
+into its data directory, fdatasyncing each like etcd's WAL does, and
+``judge`` holds the 99th percentile against ``settings['limit_ms']``.
+The probe is a small Python script; ``probe_local`` runs the same script
+against a local directory.
+"""
+import base64
+import subprocess
+import sys
+
+settings = {
+    'profile': 'default',
+    # fsync p99 in ms a controller's disk has to stay under (etcd asks for 10)
+    'limit_ms': 10.0,
+    # what a slow disk does: warn, abort, or off to skip the probe
+    'on_slow': 'warn',
+    # writes per probe
+    'count': 200,
+}
+
+PROFILES = {
+    # etcd's own defaults, as it ran before there were profiles
+    'default': {
+        'heartbeat_interval': 100,
+        'election_timeout': 1000,
+        'snapshot_count': 100000,
+        'quota_backend_bytes': 0,
+        'auto_compaction_mode': None,
+        'auto_compaction_retention': None,
+        'data_dir': '/var/lib/etcd',
+        'data_disk': None,
+    },
+    'tuned': {
+        # leaves room for the odd slow fsync and cross-zone round trip
+        'heartbeat_interval': 250,
+        'election_timeout': 2500,
+        # snapshots more often, so followers catch up and memory is freed sooner
+        'snapshot_count': 10000,
+        'quota_backend_bytes': 8 * 1024 ** 3,
+        'auto_compaction_mode': 'periodic',
+        'auto_compaction_retention': '1h',
+        'data_dir': '/var/lib/etcd',
+        'data_disk': None,
+    },
+}
+
+# what GCE names the dedicated disk in /dev/disk/by-id
+DEVICE_NAME = 'etcd'
+
+# the size of an average WAL entry of a kubernetes cluster, per etcd's fio guide
+BLOCK_SIZE = 2300
+
+PROBE = '''
+import os, sys, time
+directory, count, size = sys.argv[1], int(sys.argv[2]), int(sys.argv[3])
+path = os.path.join(directory, '.hardway-fsync-probe')
+block = b'\\0' * size
+latencies = []
+fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+try:
+    for _ in range(count):
+        os.write(fd, block)
+        start = time.time()
+        os.fdatasync(fd)
+        latencies.append((time.time() - start) * 1000)
+finally:
+    os.close(fd)
+    os.unlink(path)
+latencies.sort()
+print('fsync-probe {0} {1:.3f} {2:.3f} {3:.3f}'.format(
+    count, latencies[len(latencies) // 2], latencies[min(count - 1, int(count * 0.99))], latencies[-1]))
+'''
+
+OK = 'ok'
+SLOW = 'slow'
+UNKNOWN = 'unknown'
+
+_overrides = {}
+
+
+class EtcdProfileError(ValueError):
+    pass
+
+
+class Profile(object):
+    def __init__(self, name, values):
+        self.name = name
+        self.values = values
+        self.data_dir = values['data_dir']
+        self.data_disk = values['data_disk']
+
+    def flags(self):
+        """
+        The etcd command line flags of the profile, as (name, value)
+        """
+        values = self.values
+        flags = [
+            ('heartbeat-interval', values['heartbeat_interval']),
+            ('election-timeout', values['election_timeout']),
+            ('snapshot-count', values['snapshot_count']),
+        ]
+        if values['quota_backend_bytes']:
+            flags.append(('quota-backend-bytes', values['quota_backend_bytes']))
+        if values['auto_compaction_mode']:
+            flags.append(('auto-compaction-mode', values['auto_compaction_mode']))
+            flags.append(('auto-compaction-retention', values['auto_compaction_retention']))
+        return flags
+
+    def disk_args(self):
+        """
+        The extra gcloud instances create arguments for the data disk
+        """
+        if not self.data_disk:
+            return ''
+        return '--create-disk=size={0},type=pd-ssd,device-name={1},auto-delete=yes '.format(self.data_disk, DEVICE_NAME)
+
+    def mount_command(self):
+        """
+        Format the data disk the first time, and mount it on the data dir now
+        and on every boot
+        """
+        device = '/dev/disk/by-id/google-' + DEVICE_NAME
+        return ('sudo mkdir -p {1} && (sudo blkid {0} >/dev/null || sudo mkfs.ext4 -q -F {0}) && '
+                '(grep -q " {1} " /etc/fstab || echo "{0} {1} ext4 defaults,noatime 0 2" | sudo tee -a /etc/fstab >/dev/null) && '
+                '(mountpoint -q {1} || sudo mount {1})').format(device, self.data_dir)
+
+    def fingerprint(self):
+        return [self.name, sorted((k, str(v)) for k, v in self.values.items())]
+
+
+def validate(values):
+    heartbeat, election = values['heartbeat_interval'], values['election_timeout']
+    if heartbeat < 10:
+        raise EtcdProfileError('heartbeat_interval must be at least 10ms, got {0}'.format(heartbeat))
+    # etcd itself refuses anything under 5 heartbeats
+    if election < 5 * heartbeat or election > 50000:
+        raise EtcdProfileError('election_timeout must be between 5 heartbeats ({0}ms) and 50000ms, got {1}'.format(
+            5 * heartbeat, election))
+    if values['snapshot_count'] < 1000:
+        raise EtcdProfileError('snapshot_count must be at least 1000, got {0}'.format(values['snapshot_count']))
+    if values['quota_backend_bytes'] and not 1024 ** 3 <= values['quota_backend_bytes'] <= 8 * 1024 ** 3:
+        raise EtcdProfileError('quota_backend_bytes must be 0 (etcd default) or between 1GB and 8GB, got {0}'.format(
+            values['quota_backend_bytes']))
+    if values['auto_compaction_mode'] not in (None, 'periodic', 'revision'):
+        raise EtcdProfileError('auto_compaction_mode must be periodic or revision, got {0!r}'.format(
+            values['auto_compaction_mode']))
+    if values['auto_compaction_mode'] and not values['auto_compaction_retention']:
+        raise EtcdProfileError('auto_compaction_mode needs an auto_compaction_retention')
+    if not values['data_dir'].startswith('/') or values['data_dir'] == '/':
+        raise EtcdProfileError('data_dir must be an absolute path other than /, got {0!r}'.format(values['data_dir']))
+
+
+def use(profile=None, **overrides):
+    """
+    Switch to the named profile, with any of its values overridden
+    """
+    if profile is not None:
+        if profile not in PROFILES:
+            raise EtcdProfileError('unknown etcd profile {0!r}, use one of {1}'.format(
+                profile, ', '.join(sorted(PROFILES))))
+        settings['profile'] = profile
+        _overrides.clear()
+    for key, value in overrides.items():
+        if value is None:
+            continue
+        if key not in PROFILES['default']:
+            raise EtcdProfileError('unknown etcd setting {0!r}'.format(key))
+        default = PROFILES['default'][key]
+        _overrides[key] = int(value) if isinstance(default, int) else value
+    return current()
+
+
+def current():
+    values = dict(PROFILES[settings['profile']])
+    values.update(_overrides)
+    validate(values)
+    return Profile(settings['profile'], values)
+
+
+def configure(limit_ms=None, on_slow=None, count=None):
+    if limit_ms is not None:
+        settings['limit_ms'] = float(limit_ms)
+    if on_slow is not None:
+        if on_slow not in ('warn', 'abort', 'off'):
+            raise ValueError('on_slow must be warn, abort or off, got {0!r}'.format(on_slow))
+        settings['on_slow'] = on_slow
+    if count is not None:
+        settings['count'] = int(count)
+
+
+### fsync probe ################################################################
+
+class Probe(object):
+    """
+    Latencies in ms of count fdatasyncs of one disk
+    """
+    def __init__(self, count, p50, p99, max):
+        self.count = count
+        self.p50 = p50
+        self.p99 = p99
+        self.max = max
+
+    def __str__(self):
+        return '{0} fsyncs, p50 {1:.2f}ms, p99 {2:.2f}ms, max {3:.2f}ms'.format(self.count, self.p50, self.p99, self.max)
+
+
+def probe_command(directory, count=None):
+    """
+    The shell command that probes directory; the script goes base64-encoded
+    so it survives any quoting
+    """
+    script = base64.b64encode(PROBE.encode()).decode()
+    return 'sudo mkdir -p {0} && echo {1} | base64 -d | sudo python3 - {0} {2} {3}'.format(
+        directory, script, count or settings['count'], BLOCK_SIZE)
+
+
+def parse(output):
+    """
+    The Probe in the output of the probe script, None if there is none
+    """
+    for line in (output or '').splitlines():
+        words = line.split()
+        if len(words) == 5 and words[0] == 'fsync-probe':
+            try:
+                return Probe(int(words[1]), float(words[2]), float(words[3]), float(words[4]))
+            except ValueError:
+                return None
+    return None
+
+
+def probe_local(directory, count=None):
+    """
+    Run the probe script against a local directory
+    """
+    output = subprocess.check_output(
+        [sys.executable, '-c', PROBE, directory, str(count or settings['count']), str(BLOCK_SIZE)])
+    return parse(output.decode())
+
+
+def judge(result, limit_ms=None):
+    """
+    OK, SLOW or UNKNOWN (no result) for a Probe
+    """
+    if result is None:
+        return UNKNOWN
+    return OK if result.p99 <= (limit_ms or settings['limit_ms']) else SLOW
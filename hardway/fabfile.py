@@ -1,11 +1,42 @@
 import os
-import binascii
-from fabric.api import local, lcd, settings
-from mako.template import Template
+import atexit
+import json
+from fabric.api import abort, settings
+
+import artifacts
+import auditlog
+import bench
+import dataplane
+import etcdperf
+import drift
+import facts
+import fanout
+import health
+import inventory
+import kubeconfig
+import pipeline
+import pki
+import plan
+import profiler
+import provision
+import rotation
+import session
+import teardown
+import templating
+import topology
+import transfer
+import tuning
+import upgrade
+import versions
+from profiler import local
+
+def _artifact_urls():
+    return versions.urls()
 
 def init_env(region='us-west1', zone='us-west1-c', os='osx'):
     local('gcloud config set compute/region us-west1')
     local('gcloud config set compute/zone us-west1-c')
+    facts.invalidate()
 
 def cfssl(os='osx'):
     if os == 'osx':
@@ -13,146 +44,391 @@ def cfssl(os='osx'):
 
 def kubectl(os='osx'):
     if os == 'osx':
-        local('curl -o kubectl https://storage.googleapis.com/kubernetes-release/release/v1.10.2/bin/darwin/amd64/kubectl')
-        local ('chmod +x kubectl')
-        local('mv kubectl /usr/local/bin/')
+        component = versions.get('kubectl')
+        local('cmp -s {0} {1} || install -m 0755 {0} {1}'.format(artifacts.fetch(component.urls[0]), component.binaries[0]))
+
+def artifact_cache(path=None, offline=False, checksums=None, unpinned=False):
+    """
+    Use another artifact cache directory, and with offline=yes never download,
+    e.g. fab artifact_cache:path=/srv/hardway-cache,offline=yes step_06;
+    checksums is another file of pins, and with unpinned=yes releases without
+    a pin are used unverified
+    """
+    artifacts.configure(path=path, offline=offline, checksums=checksums, unpinned=unpinned)
+
+def fetch_artifacts():
+    """
+    Download every release the setup uses into the artifact cache
+    """
+    for url, path in sorted(artifacts.fetch_all(_artifact_urls()).items()):
+        print('{0} {1}'.format(os.path.basename(path), url))
+
+def pin_artifacts(sums):
+    """
+    Pin the releases that have no hash in artifacts.sha256 yet, e.g. after
+    changing a version in versions.yaml, to their hashes in sums: sha256sum
+    lines for their URLs or file names, as published with the releases, e.g.
+    fab pin_artifacts:sums=SHA256SUMS
+    """
+    urls = _artifact_urls()
+    for url, digest in sorted(artifacts.pin(urls, artifacts.read_sums(sums)).items()):
+        print('{0}  {1}'.format(digest, url))
+    pins = artifacts.pinned()
+    for url in sorted(url for url in urls if url not in pins):
+        print('no hash for {0} yet'.format(url))
+
+def seed_artifacts(directory):
+    """
+    Fill the artifact cache from a directory of release files downloaded
+    elsewhere, named as in their URLs
+    """
+    for url in artifacts.seed(directory, _artifact_urls()):
+        print('added {0}'.format(url))
 
 # create vpc, subnet and firewall rules
-def networking(name='kubernetes-the-hard-way', cidr='10.240.0.0/24', subnet_name='kubernetes'):
-    local('gcloud compute networks create {0} --subnet-mode custom'.format(name))
-    local('gcloud compute networks subnets create {0} --network {1} --range {2}'.format(subnet_name, name, cidr))
+def _network_resources(name, cidr, subnet_name):
+    return [
+        provision.Resource('networks', name, '--subnet-mode custom'),
+        provision.Resource('networks subnets', subnet_name, '--network {0} --range {1}'.format(name, cidr),
+                           deps=['networks/' + name]),
+    ]
+
+def _firewall_resources(name):
+    cluster = topology.current()
+    names = topology.resource_names(name)
+    return [
+        provision.Resource('firewall-rules', names['internal-firewall'],
+                           '--allow tcp,udp,icmp --network {0} --source-ranges {1},{2}'.format(
+                               name, cluster.node_network, cluster.pod_network),
+                           deps=['networks/' + name]),
+        provision.Resource('firewall-rules', names['external-firewall'],
+                           '--allow tcp:22,tcp:6443,icmp --network {0} --source-ranges 0.0.0.0/0'.format(name),
+                           deps=['networks/' + name]),
+    ]
+
+def _address_resources(name, region):
+    return [provision.Resource('addresses', name, '--region {0}'.format(region))]
+
+def _instance_resources(nodes, role):
+    cluster = topology.current()
+    resources = []
+    # etcd gets its own disk on the controllers if the profile asks for one
+    disks = etcdperf.current().disk_args() if role == 'controller' else ''
+    for node in nodes:
+        metadata = '--metadata pod-cidr={0} '.format(node.pod_cidr) if node.pod_cidr else ''
+        resources.append(provision.Resource('instances', node.name,
+            '--boot-disk-size {0} --can-ip-forward {6}--image-family ubuntu-1804-lts --image-project ubuntu-os-cloud '
+            '--machine-type {1} {2}--private-network-ip {3} '
+            '--scopes compute-rw,storage-ro,service-management,service-control,logging-write,monitoring '
+            '--subnet {4} --tags {7},{5}'.format(
+                cluster.boot_disk_size, cluster.machine_type, metadata, node.internal_ip, cluster.subnet, role, disks,
+                cluster.name),
+            deps=['networks-subnets/' + cluster.subnet]))
+    return resources
+
+def _route_resources(name=None):
+    cluster = topology.current()
+    name = name or cluster.name
+    return [provision.Resource('routes', cluster.route_name(node),
+                               '--network {0} --next-hop-address {1} --destination-range {2}'.format(
+                                   name, node.internal_ip, node.pod_cidr),
+                               deps=['networks/' + name])
+            for node in cluster.workers]
+
+def _gcloud_list(command):
+    # there is nothing to list behind the fake backend
+    if provision.settings['backend'] == 'gcloud':
+        local(command)
 
+def compute_backend(name='gcloud'):
+    """
+    Create cloud resources through gcloud, or with name=fake through an
+    in-memory compute API, e.g. fab compute_backend:fake provision_cluster
+    """
+    if name != 'fake' and name not in provision.backends:
+        abort('unknown compute backend {0}, use {1}'.format(name, ', '.join(['fake'] + sorted(provision.backends))))
+    provision.settings['backend'] = name
+
+def networking(name=None, cidr=None, subnet_name=None):
+    name = name or topology.current().name
+    cidr = cidr or str(topology.current().node_network)
+    subnet_name = subnet_name or topology.current().subnet
+    provision.create(_network_resources(name, cidr, subnet_name))
+
+
+def firewall_rules(name=None):
+    name = name or topology.current().name
+    provision.create(_firewall_resources(name))
+    _gcloud_list('gcloud compute firewall-rules list --filter="network:{0}"'.format(name))
 
-def firewall_rules(name='kubernetes-the-hard-way'):
-    # internal
-    local('gcloud compute firewall-rules create kubernetes-internal-firewall --allow tcp,udp,icmp --network {0} --source-ranges 10.240.0.0/24,10.200.0.0/16'.format(name))
-    # external
-    local('gcloud compute firewall-rules create kubernetes-external-firewall --allow tcp:22,tcp:6443,icmp --network {0} --source-ranges 0.0.0.0/0'.format(name))
-    local('gcloud compute firewall-rules list --filter="network:{0}"'.format(name))
+def public_ip(name=None, region='us-west1'):
+    name = name or topology.current().name
+    provision.create(_address_resources(name, region))
+    facts.invalidate('public_ip')
 
-def public_ip(name='kubernetes-the-hard-way', region='us-west1'):
-    local('gcloud compute addresses create {0} --region {1}'.format(name, region))
+def profile(out='profile', top=10):
+    """
+    Record every shell call, run_command and copy_file of the tasks that
+    follow, e.g. fab profile step_06 step_07. When fab exits the summary is
+    printed and written to <out>.txt, and the Chrome trace to <out>.json.
+    """
+    profiler.configure(enabled=True, top=top)
+    def report():
+        text = profiler.summary()
+        print(text)
+        with open(out + '.txt', 'w') as f:
+            f.write(text + '\n')
+        profiler.write_trace(out + '.json')
+        print('trace written to {0}.json'.format(out))
+    atexit.register(report)
+
+def benchmark(nodes='3;10;50;200', steps=None, deploy=True, out='bench.json', latency=None, failure_rate=0):
+    """
+    Time every step and a full deploy against fake gcloud, cfssl and kubectl
+    for each worker count and write the results to out, e.g.
+    fab benchmark:nodes='3;50',latency='ssh=0.5;scp=1',out=before.json
+    """
+    results = bench.run(
+        _artifact_urls(),
+        nodes=[int(n) for n in str(nodes).split(';')],
+        steps=steps.split(';') if steps else None,
+        deploy=_flag(deploy),
+        latency=dict((k, float(v)) for k, v in (item.split('=') for item in latency.split(';'))) if latency else None,
+        failure_rate=failure_rate,
+        progress=print)
+    with open(out, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print(bench.report(results))
+    print('results written to {0}'.format(out))
+
+def audit_report(source=None, top=20, out=None, reset=False):
+    """
+    Requests per caller, user, verb and resource with their rates and latency
+    quantiles, from what is new in the API servers' audit logs since the last
+    report (or from local copies in source, files or directories separated by
+    ';'), added to the stats of the earlier reports unless reset is set, e.g.
+    fab audit_report:top=10 or fab audit_report:source=saved-logs/,reset=yes
+    """
+    state = auditlog.State() if _flag(reset) else auditlog.State.load()
+    try:
+        if source:
+            auditlog.read(source.split(';'), state)
+        else:
+            list_logs = lambda host: remote_output(host, auditlog.list_command())
+            fanout.execute(lambda node: auditlog.fetch(node.name, state, list_logs), topology.current().controllers,
+                           name=_host, mode=fanout.COLLECT)
+    finally:
+        # hosts that were read keep their place even if another one failed
+        state.save()
+    text = auditlog.report(state.analyzer, top)
+    print(text)
+    if out:
+        with open(out, 'w') as f:
+            f.write(text + '\n')
+
+def facts_cache(ttl=3600):
+    """
+    Keep the cluster facts (public ip, region, zone, network) in a snapshot
+    file for ttl seconds so later fab runs start without lookups; ttl=0 turns
+    it off
+    """
+    facts.configure(ttl=ttl)
+
+def refresh_facts():
+    facts.invalidate()
 
 def create_controllers():
-    for i in range(0, 3):
-        local('gcloud compute instances create controller-{0} --async --boot-disk-size 200GB \
-    --can-ip-forward \
-    --image-family ubuntu-1804-lts \
-    --image-project ubuntu-os-cloud \
-    --machine-type n1-standard-1 \
-    --private-network-ip 10.240.0.1{0} \
-    --scopes compute-rw,storage-ro,service-management,service-control,logging-write,monitoring \
-    --subnet kubernetes \
-    --tags kubernetes-the-hard-way,controller'.format(i))
+    provision.create(_instance_resources(topology.current().controllers, 'controller'))
+    inventory.invalidate()
 
 def create_workers():
-    for i in range(0,3):
-        local('gcloud compute instances create worker-{0} \
-    --async \
-    --boot-disk-size 200GB \
-    --can-ip-forward \
-    --image-family ubuntu-1804-lts \
-    --image-project ubuntu-os-cloud \
-    --machine-type n1-standard-1 \
-    --metadata pod-cidr=10.200.{0}.0/24 \
-    --private-network-ip 10.240.0.2{0} \
-    --scopes compute-rw,storage-ro,service-management,service-control,logging-write,monitoring \
-    --subnet kubernetes \
-    --tags kubernetes-the-hard-way,worker'.format(i))
+    provision.create(_instance_resources(topology.current().workers, 'worker'))
+    inventory.invalidate()
+
+def provision_cluster(name=None, region='us-west1'):
+    """
+    Create the network, subnet, firewall rules, public address and every
+    instance, each as soon as what it needs exists, and wait until they all do
+    """
+    cluster = topology.current()
+    name = name or cluster.name
+    try:
+        provision.create(
+            _network_resources(name, str(cluster.node_network), cluster.subnet) + _firewall_resources(name) +
+            _address_resources(name, region) + _instance_resources(cluster.controllers, 'controller') +
+            _instance_resources(cluster.workers, 'worker'))
+    finally:
+        inventory.invalidate()
+        facts.invalidate('public_ip')
+
+def inventory_cache(ttl=300):
+    """
+    Keep the instance inventory in a snapshot file for ttl seconds, so later
+    fab runs don't list the instances again; ttl=0 turns it off
+    """
+    inventory.configure(ttl=ttl)
+
+def refresh_inventory():
+    inventory.invalidate()
+
+def concurrency(parallel=10, mode='fail-fast'):
+    """
+    Set how many hosts a task works on at once and whether the first failure
+    stops the rest (fail-fast) or every host runs (collect), e.g.
+    fab concurrency:parallel=5,mode=collect step_08
+    """
+    fanout.configure(parallel=parallel, mode=mode)
+
+def use_topology(path='cluster.yaml'):
+    """
+    Lay the cluster out from another topology file, e.g.
+    fab use_topology:path=big.yaml step_02
+    """
+    topology.use(path)
+
+def use_versions(path='versions.yaml'):
+    """
+    Install the releases listed in another version manifest, e.g.
+    fab use_versions:path=next.yaml step_08
+    """
+    versions.use(path)
+
+def use_etcd_profile(profile=None, data_disk=None, data_dir=None, limit_ms=None, on_slow=None):
+    """
+    Run etcd with another profile (default or tuned), on a dedicated SSD of
+    data_disk size mounted at data_dir, and set the fsync preflight's limit
+    and what a slow disk does (warn, abort or off), e.g.
+    fab use_etcd_profile:profile=tuned,data_disk=50GB,on_slow=abort step_02 step_06
+    """
+    profile = etcdperf.use(profile=profile, data_disk=data_disk, data_dir=data_dir)
+    etcdperf.configure(limit_ms=limit_ms, on_slow=on_slow)
+    print('etcd profile {0}, data in {1}{2}'.format(
+        profile.name, profile.data_dir, ' on a {0} SSD'.format(profile.data_disk) if profile.data_disk else ''))
+
+def use_dataplane(profile=None, scheduler=None, mtu=None, downloads=None):
+    """
+    Run the workers' data plane with another profile (iptables or ipvs), IPVS
+    scheduler, bridge MTU or number of concurrent image layer downloads, e.g.
+    fab use_dataplane:profile=ipvs,scheduler=lc step_08
+    """
+    plane = dataplane.use(profile=profile, scheduler=scheduler, mtu=mtu, downloads=downloads)
+    print('data-plane profile {0}, kube-proxy mode {1}'.format(plane.name, plane.mode))
+
+def use_tuning(profile=None, path=None):
+    """
+    Size the API servers and kubelets with another profile (auto, small,
+    medium or large) and/or tuning file, e.g.
+    fab use_tuning:profile=large step_07 step_08
+    """
+    tuned = tuning.use(path=path, profile=profile)
+    print('tuning profile {0}'.format(tuned.name))
+
+def _host(node):
+    return node.name
 
 def generate_ca():
-    with lcd('ca'):
-        local('cfssl gencert -initca ca-csr.json | cfssljson -bare ca')
+    pki.init_ca('ca/ca-csr.json', 'ca/ca')
+
+def _admin_cert():
+    return pki.CertRequest('admin/admin-csr.json', 'admin/admin')
+
+def _kubelet_csr(node):
+    """
+    kubelet/<worker>-csr.json, or worker-0's csr with the CN of node for
+    workers that have no csr file of their own
+    """
+    path = 'kubelet/{0}-csr.json'.format(node.name)
+    if os.path.exists(path):
+        return path
+    csr = pki.load_csr('kubelet/worker-0-csr.json')
+    csr['CN'] = 'system:node:{0}'.format(node.name)
+    return csr
+
+def _kubelet_certs():
+    requests = []
+    for node in topology.current().workers:
+        ex_output = inventory.external_ip(node.name)
+        requests.append(pki.CertRequest(
+            _kubelet_csr(node), 'kubelet/{0}'.format(node.name),
+            hostnames=[node.name, ex_output, node.internal_ip]))
+    return requests
+
+def _control_manager_cert():
+    return pki.CertRequest('control_manager/kube-controller-manager-csr.json', 'control_manager/kube-controller-manager')
+
+def _kube_proxy_cert():
+    return pki.CertRequest('kube_proxy/kube-proxy-csr.json', 'kube_proxy/kube-proxy')
+
+def _scheduler_cert():
+    return pki.CertRequest('scheduler/kube-scheduler-csr.json', 'scheduler/kube-scheduler')
+
+def _api_server_cert():
+    public_ip = facts.public_ip()
+    return pki.CertRequest(
+        'api_server/kubernetes-csr.json', 'api_server/kubernetes',
+        hostnames=topology.current().api_server_sans(public_ip))
+
+def _service_account_cert():
+    return pki.CertRequest('sa/service-account-csr.json', 'sa/service-account')
 
 def generate_admin_cert():
-    with lcd('admin'):
-        local('cfssl gencert -ca=../ca/ca.pem -ca-key=../ca/ca-key.pem -config=../ca/ca-config.json -profile=kubernetes admin-csr.json | cfssljson -bare admin')
+    pki.issue([_admin_cert()])
 
 def generate_kubelet_cert():
-    with lcd('kubelet'):
-        for i in range(0,3):
-            ex_output = local("gcloud compute instances describe worker-{0} --format 'value(networkInterfaces[0].accessConfigs[0].natIP)'".format(i), capture=True)
-            in_output = local("gcloud compute instances describe worker-{0} --format 'value(networkInterfaces[0].networkIP)'".format(i), capture=True)
-            print (ex_output, in_output)
-            local('cfssl gencert -ca=../ca/ca.pem -ca-key=../ca/ca-key.pem -config=../ca/ca-config.json \
-  -hostname=worker-{0},{1},{2} \
-  -profile=kubernetes \
-  worker-{0}-csr.json | cfssljson -bare worker-{0}'.format(i, ex_output, in_output))
+    pki.issue(_kubelet_certs())
 
 def generate_control_manager_cert():
-    with lcd('control_manager'):
-        local('cfssl gencert \
-  -ca=../ca/ca.pem \
-  -ca-key=../ca/ca-key.pem \
-  -config=../ca/ca-config.json \
-  -profile=kubernetes \
-  kube-controller-manager-csr.json | cfssljson -bare kube-controller-manager')
-
+    pki.issue([_control_manager_cert()])
 
 def generate_kube_proxy_cert():
-    with lcd('kube_proxy'):
-        local('cfssl gencert \
-  -ca=../ca/ca.pem \
-  -ca-key=../ca/ca-key.pem \
-  -config=../ca/ca-config.json \
-  -profile=kubernetes \
-  kube-proxy-csr.json | cfssljson -bare kube-proxy')
-
+    pki.issue([_kube_proxy_cert()])
 
 def generate_scheduler_cert():
-    with lcd('scheduler'):
-        local('cfssl gencert \
-  -ca=../ca/ca.pem \
-  -ca-key=../ca/ca-key.pem \
-  -config=../ca/ca-config.json \
-  -profile=kubernetes \
-  kube-scheduler-csr.json | cfssljson -bare kube-scheduler')
+    pki.issue([_scheduler_cert()])
 
 def generate_api_server_cert():
-    with lcd('api_server'):
-        public_ip = local("""gcloud compute addresses describe kubernetes-the-hard-way """
-                    """--region us-west1 --format 'value(address)'""", capture=True)
-        local("""cfssl gencert -ca=../ca/ca.pem -ca-key=../ca/ca-key.pem -config=../ca/ca-config.json """
-            """-hostname=10.32.0.1,10.240.0.10,10.240.0.11,10.240.0.12,{0},127.0.0.1,kubernetes.default """
-            """-profile=kubernetes kubernetes-csr.json | cfssljson -bare kubernetes""".format(public_ip))
+    pki.issue([_api_server_cert()])
 
 def generate_service_account_cert():
-    with lcd('sa'):
-        local("""cfssl gencert -ca=../ca/ca.pem -ca-key=../ca/ca-key.pem -config=../ca/ca-config.json """
-            """-profile=kubernetes service-account-csr.json | cfssljson -bare service-account""")
+    pki.issue([_service_account_cert()])
+
+def generate_certs(processes=None):
+    """
+    Issue every client and server cert signed by the CA in one process pool
+    """
+    pki.issue(
+        [_admin_cert()] + _kubelet_certs() + [
+            _kube_proxy_cert(),
+            _scheduler_cert(),
+            _api_server_cert(),
+            _control_manager_cert(),
+            _service_account_cert(),
+        ],
+        processes=int(processes) if processes else None)
 
 def copy_certs():
-    for i in range(0, 3):
-        local('gcloud compute scp ca/ca.pem kubelet/worker-{0}-key.pem kubelet/worker-{0}.pem worker-{0}:~/'.format(i))
-        local('gcloud compute scp ca/ca.pem ca/ca-key.pem api_server/kubernetes-key.pem api_server/kubernetes.pem sa/service-account-key.pem sa/service-account.pem controller-{0}:~/'.format(i))
+    def copy_worker(node):
+        _gcloud('gcloud compute scp ca/ca.pem kubelet/{0}-key.pem kubelet/{0}.pem {0}:~/'.format(node.name))
+    # the controllers' certs are converged by the tasks of the services using them
+    fanout.execute(copy_worker, topology.current().workers, name=_host)
+
+def _kubelet_config_specs(public_ip):
+    return [_config_spec(name=node.name, dir_name='kubelet', server_ip=public_ip) for node in topology.current().workers]
 
 def create_kubelet_config():
-    public_ip = local("""gcloud compute addresses describe kubernetes-the-hard-way """
-                      """--region us-west1 --format 'value(address)'""", capture=True)
-    for i in range(0, 3):
-        with lcd('kubelet'):
-            local("""kubectl config set-cluster kubernetes-the-hard-way --certificate-authority=../ca/ca.pem --embed-certs=true """
-            """--server=https://{0}:6443 --kubeconfig=worker-{1}.kubeconfig""".format(public_ip, i))
-            local("""kubectl config set-credentials system:node:worker-{0} --client-certificate=worker-{0}.pem --client-key=worker-{0}-key.pem """
-            """--embed-certs=true --kubeconfig=worker-{0}.kubeconfig""".format(i))
-            local("""kubectl config set-context default --cluster=kubernetes-the-hard-way --user=system:node:worker-{0} """
-             """--kubeconfig=worker-{0}.kubeconfig""".format(i))
-            local("""kubectl config use-context default --kubeconfig=worker-{0}.kubeconfig""".format(i))
+    kubeconfig.generate(_kubelet_config_specs(facts.public_ip()))
 
 def create_kube_proxy_config():
-    public_ip = local("""gcloud compute addresses describe kubernetes-the-hard-way """
-                      """--region us-west1 --format 'value(address)'""", capture=True)
+    public_ip = facts.public_ip()
     create_config(name='kube-proxy', dir_name='kube_proxy', server_ip=public_ip)
 
 def create_controller_manager_config():
-    public_ip = local("""gcloud compute addresses describe kubernetes-the-hard-way """
-                      """--region us-west1 --format 'value(address)'""", capture=True)
+    public_ip = facts.public_ip()
     create_config(name='kube-controller-manager',
                   dir_name='control_manager', server_ip=public_ip)
 
 def create_scheduler_config():
-    public_ip = local("""gcloud compute addresses describe kubernetes-the-hard-way """
-                      """--region us-west1 --format 'value(address)'""", capture=True)
+    public_ip = facts.public_ip()
     create_config(name='kube-scheduler',
                   dir_name='scheduler', server_ip=public_ip)
 
@@ -161,297 +437,547 @@ def create_admin_config():
     create_config(name='admin', dir_name='admin', server_ip=server_ip)
 
 def copy_config():
-    for i in range(0, 3):
-        local('gcloud compute scp kubelet/worker-{0}.kubeconfig kube_proxy/kube-proxy.kubeconfig worker-{0}:~/'.format(i))
-        local('gcloud compute scp admin/admin.kubeconfig control_manager/kube-controller-manager.kubeconfig scheduler/kube-scheduler.kubeconfig controller-{0}:~/'.format(i))
+    def copy_worker(node):
+        _gcloud('gcloud compute scp kubelet/{0}.kubeconfig kube_proxy/kube-proxy.kubeconfig {0}:~/'.format(node.name))
+    def copy_controller(node):
+        _gcloud('gcloud compute scp admin/admin.kubeconfig {0}:~/'.format(node.name))
+    fanout.execute(copy_worker, topology.current().workers, name=_host)
+    fanout.execute(copy_controller, topology.current().controllers, name=_host)
+
+def _config_spec(name, dir_name, server_ip):
+    return kubeconfig.Spec(
+        path='{0}/{1}.kubeconfig'.format(dir_name, name),
+        user='system:node:{0}'.format(name),
+        server=server_ip,
+        cert='{0}/{1}.pem'.format(dir_name, name),
+        key='{0}/{1}-key.pem'.format(dir_name, name),
+        cluster=topology.current().name)
 
 def create_config(name, dir_name, server_ip):
-    with lcd(dir_name):
-        local("""kubectl config set-cluster kubernetes-the-hard-way --certificate-authority=../ca/ca.pem --embed-certs=true """
-            """--server=https://{0}:6443 --kubeconfig={1}.kubeconfig""".format(server_ip, name))
-        local("""kubectl config set-credentials system:node:{0} --client-certificate={0}.pem --client-key={0}-key.pem """
-            """--embed-certs=true --kubeconfig={0}.kubeconfig""".format(name))
-        local("""kubectl config set-context default --cluster=kubernetes-the-hard-way --user=system:node:{0} """
-            """--kubeconfig={0}.kubeconfig""".format(name))
-        local("""kubectl config use-context default --kubeconfig={0}.kubeconfig""".format(name))
+    kubeconfig.generate([_config_spec(name, dir_name, server_ip)])
+
+def create_kubeconfigs():
+    """
+    Write the worker, kube-proxy, controller-manager, scheduler and admin
+    kubeconfigs in one pass
+    """
+    public_ip = facts.public_ip()
+    kubeconfig.generate(_kubelet_config_specs(public_ip) + [
+        _config_spec(name='kube-proxy', dir_name='kube_proxy', server_ip=public_ip),
+        _config_spec(name='kube-controller-manager', dir_name='control_manager', server_ip=public_ip),
+        _config_spec(name='kube-scheduler', dir_name='scheduler', server_ip=public_ip),
+        _config_spec(name='admin', dir_name='admin', server_ip='127.0.0.1'),
+    ])
+
+def _render_encryption_config(keyring):
+    templating.render_to('templates/encryption-config.mako', 'encryption/encryption-config.yaml', keys=keyring.keys)
 
 def setup_encryption():
-    mytemplate = Template(
-        filename='templates/encryption-config.mako',
-        module_directory='/tmp/mako_modules')
-    key = str(binascii.b2a_base64(os.urandom(32)), 'utf-8')
-    with open('encryption/encryption-config.yaml', 'w') as f:
-        f.write(mytemplate.render(encryption_key=key))
-    for i in range(0, 3):
-        local('gcloud compute scp encryption/encryption-config.yaml controller-{0}:~/'.format(i))
+    # the key is made once; the API servers can't read what was written with
+    # a key they no longer have
+    keyring = rotation.Keyring.load()
+    if not keyring.keys:
+        keyring.add()
+        keyring.save()
+    # the API servers get it with their other files, and rotate_encryption_key
+    # rolls a new one out; both converge _encryption_files, so neither undoes
+    # the other
+    _render_encryption_config(keyring)
 
 # setup 07
+def _gcloud(command):
+    """
+    Run a gcloud command locally. Inside fanout.execute the output goes to the
+    buffer of the host being set up instead of stdout.
+    """
+    if not fanout.capturing():
+        return local(command)
+    fanout.log(command)
+    output = local(command, capture=True)
+    fanout.log(output)
+    return output
+
 def run_command(host, command):
     """
-    Utility function to run commads in remote host
+    Utility function to run commads in remote host. Inside a
+    session.RemoteSession for the host the command is queued and sent with the
+    rest of the session instead.
+    """
+    if plan.recording():
+        return plan.record(plan.Op(plan.RUN, host, command))
+    with profiler.span(command, kind='op', host=host):
+        batch = session.active(host)
+        if batch is not None:
+            return batch.run(command)
+        return _gcloud("gcloud compute ssh {0} --command '{1}'".format(host, command))
+
+def _etcd_vars(node):
+    profile = etcdperf.current()
+    return dict(internal_ip=node.internal_ip, name=node.name,
+                initial_cluster=topology.current().etcd_initial_cluster(),
+                etcd_flags=profile.flags(), data_dir=profile.data_dir)
+
+def _api_server_vars(node):
+    cluster = topology.current()
+    return dict(internal_ip=node.internal_ip, apiserver_count=len(cluster.controllers),
+                etcd_servers=cluster.etcd_servers(), service_cidr=cluster.service_network,
+                tuning_flags=sorted(tuning.current().api_server_flags().items()))
+
+def _bridge_vars(node):
+    return dict(pod_cidr=node.pod_cidr, plane=dataplane.current())
+
+def _kube_proxy_vars():
+    return dict(pod_cidr=topology.current().pod_network, plane=dataplane.current())
+
+def _containerd_vars():
+    return dict(plane=dataplane.current())
+
+def _kubelet_vars(node):
+    return dict(pod_cidr=node.pod_cidr, host_name=node.name, cluster_dns=topology.current().dns_service_ip,
+                tuning=tuning.current().kubelet)
+
+def _check_tuning(api_servers=(), kubelets=()):
+    """
+    Make sure the rendered kube-apiserver units and kubelet configs carry the
+    tuning profile before they go anywhere
+    """
+    tuned = tuning.current()
+    for path in api_servers:
+        with open(path) as f:
+            tuning.check_api_server(f.read(), tuned)
+    for path in kubelets:
+        with open(path) as f:
+            tuning.check_kubelet(f.read(), tuned)
+
+def _check_dataplane(bridges=(), kube_proxies=()):
+    """
+    Make sure the rendered bridge and kube-proxy configs carry the data-plane
+    profile before they go anywhere
+    """
+    plane = dataplane.current()
+    for path in bridges:
+        with open(path) as f:
+            dataplane.check_bridge(f.read(), plane)
+    for path in kube_proxies:
+        with open(path) as f:
+            dataplane.check_kube_proxy(f.read(), plane)
+
+def _render_worker_configs():
+    """
+    Render the containerd and kube-proxy configs, the same on every worker
     """
-    local("gcloud compute ssh {0} --command '{1}'".format(host, command))
+    templating.render_to('templates/containerd-config.toml.mako', 'containerd/config.toml', **_containerd_vars())
+    _check_dataplane(kube_proxies=[templating.render_to(
+        'templates/kube-proxy-config.yaml.mako', 'kube_proxy/kube-proxy-config.yaml', **_kube_proxy_vars())])
+
+def _services(components):
+    return sorted(set(service for component in components for service in component.services))
+
+def _etcd_files(node):
+    return [
+        ('etcd/etcd.service.{0}'.format(node.index), '/etc/systemd/system/etcd.service', ['etcd']),
+        ('ca/ca.pem', '/etc/etcd/ca.pem', ['etcd']),
+        ('api_server/kubernetes.pem', '/etc/etcd/kubernetes.pem', ['etcd']),
+        ('api_server/kubernetes-key.pem', '/etc/etcd/kubernetes-key.pem', ['etcd'], 0o600),
+    ]
+
+def _ca_file(service):
+    # both the API server and the controller manager read the CA; whichever
+    # task puts a new one in place restarts the other too if it runs
+    others = [s for s in ('kube-apiserver', 'kube-controller-manager') if s != service]
+    return drift.Managed('ca/ca.pem', '/var/lib/kubernetes/ca.pem', [service], notify=others)
+
+def _api_server_files(node):
+    return _encryption_files(node) + [
+        _ca_file('kube-apiserver'),
+        ('api_server/kubernetes.pem', '/var/lib/kubernetes/kubernetes.pem', ['kube-apiserver']),
+        ('api_server/kubernetes-key.pem', '/var/lib/kubernetes/kubernetes-key.pem', ['kube-apiserver'], 0o600),
+        ('sa/service-account.pem', '/var/lib/kubernetes/service-account.pem', ['kube-apiserver']),
+        ('api_server/audit-policy.yaml', '/var/lib/kubernetes/audit-policy.yaml', ['kube-apiserver']),
+        ('api_server/kube-apiserver.service.{0}'.format(node.index), '/etc/systemd/system/kube-apiserver.service',
+         ['kube-apiserver']),
+    ]
+
+def _controller_manager_files(node):
+    return [
+        _ca_file('kube-controller-manager'),
+        ('ca/ca-key.pem', '/var/lib/kubernetes/ca-key.pem', ['kube-controller-manager'], 0o600),
+        ('sa/service-account-key.pem', '/var/lib/kubernetes/service-account-key.pem', ['kube-controller-manager'],
+         0o600),
+        ('control_manager/kube-controller-manager.kubeconfig', '/var/lib/kubernetes/kube-controller-manager.kubeconfig',
+         ['kube-controller-manager'], 0o600),
+        ('control_manager/kube-controller-manager.service', '/etc/systemd/system/kube-controller-manager.service',
+         ['kube-controller-manager']),
+    ]
+
+def _scheduler_files(node):
+    return [
+        ('scheduler/kube-scheduler.kubeconfig', '/var/lib/kubernetes/kube-scheduler.kubeconfig', ['kube-scheduler'],
+         0o600),
+        ('scheduler/kube-scheduler.yaml', '/etc/kubernetes/config/kube-scheduler.yaml', ['kube-scheduler']),
+        ('scheduler/kube-scheduler.service', '/etc/systemd/system/kube-scheduler.service', ['kube-scheduler']),
+    ]
+
+def _cni_files(node):
+    # the kubelet reads the CNI config for every pod, nothing restarts
+    return [
+        ('cni/10-bridge.conf.{0}'.format(node.index), '/etc/cni/net.d/10-bridge.conf'),
+        ('cni/99-loopback.conf', '/etc/cni/net.d/99-loopback.conf'),
+    ]
+
+def _containerd_files(node):
+    return [
+        ('containerd/config.toml', '/etc/containerd/config.toml', ['containerd']),
+        ('containerd/containerd.service', '/etc/systemd/system/containerd.service', ['containerd']),
+    ]
+
+def _kubelet_files(node):
+    return [
+        ('kubelet/kubelet-config.yaml.{0}'.format(node.index), '/var/lib/kubelet/kubelet-config.yaml', ['kubelet']),
+        ('kubelet/kubelet.service', '/etc/systemd/system/kubelet.service', ['kubelet']),
+    ]
+
+def _kube_proxy_files(node):
+    return [
+        ('kube_proxy/kube-proxy-config.yaml', '/var/lib/kube-proxy/kube-proxy-config.yaml', ['kube-proxy']),
+        ('kube_proxy/kube-proxy.service', '/etc/systemd/system/kube-proxy.service', ['kube-proxy']),
+    ]
+
+def _render_templates():
+    """
+    Render the per-node configs of every setup task for the whole topology
+    """
+    cluster = topology.current()
+    templating.render_many('etcd/etcd.service.mako', [
+        ('etcd/etcd.service.{0}'.format(node.index), _etcd_vars(node)) for node in cluster.controllers])
+    api_servers = templating.render_many('templates/kube-apiserver.service.mako', [
+        ('api_server/kube-apiserver.service.{0}'.format(node.index), _api_server_vars(node)) for node in cluster.controllers])
+    bridges = templating.render_many('templates/10-bridge.conf.mako', [
+        ('cni/10-bridge.conf.{0}'.format(node.index), _bridge_vars(node)) for node in cluster.workers])
+    kubelets = templating.render_many('templates/kubelet-config.yaml.mako', [
+        ('kubelet/kubelet-config.yaml.{0}'.format(node.index), _kubelet_vars(node)) for node in cluster.workers])
+    _check_tuning(api_servers, kubelets)
+    _check_dataplane(bridges)
+    _render_worker_configs()
+
+def _prepare_etcd_disk(node):
+    """
+    Mount the dedicated etcd disk, if there is one, then probe the fsync
+    latency of the etcd data dir and warn or stop as settings['on_slow'] says
+    """
+    profile = etcdperf.current()
+    if profile.data_disk:
+        # right away, not queued in a session: the probe has to hit the disk
+        remote_output(node.name, profile.mount_command())
+    if etcdperf.settings['on_slow'] == 'off':
+        return None
+    result = etcdperf.parse(remote_output(node.name, etcdperf.probe_command(profile.data_dir)))
+    verdict = etcdperf.judge(result)
+    if verdict == etcdperf.UNKNOWN:
+        fanout.log('warning: could not measure the disk of {0}'.format(node.name))
+    elif verdict == etcdperf.SLOW:
+        message = 'fsync p99 above {0}ms on {1} ({2}); etcd there will miss heartbeats under load'.format(
+            etcdperf.settings['limit_ms'], node.name, result)
+        if etcdperf.settings['on_slow'] == 'abort':
+            abort(message)
+        fanout.log('warning: ' + message)
+    else:
+        fanout.log('{0}: {1}'.format(profile.data_dir, result))
+    return verdict
+
+def etcd_preflight(limit_ms=None, on_slow=None):
+    """
+    Measure fsync latency in the etcd data dir of every controller at once and
+    warn (on_slow=warn) or stop (on_slow=abort) if a p99 is above limit_ms,
+    e.g. fab etcd_preflight:limit_ms=5,on_slow=abort. setup_etcd runs the
+    same check on each controller before installing etcd there.
+    """
+    etcdperf.configure(limit_ms=limit_ms, on_slow=on_slow)
+    fanout.execute(_prepare_etcd_disk, topology.current().controllers, name=_host, mode=fanout.COLLECT)
 
 def setup_etcd():
-    for i in range(0, 3):
-        internal_ip = local(
-            "gcloud compute instances describe controller-{0} --format 'value(networkInterfaces[0].networkIP)'".format(i), capture=True)
-        mytemplate = Template(
-            filename='etcd/etcd.service.mako',
-            module_directory='/tmp/mako_modules')
-        with open('etcd/etcd.service.{0}'.format(i), 'w') as f:
-            f.write(mytemplate.render(internal_ip=internal_ip, name='controller-{0}'.format(i)))
-        host_name = "controller-{0}".format(i)
-        local(
-            'gcloud compute scp etcd/etcd.service.{0} controller-{0}:~/etcd.service'.format(i))
-        local(
-            "gcloud compute ssh controller-{0} --command 'sudo cp ~/etcd.service /etc/systemd/system/etcd.service'".format(i))
-        run_command(
-            host=host_name, 
-            command='wget -q --show-progress --https-only --timestamping "https://github.com/coreos/etcd/releases/download/v3.3.5/etcd-v3.3.5-linux-amd64.tar.gz"')
-        run_command(
-            host=host_name, 
-            command="tar -xvf etcd-v3.3.5-linux-amd64.tar.gz && sudo mv etcd-v3.3.5-linux-amd64/etcd* /usr/local/bin/")
-        run_command(
-            host=host_name,
-            command="sudo mkdir -p /etc/etcd /var/lib/etcd")
-        run_command(
-            host=host_name,
-            command="sudo cp ca.pem kubernetes-key.pem kubernetes.pem /etc/etcd/")
-        run_command(
-            host=host_name,
-            command="sudo systemctl daemon-reload && sudo systemctl enable etcd && sudo systemctl start etcd")
+    controllers = topology.current().controllers
+    templating.render_many('etcd/etcd.service.mako', [
+        ('etcd/etcd.service.{0}'.format(node.index), _etcd_vars(node)) for node in controllers])
+    # a new etcd cluster only comes up once a quorum of members has started,
+    # so it is started everywhere at once; a running one is rolled
+    if 'active' in remote_output(controllers[0].name, 'systemctl is-active etcd; true').split():
+        _rolling(controllers, _etcd_node)
+    else:
+        fanout.execute(session.batched(_etcd_node, _host), controllers, name=_host)
+
+def _etcd_node(node):
+    host_name = node.name
+    _prepare_etcd_disk(node)
+    upgraded = install_components(host_name, [versions.get('etcd')])
+    run_command(
+        host=host_name,
+        command="sudo mkdir -p /etc/etcd {0}".format(etcdperf.current().data_dir))
+    converge(host_name, _etcd_files(node), restart=_services(upgraded), gate=True)
+
+ETCD_MEMBER_LIST = "sudo ETCDCTL_API=3 etcdctl member list --endpoints=https://127.0.0.1:2379 --cacert=/etc/etcd/ca.pem \
+  --cert=/etc/etcd/kubernetes.pem --key=/etc/etcd/kubernetes-key.pem"
 
 def verify_etcd():
     run_command(
-        host="controller-0",
-        command="sudo ETCDCTL_API=3 etcdctl member list --endpoints=https://127.0.0.1:2379 --cacert=/etc/etcd/ca.pem \
-  --cert=/etc/etcd/kubernetes.pem --key=/etc/etcd/kubernetes-key.pem")
+        host=topology.current().controllers[0].name,
+        command=ETCD_MEMBER_LIST)
 
 def setup_controller():
-    for i in range(0, 3):
-        host_name = "controller-{0}".format(i)
+    def setup_one(node):
+        host_name = node.name
         run_command(
             host=host_name,
             command="sudo mkdir -p /etc/kubernetes/config")
-        run_command(
-            host=host_name,
-            command='wget -q --show-progress --https-only --timestamping \
-  "https://storage.googleapis.com/kubernetes-release/release/v1.10.2/bin/linux/amd64/kube-apiserver" \
-  "https://storage.googleapis.com/kubernetes-release/release/v1.10.2/bin/linux/amd64/kube-controller-manager" \
-  "https://storage.googleapis.com/kubernetes-release/release/v1.10.2/bin/linux/amd64/kube-scheduler" \
-  "https://storage.googleapis.com/kubernetes-release/release/v1.10.2/bin/linux/amd64/kubectl"')
-        # run_command(
-        #     host=host_name,
-        #     command='chmod +x kube-apiserver kube-controller-manager kube-scheduler kubectl && sudo cp kube-apiserver kube-controller-manager kube-scheduler kubectl /usr/local/bin/'
-        # )
-        run_command(
-            host=host_name,
-            command='sudo mkdir -p /var/lib/kubernetes/')
-        run_command(
-            host=host_name,
-            command='sudo cp ca.pem ca-key.pem kubernetes-key.pem kubernetes.pem service-account-key.pem service-account.pem encryption-config.yaml /var/lib/kubernetes/')
+        install_components(host_name, [versions.get('kubernetes-control-plane')])
+    fanout.execute(session.batched(setup_one, _host), topology.current().controllers, name=_host)
 
-def copy_file(host, src, destination):
+def copy_file(host, src, destination, mode=None, owner=None):
     """
     Utility function to copy files to remote instance
     """
-    tmp_file = str(binascii.b2a_hex(os.urandom(10)), 'utf-8')
-    local(
-        'gcloud compute scp {0} {1}:~/{2}'.format(src, host, tmp_file))
-    local(
-        "gcloud compute ssh {0} --command 'sudo cp ~/{1} {2}'".format(host, tmp_file, destination))
-    local(
-        "gcloud compute ssh {0} --command 'sudo rm ~/{1}'".format(host, tmp_file))
+    copy_files(host, [(src, destination, mode, owner)])
+
+def copy_files(host, manifest):
+    """
+    Copy every (src, destination[, mode[, owner]]) in manifest to host with
+    one scp of a tarball and one privileged unpack, which joins the open
+    session for the host if there is one
+    """
+    if plan.recording():
+        return plan.record(plan.Op(plan.COPY, host, files=[
+            (entry.src, entry.destination, entry.mode, entry.owner) for entry in transfer.manifest(manifest)]))
+    with profiler.span('copy {0} files'.format(len(manifest)), kind='op', host=host) as info:
+        archive = transfer.pack(manifest)
+        info['size'] = os.path.getsize(archive)
+        try:
+            upload_archive(host, archive)
+        finally:
+            os.remove(archive)
+
+def remote_output(host, command):
+    """
+    Run command on host right away, outside any open session, and return
+    its output
+    """
+    command = "gcloud compute ssh {0} --command '{1}'".format(host, command)
+    if fanout.capturing():
+        fanout.log(command)
+    return local(command, capture=True)
+
+def install_components(host, components):
+    """
+    Install those of components that host doesn't have at the version in the
+    manifest, or whose binaries changed since they were installed. One probe
+    call finds them; their artifacts go in one upload.
+    """
+    stale = versions.pending(components, remote_output(host, versions.probe_command(components)))
+    if not stale:
+        fanout.log('{0} up to date'.format(', '.join(component.name for component in components)))
+        return stale
+    fanout.log('installing {0}'.format(', '.join('{0} {1}'.format(c.name, c.version) for c in stale)))
+    upload_archive(host, artifacts.bundle([url for component in stale for url in component.urls]))
+    for component in stale:
+        for command in component.install:
+            run_command(host=host, command=command)
+        run_command(host=host, command=component.stamp_command())
+    return stale
+
+def converge(host, files, services=(), restart=(), gate=False):
+    """
+    Push those of files (drift.Managed or (src, destination[, services[,
+    mode[, owner]]]) tuples) whose hash on host differs, restart the services
+    of the changed files and those in restart, and start services that aren't
+    running. With gate set every restart waits for the service's health check.
+    """
+    files = drift.manifest(files)
+    changes = drift.Plan(files, services, remote_output(host, drift.probe_command(files, services)), restart=restart)
+    fanout.log(changes.describe())
+    if changes.changed:
+        copy_files(host, changes.changed)
+    for command in changes.commands(gate=gate):
+        run_command(host=host, command=command)
+    return changes
+
+def _rolling(nodes, setup_one):
+    """
+    Set up control plane nodes one at a time, so a restart never takes down
+    more than one and a node that fails its health check stops the roll
+    """
+    with plan.serial():
+        fanout.execute(session.batched(setup_one, _host), nodes, name=_host, parallel=1, mode=fanout.FAIL_FAST)
+
+def upload_archive(host, archive):
+    """
+    scp an archive made by transfer.pack to host and unpack it into /
+    """
+    if plan.recording():
+        return plan.record(plan.Op(plan.UPLOAD, host, archive))
+    remote_path = transfer.remote_name(compress=archive.endswith('.gz'))
+    _gcloud('gcloud compute scp {0} {1}:~/{2}'.format(archive, host, remote_path))
+    run_command(host=host, command=transfer.install_command(remote_path))
+
+def _encryption_files(node):
+    return [('encryption/encryption-config.yaml', '/var/lib/kubernetes/encryption-config.yaml', ['kube-apiserver'], 0o600)]
+
+def _roll_encryption_config(keyring):
+    """
+    Render the keyring and restart the API servers with it one at a time
+    """
+    _render_encryption_config(keyring)
+    _rolling(topology.current().controllers, lambda node: converge(node.name, _encryption_files(node), gate=True))
+
+def rotate_encryption_key(rate=None, parallel=None, page=None):
+    """
+    Encrypt every Secret with a new key: add it to every API server, make it
+    the one written with, write every Secret back at most rate a second from
+    parallel writers, page Secrets per list, then drop the old key. An
+    interrupted rotation carries on where it stopped, e.g.
+    fab rotate_encryption_key:rate=20,parallel=2
+    """
+    keyring = rotation.Keyring.load()
+    if not keyring.keys:
+        abort('there is no encryption key to rotate yet, run setup_encryption first')
+    state = rotation.State.load()
+    if state is None:
+        state = rotation.State(key=keyring.next_name())
+        state.save()
+    else:
+        print('resuming the rotation to {0}, done: {1}'.format(state.key, ', '.join(state.done) or 'nothing'))
+    for phase in state.pending:
+        print('[rotation] {0} {1}'.format(phase, state.key))
+        if phase == 'rewrite':
+            api = rotation.HttpApi(facts.public_ip(), 6443,
+                                   health.client_context('ca/ca.pem', 'admin/admin.pem', 'admin/admin-key.pem'))
+            rotation.reencrypt(api, state.checkpoint, save=lambda checkpoint: state.save(),
+                               rate=rate, parallel=parallel, page=page, log=print)
+        else:
+            if phase == 'add':
+                keyring.add(state.key)
+            elif phase == 'promote':
+                keyring.promote(state.key)
+            elif phase == 'prune':
+                print('dropping {0}'.format(', '.join(keyring.prune()) or 'no keys'))
+            keyring.save()
+            _roll_encryption_config(keyring)
+        state.done.append(phase)
+        state.save()
+    rotation.State.remove()
+    print('Secrets are encrypted with {0}'.format(keyring.primary))
 
 def setup_api_server():
-    for i in range(0, 3):
-        internal_ip = local(
-            "gcloud compute instances describe controller-{0} --format 'value(networkInterfaces[0].networkIP)'".format(i), capture=True)
-        host_name = "controller-{0}".format(i)
-        mytemplate = Template(
-            filename='templates/kube-apiserver.service.mako',
-            module_directory='/tmp/mako_modules')
-        with open('api_server/kube-apiserver.service.{0}'.format(i), 'w') as f:
-            f.write(mytemplate.render(internal_ip=internal_ip))
-        copy_file(
-            host=host_name, 
-            src='api_server/kube-apiserver.service.{0}'.format(i), 
-            destination='/etc/systemd/system/kube-apiserver.service')
-        run_command(
-            host=host_name,
-            command="sudo systemctl daemon-reload && sudo systemctl enable kube-apiserver && sudo systemctl start kube-apiserver")
+    controllers = topology.current().controllers
+    _check_tuning(api_servers=templating.render_many('templates/kube-apiserver.service.mako', [
+        ('api_server/kube-apiserver.service.{0}'.format(node.index), _api_server_vars(node)) for node in controllers]))
+    def setup_one(node):
+        host_name = node.name
+        converge(host_name, _api_server_files(node), gate=True)
+    _rolling(controllers, setup_one)
 
 def setup_controller_manager():
-    for i in range(0, 3):
-        host_name = "controller-{0}".format(i)
-        run_command(
-            host=host_name,
-            command='sudo cp kube-controller-manager.kubeconfig /var/lib/kubernetes/')
-        copy_file(
-            host=host_name,
-            src='control_manager/kube-controller-manager.service',
-            destination='/etc/systemd/system/kube-controller-manager.service')
-        run_command(
-            host=host_name,
-            command="sudo systemctl daemon-reload && sudo systemctl enable kube-controller-manager && sudo systemctl start kube-controller-manager")
-                                      
+    def setup_one(node):
+        host_name = node.name
+        converge(host_name, _controller_manager_files(node), gate=True)
+    _rolling(topology.current().controllers, setup_one)
+
 def setup_scheduler():
-    for i in range(0, 3):
-        host_name = "controller-{0}".format(i)
-        run_command(
-            host=host_name,
-            command='sudo cp kube-scheduler.kubeconfig /var/lib/kubernetes/')
-        copy_file(
-            host=host_name,
-            src='scheduler/kube-scheduler.yaml',
-            destination='/etc/kubernetes/config/kube-scheduler.yaml')
-        copy_file(
-            host=host_name,
-            src='scheduler/kube-scheduler.service',
-            destination='/etc/systemd/system/kube-scheduler.service')
-        run_command(
-            host=host_name,
-            command="sudo systemctl daemon-reload && sudo systemctl enable kube-scheduler && sudo systemctl start kube-scheduler")
+    def setup_one(node):
+        host_name = node.name
+        converge(host_name, _scheduler_files(node), gate=True)
+    _rolling(topology.current().controllers, setup_one)
 
 def setup_nginx():
-     for i in range(0, 3):
-        host_name = "controller-{0}".format(i)
-        run_command(
-            host=host_name,
-            command='sudo apt-get install -y nginx')
-        copy_file(
-            host=host_name,
-            src='nginx/kubernetes.default.svc.cluster.local',
-            destination='/etc/nginx/sites-available/kubernetes.default.svc.cluster.local')
+    def setup_one(node):
+        host_name = node.name
         run_command(
             host=host_name,
-            command='sudo rm -f /etc/nginx/sites-enabled/kubernetes.default.svc.cluster.local')
+            command='dpkg -s nginx >/dev/null 2>&1 || sudo apt-get install -y nginx')
         run_command(
              host=host_name,
-             command='sudo ln -s /etc/nginx/sites-available/kubernetes.default.svc.cluster.local /etc/nginx/sites-enabled/')
-        run_command(
+             command='sudo ln -sf /etc/nginx/sites-available/kubernetes.default.svc.cluster.local /etc/nginx/sites-enabled/')
+        converge(host_name, [
+            ('nginx/kubernetes.default.svc.cluster.local',
+             '/etc/nginx/sites-available/kubernetes.default.svc.cluster.local', ['nginx']),
+        ], gate=True)
+    _rolling(topology.current().controllers, setup_one)
+
+def setup_rbac():
+    host_name = topology.current().controllers[0].name
+    with session.RemoteSession(host_name):
+        copy_file(
             host=host_name,
-            command='sudo systemctl restart nginx')
+            src='admin/rbac-authorization.yaml',
+            destination='/etc/rbac-authorization.yaml')
         run_command(
             host=host_name,
-            command='systemctl enable nginx')
-        
-def setup_rbac():
-    host_name = "controller-0"
-    copy_file(
-        host=host_name,
-        src='admin/rbac-authorization.yaml',
-        destination='/etc/rbac-authorization.yaml')
-    run_command(
-        host=host_name,
-        command='kubectl apply --kubeconfig admin.kubeconfig -f /etc/rbac-authorization.yaml')
+            command='kubectl apply --kubeconfig admin.kubeconfig -f /etc/rbac-authorization.yaml')
 
 def setup_lb():
-    public_ip = local("""gcloud compute addresses describe kubernetes-the-hard-way """
-                      """--region us-west1 --format 'value(address)'""", capture=True)
-    local("""gcloud compute http-health-checks create kubernetes --description \"Kubernetes Health Check\" """
-        """--host \"kubernetes.default.svc.cluster.local\" --request-path \"/healthz\" """)
-    local("""gcloud compute firewall-rules create kubernetes-the-hard-way-allow-health-check """
-        """--network kubernetes-the-hard-way --source-ranges 209.85.152.0/22,209.85.204.0/22,35.191.0.0/16 --allow tcp""")
-    local("""gcloud compute target-pools create kubernetes-target-pool --http-health-check kubernetes""")
-    local("""gcloud compute target-pools add-instances kubernetes-target-pool --instances controller-0,controller-1,controller-2""")
-    local("""gcloud compute forwarding-rules create kubernetes-forwarding-rule --address {0} --ports 6443 """
-        """--region $(gcloud config get-value compute/region) --target-pool kubernetes-target-pool""".format(public_ip))
+    public_ip = facts.public_ip()
+    cluster = topology.current()
+    names = cluster.resource_names
+    local("""gcloud compute http-health-checks create {0} --description \"Kubernetes Health Check\" """
+        """--host \"kubernetes.default.svc.cluster.local\" --request-path \"/healthz\" """.format(
+            names['http-health-check']))
+    local("""gcloud compute firewall-rules create {0} """
+        """--network {1} --source-ranges 209.85.152.0/22,209.85.204.0/22,35.191.0.0/16 --allow tcp""".format(
+            names['health-check-firewall'], cluster.name))
+    local("""gcloud compute target-pools create {0} --http-health-check {1}""".format(
+        names['target-pool'], names['http-health-check']))
+    local("""gcloud compute target-pools add-instances {0} --instances {1}""".format(
+        names['target-pool'], ','.join(node.name for node in cluster.controllers)))
+    local("""gcloud compute forwarding-rules create {0} --address {1} --ports 6443 """
+        """--region {2} --target-pool {3}""".format(
+            names['forwarding-rule'], public_ip, facts.region(), names['target-pool']))
 
 ### worker node setup ###
 def setup_worker():
-    for i in range(0, 3):
-        host_name = "worker-{0}".format(i)
+    plane = dataplane.current()
+    packages = ' '.join(['socat', 'conntrack', 'ipset'] + plane.packages)
+    modules = ' '.join(plane.kernel_modules)
+    def setup_one(node):
+        host_name = node.name
         run_command(
             host=host_name,
-            command='sudo apt-get update && sudo apt-get -y install socat conntrack ipset')
+            command='dpkg -s {0} >/dev/null 2>&1 || (sudo apt-get update && sudo apt-get -y install {0})'.format(packages))
+        # loaded now and on every boot, before kube-proxy and the bridge need them
         run_command(
             host=host_name,
-            command="""wget -q --show-progress --https-only --timestamping """
-                """https://github.com/kubernetes-incubator/cri-tools/releases/download/v1.0.0-beta.0/crictl-v1.0.0-beta.0-linux-amd64.tar.gz """
-                """https://storage.googleapis.com/kubernetes-the-hard-way/runsc """
-                """https://github.com/opencontainers/runc/releases/download/v1.0.0-rc5/runc.amd64 """
-                """https://github.com/containernetworking/plugins/releases/download/v0.6.0/cni-plugins-amd64-v0.6.0.tgz """
-                """https://github.com/containerd/containerd/releases/download/v1.1.0/containerd-1.1.0.linux-amd64.tar.gz """
-                """https://storage.googleapis.com/kubernetes-release/release/v1.10.2/bin/linux/amd64/kubectl """
-                """https://storage.googleapis.com/kubernetes-release/release/v1.10.2/bin/linux/amd64/kube-proxy """
-                """https://storage.googleapis.com/kubernetes-release/release/v1.10.2/bin/linux/amd64/kubelet """)
+            command='sudo modprobe -a {0} && echo {0} | tr " " "\\n" | sudo tee /etc/modules-load.d/kubernetes.conf >/dev/null'.format(modules))
         run_command(
             host=host_name,
             command="""sudo mkdir -p /etc/cni/net.d /opt/cni/bin /var/lib/kubelet """
                 """/var/lib/kube-proxy /var/lib/kubernetes /var/run/kubernetes"""
         )
-        run_command(
-            host=host_name,
-            command='chmod +x kubectl kube-proxy kubelet runc.amd64 runsc'
-        )
-        run_command(
-            host=host_name,
-            command='sudo cp runc.amd64 runc'
-        )
-        run_command(
-            host=host_name,
-            command=' sudo cp kubectl kube-proxy kubelet runc runsc /usr/local/bin/'
-        )
-        run_command(
-            host=host_name,
-            command='sudo tar -xvf crictl-v1.0.0-beta.0-linux-amd64.tar.gz -C /usr/local/bin/'
-        )
-        run_command(
-            host=host_name,
-            command='sudo tar -xvf cni-plugins-amd64-v0.6.0.tgz -C /opt/cni/bin/'
-        )
-        run_command(
-            host=host_name,
-            command='sudo tar -xvf containerd-1.1.0.linux-amd64.tar.gz -C /'
-        )
+        upgraded = _services(install_components(host_name, versions.components('worker')))
+        if upgraded:
+            # running daemons keep the old binaries until restarted; those not
+            # set up yet are left to their setup task
+            run_command(host=host_name, command='sudo systemctl try-restart {0}'.format(' '.join(upgraded)))
+    fanout.execute(session.batched(setup_one, _host), topology.current().workers, name=_host)
 
 def setup_cni():
-    for i in range(0, 3):
-        host_name = "worker-{0}".format(i)
-        pod_cidr = '10.200.{0}.0/24'.format(i)
-        mytemplate = Template(
-            filename='templates/10-bridge.conf.mako',
-            module_directory='/tmp/mako_modules')
-        with open('cni/10-bridge.conf.{0}'.format(i), 'w') as f:
-            f.write(mytemplate.render(pod_cidr=pod_cidr))
-        copy_file(
-            host=host_name,
-            src='cni/10-bridge.conf.{0}'.format(i),
-            destination='/etc/cni/net.d/10-bridge.conf'
-        )
-        copy_file(
-            host=host_name,
-            src='cni/99-loopback.conf',
-            destination='/etc/cni/net.d/99-loopback.conf'
-        )
+    workers = topology.current().workers
+    _check_dataplane(bridges=templating.render_many('templates/10-bridge.conf.mako', [
+        ('cni/10-bridge.conf.{0}'.format(node.index), _bridge_vars(node)) for node in workers]))
+    def setup_one(node):
+        host_name = node.name
+        converge(host_name, _cni_files(node))
+    fanout.execute(session.batched(setup_one, _host), workers, name=_host)
 
 def setup_containerd():
-    for i in range(0, 3):
-        host_name = "worker-{0}".format(i)
-        run_command(
-            host=host_name,
-            command='sudo mkdir -p /etc/containerd/'
-        )
-        copy_file(
-            host=host_name,
-            src='containerd/config.toml',
-            destination='/etc/containerd/config.toml'
-        )
-        copy_file(
-            host=host_name,
-            src='containerd/containerd.service',
-            destination='/etc/systemd/system/containerd.service'
-        )
-        run_command(
-            host=host_name,
-            command="sudo systemctl daemon-reload && sudo systemctl enable containerd && sudo systemctl start containerd")
+    _render_worker_configs()
+    def setup_one(node):
+        host_name = node.name
+        converge(host_name, _containerd_files(node))
+    fanout.execute(session.batched(setup_one, _host), topology.current().workers, name=_host)
 
 def setup_kubelet():
-    for i in range(0, 3):
-        host_name = "worker-{0}".format(i)
-        pod_cidr = '10.200.{0}.0/24'.format(i)
+    workers = topology.current().workers
+    _check_tuning(kubelets=templating.render_many('templates/kubelet-config.yaml.mako', [
+        ('kubelet/kubelet-config.yaml.{0}'.format(node.index), _kubelet_vars(node)) for node in workers]))
+    def setup_one(node):
+        host_name = node.name
         """
         sudo mv ${HOSTNAME}-key.pem ${HOSTNAME}.pem /var/lib/kubelet/
         sudo mv ${HOSTNAME}.kubeconfig /var/lib/kubelet/kubeconfig
@@ -469,136 +995,158 @@ def setup_kubelet():
             host=host_name,
             command='sudo cp ca.pem /var/lib/kubernetes/'
         )
-        mytemplate = Template(
-            filename='templates/kubelet-config.yaml.mako',
-            module_directory='/tmp/mako_modules')
-        with open('kubelet/kubelet-config.yaml.{0}'.format(i), 'w') as f:
-            f.write(mytemplate.render(pod_cidr=pod_cidr, host_name=host_name))
-        copy_file(
-            host=host_name,
-            src='kubelet/kubelet-config.yaml.{0}'.format(i),
-            destination='/var/lib/kubelet/kubelet-config.yaml'
-        )
-        copy_file(
-            host=host_name,
-            src='kubelet/kubelet.service',
-            destination='/etc/systemd/system/kubelet.service'
-        )
-        run_command(
-            host=host_name,
-            command="sudo systemctl daemon-reload && sudo systemctl enable kubelet && sudo systemctl start kubelet")
+        converge(host_name, _kubelet_files(node))
+    fanout.execute(session.batched(setup_one, _host), workers, name=_host)
 
 def setup_kube_proxy():
-    for i in range(0, 3):
-        host_name = "worker-{0}".format(i)
+    _render_worker_configs()
+    def setup_one(node):
+        host_name = node.name
         run_command(
             host=host_name,
             command='sudo cp kube-proxy.kubeconfig /var/lib/kube-proxy/kubeconfig'
         )
-        copy_file(
-            host=host_name,
-            src='kube_proxy/kube-proxy-config.yaml',
-            destination='/var/lib/kube-proxy/kube-proxy-config.yaml'
-        )
-        copy_file(
-            host=host_name,
-            src='kube_proxy/kube-proxy.service',
-            destination='/etc/systemd/system/kube-proxy.service'
-        )
-        run_command(
-            host=host_name,
-            command="sudo systemctl daemon-reload && sudo systemctl enable kube-proxy && sudo systemctl start kube-proxy")
+        converge(host_name, _kube_proxy_files(node))
+    fanout.execute(session.batched(setup_one, _host), topology.current().workers, name=_host)
 
 def setup_kubectl():
-    public_ip = local(
-        """gcloud compute addresses describe kubernetes-the-hard-way """
-        """--region us-west1 --format 'value(address)'""",
-        capture=True
-    )
+    public_ip = facts.public_ip()
+    name = topology.current().name
     local(
-        """kubectl config set-cluster kubernetes-the-hard-way --certificate-authority=ca/ca.pem """
-        """--embed-certs=true --server=https://{0}:6443""".format(public_ip)
+        """kubectl config set-cluster {0} --certificate-authority=ca/ca.pem """
+        """--embed-certs=true --server=https://{1}:6443""".format(name, public_ip)
     )
     local(
         """kubectl config set-credentials admin --client-certificate=admin/admin.pem --client-key=admin/admin-key.pem"""
     )
     local(
-        """ kubectl config set-context kubernetes-the-hard-way --cluster=kubernetes-the-hard-way --user=admin"""
+        """ kubectl config set-context {0} --cluster={0} --user=admin""".format(name)
     )
-    local('kubectl config use-context kubernetes-the-hard-way')
+    local('kubectl config use-context {0}'.format(name))
+    wait_ready(checks='apiserver')
     local('kubectl get componentstatuses')
     local('kubectl get nodes')
 
+def _readiness_checks(kinds, internal=False):
+    cluster = topology.current()
+    def address(node):
+        return node.internal_ip if internal else inventory.external_ip(node.name)
+    admin = health.client_context('ca/ca.pem', 'admin/admin.pem', 'admin/admin-key.pem')
+    # the apiserver's cert, which etcd and the kubelets accept as a client
+    apiserver = health.client_context('ca/ca.pem', 'api_server/kubernetes.pem', 'api_server/kubernetes-key.pem')
+    checks = []
+    for node in cluster.controllers:
+        # the certs carry internal IPs, so that is what they are checked against
+        if 'etcd' in kinds:
+            checks.append(health.Check('etcd {0}'.format(node.name), address(node), 2379, '/health', apiserver,
+                                       server_name=node.internal_ip, expect=health.expect_etcd_health))
+        if 'apiserver' in kinds:
+            checks.append(health.Check('apiserver {0}'.format(node.name), address(node), 6443, '/healthz', admin,
+                                       server_name=node.internal_ip, expect=health.expect_status(200, b'ok')))
+    for node in cluster.workers:
+        if 'kubelet' in kinds:
+            checks.append(health.Check('kubelet {0}'.format(node.name), address(node), 10250, '/healthz', apiserver,
+                                       server_name=node.internal_ip, expect=health.expect_status(200, b'ok')))
+        if 'nodes' in kinds:
+            public_ip = facts.public_ip()
+            checks.append(health.Check('node {0}'.format(node.name), public_ip, 6443,
+                                       '/api/v1/nodes/{0}'.format(node.name), admin, expect=health.expect_node_ready))
+    return checks
+
+def wait_ready(checks='apiserver;nodes', deadline=60, internal=False):
+    """
+    Poll etcd, apiserver, kubelet and node readiness checks concurrently until
+    they pass or deadline seconds run out, then print how long each took.
+    Only the apiserver port is open to the outside; check etcd and kubelets
+    with internal=yes from inside the network, e.g.
+    fab wait_ready:checks='etcd;apiserver;kubelet;nodes',internal=yes
+    """
+    health.settings['deadline'] = float(deadline)
+    if plan.recording():
+        plan.record(plan.Op(plan.WAIT, command=checks, args={'deadline': deadline, 'internal': internal}))
+        return
+    results = health.run(_readiness_checks(checks.split(';'), internal=_flag(internal)))
+    print(health.report(results))
+    failed = [result.name for result in results if not result.ok]
+    if failed:
+        abort('not ready: {0}'.format(', '.join(failed)))
+
 def setup_pod_routes():
-    for i in range(0,3):
-        local(
-            """gcloud compute routes create kubernetes-route-10-200-{0}-0-24 --network kubernetes-the-hard-way """
-            """--next-hop-address 10.240.0.2{0} --destination-range 10.200.{0}.0/24""".format(i))
-        local('gcloud compute routes list --filter "network: kubernetes-the-hard-way"')
+    provision.create(_route_resources())
+    _gcloud_list('gcloud compute routes list --filter "network: {0}"'.format(topology.current().name))
 
 def setup_kube_dns():
     local('kubectl create -f https://storage.googleapis.com/kubernetes-the-hard-way/kube-dns.yaml')
 
-def cleanup():
-    with settings(warn_only=True):
-        local("""gcloud -q compute instances delete controller-0 controller-1 controller-2 """
-            """worker-0 worker-1 worker-2""")
-        # network
-        local(
-            """gcloud -q compute forwarding-rules delete kubernetes-forwarding-rule """
-            """--region $(gcloud config get-value compute/region)""")
-        local(
-            'gcloud -q compute target-pools delete kubernetes-target-pool'
-        )
-        local(
-            'gcloud -q compute http-health-checks delete kubernetes'
-        )
-        local(
-            'gcloud -q compute addresses delete kubernetes-the-hard-way'
-        )
-        # firewall
-        local("""gcloud -q compute firewall-rules delete kubernetes-the-hard-way-allow-nginx-service """
-            """kubernetes-the-hard-way-allow-internal kubernetes-the-hard-way-allow-external """
-            """kubernetes-the-hard-way-allow-health-check""")
-        # VPC
-        local("""gcloud -q compute routes delete kubernetes-route-10-200-0-0-24 kubernetes-route-10-200-1-0-24 """
-            """kubernetes-route-10-200-2-0-24""")
-        local('gcloud -q compute networks subnets delete kubernetes')
-        local('gcloud -q compute networks delete kubernetes-the-hard-way')
+def cleanup(name=None, region=None):
+    """
+    Delete every resource of the cluster, found by its network, tag and names,
+    in dependency order with the independent deletes at once
+    """
+    name = name or topology.current().name
+    region = region or facts.region()
+    inventory.invalidate()
+    facts.invalidate()
+    found = teardown.discover(name, region)
+    if not found:
+        print('nothing to delete')
+        return
+    for i, layer in enumerate(teardown.layers(found)):
+        print('layer {0}: {1}'.format(i, '; '.join('{0} {1}'.format(kind, ' '.join(found[kind][0])) for kind in layer)))
+    report, failed = teardown.run(found)
+    for i, kind, names, seconds in report:
+        if kind not in failed:
+            print('deleted {0} {1} in {2:.1f}s'.format(kind, ' '.join(names), seconds))
+    if failed:
+        abort('not deleted: {0}'.format('; '.join('{0}: {1}'.format(kind, error) for kind, error in sorted(failed.items()))))
+
+def _flag(value):
+    # fab passes task arguments as strings
+    return str(value).lower() in ('1', 'true', 'yes', 'y')
+
+def render_configs(out='rendered'):
+    """
+    Write every rendered per-host config under out/<host>/<path on the host>,
+    e.g. rendered/controller-0/etc/systemd/system/etcd.service, so the configs
+    of a cluster can be reviewed and diffed without touching the cloud
+    """
+    cluster = topology.current()
+    def tree(node, path):
+        return os.path.join(out, node.name, path.lstrip('/'))
+    templating.render_many('etcd/etcd.service.mako', [
+        (tree(node, '/etc/systemd/system/etcd.service'), _etcd_vars(node)) for node in cluster.controllers])
+    api_servers = templating.render_many('templates/kube-apiserver.service.mako', [
+        (tree(node, '/etc/systemd/system/kube-apiserver.service'), _api_server_vars(node)) for node in cluster.controllers])
+    bridges = templating.render_many('templates/10-bridge.conf.mako', [
+        (tree(node, '/etc/cni/net.d/10-bridge.conf'), _bridge_vars(node)) for node in cluster.workers])
+    kubelets = templating.render_many('templates/kubelet-config.yaml.mako', [
+        (tree(node, '/var/lib/kubelet/kubelet-config.yaml'), _kubelet_vars(node)) for node in cluster.workers])
+    templating.render_many('templates/containerd-config.toml.mako', [
+        (tree(node, '/etc/containerd/config.toml'), _containerd_vars()) for node in cluster.workers])
+    kube_proxies = templating.render_many('templates/kube-proxy-config.yaml.mako', [
+        (tree(node, '/var/lib/kube-proxy/kube-proxy-config.yaml'), _kube_proxy_vars()) for node in cluster.workers])
+    _check_tuning(api_servers, kubelets)
+    _check_dataplane(bridges, kube_proxies)
+
 ##### defining steps for the process ###########################################
 
 def step_01():
     init_env()
-    cfssl()
     kubectl()
 
 def step_02():
-    # setting up networking and firewall rules
-    networking()
-    firewall_rules()
-    public_ip()
-    create_controllers()
-    create_workers()
+    # setting up networking, firewall rules and instances, concurrently
+    provision_cluster()
 
 def step_03():
     # generate client certificates and distribute them
     generate_ca()
-    generate_admin_cert()
-    generate_kubelet_cert()
-    generate_kube_proxy_cert()
-    generate_scheduler_cert()
-    generate_api_server_cert()
-    generate_control_manager_cert()
-    generate_service_account_cert()
+    generate_certs()
     copy_certs()
 
 def step_04():
     # generate kubeconfig and distributes them
-    create_kube_proxy_config()
-    create_kubelet_config()
-    create_controller_manager_config()
-    create_scheduler_config()
-    create_admin_config()
+    create_kubeconfigs()
     copy_config()
 
 def step_05():
@@ -623,3 +1171,236 @@ def step_08():
     setup_containerd()
     setup_kubelet()
     setup_kube_proxy()
+
+##### resumable pipeline over the tasks above ##################################
+
+def _cluster():
+    return topology.current().fingerprint()
+
+def _tuning():
+    return tuning.current().fingerprint()
+
+def _dataplane():
+    return dataplane.current().fingerprint()
+
+def _etcd_profile():
+    return etcdperf.current().fingerprint()
+
+def _checksums():
+    # read when the pipeline runs, so a checksums file set with artifact_cache counts
+    return sorted(artifacts.pinned().items())
+
+PIPELINE = pipeline.Pipeline()
+PIPELINE.add('init_env', init_env)
+PIPELINE.add('fetch_artifacts', fetch_artifacts, inputs=[_artifact_urls, _checksums])
+PIPELINE.add('kubectl', kubectl, deps=['fetch_artifacts'])
+PIPELINE.add('networking', networking, deps=['init_env'], inputs=[_cluster])
+PIPELINE.add('firewall_rules', firewall_rules, deps=['networking'], inputs=[_cluster])
+PIPELINE.add('public_ip', public_ip, deps=['init_env'])
+PIPELINE.add('create_controllers', create_controllers, deps=['networking'], inputs=[_cluster, _etcd_profile])
+PIPELINE.add('create_workers', create_workers, deps=['networking'], inputs=[_cluster])
+PIPELINE.add('generate_ca', generate_ca, inputs=['ca/ca-csr.json'])
+for _name, _func, _csr in (
+        ('generate_admin_cert', generate_admin_cert, 'admin/admin-csr.json'),
+        ('generate_kube_proxy_cert', generate_kube_proxy_cert, 'kube_proxy/kube-proxy-csr.json'),
+        ('generate_scheduler_cert', generate_scheduler_cert, 'scheduler/kube-scheduler-csr.json'),
+        ('generate_control_manager_cert', generate_control_manager_cert, 'control_manager/kube-controller-manager-csr.json'),
+        ('generate_service_account_cert', generate_service_account_cert, 'sa/service-account-csr.json')):
+    PIPELINE.add(_name, _func, deps=['generate_ca'], inputs=[_csr, 'ca/ca.pem', 'ca/ca-config.json'])
+PIPELINE.add('generate_kubelet_cert', generate_kubelet_cert, deps=['generate_ca', 'create_workers'],
+             inputs=['kubelet/*-csr.json', 'ca/ca.pem', 'ca/ca-config.json', _cluster])
+PIPELINE.add('generate_api_server_cert', generate_api_server_cert, deps=['generate_ca', 'public_ip'],
+             inputs=['api_server/kubernetes-csr.json', 'ca/ca.pem', 'ca/ca-config.json', _cluster])
+PIPELINE.add('copy_certs', copy_certs,
+             deps=['create_controllers', 'create_workers', 'generate_kubelet_cert',
+                   'generate_api_server_cert', 'generate_service_account_cert'],
+             inputs=['ca/ca.pem', 'kubelet/*.pem', 'api_server/*.pem', 'sa/*.pem', _cluster])
+PIPELINE.add('create_kubeconfigs', create_kubeconfigs,
+             deps=['public_ip', 'generate_admin_cert', 'generate_kubelet_cert', 'generate_kube_proxy_cert',
+                   'generate_scheduler_cert', 'generate_control_manager_cert'],
+             inputs=['ca/ca.pem', 'admin/*.pem', 'kubelet/*.pem', 'kube_proxy/*.pem', 'scheduler/*.pem',
+                     'control_manager/*.pem', _cluster])
+PIPELINE.add('copy_config', copy_config, deps=['create_kubeconfigs', 'create_controllers', 'create_workers'],
+             inputs=['*/*.kubeconfig', _cluster])
+PIPELINE.add('setup_encryption', setup_encryption, inputs=['templates/encryption-config.mako', 'encryption/keys.json'])
+PIPELINE.add('setup_etcd', setup_etcd, deps=['copy_certs', 'fetch_artifacts'],
+             inputs=['etcd/etcd.service.mako', 'versions.yaml', 'ca/ca.pem', 'api_server/*.pem', _cluster, _etcd_profile])
+PIPELINE.add('verify_etcd', verify_etcd, deps=['setup_etcd'])
+PIPELINE.add('setup_controller', setup_controller, deps=['copy_certs', 'fetch_artifacts'],
+             inputs=['versions.yaml', _cluster, _dataplane])
+PIPELINE.add('setup_api_server', setup_api_server, deps=['setup_controller', 'setup_etcd', 'setup_encryption'],
+             inputs=['templates/kube-apiserver.service.mako', 'api_server/audit-policy.yaml',
+                     'encryption/encryption-config.yaml', 'ca/ca.pem', 'api_server/*.pem', 'sa/service-account.pem',
+                     _cluster, _tuning])
+PIPELINE.add('setup_controller_manager', setup_controller_manager, deps=['setup_controller', 'create_kubeconfigs'],
+             inputs=['control_manager/kube-controller-manager.service', 'control_manager/kube-controller-manager.kubeconfig',
+                     'ca/ca.pem', 'ca/ca-key.pem', 'sa/service-account-key.pem', _cluster])
+PIPELINE.add('setup_scheduler', setup_scheduler, deps=['setup_controller', 'create_kubeconfigs'],
+             inputs=['scheduler/kube-scheduler.yaml', 'scheduler/kube-scheduler.service',
+                     'scheduler/kube-scheduler.kubeconfig', _cluster])
+PIPELINE.add('setup_nginx', setup_nginx, deps=['setup_api_server'],
+             inputs=['nginx/kubernetes.default.svc.cluster.local', _cluster])
+PIPELINE.add('setup_rbac', setup_rbac, deps=['setup_api_server', 'copy_config'], inputs=['admin/rbac-authorization.yaml'])
+PIPELINE.add('setup_lb', setup_lb, deps=['setup_nginx', 'public_ip'], inputs=[_cluster])
+PIPELINE.add('setup_worker', setup_worker, deps=['create_workers', 'fetch_artifacts'], inputs=['versions.yaml', _cluster, _dataplane])
+PIPELINE.add('setup_cni', setup_cni, deps=['setup_worker'],
+             inputs=['templates/10-bridge.conf.mako', 'cni/99-loopback.conf', _cluster, _dataplane])
+PIPELINE.add('setup_containerd', setup_containerd, deps=['setup_worker'],
+             inputs=['templates/containerd-config.toml.mako', 'containerd/containerd.service', _cluster, _dataplane])
+PIPELINE.add('setup_kubelet', setup_kubelet, deps=['setup_cni', 'setup_containerd', 'copy_certs', 'copy_config'],
+             inputs=['templates/kubelet-config.yaml.mako', 'kubelet/kubelet.service', 'kubelet/*.kubeconfig',
+                     'kubelet/*.pem', 'ca/ca.pem', _cluster, _tuning])
+PIPELINE.add('setup_kube_proxy', setup_kube_proxy, deps=['setup_containerd', 'copy_config'],
+             inputs=['templates/kube-proxy-config.yaml.mako', 'kube_proxy/kube-proxy.service',
+                     'kube_proxy/kube-proxy.kubeconfig', _cluster, _dataplane])
+PIPELINE.add('setup_pod_routes', setup_pod_routes, deps=['create_workers'], inputs=[_cluster])
+
+def deploy(target=None, force=False, parallel=None):
+    """
+    Run the whole setup (or only what target needs) as a dependency graph,
+    independent tasks concurrently. Work recorded in the journal is skipped,
+    so after a failure running deploy again resumes where it stopped, e.g.
+    fab deploy, fab deploy:target=setup_kubelet, fab deploy:force=yes
+    """
+    PIPELINE.run(targets=target.split(';') if target else None, parallel=parallel, force=_flag(force))
+
+def make_plan(tasks='deploy', out='plan.json', verbose=False):
+    """
+    Record what tasks would run (by default a whole deploy, journal aside)
+    without running it, optimize it and save it to out, e.g.
+    fab make_plan:tasks='step_07;step_08',out=workers.json
+    """
+    journal = pipeline.settings['journal']
+    pipeline.settings['journal'] = out + '.journal'
+    try:
+        with plan.recorder() as recorded:
+            for name in tasks.split(';'):
+                task = globals().get(name)
+                if not callable(task) or name.startswith('_'):
+                    abort('no task named {0}'.format(name))
+                with profiler.step(name):
+                    task()
+    finally:
+        pipeline.settings['journal'] = journal
+        if os.path.exists(out + '.journal'):
+            os.remove(out + '.journal')
+    optimized = plan.optimize(recorded)
+    print('\n'.join(optimized.lines(verbose=_flag(verbose))))
+    print('recorded {0} ops costing {1[total]} calls, optimized to {2} ops costing {3[total]}'.format(
+        len(recorded.ops), recorded.cost(), len(optimized.ops), optimized.cost()))
+    optimized.save(out)
+
+def show_plan(path='plan.json', verbose=False):
+    print('\n'.join(plan.Plan.load(path).lines(verbose=_flag(verbose))))
+
+def diff_plans(before, after='plan.json'):
+    """
+    What changed between two saved plans, e.g. before and after a change to
+    this file
+    """
+    print(plan.diff(plan.Plan.load(before), plan.Plan.load(after), (before, after)))
+
+def run_plan(path='plan.json'):
+    """
+    Run a saved plan wave by wave
+    """
+    plan.execute(plan.Plan.load(path), run_command, copy_files, upload_archive, wait=wait_ready)
+
+def forget(task=None):
+    """
+    Drop a task (or everything) from the journal so deploy runs it again
+    """
+    pipeline.Journal(pipeline.settings['journal']).forget(task)
+
+##### rolling upgrade ##########################################################
+
+def _check(host, command):
+    """
+    (succeeded, output) of command on host, without aborting when it fails
+    """
+    with settings(warn_only=True):
+        output = remote_output(host, command)
+    return output.succeeded, output
+
+def _etcd_gate(batch):
+    host = batch[0].name
+    ok, output = _check(host, ETCD_MEMBER_LIST)
+    if not ok:
+        return ['etcdctl member list failed on {0}'.format(host)]
+    started = set()
+    for line in output.splitlines():
+        fields = [field.strip() for field in line.split(',')]
+        if len(fields) >= 3 and fields[1] == 'started':
+            started.add(fields[2])
+    return ['{0} is not a started member'.format(node.name)
+            for node in topology.current().controllers if node.name not in started]
+
+def _api_server_gate(batch):
+    problems = []
+    for node in batch:
+        ok, output = _check(node.name, drift.HEALTH_CHECKS['nginx'])
+        if not ok or output.strip() != 'ok':
+            problems.append('{0} /healthz through nginx is not ok'.format(node.name))
+    return problems
+
+def _node_ready_gate(batch):
+    version = versions.get('kubernetes-node').version
+    ok, output = _check(topology.current().controllers[0].name, 'kubectl get nodes --kubeconfig admin.kubeconfig --no-headers')
+    if not ok:
+        return ['kubectl get nodes failed']
+    nodes = dict((line.split()[0], line.split()) for line in output.splitlines() if len(line.split()) >= 5)
+    problems = []
+    for node in batch:
+        fields = nodes.get(node.name)
+        if fields is None:
+            problems.append('{0} is not registered'.format(node.name))
+        elif fields[1] != 'Ready':
+            problems.append('{0} is {1}'.format(node.name, fields[1]))
+        elif fields[-1] != version:
+            problems.append('{0} runs {1}, not {2}'.format(node.name, fields[-1], version))
+    return problems
+
+def _upgrade_control_plane(node):
+    upgraded = install_components(node.name, [versions.get('kubernetes-control-plane')])
+    converge(node.name, _api_server_files(node) + _controller_manager_files(node) + _scheduler_files(node),
+             restart=_services(upgraded), gate=True)
+
+def _upgrade_worker(node):
+    upgraded = install_components(node.name, versions.components('worker'))
+    converge(node.name, _cni_files(node) + _containerd_files(node) + _kubelet_files(node) + _kube_proxy_files(node),
+             restart=_services(upgraded))
+
+def _on_batch(body):
+    return lambda batch: fanout.execute(session.batched(body, _host), batch, name=_host, mode=fanout.FAIL_FAST)
+
+def rolling_upgrade(batch_size=1, max_unavailable=1, phases='etcd;control-plane;workers'):
+    """
+    Bring the cluster to the versions and configs in the tree in waves: etcd
+    members, then the rest of the control plane, then workers, batch_size
+    nodes at a time but never more than max_unavailable (or than etcd's
+    quorum allows) down, each wave gated on etcd member list, apiserver
+    /healthz through nginx or node Ready, e.g.
+    fab use_versions:path=next.yaml rolling_upgrade:batch_size=5,max_unavailable=5
+    """
+    cluster = topology.current()
+    _render_templates()
+    artifacts.fetch_all(versions.urls())
+    available = [
+        upgrade.Phase('etcd', cluster.controllers, _on_batch(_etcd_node),
+                      gates=[('etcd members', _etcd_gate)], limit=upgrade.quorum_limit(len(cluster.controllers))),
+        upgrade.Phase('control-plane', cluster.controllers, _on_batch(_upgrade_control_plane),
+                      gates=[('apiserver', _api_server_gate)], limit=len(cluster.controllers) - 1),
+        upgrade.Phase('workers', cluster.workers, _on_batch(_upgrade_worker),
+                      gates=[('node ready', _node_ready_gate)]),
+    ]
+    wanted = phases.split(';')
+    unknown = set(wanted) - set(phase.name for phase in available)
+    if unknown:
+        abort('unknown upgrade phases: {0}'.format(', '.join(sorted(unknown))))
+    try:
+        report = upgrade.run([phase for phase in available if phase.name in wanted],
+                             size=batch_size, max_unavailable=max_unavailable)
+    except upgrade.UpgradeError as e:
+        abort('upgrade stopped: {0}'.format(e))
+    for phase, names, seconds, tries in report:
+        print('{0:<14} {1:>7.1f}s  {2}'.format(phase, seconds, ', '.join(names)))
@@ -0,0 +1,121 @@
+"""
+Cluster-wide facts looked up once per process.
+
+The public address of the cluster, its region, zone and network name used to
+be looked up again by every kubeconfig and cert task. ``get`` memoizes each
+fact for the rest of the fab run; with a ttl set the facts are also kept in a
+snapshot file so the next fab run starts without any lookup. ``invalidate``
+drops one fact or all of them.
+"""
+import threading
+
+import snapshot
+import topology
+from profiler import local
+
+settings = {
+    # the cluster's address and network name, the topology's name if None
+    'name': None,
+    'path': '.cluster-facts.json',
+    'ttl': 0,
+}
+
+_lock = threading.Lock()
+_facts = {}
+_loaded = False
+
+
+def _name():
+    return settings['name'] or topology.current().name
+
+
+def _region():
+    return local('gcloud config get-value compute/region', capture=True).strip() or 'us-west1'
+
+
+def _zone():
+    return local('gcloud config get-value compute/zone', capture=True).strip() or 'us-west1-c'
+
+
+def _public_ip():
+    return local(
+        """gcloud compute addresses describe {0} --region {1} --format 'value(address)'""".format(
+            _name(), get('region')),
+        capture=True)
+
+
+def _network():
+    return _name()
+
+
+LOOKUPS = {
+    'region': _region,
+    'zone': _zone,
+    'public_ip': _public_ip,
+    'network': _network,
+}
+
+
+def configure(name=None, path=None, ttl=None):
+    if name is not None:
+        settings['name'] = name
+    if path is not None:
+        settings['path'] = path
+    if ttl is not None:
+        settings['ttl'] = float(ttl)
+
+
+def _load():
+    global _loaded
+    if not _loaded:
+        _facts.update(snapshot.load(settings['path'], settings['ttl']) or {})
+        _loaded = True
+
+
+def get(fact):
+    """
+    Value of fact, looked up the first time it is asked for
+    """
+    if fact not in LOOKUPS:
+        raise KeyError('unknown cluster fact {0!r}, expected one of {1}'.format(fact, sorted(LOOKUPS)))
+    with _lock:
+        _load()
+        if fact in _facts:
+            return _facts[fact]
+    # looked up outside the lock, since lookups can depend on other facts
+    value = LOOKUPS[fact]()
+    with _lock:
+        _facts.setdefault(fact, value)
+        if settings['ttl']:
+            snapshot.save(settings['path'], _facts)
+        return _facts[fact]
+
+
+def public_ip():
+    return get('public_ip')
+
+
+def region():
+    return get('region')
+
+
+def zone():
+    return get('zone')
+
+
+def network():
+    return get('network')
+
+
+def invalidate(fact=None):
+    """
+    Forget one fact, or all of them, here and in the snapshot
+    """
+    with _lock:
+        if fact is None:
+            _facts.clear()
+            snapshot.remove(settings['path'])
+        else:
+            _facts.pop(fact, None)
+            if settings['ttl']:
+                snapshot.save(settings['path'], _facts)
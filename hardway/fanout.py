@@ -0,0 +1,206 @@
+"""
+Run the per-host body of a setup task on many hosts at once.
+
+Tasks in fabfile.py used to walk ``for i in range(0, 3)`` one host after the
+other. ``execute`` hands every item to a bounded thread pool instead, keeps the
+output of each host in its own buffer and prints it as one block when the host
+is done, so logs of concurrent hosts don't interleave.
+"""
+import sys
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, FIRST_EXCEPTION, ALL_COMPLETED, wait
+
+from fabric.api import abort
+from fabric.state import output
+
+FAIL_FAST = 'fail-fast'
+COLLECT = 'collect'
+
+settings = {
+    'parallel': 10,
+    'mode': FAIL_FAST,
+}
+
+# callables wrapper(func, name) -> func applied to every per-host body, so
+# other modules (e.g. pipeline.py) can hook into each host's run
+wrappers = []
+
+_state = threading.local()
+_print_lock = threading.Lock()
+_quiet_lock = threading.Lock()
+_quiet_depth = [0, None]
+
+
+class HostFailure(object):
+    """
+    Error raised by the body of one host
+    """
+    def __init__(self, host, error):
+        self.host = host
+        self.error = error
+
+    def __str__(self):
+        return '{0}: {1}'.format(self.host, describe_error(self.error))
+
+
+def describe_error(error):
+    if isinstance(error, SystemExit):
+        # fabric's abort() exits with the message already printed
+        return 'aborted'
+    return '{0}: {1}'.format(type(error).__name__, error)
+
+
+def configure(parallel=None, mode=None):
+    if parallel is not None:
+        parallel = int(parallel)
+        if parallel < 1:
+            raise ValueError('parallel must be at least 1, got {0}'.format(parallel))
+        settings['parallel'] = parallel
+    if mode is not None:
+        if mode not in (FAIL_FAST, COLLECT):
+            raise ValueError('mode must be {0!r} or {1!r}, got {2!r}'.format(FAIL_FAST, COLLECT, mode))
+        settings['mode'] = mode
+
+
+def current_host():
+    """
+    Name of the host whose body runs in this thread, None outside execute()
+    """
+    return getattr(_state, 'host', None)
+
+
+def capturing():
+    """
+    True when output should go to the per-host buffer instead of stdout
+    """
+    return getattr(_state, 'buffer', None) is not None
+
+
+def log(text):
+    """
+    Write text to the buffer of the current host, or straight to stdout
+    """
+    if not text:
+        return
+    buf = getattr(_state, 'buffer', None)
+    if buf is None:
+        with _print_lock:
+            sys.stdout.write('{0}\n'.format(text))
+            sys.stdout.flush()
+    else:
+        buf.append(text)
+
+
+def _flush(host, lines):
+    if not lines:
+        return
+    with _print_lock:
+        for text in lines:
+            for line in str(text).splitlines():
+                sys.stdout.write('[{0}] {1}\n'.format(host, line))
+        sys.stdout.flush()
+
+
+@contextmanager
+def _quiet():
+    """
+    Like fabric's hide('running'), but safe when several execute() calls run
+    at once: the first one in hides, the last one out restores
+    """
+    with _quiet_lock:
+        if _quiet_depth[0] == 0:
+            _quiet_depth[1] = output['running']
+            output['running'] = False
+        _quiet_depth[0] += 1
+    try:
+        yield
+    finally:
+        with _quiet_lock:
+            _quiet_depth[0] -= 1
+            if _quiet_depth[0] == 0:
+                output['running'] = _quiet_depth[1]
+
+
+def _run_one(func, item, host):
+    _state.host = host
+    _state.buffer = []
+    try:
+        return func(item)
+    finally:
+        lines = _state.buffer
+        _state.host = None
+        _state.buffer = None
+        _flush(host, lines)
+
+
+def execute(func, items, name=str, parallel=None, mode=None):
+    """
+    Call func(item) for every item concurrently and return {name(item): result}.
+
+    At most ``parallel`` bodies run at the same time. In fail-fast mode the
+    first failure stops hosts that have not started yet; in collect mode every
+    host runs and all failures are reported together. Either way the task
+    aborts if any host failed.
+    """
+    items = list(items)
+    parallel = int(parallel or settings['parallel'])
+    mode = mode or settings['mode']
+    names = [name(item) for item in items]
+    if not items:
+        return {}
+    for wrap in wrappers:
+        func = wrap(func, name)
+    if parallel == 1 or len(items) == 1:
+        return _execute_serial(func, items, names, mode)
+
+    results = {}
+    failures = []
+    # fabric echoes every local() as it starts; hosts log their own commands
+    # into their buffers instead
+    with _quiet(), ThreadPoolExecutor(max_workers=min(parallel, len(items))) as pool:
+        futures = dict(
+            (pool.submit(_run_one, func, item, host), host)
+            for item, host in zip(items, names))
+        done, pending = wait(futures, return_when=FIRST_EXCEPTION if mode == FAIL_FAST else ALL_COMPLETED)
+        for future in pending:
+            future.cancel()
+        wait(pending)
+        for future, host in futures.items():
+            if future.cancelled():
+                continue
+            error = future.exception()
+            if error is None:
+                results[host] = future.result()
+            else:
+                failures.append(HostFailure(host, error))
+    _report(failures, names)
+    return results
+
+
+def _execute_serial(func, items, names, mode):
+    results = {}
+    failures = []
+    for item, host in zip(items, names):
+        _state.host = host
+        try:
+            results[host] = func(item)
+        except BaseException as error:
+            if isinstance(error, KeyboardInterrupt):
+                raise
+            failures.append(HostFailure(host, error))
+            if mode == FAIL_FAST:
+                break
+        finally:
+            _state.host = None
+    _report(failures, names)
+    return results
+
+
+def _report(failures, names):
+    if not failures:
+        return
+    order = dict((host, i) for i, host in enumerate(names))
+    failures.sort(key=lambda f: order[f.host])
+    abort('{0} of {1} hosts failed:\n  {2}'.format(
+        len(failures), len(names), '\n  '.join(str(f) for f in failures)))
@@ -0,0 +1,259 @@
+"""
+Wait for the cluster's endpoints to become healthy, all of them at once.
+
+``verify_etcd`` and ``setup_kubectl`` checked one thing at a time, once, right
+after the daemons were started, so they either raced the daemons or needed
+manual sleeps. Here every check (etcd ``/health``, ``/healthz`` of every API
+server and kubelet, node Ready) runs concurrently on one asyncio loop and is
+retried with exponential backoff until it passes or its deadline runs out.
+Connections are kept alive and reused between the retries of an endpoint, so
+a check that polls for a minute does one TLS handshake, not a hundred. The
+result is a report with the attempts and latency of every check.
+"""
+import asyncio
+import json
+import ssl
+import time
+
+settings = {
+    # seconds for one request, for a check to pass, and between the first retries
+    'timeout': 2.0,
+    'deadline': 60.0,
+    'backoff': 0.25,
+    'max_backoff': 5.0,
+}
+
+
+class Check(object):
+    """
+    A GET of path on host:port, healthy when expect(status, body) returns
+    None; expect returns the problem otherwise. server_name is the name the
+    server's certificate is checked against when it isn't host.
+    """
+    def __init__(self, name, host, port, path, context=None, server_name=None, expect=None, deadline=None):
+        self.name = name
+        self.host = host
+        self.port = int(port)
+        self.path = path
+        self.context = context
+        self.server_name = server_name
+        self.expect = expect or expect_status(200)
+        self.deadline = deadline
+
+
+class Result(object):
+    def __init__(self, check, ok, attempts, elapsed, latency=None, problem=None):
+        self.check = check
+        self.ok = ok
+        self.attempts = attempts
+        self.elapsed = elapsed
+        self.latency = latency
+        self.problem = problem
+
+    @property
+    def name(self):
+        return self.check.name
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'ok': self.ok,
+            'attempts': self.attempts,
+            'elapsed': round(self.elapsed, 3),
+            'latency': None if self.latency is None else round(self.latency, 3),
+            'problem': self.problem,
+        }
+
+
+def expect_status(status=200, body=None):
+    """
+    An expect for Check: the status, and the body if given, e.g. b'ok'
+    """
+    def expect(got_status, got_body):
+        if got_status != status:
+            return 'HTTP {0}'.format(got_status)
+        if body is not None and got_body.strip() != body:
+            return 'unexpected body {0!r}'.format(got_body[:80])
+        return None
+    return expect
+
+
+def expect_node_ready(status, body):
+    """
+    An expect for GET /api/v1/nodes/<name>: the node's Ready condition is True
+    """
+    if status != 200:
+        return 'HTTP {0}'.format(status)
+    for condition in json.loads(body.decode('utf-8')).get('status', {}).get('conditions', []):
+        if condition.get('type') == 'Ready':
+            return None if condition.get('status') == 'True' else 'not Ready: {0}'.format(condition.get('reason'))
+    return 'no Ready condition yet'
+
+
+def expect_etcd_health(status, body):
+    if status != 200:
+        return 'HTTP {0}'.format(status)
+    health = json.loads(body.decode('utf-8')).get('health')
+    return None if health in (True, 'true') else 'health is {0!r}'.format(health)
+
+
+def client_context(ca, cert=None, key=None):
+    """
+    TLS context that trusts ca and authenticates with cert and key
+    """
+    context = ssl.create_default_context(cafile=ca)
+    if cert:
+        context.load_cert_chain(cert, key)
+    return context
+
+
+class HTTPError(Exception):
+    pass
+
+
+class Pool(object):
+    """
+    Idle keep-alive connections by endpoint
+    """
+    def __init__(self):
+        self.idle = {}
+        self.opened = 0
+
+    def _key(self, check):
+        return (check.host, check.port, id(check.context), check.server_name)
+
+    async def get(self, check):
+        """
+        (status, body) of GET check.path, on an idle connection to the
+        endpoint if there is one
+        """
+        key = self._key(check)
+        idle = self.idle.setdefault(key, [])
+        if idle:
+            reader, writer = idle.pop()
+        else:
+            kwargs = {}
+            if check.context is not None:
+                kwargs = dict(ssl=check.context, server_hostname=check.server_name or check.host)
+            reader, writer = await asyncio.open_connection(check.host, check.port, **kwargs)
+            self.opened += 1
+        try:
+            status, body, reusable = await _request(reader, writer, check)
+        except BaseException:
+            writer.close()
+            raise
+        if reusable:
+            idle.append((reader, writer))
+        else:
+            writer.close()
+        return status, body
+
+    def close(self):
+        for connections in self.idle.values():
+            for _, writer in connections:
+                writer.close()
+        self.idle = {}
+
+
+async def _request(reader, writer, check):
+    writer.write('GET {0} HTTP/1.1\r\nHost: {1}:{2}\r\nAccept: */*\r\n\r\n'.format(
+        check.path, check.server_name or check.host, check.port).encode('ascii'))
+    await writer.drain()
+    status_line = await reader.readline()
+    if not status_line:
+        raise HTTPError('connection closed')
+    parts = status_line.decode('latin-1').split(None, 2)
+    if len(parts) < 2 or not parts[0].startswith('HTTP/'):
+        raise HTTPError('bad status line {0!r}'.format(status_line))
+    status = int(parts[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    reusable = headers.get('connection', '').lower() != 'close'
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                await reader.readline()
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()
+        body = b''.join(chunks)
+    elif 'content-length' in headers:
+        body = await reader.readexactly(int(headers['content-length']))
+    else:
+        body = await reader.read()
+        reusable = False
+    return status, body, reusable
+
+
+def _describe(error):
+    return str(error) or type(error).__name__
+
+
+async def probe(check, pool, clock=time.monotonic):
+    """
+    Poll check until it passes or its deadline runs out
+    """
+    deadline = float(check.deadline or settings['deadline'])
+    timeout = float(settings['timeout'])
+    backoff = float(settings['backoff'])
+    started = clock()
+    attempts = 0
+    latency = None
+    while True:
+        attempts += 1
+        sent = clock()
+        try:
+            status, body = await asyncio.wait_for(pool.get(check), timeout)
+            latency = clock() - sent
+            problem = check.expect(status, body)
+        except (OSError, asyncio.TimeoutError, HTTPError, ValueError, ssl.SSLError) as e:
+            problem = _describe(e)
+        if problem is None:
+            return Result(check, True, attempts, clock() - started, latency)
+        left = deadline - (clock() - started)
+        if left <= 0:
+            return Result(check, False, attempts, clock() - started, latency, problem)
+        await asyncio.sleep(min(backoff, left))
+        backoff = min(backoff * 2, float(settings['max_backoff']))
+
+
+async def probe_all(checks):
+    pool = Pool()
+    try:
+        return await asyncio.gather(*[probe(check, pool) for check in checks])
+    finally:
+        pool.close()
+
+
+def run(checks):
+    """
+    Run every check concurrently; returns their Results in order
+    """
+    checks = list(checks)
+    if not checks:
+        return []
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(probe_all(checks))
+    finally:
+        loop.close()
+
+
+def report(results):
+    """
+    The results as a table, slowest first
+    """
+    lines = ['{0:<32} {1:<6} {2:>8} {3:>10} {4:>10}  {5}'.format('check', 'status', 'attempts', 'latency', 'ready in', 'problem')]
+    for result in sorted(results, key=lambda r: -r.elapsed):
+        lines.append('{0:<32} {1:<6} {2:>8} {3:>10} {4:>9.2f}s  {5}'.format(
+            result.name, 'ok' if result.ok else 'FAIL', result.attempts,
+            '-' if result.latency is None else '{0:.1f}ms'.format(result.latency * 1000),
+            result.elapsed, result.problem or ''))
+    return '\n'.join(lines)
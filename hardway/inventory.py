@@ -0,0 +1,129 @@
+"""
+Instance metadata for the whole cluster from a single gcloud call.
+
+Tasks used to run ``gcloud compute instances describe`` once per host and per
+field. The inventory lists every instance tagged for the cluster in one call
+with a JSON projection, indexes them by name and keeps them in memory for the
+rest of the fab run. With a ttl set it is also kept in a snapshot file so the
+next fab run starts without a lookup.
+"""
+import json
+import threading
+
+import snapshot
+import topology
+from profiler import local
+
+settings = {
+    # the tag of the cluster's instances, the topology's name if None
+    'tag': None,
+    'path': '.inventory.json',
+    'ttl': 0,
+}
+
+FORMAT = ('json(name,zone.basename(),status,'
+          'networkInterfaces[0].networkIP,'
+          'networkInterfaces[0].accessConfigs[0].natIP,'
+          'metadata.items)')
+
+_lock = threading.Lock()
+_instances = None
+
+
+class Instance(object):
+    def __init__(self, name, internal_ip=None, external_ip=None, zone=None, status=None, metadata=None):
+        self.name = name
+        self.internal_ip = internal_ip
+        self.external_ip = external_ip
+        self.zone = zone
+        self.status = status
+        self.metadata = metadata or {}
+
+    @classmethod
+    def from_gcloud(cls, data):
+        interface = (data.get('networkInterfaces') or [{}])[0]
+        access = (interface.get('accessConfigs') or [{}])[0]
+        items = (data.get('metadata') or {}).get('items') or []
+        return cls(
+            name=data['name'],
+            internal_ip=interface.get('networkIP'),
+            external_ip=access.get('natIP'),
+            zone=data.get('zone'),
+            status=data.get('status'),
+            metadata=dict((item['key'], item.get('value')) for item in items))
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+    def __repr__(self):
+        return 'Instance({0!r}, internal_ip={1!r}, external_ip={2!r})'.format(
+            self.name, self.internal_ip, self.external_ip)
+
+
+def _tag():
+    return settings['tag'] or topology.current().name
+
+
+def configure(tag=None, path=None, ttl=None):
+    if tag is not None:
+        settings['tag'] = tag
+    if path is not None:
+        settings['path'] = path
+    if ttl is not None:
+        settings['ttl'] = float(ttl)
+
+
+def fetch():
+    """
+    List the cluster's instances with one gcloud call
+    """
+    output = local(
+        """gcloud compute instances list --filter "tags.items={0}" --format '{1}'""".format(_tag(), FORMAT),
+        capture=True)
+    return parse(output)
+
+
+def parse(output):
+    return dict((i.name, i) for i in (Instance.from_gcloud(d) for d in json.loads(output or '[]')))
+
+
+def instances():
+    """
+    All instances by name, fetched at most once per fab run (or per ttl)
+    """
+    global _instances
+    with _lock:
+        if _instances is None:
+            saved = snapshot.load(settings['path'], settings['ttl'])
+            if saved is not None:
+                _instances = dict((name, Instance(**data)) for name, data in saved.items())
+            else:
+                _instances = fetch()
+                if settings['ttl']:
+                    snapshot.save(settings['path'], dict((n, i.to_dict()) for n, i in _instances.items()))
+        return _instances
+
+
+def get(name):
+    try:
+        return instances()[name]
+    except KeyError:
+        raise KeyError('no instance named {0!r} tagged {1!r}'.format(name, _tag()))
+
+
+def internal_ip(name):
+    return get(name).internal_ip
+
+
+def external_ip(name):
+    return get(name).external_ip
+
+
+def invalidate():
+    """
+    Forget the cached instances, e.g. after creating or deleting some
+    """
+    global _instances
+    with _lock:
+        _instances = None
+        snapshot.remove(settings['path'])
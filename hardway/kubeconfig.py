@@ -0,0 +1,99 @@
+"""
+Write kubeconfig files without kubectl.
+
+``kubectl config set-cluster``, ``set-credentials``, ``set-context`` and
+``use-context`` each re-read and re-write the file and re-embed the certs. A
+kubeconfig is only a small YAML document, so it is built here from the CA and
+client certs (each file read once however many kubeconfigs embed it) and
+written with a single emit. The layout matches what kubectl writes.
+"""
+import base64
+import os
+
+import yaml
+
+import fanout
+
+CLUSTER = 'kubernetes-the-hard-way'
+
+
+class Spec(object):
+    """
+    One kubeconfig to write: who it authenticates as and against what server
+    """
+    def __init__(self, path, user, server, cert, key, ca='ca/ca.pem', cluster=CLUSTER, context='default'):
+        self.path = path
+        self.user = user
+        self.server = server
+        self.cert = cert
+        self.key = key
+        self.ca = ca
+        self.cluster = cluster
+        self.context = context
+
+
+def _data(pem):
+    return str(base64.b64encode(pem), 'ascii')
+
+
+def build(spec, files):
+    """
+    The kubeconfig for spec as a dict; files maps paths to their contents
+    """
+    return {
+        'apiVersion': 'v1',
+        'kind': 'Config',
+        'clusters': [{
+            'name': spec.cluster,
+            'cluster': {
+                'certificate-authority-data': _data(files[spec.ca]),
+                'server': 'https://{0}:6443'.format(spec.server),
+            },
+        }],
+        'users': [{
+            'name': spec.user,
+            'user': {
+                'client-certificate-data': _data(files[spec.cert]),
+                'client-key-data': _data(files[spec.key]),
+            },
+        }],
+        'contexts': [{
+            'name': spec.context,
+            'context': {
+                'cluster': spec.cluster,
+                'user': spec.user,
+            },
+        }],
+        'current-context': spec.context,
+        'preferences': {},
+    }
+
+
+def read_files(specs):
+    files = {}
+    for spec in specs:
+        for path in (spec.ca, spec.cert, spec.key):
+            if path not in files:
+                with open(path, 'rb') as f:
+                    files[path] = f.read()
+    return files
+
+
+def write(spec, files):
+    config = yaml.safe_dump(build(spec, files), default_flow_style=False)
+    # the file holds a private key
+    fd = os.open(spec.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    # the mode only applies to a new file; one kubectl wrote may be 0644
+    os.fchmod(fd, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(config)
+    return spec.path
+
+
+def generate(specs):
+    """
+    Write every kubeconfig in specs, concurrently
+    """
+    specs = list(specs)
+    files = read_files(specs)
+    return fanout.execute(lambda spec: write(spec, files), specs, name=lambda spec: spec.path)
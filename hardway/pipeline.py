@@ -0,0 +1,219 @@
+"""
+Run the setup tasks as a dependency graph that can be resumed.
+
+Re-running the steps after a failure used to redo everything: re-create the
+network (and fail), re-download binaries, re-issue certs and restart every
+daemon. A ``Pipeline`` knows which tasks depend on which, runs tasks whose
+dependencies are done concurrently, and records finished work in a JSON lines
+journal keyed by task, host and a hash of the task's inputs. Work already in
+the journal with the same input hash is skipped, so a re-run resumes where the
+last one failed; change an input and the task runs again.
+
+Per-host bodies run through ``fanout.execute`` inside a pipeline task are
+journaled host by host, so a task that failed on one host only re-runs there.
+A task can fan out more than once over the same hosts, so each host is
+journaled under the number of the fan-out in the task as well: finishing the
+first fan-out on a host does not skip the second one there.
+"""
+import glob
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from fabric.api import abort
+
+import fanout
+import profiler
+
+settings = {
+    'journal': '.journal.jsonl',
+    'parallel': 4,
+}
+
+_state = threading.local()
+
+
+class _Run(object):
+    """
+    The pipeline task running on this thread, and how many fan-outs it has
+    started so far
+    """
+    def __init__(self, journal, name, digest, force):
+        self.journal = journal
+        self.name = name
+        self.digest = digest
+        self.force = force
+        self.fanouts = 0
+
+
+class Journal(object):
+    """
+    Append-only record of finished (task, host, digest) entries
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # a line cut short by an interrupted run
+                        continue
+                    self.entries.add((entry['task'], entry['host'], entry['digest']))
+
+    def done(self, task, host, digest):
+        return (task, host or '', digest) in self.entries
+
+    def record(self, task, host, digest):
+        entry = {'task': task, 'host': host or '', 'digest': digest, 'time': time.time()}
+        with self.lock:
+            self.entries.add((task, entry['host'], digest))
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(entry, sort_keys=True) + '\n')
+
+    def forget(self, task=None):
+        with self.lock:
+            if task is None:
+                self.entries.clear()
+            else:
+                self.entries = set(e for e in self.entries if e[0] != task)
+            with open(self.path, 'w') as f:
+                for name, host, digest in sorted(self.entries):
+                    f.write(json.dumps({'task': name, 'host': host, 'digest': digest}, sort_keys=True) + '\n')
+
+
+class Task(object):
+    """
+    A fab task in the graph. inputs are file paths or globs whose contents,
+    and callables whose return values, make up the task's input hash.
+    """
+    def __init__(self, name, func, deps=(), inputs=()):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.inputs = list(inputs)
+
+    def digest(self):
+        h = hashlib.sha256(self.name.encode('utf-8'))
+        for source in self.inputs:
+            if callable(source):
+                h.update(repr(source()).encode('utf-8'))
+                continue
+            for path in sorted(glob.glob(source)) or [source]:
+                h.update(path.encode('utf-8'))
+                if os.path.isfile(path):
+                    with open(path, 'rb') as f:
+                        h.update(f.read())
+        return h.hexdigest()
+
+
+class Pipeline(object):
+    def __init__(self):
+        self.tasks = {}
+
+    def add(self, name, func, deps=(), inputs=()):
+        for dep in deps:
+            if dep not in self.tasks:
+                raise ValueError('{0} depends on unknown task {1}'.format(name, dep))
+        self.tasks[name] = Task(name, func, deps, inputs)
+
+    def closure(self, targets=None):
+        """
+        The tasks needed for targets (all tasks if None), dependencies first
+        """
+        if not targets:
+            return list(self.tasks)
+        needed = []
+        def visit(name):
+            if name not in self.tasks:
+                raise KeyError('unknown task {0!r}'.format(name))
+            if name in needed:
+                return
+            for dep in self.tasks[name].deps:
+                visit(dep)
+            needed.append(name)
+        for target in targets:
+            visit(target)
+        return needed
+
+    def run(self, targets=None, journal=None, parallel=None, force=False):
+        """
+        Run the tasks for targets, each as soon as its dependencies are done,
+        skipping those already in the journal with the same input hash. Stops
+        scheduling new tasks after the first failure.
+        """
+        journal = journal or Journal(settings['journal'])
+        parallel = int(parallel or settings['parallel'])
+        pending = self.closure(targets)
+        finished = set()
+        failed = []
+        running = {}
+        with ThreadPoolExecutor(max_workers=parallel) as pool:
+            while pending or running:
+                if not failed:
+                    for name in list(pending):
+                        if all(dep in finished for dep in self.tasks[name].deps if dep in self.tasks):
+                            pending.remove(name)
+                            running[pool.submit(self._run_task, self.tasks[name], journal, force)] = name
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    error = future.exception()
+                    if error is None:
+                        finished.add(name)
+                    else:
+                        failed.append((name, error))
+        if failed:
+            abort('pipeline stopped, failed: {0}; run it again to resume'.format(
+                ', '.join('{0} ({1})'.format(name, fanout.describe_error(error)) for name, error in failed)))
+        return finished
+
+    def _run_task(self, task, journal, force):
+        digest = task.digest()
+        if not force and journal.done(task.name, None, digest):
+            fanout.log('[pipeline] {0}: already done, skipping'.format(task.name))
+            return
+        fanout.log('[pipeline] {0}: running'.format(task.name))
+        _state.task = _Run(journal, task.name, digest, force)
+        try:
+            with profiler.step(task.name):
+                task.func()
+        finally:
+            _state.task = None
+        journal.record(task.name, None, digest)
+
+
+def _journal_hosts(func, name):
+    """
+    fanout wrapper: inside a pipeline task, skip hosts the journal already has
+    for this fan-out of the task and input hash, and record hosts as they
+    finish it
+    """
+    task = getattr(_state, 'task', None)
+    if task is None:
+        return func
+    task.fanouts += 1
+    fanout_number = task.fanouts
+    def run(item):
+        host = '{0}#{1}'.format(name(item), fanout_number)
+        if not task.force and task.journal.done(task.name, host, task.digest):
+            fanout.log('{0}: already done on this host, skipping'.format(task.name))
+            return None
+        result = func(item)
+        task.journal.record(task.name, host, task.digest)
+        return result
+    return run
+
+
+fanout.wrappers.append(_journal_hosts)
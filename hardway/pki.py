@@ -0,0 +1,255 @@
+"""
+Issue the cluster certificates in-process instead of through cfssl.
+
+``cfssl gencert | cfssljson`` re-parses the CA key and ca-config.json for every
+cert, one cert at a time. This module reads the same ``*-csr.json`` files and
+the ``kubernetes`` profile of ``ca/ca-config.json``, loads the CA once per
+worker process and generates keys and signs certs in a process pool, so RSA
+key generation uses every core. Files are written with the names cfssljson
+uses (``worker-0.pem``, ``worker-0-key.pem``, ``worker-0.csr``).
+"""
+import datetime
+import ipaddress
+import json
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+from cryptography.x509.oid import ExtendedKeyUsageOID, NameOID
+
+CA_EXPIRY = '43800h'
+# cfssl backdates certs so small clock skew between hosts doesn't matter
+BACKDATE = datetime.timedelta(minutes=5)
+
+NAME_FIELDS = (
+    ('C', NameOID.COUNTRY_NAME),
+    ('ST', NameOID.STATE_OR_PROVINCE_NAME),
+    ('L', NameOID.LOCALITY_NAME),
+    ('O', NameOID.ORGANIZATION_NAME),
+    ('OU', NameOID.ORGANIZATIONAL_UNIT_NAME),
+)
+
+KEY_USAGES = {
+    'signing': 'digital_signature',
+    'digital signature': 'digital_signature',
+    'key encipherment': 'key_encipherment',
+    'cert sign': 'key_cert_sign',
+    'crl sign': 'crl_sign',
+}
+
+EXTENDED_KEY_USAGES = {
+    'server auth': ExtendedKeyUsageOID.SERVER_AUTH,
+    'client auth': ExtendedKeyUsageOID.CLIENT_AUTH,
+}
+
+
+class CertRequest(object):
+    """
+    A cert to issue from csr (a cfssl csr json file or its parsed dict) to
+    the files starting with out, e.g. out='kubelet/worker-0' writes kubelet/worker-0.pem
+    """
+    def __init__(self, csr, out, hostnames=()):
+        self.csr = csr
+        self.out = out
+        self.hostnames = [h for h in hostnames if h]
+
+
+def parse_duration(value):
+    """
+    cfssl expiries are Go durations, in practice always hours like '8760h'
+    """
+    match = re.match(r'^(\d+)h$', value)
+    if not match:
+        raise ValueError('unsupported expiry {0!r}, expected hours like 8760h'.format(value))
+    return datetime.timedelta(hours=int(match.group(1)))
+
+
+def load_csr(path):
+    """
+    A cfssl csr json file, or the already parsed csr if path is a dict
+    """
+    if isinstance(path, dict):
+        return path
+    with open(path) as f:
+        return json.load(f)
+
+
+def load_profile(config_path, profile='kubernetes'):
+    with open(config_path) as f:
+        signing = json.load(f)['signing']
+    settings = dict(signing.get('default', {}))
+    settings.update(signing.get('profiles', {}).get(profile, {}))
+    return settings
+
+
+def subject(csr):
+    attributes = []
+    for name in csr.get('names', []):
+        for field, oid in NAME_FIELDS:
+            if name.get(field):
+                attributes.append(x509.NameAttribute(oid, name[field]))
+    if csr.get('CN'):
+        attributes.append(x509.NameAttribute(NameOID.COMMON_NAME, csr['CN']))
+    return x509.Name(attributes)
+
+
+def generate_key(csr):
+    spec = csr.get('key', {})
+    algo = spec.get('algo', 'rsa')
+    if algo == 'rsa':
+        return rsa.generate_private_key(public_exponent=65537, key_size=spec.get('size', 2048), backend=default_backend())
+    if algo == 'ecdsa':
+        curves = {256: ec.SECP256R1, 384: ec.SECP384R1, 521: ec.SECP521R1}
+        return ec.generate_private_key(curves[spec.get('size', 256)](), default_backend())
+    raise ValueError('unsupported key algorithm {0!r}'.format(algo))
+
+
+def subject_alt_names(hostnames):
+    names = []
+    for host in hostnames:
+        try:
+            names.append(x509.IPAddress(ipaddress.ip_address(host)))
+        except ValueError:
+            names.append(x509.DNSName(host))
+    return names
+
+
+def key_usage(usages, ca=False):
+    flags = dict((attr, False) for attr in (
+        'digital_signature', 'content_commitment', 'key_encipherment', 'data_encipherment',
+        'key_agreement', 'key_cert_sign', 'crl_sign', 'encipher_only', 'decipher_only'))
+    for usage in usages:
+        if usage in KEY_USAGES:
+            flags[KEY_USAGES[usage]] = True
+    if ca:
+        flags['key_cert_sign'] = flags['crl_sign'] = True
+    return x509.KeyUsage(**flags)
+
+
+def _pem_key(key):
+    return key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.TraditionalOpenSSL,
+        encryption_algorithm=serialization.NoEncryption())
+
+
+def _pem(obj):
+    return obj.public_bytes(serialization.Encoding.PEM)
+
+
+def _write(out, key, cert, csr=None):
+    fd = os.open(out + '-key.pem', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(_pem_key(key))
+    with open(out + '.pem', 'wb') as f:
+        f.write(_pem(cert))
+    if csr is not None:
+        with open(out + '.csr', 'wb') as f:
+            f.write(_pem(csr))
+
+
+def _signing_request(csr, key, hostnames):
+    builder = x509.CertificateSigningRequestBuilder().subject_name(subject(csr))
+    if hostnames:
+        builder = builder.add_extension(x509.SubjectAlternativeName(subject_alt_names(hostnames)), critical=False)
+    return builder.sign(key, hashes.SHA256(), default_backend())
+
+
+def init_ca(csr_path, out):
+    """
+    Self-signed CA like cfssl gencert -initca
+    """
+    csr = load_csr(csr_path)
+    key = generate_key(csr)
+    name = subject(csr)
+    now = datetime.datetime.utcnow()
+    expiry = parse_duration(csr.get('ca', {}).get('expiry', CA_EXPIRY))
+    cert = (x509.CertificateBuilder()
+            .subject_name(name)
+            .issuer_name(name)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - BACKDATE)
+            .not_valid_after(now + expiry)
+            .add_extension(key_usage([], ca=True), critical=True)
+            .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+            .add_extension(x509.SubjectKeyIdentifier.from_public_key(key.public_key()), critical=False)
+            .sign(key, hashes.SHA256(), default_backend()))
+    _write(out, key, cert, _signing_request(csr, key, []))
+    return out + '.pem'
+
+
+class Signer(object):
+    """
+    The CA key, cert and signing profile, loaded once
+    """
+    def __init__(self, ca_cert_pem, ca_key_pem, profile):
+        self.cert = x509.load_pem_x509_certificate(ca_cert_pem, default_backend())
+        self.key = serialization.load_pem_private_key(ca_key_pem, password=None, backend=default_backend())
+        self.profile = profile
+
+    def sign(self, request):
+        csr = load_csr(request.csr)
+        key = generate_key(csr)
+        now = datetime.datetime.utcnow()
+        usages = self.profile.get('usages', [])
+        builder = (x509.CertificateBuilder()
+                   .subject_name(subject(csr))
+                   .issuer_name(self.cert.subject)
+                   .public_key(key.public_key())
+                   .serial_number(x509.random_serial_number())
+                   .not_valid_before(now - BACKDATE)
+                   .not_valid_after(now + parse_duration(self.profile.get('expiry', '8760h')))
+                   .add_extension(key_usage(usages), critical=True)
+                   .add_extension(x509.BasicConstraints(ca=False, path_length=None), critical=True)
+                   .add_extension(x509.SubjectKeyIdentifier.from_public_key(key.public_key()), critical=False)
+                   .add_extension(x509.AuthorityKeyIdentifier.from_issuer_public_key(self.key.public_key()), critical=False))
+        extended = [EXTENDED_KEY_USAGES[u] for u in usages if u in EXTENDED_KEY_USAGES]
+        if extended:
+            builder = builder.add_extension(x509.ExtendedKeyUsage(extended), critical=False)
+        if request.hostnames:
+            builder = builder.add_extension(
+                x509.SubjectAlternativeName(subject_alt_names(request.hostnames)), critical=False)
+        cert = builder.sign(self.key, hashes.SHA256(), default_backend())
+        _write(request.out, key, cert, _signing_request(csr, key, request.hostnames))
+        return request.out + '.pem'
+
+
+_signer = None
+
+
+def _init_worker(ca_cert_pem, ca_key_pem, profile):
+    global _signer
+    _signer = Signer(ca_cert_pem, ca_key_pem, profile)
+
+
+def _sign(request):
+    return _signer.sign(request)
+
+
+def issue(requests, ca='ca/ca', config='ca/ca-config.json', profile='kubernetes', processes=None):
+    """
+    Issue every CertRequest, spread over a pool of processes that each load
+    the CA once. Returns the paths of the new certs in request order.
+    """
+    requests = list(requests)
+    if not requests:
+        return []
+    with open(ca + '.pem', 'rb') as f:
+        cert_pem = f.read()
+    with open(ca + '-key.pem', 'rb') as f:
+        key_pem = f.read()
+    settings = load_profile(config, profile)
+    if len(requests) == 1 or processes == 1:
+        signer = Signer(cert_pem, key_pem, settings)
+        return [signer.sign(request) for request in requests]
+    # issue() runs from pipeline threads while other tasks run; a forked child
+    # could inherit a lock another thread held, so the workers are spawned
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_worker, initargs=(cert_pem, key_pem, settings)) as pool:
+        return list(pool.map(_sign, requests))
@@ -0,0 +1,413 @@
+"""
+Compile tasks into a plan of operations instead of running them.
+
+Every task ran its side effects as it went, so the cost of a deploy in remote
+operations could only be found by running it, and nothing looked at the
+operations as a whole. While ``recording`` is on, ``profiler.local``,
+``run_command``, ``copy_files`` and ``upload_archive`` append an ``Op`` to the
+plan and return an empty, successful result instead; cloud resources are
+"created" through a backend that records the gcloud calls. Everything that
+happens in-process (rendering templates, issuing certs, filling the artifact
+cache) still happens, since the uploads need those files, and so do describes
+and lists unless ``settings['reads']`` is off, since certs and configs are
+made from their answers.
+
+Probes return nothing while recording, so the plan is the worst case: every
+file pushed, every component installed. ``optimize`` then drops repeated
+describes and uploads, merges the consecutive commands and uploads for a host
+into one session and groups the operations into waves that don't depend on
+each other. Ops recorded inside ``serial()`` (nodes rolled one at a time)
+keep their hosts one after the other in the waves; readiness waits are
+``WAIT`` ops, run in-process by ``execute`` and waited on like a barrier.
+Plans are saved as JSON, printed, diffed and run.
+"""
+import difflib
+import hashlib
+import itertools
+import json
+import threading
+from contextlib import contextmanager
+
+import fanout
+import profiler
+import provision
+import session
+
+LOCAL = 'local'
+RUN = 'run'
+COPY = 'copy'
+UPLOAD = 'upload'
+SESSION = 'session'
+WAIT = 'wait'
+
+settings = {
+    # run describes and lists while recording instead of answering them empty
+    'reads': True,
+}
+
+_lock = threading.Lock()
+_recording = [None]
+_state = threading.local()
+_serial_groups = itertools.count(1)
+
+
+class Op(object):
+    """
+    One operation: a local command (on behalf of host, if one is set), a
+    command run on host, files copied to host, an archive uploaded to host,
+    or a session of run/copy/upload items sent to host at once; or a wait
+    for the readiness checks in command, with the keyword arguments in args.
+    Ops with the same serial group run one host after the other.
+    """
+    def __init__(self, kind, host=None, command=None, files=(), items=(), step=None, serial=None, args=None):
+        self.kind = kind
+        self.host = host
+        self.command = command
+        self.files = [tuple(f) for f in files]
+        self.items = list(items)
+        self.step = step
+        self.serial = serial
+        self.args = dict(args or {})
+
+    @property
+    def describe_only(self):
+        return self.kind == LOCAL and self.host is None and profiler.classify(self.command) == 'describe'
+
+    @property
+    def barrier(self):
+        """
+        Local commands on no host's behalf may change anything, and readiness
+        waits are for everything before them, so everything before them has
+        to be done and everything after waits for them
+        """
+        if self.kind == WAIT:
+            return True
+        return self.kind == LOCAL and self.host is None and not self.describe_only
+
+    def key(self):
+        """
+        What makes two operations the same one, for deduplication
+        """
+        if self.kind == COPY:
+            return (COPY, self.host, tuple((_digest(f[0]),) + tuple(f[1:]) for f in self.files))
+        if self.kind == UPLOAD:
+            return (UPLOAD, self.host, _digest(self.command))
+        return (self.kind, self.host, self.command)
+
+    def cost(self):
+        """
+        {'ssh': n, 'scp': n, <class of a local command>: n} this op takes
+        """
+        if self.kind == LOCAL:
+            return {profiler.classify(self.command): 1}
+        if self.kind == WAIT:
+            return {}
+        if self.kind == RUN:
+            return {'ssh': 1}
+        if self.kind in (COPY, UPLOAD):
+            # one scp and the unpack over ssh
+            return {'scp': 1, 'ssh': 1}
+        return {'scp': len([i for i in self.items if i.kind in (COPY, UPLOAD)]), 'ssh': 1}
+
+    def summary(self):
+        where = self.host or '-'
+        if self.kind == LOCAL:
+            return '{0} local {1}'.format(where, self.command)
+        if self.kind == RUN:
+            return '{0} run {1}'.format(where, self.command)
+        if self.kind == COPY:
+            return '{0} copy {1}'.format(where, ' '.join(f[1] for f in self.files))
+        if self.kind == UPLOAD:
+            return '{0} upload {1}'.format(where, self.command)
+        if self.kind == WAIT:
+            return '{0} wait for {1}'.format(where, self.command)
+        copies = [i for i in self.items if i.kind in (COPY, UPLOAD)]
+        return '{0} session of {1} commands, {2} uploads'.format(where, len(self.items) - len(copies), len(copies))
+
+    def to_dict(self):
+        data = {'kind': self.kind, 'host': self.host, 'step': self.step}
+        if self.command is not None:
+            data['command'] = self.command
+        if self.files:
+            data['files'] = self.files
+        if self.items:
+            data['items'] = [item.to_dict() for item in self.items]
+        if self.serial is not None:
+            data['serial'] = self.serial
+        if self.args:
+            data['args'] = self.args
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['kind'], data.get('host'), data.get('command'), data.get('files', ()),
+                   [cls.from_dict(item) for item in data.get('items', ())], data.get('step'),
+                   data.get('serial'), data.get('args'))
+
+
+def _digest(path):
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except (IOError, OSError):
+        return path
+
+
+class Plan(object):
+    def __init__(self, ops=()):
+        self.ops = list(ops)
+
+    def add(self, op):
+        with _lock:
+            self.ops.append(op)
+
+    def cost(self):
+        total = {}
+        for op in self.ops:
+            for kind, n in op.cost().items():
+                total[kind] = total.get(kind, 0) + n
+        total['total'] = sum(total.values())
+        return total
+
+    def waves(self):
+        return waves(self.ops)
+
+    def lines(self, verbose=False):
+        lines = []
+        for i, wave in enumerate(self.waves()):
+            lines.append('wave {0}: {1} ops'.format(i, len(wave)))
+            for op in sorted(wave, key=lambda op: (op.host or '', op.summary())):
+                lines.append('  ' + op.summary())
+                if verbose:
+                    lines.extend('    ' + item.summary() for item in op.items)
+        cost = self.cost()
+        lines.append('cost: {0}'.format(', '.join('{0} {1}'.format(k, cost[k]) for k in sorted(cost))))
+        return lines
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({'ops': [op.to_dict() for op in self.ops]}, f, indent=1)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(Op.from_dict(data) for data in json.load(f)['ops'])
+
+
+### recording ##################################################################
+
+class _Output(str):
+    """
+    What fabric's local() returns, for a command that was only recorded
+    """
+    return_code = 0
+    succeeded = True
+    failed = False
+    stderr = ''
+
+
+def recording():
+    return _recording[0] is not None
+
+
+def record(op):
+    """
+    Add op to the plan being recorded; returns an empty successful output
+    """
+    if op.host is None and op.kind == LOCAL:
+        op.host = fanout.current_host()
+    op.step = profiler.current_step()
+    op.serial = getattr(_state, 'serial', None)
+    _recording[0].add(op)
+    return _Output('')
+
+
+def _intercept(command, capture):
+    if not recording():
+        return None
+    result = record(Op(LOCAL, command=command))
+    if settings['reads'] and profiler.classify(command) == 'describe':
+        # describes change nothing; their answers (instances, addresses) are
+        # what the rest of the plan is laid out from
+        return None
+    return result
+
+
+profiler.interceptors.append(_intercept)
+
+
+class _Backend(provision.GcloudBackend):
+    """
+    gcloud, with its calls recorded; a create is done as soon as it is made
+    """
+    def create(self, resource):
+        provision.GcloudBackend.create(self, resource)
+        return provision.Operation(resource, provision.DONE)
+
+
+provision.backends['plan'] = _Backend
+
+
+@contextmanager
+def serial():
+    """
+    Ops recorded in the with block on this thread go to their hosts one host
+    after the other, as they were recorded, in every plan made from them
+    """
+    previous = getattr(_state, 'serial', None)
+    _state.serial = next(_serial_groups)
+    try:
+        yield
+    finally:
+        _state.serial = previous
+
+
+@contextmanager
+def recorder():
+    """
+    Record instead of run inside the with block; yields the Plan
+    """
+    if recording():
+        raise RuntimeError('already recording a plan')
+    backend = provision.settings['backend']
+    _recording[0] = Plan()
+    provision.settings['backend'] = 'plan'
+    try:
+        yield _recording[0]
+    finally:
+        _recording[0] = None
+        provision.settings['backend'] = backend
+
+
+### optimizing #################################################################
+
+def dedupe(ops):
+    """
+    Drop describes repeated since the last barrier and uploads of the same
+    content to the same place on the same host
+    """
+    result = []
+    described = set()
+    uploaded = set()
+    for op in ops:
+        if op.barrier:
+            described = set()
+        elif op.describe_only:
+            if op.command in described:
+                continue
+            described.add(op.command)
+        elif op.kind in (COPY, UPLOAD):
+            if op.key() in uploaded:
+                continue
+            uploaded.add(op.key())
+        result.append(op)
+    return result
+
+
+def merge(ops):
+    """
+    Turn the run, copy and upload ops of a host up to its next local op or
+    the next barrier into one session, with consecutive copies packed
+    together. A session holds ops of one serial group only.
+    """
+    result = []
+    open_sessions = {}
+    for op in ops:
+        if op.barrier:
+            open_sessions = {}
+        if op.kind not in (RUN, COPY, UPLOAD):
+            open_sessions.pop(op.host, None)
+            result.append(op)
+            continue
+        current = open_sessions.get(op.host)
+        if current is None or current.serial != op.serial:
+            current = open_sessions[op.host] = Op(SESSION, op.host, step=op.step, serial=op.serial)
+            result.append(current)
+        last = current.items[-1] if current.items else None
+        if op.kind == COPY and last is not None and last.kind == COPY:
+            last.files.extend(op.files)
+        else:
+            current.items.append(Op(op.kind, op.host, op.command, op.files, step=op.step, serial=op.serial))
+    # a session of one item is just that item
+    return [op.items[0] if op.kind == SESSION and len(op.items) == 1 else op for op in result]
+
+
+def waves(ops):
+    """
+    Group ops so that every op comes after everything it depends on: the
+    previous op of its host, the previous barrier, for a barrier all earlier
+    ops, and for an op in a serial group every op of the group on the hosts
+    recorded before its own. Ops within a wave are independent.
+    """
+    levels = []
+    last_barrier = -1
+    last_by_host = {}
+    since_barrier = []
+    # serial group: [host, last level of the hosts before it, of the host]
+    groups = {}
+    for op in ops:
+        if op.barrier:
+            level = max(since_barrier + [last_barrier]) + 1
+            last_barrier = level
+            last_by_host = {}
+            since_barrier = []
+        else:
+            level = max(last_barrier, last_by_host.get(op.host, -1) if op.host else -1) + 1
+            if op.serial is not None:
+                group = groups.setdefault(op.serial, [op.host, -1, -1])
+                if group[0] != op.host:
+                    group[:] = [op.host, max(group[1], group[2]), -1]
+                level = max(level, group[1] + 1)
+                group[2] = max(group[2], level)
+            if op.host:
+                last_by_host[op.host] = level
+            since_barrier.append(level)
+        levels.append(level)
+    result = [[] for _ in range(max(levels) + 1)] if levels else []
+    for op, level in zip(ops, levels):
+        result[level].append(op)
+    return result
+
+
+def optimize(plan):
+    return Plan(merge(dedupe(plan.ops)))
+
+
+def diff(before, after, names=('before', 'after')):
+    return '\n'.join(difflib.unified_diff(before.lines(), after.lines(), names[0], names[1], lineterm=''))
+
+
+### running ####################################################################
+
+def execute(plan, run_command, copy_files, upload_archive, wait=None):
+    """
+    Run plan wave by wave, the ops of a wave concurrently, with the fabfile's
+    run_command, copy_files and upload_archive, and wait(checks, **args) for
+    readiness waits
+    """
+    def run_item(op):
+        if op.kind == RUN:
+            run_command(op.host, op.command)
+        elif op.kind == COPY:
+            copy_files(op.host, op.files)
+        elif op.kind == UPLOAD:
+            upload_archive(op.host, op.command)
+
+    def run_op(op):
+        if op.kind == LOCAL:
+            profiler.local(op.command)
+        elif op.kind == WAIT:
+            if wait is None:
+                raise ValueError('the plan waits for {0}, but there is nothing to wait with'.format(op.command))
+            wait(op.command, **op.args)
+        elif op.kind == SESSION:
+            with session.RemoteSession(op.host):
+                for item in op.items:
+                    run_item(item)
+        else:
+            run_item(op)
+
+    for i, wave in enumerate(plan.waves()):
+        fanout.log('[plan] wave {0}: {1} ops'.format(i, len(wave)))
+        names = dict((id(op), '{0}#{1}'.format(op.host or 'local', n)) for n, op in enumerate(wave))
+        fanout.execute(run_op, wave, name=lambda op: names[id(op)])
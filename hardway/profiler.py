@@ -0,0 +1,278 @@
+"""
+Where a run spends its time, call by call.
+
+A full ``step_01`` to ``step_08`` run takes about twenty minutes and every
+``local()`` in it was opaque. The modules run their shell commands through
+``local`` here instead of fabric's; with profiling on, every call is recorded
+with its wall time, host, step, class (ssh, scp, describe, gcloud, cfssl,
+kubectl, local), bytes and exit status, and so are ``run_command`` and
+``copy_files`` in the fabfile through ``span``. ``summary`` breaks the time
+down by step and class and lists the slowest calls; ``write_trace`` writes
+the spans as Chrome trace JSON (chrome://tracing, Perfetto), one row per
+thread, named after the host it worked on.
+"""
+import json
+import os
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+from fabric.api import env, local as fabric_local
+
+import fanout
+
+settings = {
+    'enabled': False,
+    'top': 10,
+}
+
+# callables interceptor(command, capture) -> result or None, asked before a
+# command runs; the first result is returned instead of running it (plan.py
+# records commands this way)
+interceptors = []
+
+_lock = threading.Lock()
+_state = threading.local()
+_spans = []
+_threads = {}
+_started = time.time()
+
+# command class: words that put a command in it, tried in order
+CLASSES = [
+    ('ssh', ('gcloud compute ssh',)),
+    ('scp', ('gcloud compute scp',)),
+    ('describe', (' describe ', ' list', 'get-value')),
+    ('gcloud', ('gcloud ',)),
+    ('cfssl', ('cfssl',)),
+    ('kubectl', ('kubectl ',)),
+]
+
+
+class Span(object):
+    def __init__(self, name, kind, host, step, start, duration, size=0, status=0, thread=None):
+        self.name = name
+        self.kind = kind
+        self.host = host
+        self.step = step
+        self.start = start
+        self.duration = duration
+        self.size = size
+        self.status = status
+        self.thread = thread
+
+    @property
+    def failed(self):
+        return self.status not in (0, None)
+
+
+def configure(enabled=None, top=None):
+    global _started
+    with _lock:
+        if enabled is not None:
+            settings['enabled'] = str(enabled).lower() in ('1', 'true', 'yes', 'y')
+            del _spans[:]
+            _threads.clear()
+            _started = time.time()
+        if top is not None:
+            settings['top'] = int(top)
+
+
+def classify(command):
+    for kind, words in CLASSES:
+        if any(word in command for word in words):
+            return kind
+    return 'local'
+
+
+def current_step():
+    """
+    The pipeline task or fab task this thread works for
+    """
+    return getattr(_state, 'step', None) or env.get('command') or 'main'
+
+
+@contextmanager
+def step(name):
+    previous = getattr(_state, 'step', None)
+    _state.step = name
+    try:
+        yield
+    finally:
+        _state.step = previous
+
+
+def _carry_step(func, name):
+    """
+    fanout wrapper: hosts run in pool threads, which get the step of the
+    thread that started them
+    """
+    name = getattr(_state, 'step', None)
+    if name is None:
+        return func
+    def run(item):
+        with step(name):
+            return func(item)
+    return run
+
+
+fanout.wrappers.append(_carry_step)
+
+
+def _record(span):
+    with _lock:
+        # pool threads move from host to host; each host gets its own row
+        thread = (threading.current_thread().ident, span.host)
+        if thread not in _threads:
+            _threads[thread] = (len(_threads) + 1, span.host or 'main')
+        span.thread = _threads[thread][0]
+        _spans.append(span)
+
+
+@contextmanager
+def span(name, kind=None, host=None, size=0):
+    """
+    Record the time the with block takes; status is 1 if it raises (or
+    aborts) and whatever the block sets on the yielded dict otherwise
+    """
+    if not settings['enabled']:
+        yield {}
+        return
+    info = {'status': 0, 'size': size}
+    start = time.time()
+    try:
+        yield info
+    except BaseException:
+        info['status'] = 1
+        raise
+    finally:
+        _record(Span(name, kind or classify(name), host or fanout.current_host(), current_step(),
+                     start, time.time() - start, info['size'], info['status']))
+
+
+def _scp_size(command):
+    return sum(os.path.getsize(word) for word in command.split() if os.path.isfile(word))
+
+
+class _Output(str):
+    """
+    What fabric's local(capture=True) returns
+    """
+
+
+def _checked(command):
+    """
+    Run command like fabric's local(capture=True) under warn_only, without
+    settings(): fabric's env is shared by every thread, so threads entering
+    and leaving settings() of their own restore each other's values
+    """
+    process = subprocess.run(command, shell=True, stdin=subprocess.DEVNULL,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    result = _Output(process.stdout.decode('utf-8', 'replace').strip())
+    result.stderr = process.stderr.decode('utf-8', 'replace').strip()
+    result.return_code = process.returncode
+    result.failed = process.returncode != 0
+    result.succeeded = not result.failed
+    result.command = command
+    return result
+
+
+def local(command, capture=False, warn_only=False, **kwargs):
+    """
+    fabric's local(), recorded when profiling is on. With warn_only the
+    output is captured and a failure is returned instead of aborting, as
+    under fabric's settings(warn_only=True), but safe to call from threads.
+    """
+    for intercept in interceptors:
+        result = intercept(command, capture)
+        if result is not None:
+            return result
+    if warn_only:
+        run = lambda: _checked(command)
+    else:
+        run = lambda: fabric_local(command, capture=capture, **kwargs)
+    if not settings['enabled']:
+        return run()
+    kind = classify(command)
+    with span(command, kind, size=_scp_size(command) if kind == 'scp' else 0) as info:
+        result = run()
+        info['status'] = result.return_code
+        if (capture or warn_only) and kind != 'scp':
+            info['size'] = len(result)
+    return result
+
+
+def spans():
+    with _lock:
+        return list(_spans)
+
+
+def _table(rows, headers):
+    widths = [max(len(str(row[i])) for row in rows + [headers]) for i in range(len(headers))]
+    return '\n'.join('  '.join(str(v).ljust(w) for v, w in zip(row, widths)).rstrip() for row in [headers] + rows)
+
+
+def summary(recorded=None):
+    """
+    Time by step (wall time and the calls' time by class), then the slowest
+    calls. Only shell calls count towards the classes; run_command and
+    copy_files spans contain them.
+    """
+    recorded = spans() if recorded is None else recorded
+    calls = [s for s in recorded if s.kind != 'op']
+    if not calls:
+        return 'nothing recorded'
+    kinds = sorted(set(s.kind for s in calls))
+    steps = []
+    for s in sorted(recorded, key=lambda s: s.start):
+        if s.step not in steps:
+            steps.append(s.step)
+    rows = []
+    for name in steps:
+        mine = [s for s in recorded if s.step == name]
+        wall = max(s.start + s.duration for s in mine) - min(s.start for s in mine)
+        row = [name, '{0:.1f}s'.format(wall), len([s for s in mine if s.kind != 'op'])]
+        for kind in kinds:
+            row.append('{0:.1f}s'.format(sum(s.duration for s in mine if s.kind == kind)))
+        row.append(len([s for s in mine if s.failed and s.kind != 'op']))
+        rows.append(row)
+    lines = [_table(rows, ['step', 'wall', 'calls'] + kinds + ['failed']), '']
+    rows = []
+    for kind in kinds:
+        mine = [s for s in calls if s.kind == kind]
+        total = sum(s.duration for s in mine)
+        rows.append([kind, len(mine), '{0:.1f}s'.format(total), '{0:.2f}s'.format(total / len(mine)),
+                     '{0:.2f}s'.format(max(s.duration for s in mine)), sum(s.size for s in mine)])
+    lines += [_table(rows, ['class', 'calls', 'total', 'mean', 'max', 'bytes']), '']
+    rows = [['{0:.2f}s'.format(s.duration), s.step, s.host or '-', s.status, s.name[:80]]
+            for s in sorted(calls, key=lambda s: -s.duration)[:settings['top']]]
+    lines.append(_table(rows, ['time', 'step', 'host', 'exit', 'command']))
+    return '\n'.join(lines)
+
+
+def trace(recorded=None):
+    """
+    The spans as a Chrome trace: complete events in microseconds, a thread
+    row per thread and host
+    """
+    recorded = spans() if recorded is None else recorded
+    events = []
+    with _lock:
+        threads = list(_threads.values())
+    for tid, host in threads:
+        events.append({'ph': 'M', 'name': 'thread_name', 'pid': 1, 'tid': tid, 'args': {'name': host}})
+    for s in recorded:
+        events.append({
+            'ph': 'X', 'pid': 1, 'tid': s.thread,
+            'name': s.name if len(s.name) <= 60 else s.name[:57] + '...',
+            'cat': '{0},{1}'.format(s.step, s.kind),
+            'ts': int((s.start - _started) * 1e6), 'dur': int(s.duration * 1e6),
+            'args': {'command': s.name, 'host': s.host, 'step': s.step, 'class': s.kind,
+                     'bytes': s.size, 'exit': s.status},
+        })
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def write_trace(path):
+    with open(path, 'w') as f:
+        json.dump(trace(), f)
@@ -0,0 +1,306 @@
+"""
+Create the cloud resources of the cluster concurrently and wait for them.
+
+``networking``, ``firewall_rules`` and ``setup_pod_routes`` ran one gcloud
+call after the other, and ``create_controllers``/``create_workers`` started
+instances with ``--async`` and never waited for them. Here every resource is
+a ``Resource`` with the resources it depends on; all resources whose
+dependencies exist are created at once, instances asynchronously, and the
+pending operations are polled together in one call per round until they are
+done. The compute API sits behind a backend, ``GcloudBackend`` for the real
+thing and ``FakeBackend`` to exercise the scheduling without a cloud.
+"""
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import fanout
+from profiler import local
+
+settings = {
+    'backend': 'gcloud',
+    'parallel': 16,
+    # seconds between polls of the pending operations, doubling up to max_interval
+    'interval': 1.0,
+    'max_interval': 10.0,
+    'timeout': 600,
+}
+
+PENDING = 'PENDING'
+RUNNING = 'RUNNING'
+DONE = 'DONE'
+
+
+class ProvisionError(Exception):
+    pass
+
+
+class Resource(object):
+    """
+    One resource to create, e.g. Resource('firewall-rules', 'kubernetes-the-hard-way-allow-internal',
+    '--allow tcp,udp,icmp --network kubernetes-the-hard-way', deps=['networks/kubernetes-the-hard-way'])
+    """
+    def __init__(self, kind, name, args='', deps=()):
+        self.kind = kind
+        self.name = name
+        self.args = args
+        self.deps = list(deps)
+
+    @property
+    def key(self):
+        return '{0}/{1}'.format(self.kind.replace(' ', '-'), self.name)
+
+    def __repr__(self):
+        return 'Resource({0!r})'.format(self.key)
+
+
+class Operation(object):
+    def __init__(self, resource, status=PENDING, error=None):
+        self.resource = resource
+        self.status = status
+        self.error = error
+
+    @property
+    def done(self):
+        return self.status == DONE
+
+
+class GcloudBackend(object):
+    """
+    gcloud compute. Instances are created with --async and their insert
+    operations polled with one operations list; everything else is created
+    by a blocking call, several at a time. Calls don't abort on failure and
+    don't touch fabric's env, so they can be made from several threads.
+    """
+    ASYNC_KINDS = ('instances',)
+
+    def _run(self, command):
+        return local(command, capture=True, warn_only=True)
+
+    def create(self, resource):
+        asynchronous = resource.kind in self.ASYNC_KINDS
+        command = 'gcloud compute {0} create {1} {2}{3}'.format(
+            resource.kind, resource.name, resource.args, ' --async' if asynchronous else '')
+        fanout.log(command)
+        result = self._run(command)
+        if result.failed:
+            if 'already exists' in result.stderr:
+                return Operation(resource, DONE)
+            return Operation(resource, DONE, error=result.stderr.strip() or 'exit code {0}'.format(result.return_code))
+        return Operation(resource, RUNNING if asynchronous else DONE)
+
+    def poll(self, operations):
+        """
+        Update the status of every operation with one operations list
+        """
+        names = '|'.join(operation.resource.name for operation in operations)
+        result = self._run(
+            'gcloud compute operations list --filter="operationType=insert AND targetLink ~ /({0})$" '
+            '--sort-by=insertTime --format="value(targetLink.basename(),status,error.errors[0].message)"'.format(names))
+        latest = {}
+        for line in result.splitlines():
+            fields = line.split('\t')
+            if len(fields) >= 2:
+                # sorted by insert time, so the last line is the newest insert
+                latest[fields[0]] = fields[1:]
+        for operation in operations:
+            status = latest.get(operation.resource.name)
+            if status:
+                operation.status = status[0]
+                if len(status) > 1 and status[1]:
+                    operation.error = status[1]
+
+    def list(self, kind, filter):
+        result = self._run('gcloud compute {0} list --filter="{1}" --format="value(name)"'.format(kind, filter))
+        if result.failed:
+            raise ProvisionError('listing {0}: {1}'.format(kind, result.stderr.strip()))
+        return [name for name in result.split() if name]
+
+    def delete(self, kind, names, args=''):
+        """
+        Delete names of one kind in one call; returns the error or None
+        """
+        command = 'gcloud -q compute {0} delete {1} {2}'.format(kind, ' '.join(names), args)
+        fanout.log(command)
+        result = self._run(command)
+        if result.failed and 'was not found' not in result.stderr:
+            return result.stderr.strip() or 'exit code {0}'.format(result.return_code)
+        return None
+
+
+class FakeBackend(object):
+    """
+    An in-memory compute API. Creating a resource takes latency[kind] seconds
+    (default latency for kinds not listed), blocking for blocking kinds and in
+    the background for the others; resources named in failing fail. Keeps the
+    calls made and the most creates in flight at once.
+    """
+    ASYNC_KINDS = ('instances',)
+
+    def __init__(self, latency=None, default=0.05, failing=()):
+        self.latency = dict(latency or {})
+        self.default = default
+        self.failing = set(failing)
+        self.lock = threading.Lock()
+        self.resources = {}
+        self.finish = {}
+        self.calls = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def _latency(self, resource):
+        return self.latency.get(resource.kind, self.default)
+
+    def create(self, resource):
+        with self.lock:
+            self.calls.append(('create', resource.key))
+            if resource.key in self.resources:
+                return Operation(resource, DONE)
+            missing = [dep for dep in resource.deps if dep not in self.resources]
+            if missing:
+                return Operation(resource, DONE, error='depends on missing {0}'.format(', '.join(missing)))
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        if resource.kind in self.ASYNC_KINDS:
+            with self.lock:
+                self.finish[resource.key] = time.time() + self._latency(resource)
+            return Operation(resource, RUNNING)
+        time.sleep(self._latency(resource))
+        return self._complete(Operation(resource, RUNNING))
+
+    def _complete(self, operation):
+        with self.lock:
+            self.in_flight -= 1
+            if operation.resource.name in self.failing:
+                operation.error = 'simulated failure'
+            else:
+                self.resources[operation.resource.key] = operation.resource
+            operation.status = DONE
+        return operation
+
+    def poll(self, operations):
+        with self.lock:
+            self.calls.append(('poll', len(operations)))
+        now = time.time()
+        for operation in operations:
+            if self.finish.get(operation.resource.key, now) <= now:
+                self._complete(operation)
+
+    @staticmethod
+    def _flag(resource, flag):
+        args = resource.args.split()
+        return args[args.index(flag) + 1] if flag in args[:-1] else None
+
+    def _matches(self, resource, term):
+        """
+        The filter terms teardown uses: name=, name ~ regex, network: and
+        tags.items=
+        """
+        if term.startswith('name ~ '):
+            return re.search(term[len('name ~ '):], resource.name) is not None
+        if term.startswith('name='):
+            return resource.name == term[len('name='):]
+        if term.startswith('network:'):
+            return self._flag(resource, '--network') == term[len('network:'):]
+        if term.startswith('tags.items='):
+            return term[len('tags.items='):] in (self._flag(resource, '--tags') or '').split(',')
+        raise ValueError('unsupported filter {0}'.format(term))
+
+    def list(self, kind, filter):
+        """
+        The resources of kind matching filter, terms joined with AND
+        """
+        terms = [term.strip() for term in filter.split(' AND ') if term.strip()]
+        with self.lock:
+            self.calls.append(('list', kind))
+            return sorted(resource.name for resource in self.resources.values()
+                          if resource.kind == kind and all(self._matches(resource, term) for term in terms))
+
+    def delete(self, kind, names, args=''):
+        """
+        Like GcloudBackend.delete, failing for resources others still depend on
+        """
+        keys = [Resource(kind, name).key for name in names]
+        with self.lock:
+            self.calls.append(('delete', kind, len(names)))
+            users = [other.key for other in self.resources.values()
+                     if other.key not in keys and any(dep in keys for dep in getattr(other, 'deps', ()))]
+            if users:
+                return 'in use by {0}'.format(', '.join(sorted(users)))
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.latency.get(kind, self.default))
+        with self.lock:
+            self.in_flight -= 1
+            for key in keys:
+                self.resources.pop(key, None)
+        return None
+
+
+# name: backend class, so other modules can add backends (plan.py records
+# the gcloud calls instead of making them)
+backends = {'gcloud': GcloudBackend}
+
+
+def backend():
+    if settings['backend'] == 'fake':
+        if not isinstance(getattr(backend, 'fake', None), FakeBackend):
+            backend.fake = FakeBackend()
+        return backend.fake
+    return backends[settings['backend']]()
+
+
+def create(resources, compute=None, parallel=None):
+    """
+    Create resources, each as soon as the ones it depends on are done, and
+    wait until all of them are. Dependencies outside resources are taken to
+    exist already. Raises ProvisionError listing what failed.
+    """
+    compute = compute or backend()
+    resources = list(resources)
+    keys = set(resource.key for resource in resources)
+    waiting = list(resources)
+    done = set()
+    failed = []
+    creating = {}
+    pending = []
+    interval = float(settings['interval'])
+    deadline = time.time() + float(settings['timeout'])
+    with ThreadPoolExecutor(max_workers=int(parallel or settings['parallel'])) as pool:
+        while waiting or creating or pending:
+            if not failed:
+                for resource in list(waiting):
+                    if all(dep in done or dep not in keys for dep in resource.deps):
+                        waiting.remove(resource)
+                        creating[pool.submit(compute.create, resource)] = resource
+            elif not creating and not pending:
+                break
+            if creating:
+                finished, _ = wait(creating, timeout=interval if pending else None, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    resource = creating.pop(future)
+                    try:
+                        operation = future.result()
+                    except Exception as e:
+                        operation = Operation(resource, DONE, error=fanout.describe_error(e))
+                    pending.append(operation)
+            elif pending:
+                time.sleep(interval)
+                interval = min(interval * 2, float(settings['max_interval']))
+            running = [operation for operation in pending if not operation.done]
+            if running:
+                compute.poll(running)
+            for operation in [operation for operation in pending if operation.done]:
+                pending.remove(operation)
+                if operation.error:
+                    failed.append(operation)
+                else:
+                    done.add(operation.resource.key)
+                    fanout.log('created {0}'.format(operation.resource.key))
+            if time.time() > deadline:
+                raise ProvisionError('timed out waiting for {0}'.format(
+                    ', '.join(operation.resource.key for operation in pending)))
+    if failed:
+        raise ProvisionError('; '.join('{0}: {1}'.format(o.resource.key, o.error) for o in failed))
+    return done
@@ -0,0 +1,383 @@
+"""
+Rotate the key Secrets are encrypted with, and re-encrypt them all.
+
+``setup_encryption`` rendered a single fresh key into the encryption config
+every time it ran, so there was no way to change the key, and running it
+twice locked the API servers out of every Secret written before. The keys
+now live in a keyring (``encryption/keys.json``), rendered in order: the
+API servers encrypt with the first key and decrypt with any. A rotation goes
+through ``PHASES``, each rolled out to one controller at a time:
+
+- add: the new key goes last, so every API server can read it before any
+  writes with it
+- promote: the new key goes first, so new writes use it
+- rewrite: every Secret is read and written back, which encrypts it with the
+  new key
+- prune: the old keys are dropped
+
+The rewrite lists Secrets a page at a time and writes them back from a small
+thread pool held to ``settings['rate']`` writes per second, so it doesn't
+flood the API servers and etcd. After every page the list position is saved,
+and so is the phase after each phase, so an interrupted rotation carries on
+where it stopped. ``FakeApi`` is an in-memory API server for the rewrite.
+"""
+import base64
+import http.client
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urlencode
+
+import yaml
+
+import snapshot
+
+settings = {
+    'keys': 'encryption/keys.json',
+    'config': 'encryption/encryption-config.yaml',
+    'state': 'encryption/rotation.json',
+    # Secrets written back per second, writers at once, Secrets per list page
+    'rate': 50.0,
+    'parallel': 4,
+    'page': 500,
+    # tries of a write that is throttled or fails on the server
+    'retries': 5,
+    'backoff': 1.0,
+}
+
+PHASES = ('add', 'promote', 'rewrite', 'prune')
+
+
+class RotationError(Exception):
+    pass
+
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        Exception.__init__(self, '{0}: {1}'.format(status, message))
+        self.status = status
+
+
+### keys #######################################################################
+
+def new_secret():
+    return base64.b64encode(os.urandom(32)).decode('ascii')
+
+
+class Keyring(object):
+    """
+    The aescbc keys in the order they go into the encryption config
+    """
+    def __init__(self, keys=None):
+        self.keys = list(keys or [])
+
+    @property
+    def primary(self):
+        return self.keys[0]['name'] if self.keys else None
+
+    def next_name(self):
+        numbers = [int(key['name'][3:]) for key in self.keys if key['name'][3:].isdigit()]
+        return 'key{0}'.format(max(numbers + [0]) + 1)
+
+    def add(self, name=None):
+        """
+        A new key, last: decrypts, but nothing is written with it yet. Adding
+        a name that is there already does nothing, so a phase can run again.
+        """
+        name = name or self.next_name()
+        if name not in [key['name'] for key in self.keys]:
+            self.keys.append({'name': name, 'secret': new_secret()})
+        return name
+
+    def promote(self, name):
+        key = [k for k in self.keys if k['name'] == name]
+        if not key:
+            raise RotationError('no key named {0!r} in the keyring'.format(name))
+        self.keys = key + [k for k in self.keys if k['name'] != name]
+
+    def prune(self):
+        """
+        Drop every key but the one written with
+        """
+        dropped = [k['name'] for k in self.keys[1:]]
+        self.keys = self.keys[:1]
+        return dropped
+
+    def save(self, path=None):
+        snapshot.save(path or settings['keys'], {'keys': self.keys})
+
+    @classmethod
+    def load(cls, path=None, config=None):
+        """
+        The keyring at path; a cluster set up before there was one has its
+        key in the rendered config only, so it is taken from there
+        """
+        path = path or settings['keys']
+        config = config or settings['config']
+        if os.path.exists(path):
+            with open(path) as f:
+                return cls(json.load(f)['keys'])
+        if os.path.exists(config):
+            with open(config) as f:
+                data = yaml.safe_load(f)
+            keys = []
+            for resource in data.get('resources', []):
+                for provider in resource.get('providers', []):
+                    keys.extend(provider.get('aescbc', {}).get('keys', []))
+            return cls(keys)
+        return cls()
+
+
+class State(object):
+    """
+    How far a rotation got: the key being rotated to, the phases done, and
+    where the rewrite's listing stands
+    """
+    def __init__(self, key=None, done=(), checkpoint=None):
+        self.key = key
+        self.done = list(done)
+        self.checkpoint = checkpoint or {}
+
+    @property
+    def pending(self):
+        return [phase for phase in PHASES if phase not in self.done]
+
+    def save(self, path=None):
+        snapshot.save(path or settings['state'], {'key': self.key, 'done': self.done, 'checkpoint': self.checkpoint})
+
+    @classmethod
+    def load(cls, path=None):
+        path = path or settings['state']
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            data = json.load(f)
+        return cls(data['key'], data['done'], data['checkpoint'])
+
+    @staticmethod
+    def remove(path=None):
+        snapshot.remove(path or settings['state'])
+
+
+### rate limiting ##############################################################
+
+class RateLimiter(object):
+    """
+    A token bucket: rate tokens a second, at most burst saved up; acquire
+    waits for one
+    """
+    def __init__(self, rate, burst=1, clock=time.time, sleep=time.sleep):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = self.burst
+        self.updated = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = self.clock()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                # a sleep of exactly the wait can leave the token a rounding
+                # error short, and a wait that small doesn't move the clock
+                if self.tokens >= 1 - 1e-9:
+                    self.tokens = max(self.tokens - 1, 0.0)
+                    return
+                wait = (1 - self.tokens) / self.rate
+            self.sleep(wait)
+
+
+### API servers ################################################################
+
+class HttpApi(object):
+    """
+    The Secrets API of the API server at host:port, one kept-alive
+    connection per thread
+    """
+    def __init__(self, host, port, context):
+        self.host = host
+        self.port = int(port)
+        self.context = context
+        self._local = threading.local()
+
+    def _request(self, method, path, body=None):
+        for attempt in (1, 2):
+            connection = getattr(self._local, 'connection', None)
+            if connection is None:
+                connection = self._local.connection = http.client.HTTPSConnection(
+                    self.host, self.port, context=self.context, timeout=30)
+            try:
+                connection.request(method, path, body, {'Content-Type': 'application/json', 'Accept': 'application/json'})
+                response = connection.getresponse()
+                data = response.read()
+                break
+            except (http.client.HTTPException, OSError):
+                # the server closed a kept-alive connection; reconnect once
+                connection.close()
+                self._local.connection = None
+                if attempt == 2:
+                    raise
+        if response.status >= 300:
+            raise ApiError(response.status, data.decode('utf-8', 'replace')[:200])
+        return json.loads(data.decode('utf-8'))
+
+    def list(self, limit, token=None):
+        query = {'limit': limit}
+        if token:
+            query['continue'] = token
+        data = self._request('GET', '/api/v1/secrets?' + urlencode(query))
+        return data.get('items') or [], data.get('metadata', {}).get('continue') or None
+
+    def replace(self, secret):
+        metadata = secret['metadata']
+        path = '/api/v1/namespaces/{0}/secrets/{1}'.format(quote(metadata['namespace']), quote(metadata['name']))
+        # list items carry no kind, a PUT wants one
+        body = dict(secret, kind='Secret', apiVersion='v1')
+        return self._request('PUT', path, json.dumps(body))
+
+
+class FakeApi(object):
+    """
+    An in-memory API server holding count Secrets, each stamped with the key
+    it was last written with. Continue tokens expire after expire_after lists
+    if set; replaces of names in conflicts get a 409, as if another client
+    wrote them in between, of names in failing a 503 for the first failures
+    tries. It keeps the number of calls, the most
+    replaces in flight at once and when each replace happened.
+    """
+    def __init__(self, count, key='key1', latency=0.0, conflicts=(), failing=(), failures=1, expire_after=None):
+        self.secrets = [{'metadata': {'namespace': 'ns{0}'.format(i % 10), 'name': 'secret-{0}'.format(i),
+                                      'resourceVersion': '1'}, 'data': {}} for i in range(count)]
+        self.keys = dict((self._name(s), key) for s in self.secrets)
+        self.write_key = key
+        self.latency = latency
+        self.conflicts = set(conflicts)
+        self.failing = dict((name, failures) for name in failing)
+        self.expire_after = expire_after
+        self.lists = 0
+        self.replaces = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.times = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _name(secret):
+        return '{0}/{1}'.format(secret['metadata']['namespace'], secret['metadata']['name'])
+
+    def list(self, limit, token=None):
+        with self._lock:
+            self.lists += 1
+            if token and self.expire_after and self.lists > self.expire_after:
+                self.expire_after = None
+                raise ApiError(410, 'the continue token has expired')
+        start = int(token or 0)
+        items = [dict(s) for s in self.secrets[start:start + limit]]
+        end = start + len(items)
+        return items, str(end) if end < len(self.secrets) else None
+
+    def replace(self, secret):
+        name = self._name(secret)
+        with self._lock:
+            self.replaces += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            self.times.append(time.time())
+        try:
+            if self.latency:
+                time.sleep(self.latency)
+            with self._lock:
+                if name in self.conflicts:
+                    # someone else wrote it since it was read, with the write key
+                    self.keys[name] = self.write_key
+                    raise ApiError(409, 'the object has been modified')
+                if self.failing.get(name):
+                    self.failing[name] -= 1
+                    raise ApiError(503, 'unavailable')
+                self.keys[name] = self.write_key
+            return secret
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def stale(self):
+        """
+        Secrets still encrypted with another key than the write key
+        """
+        return sorted(name for name, key in self.keys.items() if key != self.write_key)
+
+
+### re-encryption ##############################################################
+
+def _rewrite(api, secret, retries, backoff, sleep):
+    """
+    Write secret back as it was read; 'done', or 'skipped' when it changed
+    (and so was already written with the new key) or went away since
+    """
+    for attempt in range(1, retries + 1):
+        try:
+            api.replace(secret)
+            return 'done'
+        except ApiError as e:
+            if e.status in (404, 409):
+                return 'skipped'
+            if (e.status != 429 and e.status < 500) or attempt == retries:
+                raise
+        sleep(backoff * 2 ** (attempt - 1))
+
+
+def reencrypt(api, checkpoint=None, save=None, rate=None, parallel=None, page=None, retries=None, backoff=None,
+              log=None, clock=time.time, sleep=time.sleep):
+    """
+    Read every Secret and write it back, a page at a time, at most rate
+    writes a second from parallel writers. After each page checkpoint (a dict:
+    continue token, counts) is updated and passed to save, and a run given
+    the saved checkpoint starts from there. clock and sleep pace the writes
+    and the retries. Returns the checkpoint.
+    """
+    rate = float(rate or settings['rate'])
+    parallel = int(parallel or settings['parallel'])
+    page = int(page or settings['page'])
+    retries = int(retries or settings['retries'])
+    backoff = float(settings['backoff'] if backoff is None else backoff)
+    log = log or (lambda text: None)
+    save = save or (lambda checkpoint: None)
+    checkpoint = checkpoint if checkpoint is not None else {}
+    for key in ('done', 'skipped', 'pages'):
+        checkpoint.setdefault(key, 0)
+    checkpoint.setdefault('continue', None)
+    limiter = RateLimiter(rate, burst=parallel, clock=clock, sleep=sleep)
+
+    def rewrite(secret):
+        limiter.acquire()
+        return _rewrite(api, secret, retries, backoff, sleep)
+
+    started = clock()
+    with ThreadPoolExecutor(max_workers=parallel) as pool:
+        while True:
+            try:
+                items, token = api.list(page, checkpoint['continue'])
+            except ApiError as e:
+                if e.status != 410 or not checkpoint['continue']:
+                    raise
+                # the token outlived etcd's compaction; writing a Secret twice
+                # does no harm, so start the listing over
+                log('[rotation] list position expired, listing from the start again')
+                checkpoint['continue'] = None
+                continue
+            for result in pool.map(rewrite, items):
+                checkpoint[result] += 1
+            checkpoint['pages'] += 1
+            checkpoint['continue'] = token
+            save(checkpoint)
+            elapsed = max(clock() - started, 1e-6)
+            log('[rotation] page {0}: {1} rewritten, {2} skipped, {3:.1f}/s'.format(
+                checkpoint['pages'], checkpoint['done'], checkpoint['skipped'],
+                (checkpoint['done'] + checkpoint['skipped']) / elapsed))
+            if token is None:
+                return checkpoint
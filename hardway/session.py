@@ -0,0 +1,167 @@
+"""
+Send all the commands for a host over one ssh connection.
+
+Every ``gcloud compute ssh`` pays for key lookup, the TCP and ssh handshakes
+and auth again. A ``RemoteSession`` queues the commands run against its host
+and, when the ``with`` block ends, turns them into one shell script that is
+piped to a single ``bash -s`` on the host. Each command is wrapped in markers
+so its exit code and output can still be reported one by one.
+"""
+import binascii
+import os
+import tempfile
+import threading
+
+from fabric.api import abort
+
+import fanout
+from profiler import local
+
+# how the script reaches a shell on the host; {host} and {script} are filled
+# in. Point it at "bash -s < {script}" to time sessions against a local shell.
+settings = {
+    'transport': "gcloud compute ssh {host} --command 'bash -s' < {script}",
+}
+
+_state = threading.local()
+
+
+class CommandResult(object):
+    def __init__(self, command, exit_code=None, output=''):
+        self.command = command
+        self.exit_code = exit_code
+        self.output = output
+
+    @property
+    def succeeded(self):
+        return self.exit_code == 0
+
+    def __repr__(self):
+        return 'CommandResult({0!r}, exit_code={1!r})'.format(self.command, self.exit_code)
+
+
+class RemoteSession(object):
+    """
+    Queue of commands for one host, sent in a single connection on flush()
+    """
+    def __init__(self, host):
+        self.host = host
+        self.commands = []
+        self.results = []
+        self.marker = '__hardway_{0}__'.format(str(binascii.b2a_hex(os.urandom(6)), 'utf-8'))
+
+    def run(self, command):
+        self.commands.append(command)
+
+    def script(self):
+        """
+        The commands as a shell script. Each runs in a subshell with stdin
+        closed, so it can't swallow the rest of the script, and the script
+        stops at the first failure like separate ssh calls would.
+        """
+        lines = []
+        for i, command in enumerate(self.commands):
+            lines.append("echo '{0} begin {1}'".format(self.marker, i))
+            lines.append('( {0}\n) </dev/null 2>&1'.format(command))
+            lines.append('rc=$?')
+            lines.append("echo '{0} end {1}' $rc".format(self.marker, i))
+            lines.append('[ $rc -eq 0 ] || exit 0')
+        # the exit code of ssh itself is left to report connection errors
+        lines.append('exit 0')
+        return '\n'.join(lines) + '\n'
+
+    def parse(self, output):
+        results = [CommandResult(command) for command in self.commands]
+        current = None
+        chunk = []
+        for line in output.splitlines():
+            start = line.find(self.marker)
+            if start > 0:
+                # the command's last line had no newline, so the marker
+                # follows it on the same line
+                if current is not None:
+                    chunk.append(line[:start])
+                line = line[start:]
+            if start >= 0:
+                fields = line.split()
+                index = int(fields[2])
+                if fields[1] == 'begin':
+                    current, chunk = index, []
+                else:
+                    results[index].exit_code = int(fields[3])
+                    results[index].output = '\n'.join(chunk)
+                    current = None
+            elif current is not None:
+                chunk.append(line)
+        if current is not None:
+            # the connection went away in the middle of this command
+            results[current].output = '\n'.join(chunk)
+        return results
+
+    def flush(self):
+        """
+        Run the queued commands and return a CommandResult for each. Commands
+        after a failed one are not run and have exit_code None.
+        """
+        if not self.commands:
+            return []
+        fd, path = tempfile.mkstemp(prefix='hardway-session-', suffix='.sh')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.script())
+            output = local(settings['transport'].format(host=self.host, script=path), capture=True)
+        finally:
+            os.remove(path)
+        results = self.parse(output)
+        self.results.extend(results)
+        self.commands = []
+        # fanout already prefixes buffered lines with the host
+        prompt = '$' if fanout.capturing() else '{0}$'.format(self.host)
+        for result in results:
+            if result.exit_code is None:
+                continue
+            fanout.log('{0} {1}'.format(prompt, result.command))
+            fanout.log(result.output)
+        failed = [r for r in results if r.exit_code not in (0, None)]
+        if failed:
+            abort('{0}: {1!r} exited with {2}'.format(self.host, failed[0].command, failed[0].exit_code))
+        if any(r.exit_code is None for r in results):
+            abort('{0}: session ended before all commands ran'.format(self.host))
+        return results
+
+    def __enter__(self):
+        sessions = _active()
+        if self.host in sessions:
+            raise RuntimeError('a session for {0} is already open'.format(self.host))
+        sessions[self.host] = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        del _active()[self.host]
+        if exc_type is None:
+            self.flush()
+        return False
+
+
+def _active():
+    if not hasattr(_state, 'sessions'):
+        _state.sessions = {}
+    return _state.sessions
+
+
+def active(host):
+    """
+    The session open for host in this thread, None if commands run directly
+    """
+    return _active().get(host)
+
+
+def batched(func, name):
+    """
+    Wrap a per-host body for fanout.execute so that everything it runs on
+    host name(item) goes out in one session
+    """
+    def run(item):
+        with RemoteSession(name(item)):
+            return func(item)
+    return run
@@ -0,0 +1,39 @@
+"""
+Small JSON files that carry cached lookups from one fab run to the next.
+"""
+import json
+import os
+import tempfile
+import time
+
+
+def load(path, ttl):
+    """
+    Data saved at path, or None if there is none or it is older than ttl
+    seconds. A ttl of 0 disables the snapshot.
+    """
+    if not ttl or not os.path.exists(path):
+        return None
+    if time.time() - os.path.getmtime(path) > float(ttl):
+        return None
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except ValueError:
+        return None
+
+
+def save(path, data):
+    """
+    Write data to path atomically, so a concurrent fab run never reads half a file
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.snapshot-')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.rename(tmp_path, path)
+
+
+def remove(path):
+    if os.path.exists(path):
+        os.remove(path)
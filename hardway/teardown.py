@@ -0,0 +1,111 @@
+"""
+Delete what is left of a cluster, dependents first, a layer at a time.
+
+``cleanup`` deleted a fixed list of names one call after the other, and the
+list had drifted from what the setup creates, so some resources were never
+deleted and a second run repeated every failing call. Here the resources are
+listed by the cluster's network, instance tag and the names
+``topology.resource_names`` gives the setup, and each kind is deleted
+once everything that can still refer to it is gone. The kinds in a layer are
+deleted at the same time, one call per kind, so a teardown takes as long as
+the longest chain, however many resources there are.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import provision
+import topology
+
+settings = {
+    'parallel': 8,
+}
+
+# kind: kinds that have to be gone before it can be deleted
+BLOCKED_BY = {
+    'instances': [],
+    'routes': [],
+    'forwarding-rules': ['instances'],
+    'addresses': ['forwarding-rules'],
+    'target-pools': ['forwarding-rules'],
+    'http-health-checks': ['target-pools'],
+    'firewall-rules': [],
+    'networks subnets': ['instances'],
+    'networks': ['instances', 'routes', 'firewall-rules', 'networks subnets'],
+}
+
+
+def targets(name, region):
+    """
+    (kind, list filter, delete flags) of everything a cluster named name has
+    """
+    network = 'network:{0}'.format(name)
+    names = topology.resource_names(name)
+    return [
+        ('instances', 'tags.items={0}'.format(name), ''),
+        ('routes', '{0} AND name ~ ^{1}'.format(network, topology.ROUTE_PREFIX), ''),
+        ('forwarding-rules', 'name={0}'.format(names['forwarding-rule']), '--region {0}'.format(region)),
+        ('addresses', 'name={0}'.format(name), '--region {0}'.format(region)),
+        ('target-pools', 'name={0}'.format(names['target-pool']), '--region {0}'.format(region)),
+        ('http-health-checks', 'name={0}'.format(names['http-health-check']), ''),
+        ('firewall-rules', network, ''),
+        ('networks subnets', network, '--region {0}'.format(region)),
+        ('networks', 'name={0}'.format(name), ''),
+    ]
+
+
+def discover(name, region, compute=None):
+    """
+    {kind: (names, delete flags)} of the resources that exist, listed
+    concurrently
+    """
+    compute = compute or provision.backend()
+    wanted = targets(name, region)
+    with ThreadPoolExecutor(max_workers=int(settings['parallel'])) as pool:
+        names = pool.map(lambda target: compute.list(target[0], target[1]), wanted)
+        return dict((kind, (found, flags)) for (kind, _, flags), found in zip(wanted, names) if found)
+
+
+def layers(found):
+    """
+    The kinds of found grouped in the order they can be deleted; a kind waits
+    only for the kinds blocking it that have resources
+    """
+    levels = {}
+
+    def level(kind):
+        if kind not in levels:
+            levels[kind] = max([level(b) + 1 for b in BLOCKED_BY[kind] if b in found] or [0])
+        return levels[kind]
+
+    result = {}
+    for kind in found:
+        result.setdefault(level(kind), []).append(kind)
+    return [sorted(result[i]) for i in sorted(result)]
+
+
+def run(found, compute=None, clock=time.time):
+    """
+    Delete found layer by layer, the kinds of a layer at once. A kind whose
+    blockers failed to delete is skipped. Returns (report, failures): report
+    has (layer, kind, names, seconds) of every delete, failures
+    {kind: error}.
+    """
+    compute = compute or provision.backend()
+    report = []
+    failed = {}
+
+    def delete(kind):
+        names, flags = found[kind]
+        started = clock()
+        error = compute.delete(kind, names, flags)
+        return kind, names, clock() - started, error
+
+    with ThreadPoolExecutor(max_workers=int(settings['parallel'])) as pool:
+        for i, layer in enumerate(layers(found)):
+            for kind in [kind for kind in layer if any(b in failed for b in BLOCKED_BY[kind])]:
+                failed[kind] = 'skipped, something it depends on was not deleted'
+            for kind, names, seconds, error in pool.map(delete, [k for k in layer if k not in failed]):
+                report.append((i, kind, names, seconds))
+                if error:
+                    failed[kind] = error
+    return report, failed
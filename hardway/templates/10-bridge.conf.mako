@@ -5,6 +5,12 @@
     "bridge": "cnio0",
     "isGateway": true,
     "ipMasq": true,
+% if plane.mtu:
+    "mtu": ${plane.mtu},
+% endif
+% if plane.hairpin:
+    "hairpinMode": true,
+% endif
     "ipam": {
         "type": "host-local",
         "ranges": [
@@ -6,6 +6,8 @@ resources:
     providers:
       - aescbc:
           keys:
-            - name: key1
-              secret: ${encryption_key}
+% for key in keys:
+            - name: ${key['name']}
+              secret: ${key['secret']}
+% endfor
       - identity: {}
@@ -6,11 +6,12 @@ Documentation=https://github.com/kubernetes/kubernetes
 ExecStart=/usr/local/bin/kube-apiserver \
   --advertise-address=${internal_ip}\
   --allow-privileged=true \
-  --apiserver-count=3 \
+  --apiserver-count=${apiserver_count} \
   --audit-log-maxage=30 \
   --audit-log-maxbackup=3 \
   --audit-log-maxsize=100 \
   --audit-log-path=/var/log/audit.log \
+  --audit-policy-file=/var/lib/kubernetes/audit-policy.yaml \
   --authorization-mode=Node,RBAC \
   --bind-address=0.0.0.0 \
   --client-ca-file=/var/lib/kubernetes/ca.pem \
@@ -19,7 +20,7 @@ ExecStart=/usr/local/bin/kube-apiserver \
   --etcd-cafile=/var/lib/kubernetes/ca.pem \
   --etcd-certfile=/var/lib/kubernetes/kubernetes.pem \
   --etcd-keyfile=/var/lib/kubernetes/kubernetes-key.pem \
-  --etcd-servers=https://10.240.0.10:2379,https://10.240.0.11:2379,https://10.240.0.12:2379 \
+  --etcd-servers=${etcd_servers} \
   --event-ttl=1h \
   --experimental-encryption-provider-config=/var/lib/kubernetes/encryption-config.yaml \
   --kubelet-certificate-authority=/var/lib/kubernetes/ca.pem \
@@ -28,10 +29,13 @@ ExecStart=/usr/local/bin/kube-apiserver \
   --kubelet-https=true \
   --runtime-config=api/all \
   --service-account-key-file=/var/lib/kubernetes/service-account.pem \
-  --service-cluster-ip-range=10.32.0.0/24 \
+  --service-cluster-ip-range=${service_cidr} \
   --service-node-port-range=30000-32767 \
   --tls-cert-file=/var/lib/kubernetes/kubernetes.pem \
   --tls-private-key-file=/var/lib/kubernetes/kubernetes-key.pem \
+% for name, value in tuning_flags:
+  --${name}=${value} \
+% endfor
   --v=2
 Restart=on-failure
 RestartSec=5
@@ -0,0 +1,12 @@
+kind: KubeProxyConfiguration
+apiVersion: kubeproxy.config.k8s.io/v1alpha1
+clientConnection:
+  kubeconfig: "/var/lib/kube-proxy/kubeconfig"
+mode: "${plane.mode}"
+clusterCIDR: "${pod_cidr}"
+% if plane.mode == 'ipvs':
+ipvs:
+  scheduler: "${plane.scheduler}"
+  syncPeriod: "${plane.values['sync_period']}"
+  minSyncPeriod: "${plane.values['min_sync_period']}"
+% endif
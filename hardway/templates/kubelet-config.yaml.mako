@@ -11,8 +11,19 @@ authorization:
   mode: Webhook
 clusterDomain: "cluster.local"
 clusterDNS:
-  - "10.32.0.10"
+  - "${cluster_dns}"
 podCIDR: "${pod_cidr}"
 runtimeRequestTimeout: "15m"
 tlsCertFile: "/var/lib/kubelet/${host_name}.pem"
 tlsPrivateKeyFile: "/var/lib/kubelet/${host_name}-key.pem"
+kubeAPIQPS: ${tuning['kube_api_qps']}
+kubeAPIBurst: ${tuning['kube_api_burst']}
+serializeImagePulls: ${'true' if tuning['serialize_image_pulls'] else 'false'}
+registryPullQPS: ${tuning['registry_pull_qps']}
+registryBurst: ${tuning['registry_burst']}
+eventRecordQPS: ${tuning['event_record_qps']}
+maxPods: ${tuning['max_pods']}
+evictionHard:
+% for signal, threshold in sorted(tuning['eviction_hard'].items()):
+  ${signal}: "${threshold}"
+% endfor
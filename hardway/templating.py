@@ -0,0 +1,69 @@
+"""
+Compiled Mako templates, shared by every task in the fab run.
+
+Tasks used to build a new ``Template`` for every host, all compiling into one
+shared ``/tmp/mako_modules`` with no versioning. The registry compiles each
+template once per process into a module directory named after the hash of
+the template source, so a module compiled from an older version of a template
+can never be loaded for a newer one.
+"""
+import hashlib
+import os
+import threading
+
+from mako.template import Template
+
+settings = {
+    'module_directory': '/tmp/mako_modules',
+}
+
+_lock = threading.Lock()
+_templates = {}
+
+
+def digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def get(path):
+    """
+    The compiled template for path, compiled the first time it is asked for
+    """
+    with _lock:
+        if path not in _templates:
+            module_directory = os.path.join(settings['module_directory'], digest(path)[:16])
+            _templates[path] = Template(filename=path, module_directory=module_directory)
+        return _templates[path]
+
+
+def render(path, **variables):
+    return get(path).render(**variables)
+
+
+def render_to(path, destination, **variables):
+    """
+    Render path into the file destination, creating its directory if needed
+    """
+    return render_many(path, [(destination, variables)])[0]
+
+
+def render_many(path, variants):
+    """
+    Render path once for every (destination, variables) pair in variants
+    """
+    template = get(path)
+    written = []
+    for destination, variables in variants:
+        directory = os.path.dirname(destination)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(destination, 'w') as f:
+            f.write(template.render(**variables))
+        written.append(destination)
+    return written
+
+
+def clear():
+    with _lock:
+        _templates.clear()
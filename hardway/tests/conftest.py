@@ -0,0 +1,107 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+
+# left behind by runs in the working tree, never needed by a test
+SKIP = ('tests', '.artifacts', 'rendered', '__pycache__', '.journal.jsonl', '.inventory.json', '.cluster-facts.json',
+        '.audit-state.json', 'bench.json', 'plan.json', 'profile.txt', 'profile.json')
+
+
+@pytest.fixture
+def sandbox(tmp_path, monkeypatch):
+    """
+    A scratch copy of the hardway directory, made the working directory
+    """
+    path = tmp_path / 'hardway'
+    shutil.copytree(ROOT, str(path), ignore=shutil.ignore_patterns(*SKIP))
+    monkeypatch.chdir(str(path))
+    return path
+
+
+class Cloud(object):
+    """
+    The sandbox with bench.py's fake gcloud, cfssl and kubectl first on PATH
+    and an offline artifact cache; run() runs fabfile code against it in a
+    fresh process, like fab does
+    """
+    def __init__(self, path, root, workers=2, controllers=3):
+        import bench
+        self.path = str(path)
+        self.config = {'log': os.path.join(root, 'calls.jsonl'), 'failure_rate': 0.0,
+                       'latency': dict((kind, 0) for kind in bench.settings['latency']),
+                       'controllers': controllers, 'workers': workers}
+        self.state = bench._state_dir(self.path)
+        self.config['state'] = self.state
+        bin_dir = bench._install_fakes(root, self.config)
+        with open(os.path.join(self.path, 'bench-cluster.json'), 'w') as f:
+            json.dump({'controllers': controllers, 'workers': workers}, f)
+        self.env = dict(os.environ, PATH=bin_dir + os.pathsep + os.environ.get('PATH', ''),
+                        HARDWAY_BENCH_CONFIG=os.path.join(root, 'bench-config.json'), HARDWAY_BENCH_STATE=self.state)
+        self.cache = os.path.join(root, 'artifacts')
+        self.seed = os.path.join(root, 'seed')
+        self.python('import bench, fabfile; bench._seed({0!r}, fabfile._artifact_urls())'.format(root))
+
+    def python(self, code):
+        return subprocess.run([sys.executable, '-W', 'ignore', '-c', code], cwd=self.path, env=self.env,
+                              stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    def run(self, code):
+        """
+        Run code with fabfile imported as f; (exit code, output)
+        """
+        process = self.python(
+            'import fabfile as f; f.artifact_cache(path={0!r}, offline="yes", checksums={1!r}); '
+            'f.seed_artifacts({2!r}); f.use_topology(path="bench-cluster.json"); {3}'.format(
+                self.cache, self.seed + '.sha256', self.seed, code))
+        return process.returncode, process.stdout.decode('utf-8', 'replace')
+
+    def host(self, name):
+        import bench
+        return bench.Host.load(self.state, name)
+
+
+@pytest.fixture
+def cloud(sandbox, tmp_path):
+    return Cloud(sandbox, str(tmp_path))
+
+
+GOLDEN = os.path.join(HERE, 'golden')
+
+
+def render_configs(sandbox, code):
+    """
+    Run code with fabfile imported as f, then render_configs, in a fresh
+    process in sandbox; returns the directory rendered into
+    """
+    out = os.path.join(str(sandbox), 'rendered')
+    subprocess.check_call([sys.executable, '-W', 'ignore', '-c',
+                           'import fabfile as f; {0}; f.render_configs(out={1!r})'.format(code, out)],
+                          cwd=str(sandbox), stdout=subprocess.DEVNULL)
+    return out
+
+
+def check_golden(rendered, name, paths):
+    """
+    Compare paths under rendered with the golden copies in golden/name; with
+    HARDWAY_UPDATE_GOLDEN=1 in the environment, write them instead
+    """
+    for path in paths:
+        golden = os.path.join(GOLDEN, name, path)
+        with open(os.path.join(rendered, path)) as f:
+            text = f.read()
+        if os.environ.get('HARDWAY_UPDATE_GOLDEN') == '1':
+            if not os.path.isdir(os.path.dirname(golden)):
+                os.makedirs(os.path.dirname(golden))
+            with open(golden, 'w') as f:
+                f.write(text)
+            continue
+        with open(golden) as f:
+            assert text == f.read(), '{0} differs from golden/{1}/{0}'.format(path, name)
@@ -0,0 +1,126 @@
+import hashlib
+import subprocess
+import sys
+
+import pytest
+
+import artifacts
+from artifacts import ArtifactError
+
+URL = 'https://example.com/releases/v1/tool.tar.gz'
+OTHER = 'https://example.com/releases/v1/other'
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    for key, value in (('path', str(tmp_path / 'cache')), ('checksums', str(tmp_path / 'pins.sha256')),
+                       ('offline', True), ('unpinned', False)):
+        monkeypatch.setitem(artifacts.settings, key, value)
+    monkeypatch.setattr(artifacts, '_index', None)
+    monkeypatch.setattr(artifacts, '_verified', set())
+    return tmp_path
+
+
+def _release(directory, url, data):
+    path = directory / artifacts.filename(url)
+    path.write_bytes(data)
+    return hashlib.sha256(data).hexdigest()
+
+
+def _pin(directory, pins):
+    (directory / 'pins.sha256').write_text(''.join('{0}  {1}\n'.format(digest, url) for url, digest in pins.items()))
+
+
+def test_releases_without_a_pin_are_refused(cache):
+    _release(cache, URL, b'tool')
+    with pytest.raises(ArtifactError) as error:
+        artifacts.add(URL, str(cache / 'tool.tar.gz'))
+    assert 'has no pin in' in str(error.value) and 'fab pin_artifacts' in str(error.value)
+    with pytest.raises(ArtifactError):
+        artifacts.fetch(URL)
+
+
+def test_unpinned_releases_can_be_allowed(cache):
+    _release(cache, URL, b'tool')
+    artifacts.configure(unpinned='yes')
+    path = artifacts.add(URL, str(cache / 'tool.tar.gz'))
+    assert artifacts.fetch(URL) == path
+
+
+def test_pinned_releases_are_verified(cache):
+    digest = _release(cache, URL, b'tool')
+    _pin(cache, {URL: digest})
+    path = artifacts.add(URL, str(cache / 'tool.tar.gz'))
+    assert artifacts.fetch(URL) == path
+    _pin(cache, {URL: '0' * 64})
+    with pytest.raises(ArtifactError) as error:
+        artifacts.add(URL, str(cache / 'tool.tar.gz'))
+    assert 'expected ' + '0' * 64 in str(error.value)
+
+
+def test_pin_records_the_given_hashes(cache):
+    digest = _release(cache, URL, b'tool')
+    other = hashlib.sha256(b'other').hexdigest()
+    _pin(cache, {URL: digest})
+    sums = cache / 'SHA256SUMS'
+    # a pinned release keeps its pin; the other is found by its file name
+    sums.write_text('# from the release page\n{0}  {1}\n{2} *other\n'.format('0' * 64, URL, other.upper()))
+    assert artifacts.pin([URL, OTHER], artifacts.read_sums(str(sums))) == {OTHER: other}
+    assert artifacts.pinned() == {URL: digest, OTHER: other}
+    assert (cache / 'pins.sha256').read_text().startswith(artifacts.CHECKSUMS_HEADER)
+    assert artifacts.pin([URL, OTHER], {}) == {}
+
+
+def test_pin_never_hashes_a_download(cache, monkeypatch):
+    monkeypatch.setitem(artifacts.settings, 'offline', False)
+    monkeypatch.setattr(artifacts, 'download', lambda *args: pytest.fail('pin downloaded a release'))
+    assert artifacts.pin([URL], {}) == {}
+    assert not (cache / 'pins.sha256').exists()
+    with pytest.raises(ArtifactError):
+        artifacts.expected(URL)
+
+
+def test_a_file_name_shared_by_two_releases_needs_the_url(cache):
+    darwin = 'https://example.com/releases/v1/bin/darwin/amd64/kubectl'
+    linux = 'https://example.com/releases/v1/bin/linux/amd64/kubectl'
+    assert artifacts.pin([darwin, linux], {'kubectl': '1' * 64, linux: '2' * 64}) == {linux: '2' * 64}
+
+
+def test_a_cached_copy_must_match_its_new_pin(cache):
+    _release(cache, URL, b'tool')
+    artifacts.configure(unpinned='yes')
+    artifacts.add(URL, str(cache / 'tool.tar.gz'))
+    artifacts.configure(unpinned='no')
+    with pytest.raises(ArtifactError) as error:
+        artifacts.pin([URL], {URL: '3' * 64})
+    assert 'not ' + '3' * 64 in str(error.value)
+    assert artifacts.pinned() == {}
+
+
+def test_sums_files_are_checked(cache):
+    sums = cache / 'SHA256SUMS'
+    sums.write_text('{0}  tool.tar.gz\nnot-a-hash  other\n'.format('a' * 64))
+    with pytest.raises(ArtifactError) as error:
+        artifacts.read_sums(str(sums))
+    assert ':2: not a sha256sum line' in str(error.value)
+
+
+def test_fetch_artifacts_reruns_when_the_pins_in_use_change(sandbox):
+    (sandbox / 'other.sha256').write_text('{0}  {1}\n'.format('1' * 64, URL))
+    code = '''
+import fabfile as f
+url = {0!r}
+task = f.PIPELINE.tasks['fetch_artifacts']
+digests = [task.digest()]
+f.artifact_cache(checksums='other.sha256')
+digests.append(task.digest())
+with open('other.sha256', 'w') as pins:
+    pins.write('2' * 64 + '  ' + url + '\\n')
+digests.append(task.digest())
+digests.append(task.digest())
+print(' '.join(digests))
+'''.format(URL)
+    output = subprocess.check_output([sys.executable, '-W', 'ignore', '-c', code], cwd=str(sandbox))
+    default, other, changed, again = output.decode('utf-8').split()[-4:]
+    assert len(set([default, other, changed])) == 3
+    assert changed == again
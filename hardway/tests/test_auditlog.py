@@ -0,0 +1,158 @@
+import json
+import os
+import random
+
+import pytest
+
+import auditlog
+from auditlog import Analyzer, AuditLogError, Sketch, State
+
+
+def _event(i, stage='ResponseComplete', user='system:kube-scheduler', verb='list', resource='pods', code=200,
+           ms=None):
+    ms = 5 + i % 7 if ms is None else ms
+    return json.dumps({
+        'kind': 'Event', 'level': 'Metadata', 'stage': stage, 'auditID': 'id-{0}'.format(i),
+        'requestURI': '/api/v1/{0}'.format(resource), 'verb': verb, 'user': {'username': user},
+        'objectRef': {'resource': resource, 'apiVersion': 'v1'}, 'responseStatus': {'code': code},
+        'requestReceivedTimestamp': '2018-05-01T12:00:{0:02d}.000000Z'.format(i % 60),
+        'stageTimestamp': '2018-05-01T12:00:{0:02d}.{1:06d}Z'.format(i % 60, ms * 1000),
+    }) + '\n'
+
+
+@pytest.fixture
+def sample():
+    """
+    Ten requests as an API server logs them: each received, then completed,
+    one of them panicking
+    """
+    lines = []
+    for i in range(10):
+        lines.append(_event(i, stage='RequestReceived', verb='get' if i % 2 else 'list'))
+        if i == 7:
+            lines.append(_event(i, stage='Panic', verb='get', code=500))
+        else:
+            lines.append(_event(i, verb='get' if i % 2 else 'list', code=429 if i == 4 else 200))
+    return ''.join(lines).encode('utf-8')
+
+
+@pytest.fixture
+def logs(tmp_path):
+    path = tmp_path / 'logs'
+    path.mkdir()
+    return path
+
+
+def test_only_the_end_of_a_request_is_counted(sample, logs):
+    (logs / 'audit.log').write_bytes(sample + _event(10, stage='ResponseStarted').encode('utf-8'))
+    analyzer = auditlog.read([str(logs)], State())
+    assert analyzer.lines == 21
+    verbs = analyzer.groups['verb']
+    assert (verbs['get'].count, verbs['list'].count) == (5, 5)
+    assert (verbs['get'].errors, verbs['list'].throttled) == (1, 1)
+    assert analyzer.groups['caller']['system:kube-scheduler list pods'].count == 5
+    assert analyzer.first == 1525176000.0
+    assert analyzer.last - analyzer.first == pytest.approx(9.007)
+
+
+def test_a_partial_last_line_is_read_again_next_time(sample, logs):
+    state = State()
+    last = _event(10).encode('utf-8')
+    with open(str(logs / 'audit.log'), 'wb') as f:
+        f.write(sample + last[:40])
+    auditlog.read([str(logs)], state)
+    (inode, offset), = state.offsets['local'].items()
+    assert offset == len(sample)
+    assert state.analyzer.groups['verb']['list'].count == 5
+    with open(str(logs / 'audit.log'), 'ab') as f:
+        f.write(last[40:])
+    analyzer = auditlog.read([str(logs)], state)
+    assert (analyzer.lines, analyzer.groups['verb']['list'].count) == (1, 1)
+    assert state.offsets['local'] == {inode: len(sample) + len(last)}
+    assert state.analyzer.groups['verb']['list'].count == 6
+
+
+def test_a_rotated_log_keeps_its_place(sample, logs):
+    state = State()
+    (logs / 'audit.log').write_bytes(sample)
+    auditlog.read([str(logs)], state)
+    first = str(os.stat(str(logs / 'audit.log')).st_ino)
+    # the API server appends, then rotates the file and starts a new one
+    with open(str(logs / 'audit.log'), 'ab') as f:
+        f.write(_event(10).encode('utf-8'))
+    os.rename(str(logs / 'audit.log'), str(logs / 'audit-2018-05-01T12-01-00.000.log'))
+    (logs / 'audit.log').write_bytes(_event(11).encode('utf-8') + _event(12).encode('utf-8'))
+    analyzer = auditlog.read([str(logs)], state)
+    # only the line appended before the rename and the new file
+    assert (analyzer.lines, analyzer.groups['verb']['list'].count) == (3, 3)
+    assert state.offsets['local'][first] == len(sample) + len(_event(10))
+    assert len(state.offsets['local']) == 2
+    assert auditlog.read([str(logs)], state).lines == 0
+
+
+def test_a_run_resumes_from_the_saved_state(sample, logs, tmp_path):
+    path = str(tmp_path / 'audit-state.json')
+    (logs / 'audit.log').write_bytes(sample)
+    state = State()
+    auditlog.read([str(logs)], state)
+    state.save(path)
+    with open(str(logs / 'audit.log'), 'ab') as f:
+        f.write(b''.join(_event(i, verb='watch').encode('utf-8') for i in range(10, 15)))
+
+    resumed = State.load(path)
+    analyzer = auditlog.read([str(logs)], resumed)
+    assert analyzer.lines == 5
+    # the same as reading everything in one go
+    whole = State()
+    auditlog.read([str(logs)], whole)
+    assert resumed.analyzer.to_dict() == whole.analyzer.to_dict()
+    assert resumed.offsets == whole.offsets
+    assert State.load(str(tmp_path / 'missing.json')).offsets == {}
+
+
+def _exact(values, q):
+    # the rank Sketch.quantile uses
+    return sorted(values)[int(q * (len(values) - 1))]
+
+
+def test_sketch_quantiles_are_within_the_accuracy():
+    rng = random.Random(7)
+    values = [rng.lognormvariate(3, 1.5) for _ in range(20000)]
+    for accuracy in (0.01, 0.05):
+        sketch = Sketch(accuracy)
+        for value in values:
+            sketch.add(value)
+        for q in (0.01, 0.25, 0.5, 0.9, 0.99, 0.999, 1.0):
+            exact = _exact(values, q)
+            assert abs(sketch.quantile(q) - exact) <= accuracy * exact * (1 + 1e-9), (accuracy, q)
+        assert sketch.maximum == max(values)
+        # bounded memory: buckets span the range of values, not their number
+        assert len(sketch.buckets) < 1500
+    assert Sketch().quantile(0.5) is None
+
+
+def test_merged_sketches_match_one_sketch():
+    rng = random.Random(11)
+    values = [rng.expovariate(0.05) for _ in range(5000)] + [0.0] * 50
+    whole = Sketch(0.01)
+    parts = [Sketch(0.01) for _ in range(3)]
+    for i, value in enumerate(values):
+        whole.add(value)
+        parts[i % 3].add(value)
+    merged = Sketch(0.01)
+    for part in parts:
+        merged.merge(part)
+    assert merged.to_dict() == whole.to_dict()
+    assert [merged.quantile(q) for q in auditlog.QUANTILES] == [whole.quantile(q) for q in auditlog.QUANTILES]
+    assert Sketch.from_dict(json.loads(json.dumps(merged.to_dict()))).to_dict() == whole.to_dict()
+    with pytest.raises(AuditLogError):
+        merged.merge(Sketch(0.05))
+
+
+def test_merged_analyzers_match_one_analyzer(sample):
+    whole, halves = Analyzer(), [Analyzer(), Analyzer()]
+    for i, line in enumerate(sample.splitlines(True)):
+        whole.add_line(line)
+        halves[i * 2 // len(sample.splitlines())].add_line(line)
+    halves[0].merge(halves[1])
+    assert halves[0].to_dict() == whole.to_dict()
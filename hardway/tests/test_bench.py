@@ -0,0 +1,47 @@
+import bench
+import drift
+import transfer
+import versions
+
+
+def _config(tmp_path):
+    return {'state': str(tmp_path / 'hosts'), 'controllers': 1, 'workers': 1}
+
+
+def _ssh(config, host_name, command):
+    with bench.Host(config['state'], host_name) as host:
+        return bench._ssh_one(host, command, config)
+
+
+def test_archive_files_show_up_in_the_drift_probe(tmp_path):
+    config = _config(tmp_path)
+    unit = tmp_path / 'etcd.service'
+    unit.write_text('[Service]\n')
+    files = drift.manifest([(str(unit), '/etc/systemd/system/etcd.service', ['etcd'])])
+    archive = transfer.pack(files, path=str(tmp_path / 'files.tar.gz'))
+    probe = drift.probe_command(files)
+    assert _ssh(config, 'controller-0', probe) == ('service etcd inactive', 0)
+
+    bench._scp(['compute', 'scp', archive, 'controller-0:~/hardway-1.tar.gz'], config)
+    assert _ssh(config, 'controller-0', transfer.install_command('hardway-1.tar.gz'))[1] == 0
+    assert _ssh(config, 'controller-0', 'sudo systemctl enable etcd && sudo systemctl start etcd')[1] == 0
+    changes = drift.Plan(files, [], _ssh(config, 'controller-0', probe)[0])
+    assert changes.empty
+
+
+def test_units_without_a_unit_file_do_not_start(tmp_path):
+    config = _config(tmp_path)
+    output, status = _ssh(config, 'controller-0', 'sudo systemctl start etcd')
+    assert status == 5
+    assert 'not found' in output
+    assert _ssh(config, 'controller-0', drift.health_command('etcd'))[1] == 1
+    assert bench.missing(config['state'], config, ['step_06']) == [
+        'controller-0: etcd is not running', 'controller-0: etcd is not installed']
+
+
+def test_stamps_are_reported_by_the_version_probe(tmp_path):
+    config = _config(tmp_path)
+    component = versions.get('etcd')
+    assert versions.pending([component], _ssh(config, 'controller-0', versions.probe_command([component]))[0])
+    _ssh(config, 'controller-0', component.stamp_command())
+    assert not versions.pending([component], _ssh(config, 'controller-0', versions.probe_command([component]))[0])
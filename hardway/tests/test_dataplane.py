@@ -0,0 +1,87 @@
+import pytest
+
+import dataplane
+from conftest import GOLDEN, check_golden, render_configs
+from dataplane import DataPlaneError
+
+BRIDGE = 'worker-0/etc/cni/net.d/10-bridge.conf'
+KUBE_PROXY = 'worker-0/var/lib/kube-proxy/kube-proxy-config.yaml'
+CONTAINERD = 'worker-0/etc/containerd/config.toml'
+
+
+def _golden(profile, path):
+    with open('{0}/dataplane/{1}/{2}'.format(GOLDEN, profile, path)) as f:
+        return f.read()
+
+
+@pytest.mark.parametrize('profile', sorted(dataplane.PROFILES))
+def test_renders_match_golden(sandbox, profile):
+    rendered = render_configs(sandbox, 'f.use_dataplane(profile={0!r})'.format(profile))
+    check_golden(rendered, 'dataplane/' + profile, [BRIDGE, KUBE_PROXY, CONTAINERD])
+
+
+def test_overrides_reach_the_renders(sandbox):
+    rendered = render_configs(sandbox, 'f.use_dataplane(profile="ipvs", scheduler="lc", mtu=1400, downloads=4)')
+    plane = dataplane.DataPlane('ipvs', dict(dataplane.PROFILES['ipvs'], scheduler='lc', mtu=1400))
+    with open('{0}/{1}'.format(rendered, KUBE_PROXY)) as f:
+        dataplane.check_kube_proxy(f.read(), plane)
+    with open('{0}/{1}'.format(rendered, BRIDGE)) as f:
+        dataplane.check_bridge(f.read(), plane)
+    with open('{0}/{1}'.format(rendered, CONTAINERD)) as f:
+        assert 'max_concurrent_downloads = 4' in f.read()
+
+
+def _values(profile='ipvs', **values):
+    return dict(dataplane.PROFILES[profile], **values)
+
+
+@pytest.mark.parametrize('profile', sorted(dataplane.PROFILES))
+def test_profiles_are_valid(profile):
+    dataplane.validate(_values(profile))
+
+
+@pytest.mark.parametrize('values, message', [
+    (_values(mode='nftables'), "mode must be one of iptables, ipvs, got 'nftables'"),
+    (_values(scheduler='fifo'), "scheduler must be one of dh, lc, nq, rr, sed, sh, wlc, wrr, got 'fifo'"),
+    (_values(scheduler=None), 'scheduler must be one of'),
+    (_values(mtu=500), 'mtu must be between 576 and 9000, got 500'),
+    (_values(mtu=9001), 'mtu must be between 576 and 9000, got 9001'),
+    (_values(max_concurrent_downloads=0), 'max_concurrent_downloads must be between 1 and 100, got 0'),
+    (_values('iptables', max_concurrent_downloads=101), 'max_concurrent_downloads must be between 1 and 100, got 101'),
+])
+def test_validate_rejects_bad_values(values, message):
+    with pytest.raises(DataPlaneError) as error:
+        dataplane.validate(values)
+    assert message in str(error.value)
+
+
+def test_use_rejects_bad_profiles_and_overrides(monkeypatch):
+    monkeypatch.setitem(dataplane.settings, 'profile', 'iptables')
+    monkeypatch.setattr(dataplane, '_overrides', {})
+    with pytest.raises(DataPlaneError):
+        dataplane.use(profile='ebpf')
+    with pytest.raises(DataPlaneError):
+        dataplane.use(profile='ipvs', scheduler='fifo')
+    assert dataplane.use(profile='ipvs').kernel_modules == ['br_netfilter', 'ip_vs', 'nf_conntrack_ipv4', 'ip_vs_rr']
+
+
+def test_checks_catch_a_render_without_the_profile():
+    ipvs = dataplane.DataPlane('ipvs', _values())
+    iptables = dataplane.DataPlane('iptables', _values('iptables'))
+    proxy = _golden('ipvs', KUBE_PROXY)
+    dataplane.check_kube_proxy(proxy, ipvs)
+    with pytest.raises(DataPlaneError) as error:
+        dataplane.check_kube_proxy(proxy, iptables)
+    assert str(error.value) == "kube-proxy mode is 'ipvs', the profile wants 'iptables'"
+    with pytest.raises(DataPlaneError) as error:
+        dataplane.check_kube_proxy(proxy, dataplane.DataPlane('ipvs', _values(scheduler='wlc')))
+    assert str(error.value) == "kube-proxy IPVS scheduler is 'rr', the profile wants 'wlc'"
+    bridge = _golden('ipvs', BRIDGE)
+    dataplane.check_bridge(bridge, ipvs)
+    with pytest.raises(DataPlaneError) as error:
+        dataplane.check_bridge(bridge, iptables)
+    assert str(error.value) == 'bridge MTU is 1460, the profile wants None'
+    with pytest.raises(DataPlaneError) as error:
+        dataplane.check_bridge(bridge, dataplane.DataPlane('ipvs', _values(hairpin=False)))
+    assert str(error.value) == 'bridge hairpinMode is True, the profile wants False'
+    dataplane.check_bridge(_golden('iptables', BRIDGE), iptables)
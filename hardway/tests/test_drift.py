@@ -0,0 +1,49 @@
+import pytest
+
+import drift
+
+
+@pytest.fixture
+def ca(tmp_path):
+    path = tmp_path / 'ca.pem'
+    path.write_text('new ca\n')
+    return str(path)
+
+
+def _probe(hashes=None, **states):
+    lines = ['{0}  {1}'.format(digest, path) for path, digest in (hashes or {}).items()]
+    return '\n'.join(lines + ['service {0} {1}'.format(name.replace('_', '-'), state)
+                              for name, state in states.items()])
+
+
+def test_a_changed_file_restarts_the_services_it_notifies_if_they_run(ca):
+    files = [drift.Managed(ca, '/var/lib/kubernetes/ca.pem', ['kube-apiserver'], notify=['kube-controller-manager'])]
+    changes = drift.Plan(drift.manifest(files), [], _probe(kube_apiserver='active', kube_controller_manager='active'))
+    assert changes.restart == ['kube-apiserver', 'kube-controller-manager'] and changes.start == []
+    assert 'kube-controller-manager' in drift.probe_command(drift.manifest(files))
+
+
+def test_a_notified_service_is_never_started(ca):
+    # the first deploy: the controller manager isn't set up yet
+    files = [drift.Managed(ca, '/var/lib/kubernetes/ca.pem', ['kube-apiserver'], notify=['kube-controller-manager'])]
+    changes = drift.Plan(drift.manifest(files), [], _probe(kube_apiserver='inactive', kube_controller_manager='inactive'))
+    assert (changes.restart, changes.start) == ([], ['kube-apiserver'])
+    unchanged = drift.Plan(drift.manifest(files), [], _probe({'/var/lib/kubernetes/ca.pem': drift.digest(ca)},
+                                                             kube_apiserver='active', kube_controller_manager='active'))
+    assert unchanged.empty
+
+
+def test_entries_for_one_destination_are_merged(ca):
+    files = drift.manifest([
+        drift.Managed(ca, '/var/lib/kubernetes/ca.pem', ['kube-apiserver'], notify=['kube-controller-manager']),
+        drift.Managed(ca, '/var/lib/kubernetes/ca.pem', ['kube-controller-manager'], notify=['kube-apiserver']),
+        (ca, '/etc/etcd/ca.pem', ['etcd']),
+    ])
+    assert [(f.destination, f.services, f.notify) for f in files] == [
+        ('/var/lib/kubernetes/ca.pem', ['kube-apiserver', 'kube-controller-manager'], []),
+        ('/etc/etcd/ca.pem', ['etcd'], []),
+    ]
+    changes = drift.Plan(files, [], _probe(kube_apiserver='inactive', kube_controller_manager='inactive', etcd='active'))
+    assert changes.start == ['kube-apiserver', 'kube-controller-manager'] and changes.restart == ['etcd']
+    with pytest.raises(ValueError):
+        drift.manifest([(ca, '/var/lib/kubernetes/ca.pem'), (ca + '.old', '/var/lib/kubernetes/ca.pem')])
@@ -0,0 +1,24 @@
+import bench
+
+
+def test_deploy_setup_etcd_installs_etcd(cloud):
+    code, output = cloud.run('f.deploy(target="setup_etcd")')
+    assert code == 0, output
+    assert 'already done on this host' not in output
+    assert bench.missing(cloud.state, cloud.config, ['step_06']) == []
+
+
+def test_slow_disk_stops_setup_etcd_before_installing(cloud):
+    code, output = cloud.run('f.etcdperf.configure(limit_ms=1, on_slow="abort"); f.deploy(target="setup_etcd")')
+    assert code != 0
+    assert 'fsync p99 above 1.0ms' in output
+    host = cloud.host('controller-0')
+    assert 'etcd' not in host.units
+    assert '/etc/systemd/system/etcd.service' not in host.files
+
+
+def test_slow_disk_warns(cloud):
+    code, output = cloud.run('f.etcdperf.configure(limit_ms=1, on_slow="warn"); f.deploy(target="setup_etcd")')
+    assert code == 0, output
+    assert 'warning: fsync p99 above' in output
+    assert bench.missing(cloud.state, cloud.config, ['step_06']) == []
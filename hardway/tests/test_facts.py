@@ -0,0 +1,80 @@
+import os
+import threading
+
+import pytest
+
+import facts
+
+
+@pytest.fixture
+def gcloud(tmp_path, monkeypatch):
+    """
+    Calls of facts' local(), answered like gcloud would
+    """
+    calls = []
+    answers = {'compute/region': 'europe-west1\n', 'compute/zone': 'europe-west1-b\n', 'addresses': '198.51.100.7'}
+    def local(command, capture=False):
+        calls.append(command)
+        return [answer for key, answer in answers.items() if key in command][0]
+    monkeypatch.setattr(facts, 'local', local)
+    monkeypatch.setattr(facts, '_facts', {})
+    monkeypatch.setattr(facts, '_loaded', False)
+    for key, value in (('name', 'staging'), ('path', str(tmp_path / 'facts.json')), ('ttl', 0)):
+        monkeypatch.setitem(facts.settings, key, value)
+    return calls
+
+
+def test_each_fact_is_looked_up_once(gcloud):
+    assert facts.public_ip() == '198.51.100.7'
+    assert facts.region() == 'europe-west1'
+    assert facts.zone() == 'europe-west1-b'
+    assert facts.network() == 'staging'
+    for _ in range(3):
+        facts.public_ip()
+        facts.region()
+    assert gcloud == [
+        'gcloud config get-value compute/region',
+        "gcloud compute addresses describe staging --region europe-west1 --format 'value(address)'",
+        'gcloud config get-value compute/zone',
+    ]
+
+
+def test_concurrent_tasks_share_the_lookups(gcloud):
+    threads = [threading.Thread(target=facts.public_ip) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert facts.public_ip() == '198.51.100.7'
+    assert len(facts._facts) == 2
+
+
+def test_invalidate_one_fact(gcloud):
+    facts.public_ip()
+    facts.invalidate('public_ip')
+    facts.public_ip()
+    assert len([call for call in gcloud if 'addresses' in call]) == 2
+    assert len([call for call in gcloud if 'compute/region' in call]) == 1
+
+
+def test_invalidate_everything(gcloud):
+    facts.region()
+    facts.invalidate()
+    facts.region()
+    assert len(gcloud) == 2
+
+
+def test_snapshot_carries_facts_to_the_next_run(gcloud, monkeypatch):
+    facts.configure(ttl=60)
+    facts.public_ip()
+    monkeypatch.setattr(facts, '_facts', {})
+    monkeypatch.setattr(facts, '_loaded', False)
+    assert facts.public_ip() == '198.51.100.7'
+    assert len(gcloud) == 2
+    facts.invalidate()
+    assert not os.path.exists(facts.settings['path'])
+
+
+def test_unknown_facts_are_refused(gcloud):
+    with pytest.raises(KeyError):
+        facts.get('project')
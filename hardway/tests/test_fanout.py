@@ -0,0 +1,140 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+import fanout
+
+FAKE_GCLOUD = '''#!/bin/sh
+# gcloud compute ssh <host> --command <command>
+echo "start $3" >> "{log}"
+echo "$3: first line"
+sleep 0.2
+echo "$3: second line"
+echo "end $3" >> "{log}"
+'''
+
+
+def test_hosts_run_at_once_and_print_their_own_block(sandbox, tmp_path):
+    log = tmp_path / 'gcloud.log'
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    (bin_dir / 'gcloud').write_text(FAKE_GCLOUD.format(log=log))
+    (bin_dir / 'gcloud').chmod(0o755)
+    (sandbox / 'cluster.yaml').write_text('workers: 6\n')
+    code = ('import fabfile as f, fanout; '
+            'fanout.execute(lambda node: f.run_command(node.name, "hostname"), f.topology.current().workers, '
+            'name=f._host, parallel=3)')
+    env = dict(os.environ, PATH=str(bin_dir) + os.pathsep + os.environ['PATH'])
+    output = subprocess.check_output([sys.executable, '-W', 'ignore', '-c', code], cwd=str(sandbox), env=env,
+                                     stderr=subprocess.STDOUT).decode('utf-8')
+
+    calls = log.read_text().splitlines()
+    hosts = ['worker-{0}'.format(i) for i in range(6)]
+    assert sorted(line for line in calls if line.startswith('start')) == ['start ' + host for host in hosts]
+    in_flight, most = 0, 0
+    for line in calls:
+        in_flight += 1 if line.startswith('start') else -1
+        most = max(most, in_flight)
+    assert most == 3
+
+    # every host's lines come out together, tagged with the host
+    lines = [line for line in output.splitlines() if line.startswith('[worker-')]
+    for host in hosts:
+        block = [i for i, line in enumerate(lines) if line.startswith('[{0}]'.format(host))]
+        assert block == list(range(block[0], block[0] + 3))
+        assert [lines[i] for i in block] == [
+            "[{0}] gcloud compute ssh {0} --command 'hostname'".format(host),
+            '[{0}] {0}: first line'.format(host),
+            '[{0}] {0}: second line'.format(host)]
+
+
+class _Hosts(object):
+    """
+    Bodies that take a little while, track how many run at once and fail
+    for the hosts in failing
+    """
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.started = []
+        self.in_flight = 0
+        self.most = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, host):
+        with self.lock:
+            self.started.append(host)
+            self.in_flight += 1
+            self.most = max(self.most, self.in_flight)
+        try:
+            time.sleep(0.05)
+            fanout.log('working on {0}'.format(host))
+            if host in self.failing:
+                raise RuntimeError('broken')
+            return host.upper()
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+HOSTS = ['h{0}'.format(i) for i in range(8)]
+
+
+def test_results_by_host_with_at_most_parallel_at_once():
+    body = _Hosts()
+    assert fanout.execute(body, HOSTS, parallel=3) == dict((host, host.upper()) for host in HOSTS)
+    assert body.most == 3
+
+
+def test_fail_fast_stops_hosts_that_have_not_started(capsys):
+    body = _Hosts(failing=['h0'])
+    with pytest.raises(SystemExit):
+        fanout.execute(body, HOSTS, parallel=2, mode=fanout.FAIL_FAST)
+    assert len(body.started) < len(HOSTS)
+    assert '1 of 8 hosts failed:\n  h0: RuntimeError: broken' in capsys.readouterr().err
+
+
+def test_collect_runs_every_host_and_reports_all_failures(capsys):
+    body = _Hosts(failing=['h5', 'h2'])
+    with pytest.raises(SystemExit):
+        fanout.execute(body, HOSTS, parallel=4, mode=fanout.COLLECT)
+    assert sorted(body.started) == HOSTS
+    assert '2 of 8 hosts failed:\n  h2: RuntimeError: broken\n  h5: RuntimeError: broken' in capsys.readouterr().err
+
+
+def test_serial_run_keeps_the_calling_thread():
+    threads = []
+    def body(host):
+        threads.append(threading.current_thread())
+        assert fanout.current_host() == host
+        return host
+    assert fanout.execute(body, HOSTS, parallel=1) == dict((host, host) for host in HOSTS)
+    assert set(threads) == {threading.current_thread()}
+    assert fanout.current_host() is None
+
+
+def test_wrappers_wrap_each_execute_once(monkeypatch):
+    wrapped = []
+    def wrap(func, name):
+        wrapped.append(name)
+        return lambda item: 'wrapped ' + func(item)
+    monkeypatch.setattr(fanout, 'wrappers', [wrap])
+    assert fanout.execute(lambda host: host, HOSTS[:3], parallel=3) == dict(
+        (host, 'wrapped ' + host) for host in HOSTS[:3])
+    assert len(wrapped) == 1
+
+
+def test_log_outside_execute_goes_to_stdout(capsys):
+    fanout.log('plain')
+    assert capsys.readouterr().out == 'plain\n'
+    assert not fanout.capturing()
+
+
+def test_bad_settings_are_rejected():
+    with pytest.raises(ValueError):
+        fanout.configure(parallel=0)
+    with pytest.raises(ValueError):
+        fanout.configure(mode='sometimes')
@@ -0,0 +1,178 @@
+import asyncio
+import datetime
+import ipaddress
+import json
+import ssl
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+import health
+
+
+def _self_signed(directory):
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'localhost')])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(minutes=1)).not_valid_after(now + datetime.timedelta(hours=1))
+            .add_extension(x509.SubjectAlternativeName([x509.DNSName('localhost'),
+                                                        x509.IPAddress(ipaddress.ip_address('127.0.0.1'))]), False)
+            .add_extension(x509.BasicConstraints(ca=True, path_length=None), True)
+            .sign(key, hashes.SHA256()))
+    cert_path, key_path = directory / 'server.pem', directory / 'server-key.pem'
+    cert_path.write_bytes(cert.public_bytes(serialization.Encoding.PEM))
+    key_path.write_bytes(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                           serialization.NoEncryption()))
+    return str(cert_path), str(key_path)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body, chunked=False):
+        self.send_response(status)
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            self.wfile.write(b'%x\r\n%s\r\n0\r\n\r\n' % (len(body), body))
+        else:
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests[self.path] = self.server.requests.get(self.path, 0) + 1
+            count = self.server.requests[self.path]
+        if self.path == '/healthz':
+            self._send(200, b'ok')
+        elif self.path == '/starting':
+            # ready from the fourth request on
+            self._send(200, b'ok') if count > 3 else self._send(503, b'starting')
+        elif self.path == '/unhealthy':
+            self._send(500, b'etcd cluster is unavailable')
+        elif self.path == '/slow':
+            time.sleep(1)
+            self._send(200, b'ok')
+        elif self.path == '/health':
+            self._send(200, json.dumps({'health': 'true'}).encode('ascii'), chunked=True)
+        elif self.path == '/api/v1/nodes/worker-0':
+            self._send(200, json.dumps({'status': {'conditions': [
+                {'type': 'Ready', 'status': 'False', 'reason': 'KubeletNotReady'}]}}).encode('ascii'))
+        else:
+            self._send(404, b'not found')
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    """
+    An HTTPS server on 127.0.0.1 that keeps connections alive, counting the
+    connections and the requests for each path
+    """
+    cert, key = _self_signed(tmp_path)
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    httpd.daemon_threads = True
+    # clients that time out hang up mid-response
+    httpd.handle_error = lambda request, address: None
+    httpd.lock = threading.Lock()
+    httpd.connections = 0
+    httpd.requests = {}
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+    httpd.socket = context.wrap_socket(httpd.socket, server_side=True)
+    httpd.client = health.client_context(cert)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    for key, value in (('timeout', 2.0), ('deadline', 5.0), ('backoff', 0.01), ('max_backoff', 0.05)):
+        monkeypatch.setitem(health.settings, key, value)
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def _check(server, path, name=None, **kwargs):
+    return health.Check(name or path, '127.0.0.1', server.server_address[1], path, server.client,
+                        server_name='localhost', **kwargs)
+
+
+def test_retries_reuse_one_connection(server):
+    check = _check(server, '/starting', expect=health.expect_status(200, b'ok'))
+    async def poll():
+        pool = health.Pool()
+        try:
+            return await health.probe(check, pool), pool.opened
+        finally:
+            pool.close()
+    result, opened = asyncio.run(poll())
+    assert result.ok and result.attempts == 4
+    assert opened == 1
+    assert server.connections == 1
+    assert server.requests['/starting'] == 4
+
+
+def test_checks_of_one_endpoint_share_connections(server):
+    checks = [_check(server, '/healthz', 'apiserver {0}'.format(i)) for i in range(3)] + [
+        _check(server, '/health', 'etcd', expect=health.expect_etcd_health)]
+    results = health.run(checks)
+    assert [(r.name, r.ok, r.attempts) for r in results] == [
+        ('apiserver 0', True, 1), ('apiserver 1', True, 1), ('apiserver 2', True, 1), ('etcd', True, 1)]
+    # run at once, so each needs a connection, but none more than that
+    assert server.connections <= 4
+    assert all(r.latency is not None for r in results)
+
+
+def test_a_request_that_takes_too_long_times_out(server, monkeypatch):
+    monkeypatch.setitem(health.settings, 'timeout', 0.2)
+    started = time.monotonic()
+    result, = health.run([_check(server, '/slow', deadline=0.5)])
+    assert not result.ok
+    assert result.problem == 'TimeoutError'
+    assert result.attempts >= 2
+    assert time.monotonic() - started < 1.5
+
+
+def test_unhealthy_endpoints_fail_at_their_deadline(server):
+    results = health.run([
+        _check(server, '/unhealthy', 'etcd', deadline=0.3),
+        _check(server, '/api/v1/nodes/worker-0', 'node worker-0', deadline=0.3, expect=health.expect_node_ready),
+        _check(server, '/healthz', 'apiserver'),
+    ])
+    assert [(r.name, r.ok, r.problem) for r in results] == [
+        ('etcd', False, 'HTTP 500'),
+        ('node worker-0', False, 'not Ready: KubeletNotReady'),
+        ('apiserver', True, None)]
+    assert results[0].attempts > 1 and results[0].elapsed >= 0.3
+    report = health.report(results)
+    # slowest first
+    assert report.splitlines()[-1].startswith('apiserver') and report.count('FAIL') == 2
+
+
+def test_an_untrusted_certificate_fails(server, tmp_path):
+    other = tmp_path / 'other'
+    other.mkdir()
+    check = health.Check('apiserver', '127.0.0.1', server.server_address[1], '/healthz',
+                         health.client_context(_self_signed(other)[0]), server_name='localhost', deadline=0.1)
+    result, = health.run([check])
+    assert not result.ok and 'CERTIFICATE_VERIFY_FAILED' in result.problem
+
+
+def test_nothing_listening_fails():
+    result, = health.run([health.Check('kubelet', '127.0.0.1', 1, '/healthz', deadline=0.1)])
+    assert not result.ok and result.attempts >= 1
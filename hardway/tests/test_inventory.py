@@ -0,0 +1,88 @@
+import json
+import os
+import time
+
+import pytest
+
+import inventory
+
+LISTING = json.dumps([
+    {'name': 'controller-0', 'zone': 'us-west1-c', 'status': 'RUNNING',
+     'networkInterfaces': [{'networkIP': '10.240.0.10', 'accessConfigs': [{'natIP': '203.0.113.10'}]}],
+     'metadata': {'items': [{'key': 'role', 'value': 'controller'}]}},
+    {'name': 'worker-0', 'zone': 'us-west1-c', 'status': 'RUNNING',
+     'networkInterfaces': [{'networkIP': '10.240.0.20', 'accessConfigs': [{'natIP': '203.0.113.20'}]}],
+     'metadata': {'items': [{'key': 'pod-cidr', 'value': '10.200.0.0/24'}]}},
+    # still being created: no external address, no metadata
+    {'name': 'worker-1', 'status': 'PROVISIONING', 'networkInterfaces': [{'networkIP': '10.240.0.21'}]},
+])
+
+
+@pytest.fixture
+def gcloud(tmp_path, monkeypatch):
+    """
+    Calls of inventory's local(), answered with LISTING
+    """
+    calls = []
+    def local(command, capture=False):
+        calls.append(command)
+        return LISTING
+    monkeypatch.setattr(inventory, 'local', local)
+    monkeypatch.setattr(inventory, '_instances', None)
+    for key, value in (('tag', 'staging'), ('path', str(tmp_path / 'inventory.json')), ('ttl', 0)):
+        monkeypatch.setitem(inventory.settings, key, value)
+    return calls
+
+
+def test_one_call_for_every_lookup(gcloud):
+    assert inventory.internal_ip('controller-0') == '10.240.0.10'
+    assert inventory.external_ip('controller-0') == '203.0.113.10'
+    assert inventory.external_ip('worker-0') == '203.0.113.20'
+    assert inventory.get('worker-0').metadata == {'pod-cidr': '10.200.0.0/24'}
+    worker = inventory.get('worker-1')
+    assert (worker.internal_ip, worker.external_ip, worker.status, worker.metadata) == (
+        '10.240.0.21', None, 'PROVISIONING', {})
+    assert gcloud == ['gcloud compute instances list --filter "tags.items=staging" --format \'{0}\''.format(
+        inventory.FORMAT)]
+
+
+def test_unknown_instances_name_the_tag(gcloud):
+    with pytest.raises(KeyError) as error:
+        inventory.get('worker-9')
+    assert "no instance named 'worker-9' tagged 'staging'" in str(error.value)
+
+
+def test_invalidate_lists_again(gcloud):
+    inventory.instances()
+    inventory.invalidate()
+    inventory.instances()
+    assert len(gcloud) == 2
+
+
+def test_snapshot_carries_the_listing_to_the_next_run(gcloud, monkeypatch):
+    inventory.configure(ttl=60)
+    inventory.instances()
+    assert os.path.exists(inventory.settings['path'])
+    # the next fab run starts with nothing in memory
+    monkeypatch.setattr(inventory, '_instances', None)
+    assert inventory.external_ip('worker-0') == '203.0.113.20'
+    assert len(gcloud) == 1
+
+    # past the ttl the snapshot is ignored
+    stale = time.time() - 120
+    os.utime(inventory.settings['path'], (stale, stale))
+    monkeypatch.setattr(inventory, '_instances', None)
+    inventory.instances()
+    assert len(gcloud) == 2
+
+
+def test_invalidate_removes_the_snapshot(gcloud):
+    inventory.configure(ttl=60)
+    inventory.instances()
+    inventory.invalidate()
+    assert not os.path.exists(inventory.settings['path'])
+
+
+def test_an_empty_listing_has_no_instances():
+    assert inventory.parse('') == {}
+    assert inventory.parse('[]') == {}
@@ -0,0 +1,72 @@
+import base64
+import os
+import stat
+
+import yaml
+
+import kubeconfig
+from conftest import GOLDEN
+
+FILES = os.path.join(GOLDEN, 'kubeconfig')
+
+
+def _spec(path, **kwargs):
+    return kubeconfig.Spec(str(path), 'system:node:worker-0', '203.0.113.7', os.path.join(FILES, 'worker-0.pem'),
+                           os.path.join(FILES, 'worker-0-key.pem'), ca=os.path.join(FILES, 'ca.pem'), **kwargs)
+
+
+def _read(path, mode='r'):
+    with open(path, mode) as f:
+        return f.read()
+
+
+def test_matches_what_kubectl_writes(tmp_path):
+    # worker-0.kubeconfig is laid out as kubectl config set-cluster
+    # --embed-certs, set-credentials --embed-certs, set-context default and
+    # use-context default write it
+    path = tmp_path / 'worker-0.kubeconfig'
+    kubeconfig.generate([_spec(path)])
+    golden = yaml.safe_load(_read(os.path.join(FILES, 'worker-0.kubeconfig')))
+    config = yaml.safe_load(path.read_text())
+    assert sorted(config) == sorted(golden)
+    for key in ('apiVersion', 'kind', 'clusters', 'users', 'contexts', 'current-context', 'preferences'):
+        assert config[key] == golden[key], key
+    assert path.read_text() == _read(os.path.join(FILES, 'worker-0.kubeconfig'))
+
+
+def test_certs_are_embedded_as_base64(tmp_path):
+    path = tmp_path / 'worker-0.kubeconfig'
+    kubeconfig.generate([_spec(path)])
+    config = yaml.safe_load(path.read_text())
+    cluster, user = config['clusters'][0]['cluster'], config['users'][0]['user']
+    assert base64.b64decode(cluster['certificate-authority-data']) == _read(os.path.join(FILES, 'ca.pem'), 'rb')
+    assert base64.b64decode(user['client-certificate-data']) == _read(os.path.join(FILES, 'worker-0.pem'), 'rb')
+    assert base64.b64decode(user['client-key-data']) == _read(os.path.join(FILES, 'worker-0-key.pem'), 'rb')
+
+
+def test_only_the_owner_can_read_it(tmp_path):
+    path = tmp_path / 'worker-0.kubeconfig'
+    path.write_text('left over')
+    path.chmod(0o644)
+    kubeconfig.generate([_spec(path)])
+    assert stat.S_IMODE(path.stat().st_mode) == 0o600
+    fresh = tmp_path / 'fresh.kubeconfig'
+    kubeconfig.generate([_spec(fresh)])
+    assert stat.S_IMODE(fresh.stat().st_mode) == 0o600
+
+
+def test_many_kubeconfigs_read_each_cert_once(tmp_path, monkeypatch):
+    opened = []
+    real_open = open
+    def counting_open(path, *args, **kwargs):
+        opened.append(path)
+        return real_open(path, *args, **kwargs)
+    monkeypatch.setattr('builtins.open', counting_open)
+    specs = [_spec(tmp_path / '{0}.kubeconfig'.format(i), cluster='staging') for i in range(5)]
+    files = kubeconfig.read_files(specs)
+    assert len(opened) == 3 and len(files) == 3
+    monkeypatch.setattr('builtins.open', real_open)
+    kubeconfig.generate(specs)
+    for spec in specs:
+        config = yaml.safe_load(_read(spec.path))
+        assert config['clusters'][0]['name'] == config['contexts'][0]['context']['cluster'] == 'staging'
@@ -0,0 +1,70 @@
+import threading
+
+import pytest
+
+import fanout
+import pipeline
+
+
+def _pipeline(calls, fanouts=2):
+    hosts = ['worker-0', 'worker-1']
+    lock = threading.Lock()
+    def task():
+        for step in range(fanouts):
+            def one(host, step=step):
+                with lock:
+                    calls.append((step, host))
+            fanout.execute(one, hosts)
+    p = pipeline.Pipeline()
+    p.add('setup', task)
+    return p
+
+
+def test_every_fanout_of_a_task_runs(tmp_path):
+    calls = []
+    journal = pipeline.Journal(str(tmp_path / 'journal.jsonl'))
+    _pipeline(calls).run(journal=journal)
+    assert sorted(calls) == [(0, 'worker-0'), (0, 'worker-1'), (1, 'worker-0'), (1, 'worker-1')]
+
+
+def test_finished_task_is_skipped(tmp_path):
+    calls = []
+    path = str(tmp_path / 'journal.jsonl')
+    _pipeline(calls).run(journal=pipeline.Journal(path))
+    del calls[:]
+    _pipeline(calls).run(journal=pipeline.Journal(path))
+    assert calls == []
+
+
+def test_resume_runs_only_the_fanout_and_host_that_failed(tmp_path):
+    path = str(tmp_path / 'journal.jsonl')
+    calls = []
+    def task():
+        fanout.execute(lambda host: calls.append((0, host)), ['worker-0', 'worker-1'])
+        def second(host):
+            if fail and host == 'worker-1':
+                raise RuntimeError('boom')
+            calls.append((1, host))
+        fanout.execute(second, ['worker-0', 'worker-1'], mode=fanout.COLLECT)
+    p = pipeline.Pipeline()
+    p.add('setup', task)
+    fail = True
+    with pytest.raises(SystemExit):
+        p.run(journal=pipeline.Journal(path))
+    del calls[:]
+    fail = False
+    p.run(journal=pipeline.Journal(path))
+    assert calls == [(1, 'worker-1')]
+
+
+def test_changed_input_runs_again(tmp_path):
+    path = str(tmp_path / 'journal.jsonl')
+    source = tmp_path / 'input.txt'
+    source.write_text('one')
+    calls = []
+    p = pipeline.Pipeline()
+    p.add('setup', lambda: fanout.execute(calls.append, ['worker-0']), inputs=[str(source)])
+    p.run(journal=pipeline.Journal(path))
+    source.write_text('two')
+    p.run(journal=pipeline.Journal(path))
+    assert calls == ['worker-0', 'worker-0']
@@ -0,0 +1,88 @@
+import os
+import threading
+import time
+
+from cryptography import x509
+from cryptography.hazmat.primitives import serialization
+from cryptography.x509.oid import ExtendedKeyUsageOID, NameOID
+
+import pki
+from conftest import ROOT
+
+WORKERS = 100
+CLIENTS = ['admin/admin', 'kube_proxy/kube-proxy', 'scheduler/kube-scheduler',
+           'control_manager/kube-controller-manager', 'sa/service-account']
+
+
+def _load(path):
+    with open(path, 'rb') as f:
+        return x509.load_pem_x509_certificate(f.read())
+
+
+def _requests(out):
+    requests = [pki.CertRequest(os.path.join(ROOT, name + '-csr.json'), os.path.join(out, os.path.basename(name)))
+                for name in CLIENTS]
+    requests.append(pki.CertRequest(os.path.join(ROOT, 'api_server/kubernetes-csr.json'), os.path.join(out, 'kubernetes'),
+                                    hostnames=['10.32.0.1', '10.240.0.10', '203.0.113.7', '127.0.0.1', 'kubernetes.default']))
+    csr = pki.load_csr(os.path.join(ROOT, 'kubelet/worker-0-csr.json'))
+    for i in range(WORKERS):
+        requests.append(pki.CertRequest(dict(csr, CN='system:node:worker-{0}'.format(i)),
+                                        os.path.join(out, 'worker-{0}'.format(i)),
+                                        hostnames=['worker-{0}'.format(i), '10.240.{0}.{1}'.format(i // 200, 20 + i % 200)]))
+    return requests
+
+
+def test_the_full_cert_set_chains_to_the_ca(tmp_path):
+    ca = str(tmp_path / 'ca')
+    pki.init_ca(os.path.join(ROOT, 'ca/ca-csr.json'), ca)
+    requests = _requests(str(tmp_path))
+
+    # issued from a thread while others run, as pipeline tasks do
+    result = {}
+    busy = threading.Event()
+    def other_task():
+        while not busy.is_set():
+            time.sleep(0.001)
+    def issue():
+        started = time.time()
+        result['paths'] = pki.issue(requests, ca=ca, config=os.path.join(ROOT, 'ca/ca-config.json'), processes=2)
+        result['seconds'] = time.time() - started
+    threads = [threading.Thread(target=other_task) for _ in range(3)] + [threading.Thread(target=issue)]
+    for thread in threads:
+        thread.start()
+    threads[-1].join(300)
+    busy.set()
+    for thread in threads[:-1]:
+        thread.join()
+
+    assert result['paths'] == [request.out + '.pem' for request in requests]
+    # a hundred workers' certs in well under the minutes cfssl takes
+    assert result['seconds'] < 120, result['seconds']
+
+    authority = _load(ca + '.pem')
+    assert authority.extensions.get_extension_for_class(x509.BasicConstraints).value.ca
+    for request in requests:
+        cert = _load(request.out + '.pem')
+        cert.verify_directly_issued_by(authority)
+        assert not cert.extensions.get_extension_for_class(x509.BasicConstraints).value.ca
+        assert set(cert.extensions.get_extension_for_class(x509.ExtendedKeyUsage).value) == {
+            ExtendedKeyUsageOID.SERVER_AUTH, ExtendedKeyUsageOID.CLIENT_AUTH}
+        with open(request.out + '-key.pem', 'rb') as f:
+            key = serialization.load_pem_private_key(f.read(), password=None)
+        assert key.public_key().public_numbers() == cert.public_key().public_numbers()
+        assert oct(os.stat(request.out + '-key.pem').st_mode & 0o777) == '0o600'
+        assert os.path.exists(request.out + '.csr')
+
+    worker = _load(str(tmp_path / 'worker-42.pem'))
+    assert worker.subject.get_attributes_for_oid(NameOID.COMMON_NAME)[0].value == 'system:node:worker-42'
+    names = worker.extensions.get_extension_for_class(x509.SubjectAlternativeName).value
+    assert names.get_values_for_type(x509.DNSName) == ['worker-42']
+    assert [str(ip) for ip in names.get_values_for_type(x509.IPAddress)] == ['10.240.0.62']
+
+
+def test_a_single_cert_is_issued_in_process(tmp_path):
+    ca = str(tmp_path / 'ca')
+    pki.init_ca(os.path.join(ROOT, 'ca/ca-csr.json'), ca)
+    request = pki.CertRequest(os.path.join(ROOT, 'admin/admin-csr.json'), str(tmp_path / 'admin'))
+    assert pki.issue([request], ca=ca, config=os.path.join(ROOT, 'ca/ca-config.json')) == [request.out + '.pem']
+    _load(request.out + '.pem').verify_directly_issued_by(_load(ca + '.pem'))
@@ -0,0 +1,148 @@
+import json
+
+import pytest
+
+import plan
+from plan import Op
+
+
+def _record(body):
+    with plan.recorder() as recorded:
+        body()
+    return recorded
+
+
+def _rolled(hosts):
+    """
+    What a rolling restart records: per host a probe, a copy and a gated
+    restart, one host after the other
+    """
+    def body():
+        plan.record(Op(plan.LOCAL, command='gcloud compute instances list'))
+        with plan.serial():
+            for host in hosts:
+                plan.record(Op(plan.RUN, host, 'sudo mkdir -p /var/lib/kubernetes/'))
+                plan.record(Op(plan.COPY, host, files=[('/dev/null', '/etc/systemd/system/kube-apiserver.service')]))
+                plan.record(Op(plan.RUN, host, 'sudo systemctl restart kube-apiserver'))
+        for host in hosts:
+            plan.record(Op(plan.RUN, host, 'sudo systemctl start nginx'))
+    return _record(body)
+
+
+def _level(waves, predicate):
+    return [i for i, wave in enumerate(waves) for op in wave if predicate(op)]
+
+
+def test_optimize_counts():
+    hosts = ['controller-0', 'controller-1']
+    def body():
+        for _ in range(3):
+            plan.record(Op(plan.LOCAL, command='gcloud compute addresses describe kubernetes-the-hard-way'))
+        for host in hosts:
+            plan.record(Op(plan.UPLOAD, host, '/dev/null'))
+            plan.record(Op(plan.UPLOAD, host, '/dev/null'))
+            plan.record(Op(plan.RUN, host, 'sudo mkdir -p /etc/etcd'))
+            plan.record(Op(plan.COPY, host, files=[('/dev/null', '/etc/etcd/ca.pem')]))
+            plan.record(Op(plan.COPY, host, files=[('/dev/null', '/etc/etcd/kubernetes.pem')]))
+            plan.record(Op(plan.RUN, host, 'sudo systemctl start etcd'))
+    recorded = _record(body)
+    assert len(recorded.ops) == 15
+    assert recorded.cost() == {'describe': 3, 'scp': 8, 'ssh': 12, 'total': 23}
+    optimized = plan.optimize(recorded)
+    # one describe and one session per host
+    assert len(optimized.ops) == 3
+    assert optimized.cost() == {'describe': 1, 'scp': 4, 'ssh': 2, 'total': 7}
+    sessions = [op for op in optimized.ops if op.kind == plan.SESSION]
+    assert [[item.kind for item in op.items] for op in sessions] == [[plan.UPLOAD, plan.RUN, plan.COPY, plan.RUN]] * 2
+    assert [len(op.items[2].files) for op in sessions] == [2, 2]
+    assert [len(wave) for wave in optimized.waves()] == [3]
+
+
+def test_rolled_hosts_stay_one_after_the_other():
+    hosts = ['controller-0', 'controller-1', 'controller-2']
+    recorded = _rolled(hosts)
+    for candidate in (recorded, plan.optimize(recorded)):
+        waves = candidate.waves()
+        restarts = [_level(waves, lambda op, host=host: op.host == host and op.serial is not None) for host in hosts]
+        # every op of a host comes after every op of the host rolled before it
+        for before, after in zip(restarts, restarts[1:]):
+            assert max(before) < min(after)
+        # the ops after the roll don't wait for the other hosts
+        starts = [_level(waves, lambda op, host=host: op.host == host and op.serial is None) for host in hosts]
+        assert starts[0][0] <= restarts[1][0]
+
+
+def test_optimized_roll_is_one_session_per_host_and_wave():
+    hosts = ['controller-0', 'controller-1', 'controller-2']
+    optimized = plan.optimize(_rolled(hosts))
+    assert len(optimized.ops) == 1 + 3 + 3
+    assert optimized.cost()['total'] == 1 + 3 * 2 + 3
+    rolled = [[op.host for op in wave if op.serial is not None] for wave in optimized.waves()]
+    assert [hosts for hosts in rolled if hosts] == [['controller-0'], ['controller-1'], ['controller-2']]
+
+
+def test_unrolled_hosts_share_a_wave():
+    def body():
+        for host in ['worker-0', 'worker-1', 'worker-2']:
+            plan.record(Op(plan.RUN, host, 'sudo systemctl restart kubelet'))
+    assert [len(wave) for wave in _record(body).waves()] == [3]
+
+
+def test_serial_groups_are_separate():
+    def body():
+        for service in ('kube-scheduler', 'kube-apiserver'):
+            with plan.serial():
+                for host in ['controller-0', 'controller-1']:
+                    plan.record(Op(plan.RUN, host, 'sudo systemctl restart {0}'.format(service)))
+    waves = [[(op.host, op.command.split()[-1]) for op in wave] for wave in _record(body).waves()]
+    assert waves == [
+        [('controller-0', 'kube-scheduler')],
+        [('controller-1', 'kube-scheduler'), ('controller-0', 'kube-apiserver')],
+        [('controller-1', 'kube-apiserver')],
+    ]
+
+
+def test_wait_is_a_barrier_run_in_process():
+    def body():
+        plan.record(Op(plan.RUN, 'controller-0', 'sudo systemctl start kube-apiserver'))
+        plan.record(Op(plan.WAIT, command='apiserver', args={'deadline': 30, 'internal': False}))
+        plan.record(Op(plan.RUN, 'worker-0', 'sudo systemctl start kubelet'))
+    recorded = _record(body)
+    assert [[op.kind for op in wave] for wave in recorded.waves()] == [[plan.RUN], [plan.WAIT], [plan.RUN]]
+    assert recorded.cost()['total'] == 2
+    calls = []
+    plan.execute(recorded, run_command=lambda host, command: calls.append((host, command)),
+                 copy_files=None, upload_archive=None,
+                 wait=lambda checks, **args: calls.append(('wait', checks, args)))
+    assert calls == [('controller-0', 'sudo systemctl start kube-apiserver'),
+                     ('wait', 'apiserver', {'deadline': 30, 'internal': False}),
+                     ('worker-0', 'sudo systemctl start kubelet')]
+
+
+def test_wait_without_a_waiter_fails():
+    recorded = _record(lambda: plan.record(Op(plan.WAIT, command='apiserver')))
+    with pytest.raises(SystemExit):
+        plan.execute(recorded, None, None, None)
+
+
+def test_saved_plans_keep_serial_groups_and_waits(tmp_path):
+    recorded = _rolled(['controller-0', 'controller-1'])
+    recorded.add(Op(plan.WAIT, command='apiserver;nodes', args={'deadline': 60}))
+    optimized = plan.optimize(recorded)
+    path = str(tmp_path / 'plan.json')
+    optimized.save(path)
+    loaded = plan.Plan.load(path)
+    assert [op.to_dict() for op in loaded.ops] == [op.to_dict() for op in optimized.ops]
+    assert [len(wave) for wave in loaded.waves()] == [len(wave) for wave in optimized.waves()]
+    assert json.load(open(path))['ops'][-1] == {'kind': 'wait', 'host': None, 'step': None,
+                                                'command': 'apiserver;nodes', 'args': {'deadline': 60}}
+
+
+def test_run_plan_waits_in_process(cloud):
+    code, output = cloud.run(
+        'f.make_plan(tasks="setup_kubectl"); '
+        'f.wait_ready = lambda checks, **args: print("waited for", checks, sorted(args.items())); '
+        'f.run_plan()')
+    assert code == 0, output
+    assert '- wait for apiserver' in output
+    assert "waited for apiserver [('deadline', 60), ('internal', False)]" in output
@@ -0,0 +1,130 @@
+import json
+
+import pytest
+
+import fanout
+import profiler
+from profiler import Span
+
+
+@pytest.fixture
+def profiling():
+    profiler.configure(enabled=True)
+    yield
+    profiler.configure(enabled=False)
+
+
+def _hosts(count):
+    return ['worker-{0}'.format(i) for i in range(count)]
+
+
+def _fanout(hosts, parallel=2):
+    def body(host):
+        with profiler.span('run on {0}'.format(host), kind='op') as info:
+            profiler.local('echo {0}'.format(host), capture=True)
+            profiler.local('exit 3', warn_only=True)
+            info['size'] = 7
+    with profiler.step('setup_worker'):
+        fanout.execute(body, hosts, parallel=parallel)
+
+
+def test_local_records_each_call(profiling):
+    result = profiler.local('echo hello', capture=True)
+    failed = profiler.local('echo oops >&2; exit 3', warn_only=True)
+    assert (result, failed.return_code, failed.failed, failed.stderr) == ('hello', 3, True, 'oops')
+    ok, error = profiler.spans()
+    assert (ok.name, ok.kind, ok.host, ok.step, ok.size, ok.status) == ('echo hello', 'local', None, 'main', 5, 0)
+    assert error.failed and error.status == 3
+    assert ok.duration > 0 and ok.start <= error.start
+
+    profiler.configure(enabled=False)
+    profiler.local('true')
+    assert profiler.spans() == []
+
+
+def test_interceptors_answer_instead_of_running(profiling, tmp_path):
+    marker = tmp_path / 'ran'
+    profiler.interceptors.append(lambda command, capture: 'planned' if 'touch' in command else None)
+    try:
+        assert profiler.local('touch {0}'.format(marker)) == 'planned'
+    finally:
+        profiler.interceptors.pop()
+    assert not marker.exists() and profiler.spans() == []
+
+
+def test_commands_are_classified():
+    assert [profiler.classify(command) for command in (
+        'gcloud compute ssh controller-0 --command hostname', 'gcloud compute scp a.pem worker-0:~/',
+        'gcloud compute instances list', 'gcloud config get-value compute/region', 'gcloud compute routes create r',
+        'cfssl gencert -initca ca-csr.json', 'kubectl get nodes', 'tar -czf a.tgz .')] == [
+        'ssh', 'scp', 'describe', 'describe', 'gcloud', 'cfssl', 'kubectl', 'local']
+
+
+def test_spans_nest_in_the_host_thread_with_the_step(profiling):
+    hosts = _hosts(6)
+    _fanout(hosts, parallel=2)
+    recorded = profiler.spans()
+    assert len(recorded) == 18
+    for host in hosts:
+        outer, = [s for s in recorded if s.host == host and s.kind == 'op']
+        inner = [s for s in recorded if s.host == host and s.kind != 'op']
+        assert [s.name for s in inner] == ['echo ' + host, 'exit 3']
+        assert outer.size == 7 and outer.status == 0
+        for s in inner:
+            assert outer.start <= s.start and s.start + s.duration <= outer.start + outer.duration
+            assert (s.thread, s.step) == (outer.thread, 'setup_worker')
+    # two pool threads, but a row per host
+    assert len(set(s.thread for s in recorded)) == 6
+
+
+def test_a_span_that_raises_is_failed(profiling):
+    with pytest.raises(ValueError):
+        with profiler.span('copy 3 files', kind='op', host='controller-0'):
+            raise ValueError('no space left')
+    s, = profiler.spans()
+    assert (s.failed, s.host, s.kind) == (True, 'controller-0', 'op')
+
+
+def test_summary_breaks_time_down_by_step_and_class():
+    recorded = [
+        Span('gcloud compute ssh worker-0 --command true', 'ssh', 'worker-0', 'setup_worker', 10.0, 2.0, thread=1),
+        Span('gcloud compute scp a worker-0:~/', 'scp', 'worker-0', 'setup_worker', 12.0, 1.0, size=2048, thread=1),
+        Span('run on worker-0', 'op', 'worker-0', 'setup_worker', 10.0, 3.5, thread=1),
+        Span('gcloud compute instances list', 'describe', None, 'networking', 0.0, 0.5, status=1, thread=2),
+    ]
+    text = profiler.summary(recorded)
+    steps, classes, slowest = text.split('\n\n')
+    assert steps.splitlines() == [
+        'step          wall  calls  describe  scp   ssh   failed',
+        'networking    0.5s  1      0.5s      0.0s  0.0s  1',
+        'setup_worker  3.5s  2      0.0s      1.0s  2.0s  0',
+    ]
+    assert classes.splitlines()[1:] == [
+        'describe  1      0.5s   0.50s  0.50s  0',
+        'scp       1      1.0s   1.00s  1.00s  2048',
+        'ssh       1      2.0s   2.00s  2.00s  0',
+    ]
+    assert [line.split()[0] for line in slowest.splitlines()[1:]] == ['2.00s', '1.00s', '0.50s']
+    assert profiler.summary([]) == 'nothing recorded'
+
+
+def test_trace_is_a_chrome_trace_with_a_row_per_host(profiling, tmp_path):
+    hosts = _hosts(4)
+    _fanout(hosts, parallel=2)
+    path = str(tmp_path / 'profile.json')
+    profiler.write_trace(path)
+    with open(path) as f:
+        trace = json.load(f)
+    assert trace['displayTimeUnit'] == 'ms'
+    events = trace['traceEvents']
+    names = dict((e['tid'], e['args']['name']) for e in events if e['ph'] == 'M' and e['name'] == 'thread_name')
+    assert sorted(names.values()) == hosts
+    complete = [e for e in events if e['ph'] == 'X']
+    assert len(complete) == 12
+    for e in complete:
+        assert set(e) == {'ph', 'pid', 'tid', 'name', 'cat', 'ts', 'dur', 'args'}
+        assert isinstance(e['ts'], int) and isinstance(e['dur'], int) and e['ts'] >= 0 and e['dur'] >= 0
+        # each event sits on the row named after its host
+        assert names[e['tid']] == e['args']['host']
+        assert e['cat'] == 'setup_worker,' + e['args']['class']
+    assert [e['args']['exit'] for e in complete if e['name'] == 'exit 3'] == [3] * 4
@@ -0,0 +1,89 @@
+import os
+import threading
+
+import pytest
+from fabric.api import env, output
+
+import provision
+from provision import FakeBackend, ProvisionError, Resource
+
+
+@pytest.fixture(autouse=True)
+def fast_polls(monkeypatch):
+    monkeypatch.setitem(provision.settings, 'interval', 0.01)
+    monkeypatch.setitem(provision.settings, 'max_interval', 0.02)
+
+
+def _cluster(count=6):
+    network = Resource('networks', 'net')
+    subnet = Resource('networks subnets', 'subnet', deps=[network.key])
+    firewall = Resource('firewall-rules', 'internal', deps=[network.key])
+    instances = [Resource('instances', 'node-{0}'.format(i), deps=[subnet.key]) for i in range(count)]
+    return [network, subnet, firewall] + instances
+
+
+def test_independent_resources_are_created_at_once():
+    compute = FakeBackend(default=0.05)
+    done = provision.create(_cluster(), compute=compute)
+    assert len(done) == 9
+    # the subnet and the firewall rule, then all the instances
+    assert compute.max_in_flight >= 6
+    assert len([call for call in compute.calls if call[0] == 'create']) == 9
+
+
+def test_dependencies_are_created_first():
+    compute = FakeBackend(default=0.01)
+    order = []
+    create = compute.create
+    def recording(resource):
+        order.append(resource.key)
+        missing = [dep for dep in resource.deps if dep not in compute.resources]
+        assert not missing, '{0} created before {1}'.format(resource.key, missing)
+        return create(resource)
+    compute.create = recording
+    provision.create(list(reversed(_cluster(3))), compute=compute)
+    assert order[0] == 'networks/net'
+    assert order.index('networks-subnets/subnet') < min(order.index('instances/node-{0}'.format(i)) for i in range(3))
+
+
+def test_pending_operations_are_polled_together():
+    compute = FakeBackend(latency={'instances': 0.1}, default=0.0)
+    provision.create(_cluster(8), compute=compute)
+    polls = [call for call in compute.calls if call[0] == 'poll']
+    assert polls and max(count for _, count in polls) == 8
+
+
+def test_failure_stops_what_depends_on_it():
+    compute = FakeBackend(default=0.01, failing=['subnet'])
+    with pytest.raises(ProvisionError) as error:
+        provision.create(_cluster(3), compute=compute)
+    assert 'networks-subnets/subnet: simulated failure' in str(error.value)
+    assert not [key for key in compute.resources if key.startswith('instances/')]
+
+
+def test_existing_resources_count_as_created():
+    compute = FakeBackend(default=0.0)
+    provision.create(_cluster(2), compute=compute)
+    assert len(provision.create(_cluster(2), compute=compute)) == 5
+
+
+def test_gcloud_calls_from_threads_leave_fabric_env_alone(tmp_path, monkeypatch):
+    gcloud = tmp_path / 'gcloud'
+    gcloud.write_text('#!/bin/sh\ncase "$*" in *bad*) echo "quota exceeded" >&2; exit 1;; esac\n')
+    os.chmod(str(gcloud), 0o755)
+    monkeypatch.setenv('PATH', str(tmp_path) + os.pathsep + os.environ['PATH'])
+    compute = provision.GcloudBackend()
+    before = (env.warn_only, output['stdout'], output['running'])
+    results = {}
+    def create(name):
+        results[name] = provision.create([Resource('addresses', name)], compute=compute)
+    threads = [threading.Thread(target=create, args=('ok-{0}'.format(i),)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == 8
+    with pytest.raises(ProvisionError) as error:
+        provision.create([Resource('addresses', 'bad')], compute=compute)
+    assert 'quota exceeded' in str(error.value)
+    assert (env.warn_only, output['stdout'], output['running']) == before
@@ -0,0 +1,211 @@
+import copy
+import os
+import threading
+
+import pytest
+import yaml
+
+import rotation
+import templating
+from conftest import ROOT
+from rotation import ApiError, FakeApi, Keyring, RateLimiter, RotationError, State
+
+
+class Clock(object):
+    """
+    Time that only moves when something sleeps
+    """
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            return self.now
+
+    def sleep(self, seconds):
+        with self._lock:
+            self.sleeps.append(seconds)
+            self.now += seconds
+
+
+def _rotated(count, **kwargs):
+    """
+    An API holding count Secrets written with key1, now writing with key2
+    """
+    api = FakeApi(count, **kwargs)
+    api.write_key = 'key2'
+    return api
+
+
+def _reencrypt(api, **kwargs):
+    clock = kwargs.pop('clock', None) or Clock()
+    kwargs.setdefault('rate', 1000)
+    kwargs.setdefault('backoff', 0.5)
+    return rotation.reencrypt(api, clock=clock, sleep=clock.sleep, **kwargs)
+
+
+def test_every_page_is_listed_and_rewritten():
+    api = _rotated(25)
+    saved = []
+    checkpoint = _reencrypt(api, page=10, save=lambda checkpoint: saved.append(dict(checkpoint)))
+    assert api.lists == 3 and api.replaces == 25
+    assert checkpoint == {'done': 25, 'skipped': 0, 'pages': 3, 'continue': None}
+    assert [c['continue'] for c in saved] == ['10', '20', None]
+    assert api.stale() == []
+
+
+def test_writers_never_exceed_parallel():
+    api = _rotated(40, latency=0.01)
+    rotation.reencrypt(api, rate=10000, parallel=3, page=40)
+    assert 1 < api.max_in_flight <= 3
+
+
+def test_writes_are_held_to_the_rate():
+    clock = Clock()
+    writes = []
+    api = _rotated(200)
+    replace = api.replace
+    def timed(secret):
+        writes.append(clock())
+        return replace(secret)
+    api.replace = timed
+    _reencrypt(api, clock=clock, rate=50, parallel=4, page=50)
+    assert len(writes) == 200
+    # the first parallel writes use the saved-up tokens, the rest wait for theirs
+    assert clock() - 1000.0 >= (200 - 4) / 50.0 - 1e-6
+    for i in range(len(writes)):
+        in_a_second = [t for t in writes if writes[i] <= t < writes[i] + 1.0]
+        assert len(in_a_second) <= 50 + 4
+
+
+def test_rate_limiter_waits_for_a_token():
+    clock = Clock()
+    limiter = RateLimiter(10, burst=2, clock=clock, sleep=clock.sleep)
+    for _ in range(5):
+        limiter.acquire()
+    # two from the burst, then one every 0.1s
+    assert clock() - 1000.0 == pytest.approx(0.3)
+
+
+def test_a_conflict_counts_as_skipped():
+    api = _rotated(12, conflicts=['ns3/secret-3', 'ns7/secret-7'])
+    checkpoint = _reencrypt(api)
+    assert (checkpoint['done'], checkpoint['skipped']) == (10, 2)
+    # whoever wrote them in between wrote them with the new key
+    assert api.stale() == []
+
+
+def test_an_unavailable_server_is_retried():
+    clock = Clock()
+    api = _rotated(5, failing=['ns2/secret-2'], failures=2)
+    checkpoint = _reencrypt(api, clock=clock, retries=5, backoff=0.5)
+    assert checkpoint['done'] == 5 and api.replaces == 7
+    assert [s for s in clock.sleeps if s >= 0.5] == [0.5, 1.0]
+    assert api.stale() == []
+
+
+def test_a_server_unavailable_past_the_retries_stops_the_rewrite():
+    api = _rotated(5, failing=['ns2/secret-2'], failures=3)
+    with pytest.raises(ApiError) as error:
+        _reencrypt(api, retries=3)
+    assert error.value.status == 503
+
+
+def test_an_expired_list_position_starts_the_listing_over():
+    api = _rotated(30, expire_after=2)
+    logged = []
+    checkpoint = _reencrypt(api, page=10, log=logged.append)
+    assert '[rotation] list position expired, listing from the start again' in logged
+    # two pages went by before the listing started over and were written twice
+    assert checkpoint['done'] == 50 and api.replaces == 50
+    assert api.stale() == []
+
+
+def test_a_rewrite_carries_on_from_the_saved_checkpoint(tmp_path):
+    path = str(tmp_path / 'rotation.json')
+    state = State(key='key2', done=['add', 'promote'])
+
+    class Interrupted(Exception):
+        pass
+
+    def save_then_stop(checkpoint):
+        state.save(path)
+        if checkpoint['pages'] == 2:
+            raise Interrupted()
+
+    api = _rotated(50)
+    with pytest.raises(Interrupted):
+        _reencrypt(api, checkpoint=state.checkpoint, save=save_then_stop, page=10)
+    assert api.replaces == 20
+
+    resumed = State.load(path)
+    assert (resumed.key, resumed.pending) == ('key2', ['rewrite', 'prune'])
+    assert resumed.checkpoint == {'done': 20, 'skipped': 0, 'pages': 2, 'continue': '20'}
+    checkpoint = _reencrypt(api, checkpoint=resumed.checkpoint, page=10)
+    # nothing written before the interruption is written again
+    assert api.replaces == 50 and api.lists == 5
+    assert checkpoint == {'done': 50, 'skipped': 0, 'pages': 5, 'continue': None}
+    assert api.stale() == []
+
+
+def test_state_round_trip(tmp_path):
+    path = str(tmp_path / 'rotation.json')
+    assert State.load(path) is None
+    assert State(key='key3').pending == list(rotation.PHASES)
+    State(key='key3', done=['add'], checkpoint={'continue': 'abc', 'done': 7}).save(path)
+    state = State.load(path)
+    assert (state.key, state.done, state.checkpoint) == ('key3', ['add'], {'continue': 'abc', 'done': 7})
+    assert state.pending == ['promote', 'rewrite', 'prune']
+    State.remove(path)
+    assert not os.path.exists(path)
+
+
+def _config_keys(monkeypatch, tmp_path, keyring):
+    monkeypatch.setitem(templating.settings, 'module_directory', str(tmp_path / 'modules'))
+    text = templating.render(os.path.join(ROOT, 'templates', 'encryption-config.mako'), keys=keyring.keys)
+    providers = yaml.safe_load(text)['resources'][0]['providers']
+    assert providers[-1] == {'identity': {}}
+    return [key['name'] for key in providers[0]['aescbc']['keys']]
+
+
+def test_keys_are_added_promoted_and_pruned_in_order(monkeypatch, tmp_path):
+    keyring = Keyring()
+    keyring.add()
+    old = copy.deepcopy(keyring.keys)
+    new = keyring.next_name()
+    assert new == 'key2'
+
+    # add: readable everywhere, written with nowhere
+    assert keyring.add(new) == 'key2'
+    keyring.add(new)
+    assert _config_keys(monkeypatch, tmp_path, keyring) == ['key1', 'key2']
+    assert keyring.primary == 'key1'
+    # promote: written with, the old key still reads what isn't rewritten yet
+    keyring.promote(new)
+    assert _config_keys(monkeypatch, tmp_path, keyring) == ['key2', 'key1']
+    assert keyring.primary == 'key2'
+    # prune, once every Secret is rewritten
+    assert keyring.prune() == ['key1']
+    assert _config_keys(monkeypatch, tmp_path, keyring) == ['key2']
+    assert keyring.keys[0]['secret'] != old[0]['secret']
+    with pytest.raises(RotationError):
+        keyring.promote('key9')
+
+
+def test_keyring_round_trip_and_a_keyring_from_an_old_config(monkeypatch, tmp_path):
+    path = str(tmp_path / 'keys.json')
+    keyring = Keyring()
+    keyring.promote(keyring.add())
+    keyring.save(path)
+    assert Keyring.load(path).keys == keyring.keys
+
+    # a cluster set up before the keyring has its key in the rendered config only
+    config = tmp_path / 'encryption-config.yaml'
+    monkeypatch.setitem(templating.settings, 'module_directory', str(tmp_path / 'modules'))
+    config.write_text(templating.render(os.path.join(ROOT, 'templates', 'encryption-config.mako'), keys=keyring.keys))
+    loaded = Keyring.load(str(tmp_path / 'missing.json'), config=str(config))
+    assert loaded.keys == keyring.keys
+    assert loaded.next_name() == 'key2'
+    assert Keyring.load(str(tmp_path / 'missing.json'), config=str(tmp_path / 'missing.yaml')).keys == []
@@ -0,0 +1,88 @@
+
+import pytest
+
+import fanout
+import session
+from session import RemoteSession
+
+
+@pytest.fixture
+def transport(tmp_path, monkeypatch):
+    """
+    A local shell in place of ssh, logging the host of every connection
+    """
+    log = tmp_path / 'connections.log'
+    log.touch()
+    monkeypatch.setitem(session.settings, 'transport', 'echo {host} >> ' + str(log) + '; bash -s < {script}')
+    return log
+
+
+def test_script_frames_every_command_with_markers():
+    s = RemoteSession('worker-0')
+    s.run('echo one')
+    s.run('false')
+    script = s.script()
+    assert script.count("echo '{0} begin".format(s.marker)) == 2
+    assert script.count("echo '{0} end".format(s.marker)) == 2
+    assert script.endswith('exit 0\n')
+
+
+def test_parse_splits_the_output_by_command():
+    s = RemoteSession('worker-0')
+    s.run('a')
+    s.run('b')
+    s.run('c')
+    output = '\n'.join([
+        'motd noise',
+        '{0} begin 0'.format(s.marker), 'first', 'lines', '{0} end 0 0'.format(s.marker),
+        '{0} begin 1'.format(s.marker), 'no newline{0} end 1 3'.format(s.marker),
+    ])
+    results = s.parse(output)
+    assert [(r.command, r.exit_code, r.output) for r in results] == [
+        ('a', 0, 'first\nlines'), ('b', 3, 'no newline'), ('c', None, '')]
+
+
+def test_a_connection_lost_mid_command_keeps_its_output():
+    s = RemoteSession('worker-0')
+    s.run('a')
+    result, = s.parse('{0} begin 0\nhalf'.format(s.marker))
+    assert (result.exit_code, result.output) == (None, 'half')
+
+
+def test_commands_run_in_order_over_one_connection(transport, tmp_path):
+    with RemoteSession('worker-0') as s:
+        s.run('echo one')
+        s.run('printf "two, no newline"')
+        s.run('echo "three" && cat')
+        assert session.active('worker-0') is s
+    assert session.active('worker-0') is None
+    assert [(r.exit_code, r.output) for r in s.results] == [(0, 'one'), (0, 'two, no newline'), (0, 'three')]
+    assert transport.read_text() == 'worker-0\n'
+
+
+def test_a_failure_stops_the_commands_after_it(transport, tmp_path, capsys):
+    after = tmp_path / 'after'
+    s = RemoteSession('worker-0')
+    s.run('echo before')
+    s.run('echo broken >&2; exit 4')
+    s.run('touch {0}'.format(after))
+    with pytest.raises(SystemExit):
+        s.flush()
+    assert [(r.exit_code, r.output) for r in s.results] == [(0, 'before'), (4, 'broken'), (None, '')]
+    assert not after.exists()
+    assert "worker-0: 'echo broken >&2; exit 4' exited with 4" in capsys.readouterr().err
+
+
+def test_batched_hosts_make_one_connection_each(transport):
+    def body(host):
+        for i in range(5):
+            session.active(host).run('echo {0} {1}'.format(host, i))
+    hosts = ['worker-{0}'.format(i) for i in range(4)]
+    fanout.execute(session.batched(body, str), hosts, parallel=4)
+    assert sorted(transport.read_text().split()) == hosts
+
+
+def test_one_session_per_host_and_thread():
+    with RemoteSession('worker-0'):
+        with pytest.raises(RuntimeError):
+            RemoteSession('worker-0').__enter__()
@@ -0,0 +1,104 @@
+import pytest
+
+import provision
+import teardown
+import topology
+from provision import FakeBackend, Resource
+
+
+@pytest.fixture(autouse=True)
+def fast_polls(monkeypatch):
+    monkeypatch.setitem(provision.settings, 'interval', 0.01)
+    monkeypatch.setitem(provision.settings, 'max_interval', 0.02)
+
+
+def _cluster(name, pod_cidr, prefix=''):
+    """
+    The resources the setup creates for a cluster called name, instances
+    named prefix + node name so two clusters fit in one fake
+    """
+    cluster = topology.Topology(name=name, subnet=name, pod_cidr=pod_cidr, controllers=2, workers=2)
+    names = cluster.resource_names
+    network = Resource('networks', name, '--subnet-mode custom')
+    subnet = Resource('networks subnets', name, '--network {0} --range 10.240.0.0/24'.format(name), deps=[network.key])
+    resources = [
+        network, subnet,
+        Resource('firewall-rules', names['internal-firewall'], '--network {0}'.format(name), deps=[network.key]),
+        Resource('firewall-rules', names['external-firewall'], '--network {0}'.format(name), deps=[network.key]),
+        Resource('firewall-rules', names['health-check-firewall'], '--network {0}'.format(name), deps=[network.key]),
+        Resource('addresses', name, '--region us-west1'),
+        Resource('http-health-checks', names['http-health-check']),
+    ]
+    for node in cluster.nodes:
+        instance = Resource('instances', prefix + node.name, '--subnet {0} --tags {0},{1}'.format(name, node.role),
+                            deps=[subnet.key])
+        resources.append(instance)
+        if node.role == 'worker':
+            resources.append(Resource('routes', cluster.route_name(node), '--network {0} --next-hop-address {1}'.format(
+                name, node.internal_ip), deps=[network.key]))
+    # GCE drops a deleted instance from its target pool, so the pool doesn't hold the controllers
+    pool = Resource('target-pools', names['target-pool'], '--region us-west1',
+                    deps=['http-health-checks/' + names['http-health-check']])
+    resources += [pool, Resource('forwarding-rules', names['forwarding-rule'], '--region us-west1',
+                                 deps=[pool.key, 'addresses/' + name])]
+    return resources
+
+
+@pytest.fixture
+def compute():
+    compute = FakeBackend(default=0.0)
+    provision.create(_cluster('kubernetes-the-hard-way', '10.200.0.0/16'), compute=compute)
+    provision.create(_cluster('staging', '10.201.0.0/16', prefix='staging-'), compute=compute)
+    # GCE adds these to every network and deletes them with it; they can't be deleted on their own
+    provision.create([Resource('routes', 'default-route-1f2e', '--network kubernetes-the-hard-way'),
+                      Resource('routes', 'default-route-9c4d', '--network kubernetes-the-hard-way')], compute=compute)
+    return compute
+
+
+def test_discover_finds_only_the_cluster(compute):
+    found = teardown.discover('kubernetes-the-hard-way', 'us-west1', compute=compute)
+    assert found['instances'] == (['controller-0', 'controller-1', 'worker-0', 'worker-1'], '')
+    assert found['routes'][0] == ['kubernetes-route-10-200-0-0-24', 'kubernetes-route-10-200-1-0-24']
+    assert found['firewall-rules'][0] == ['kubernetes-the-hard-way-allow-external',
+                                          'kubernetes-the-hard-way-allow-health-check',
+                                          'kubernetes-the-hard-way-allow-internal']
+    assert found['target-pools'] == (['kubernetes-the-hard-way-target-pool'], '--region us-west1')
+    assert found['http-health-checks'][0] == ['kubernetes-the-hard-way-health-check']
+    assert found['forwarding-rules'][0] == ['kubernetes-the-hard-way-forwarding-rule']
+    assert found['addresses'][0] == ['kubernetes-the-hard-way']
+    assert found['networks subnets'][0] == ['kubernetes-the-hard-way']
+    assert found['networks'][0] == ['kubernetes-the-hard-way']
+
+
+def test_layers_delete_dependents_first(compute):
+    found = teardown.discover('kubernetes-the-hard-way', 'us-west1', compute=compute)
+    assert teardown.layers(found) == [
+        ['firewall-rules', 'instances', 'routes'],
+        ['forwarding-rules', 'networks subnets'],
+        ['addresses', 'networks', 'target-pools'],
+        ['http-health-checks'],
+    ]
+
+
+def test_run_deletes_the_cluster_and_leaves_the_other(compute):
+    found = teardown.discover('kubernetes-the-hard-way', 'us-west1', compute=compute)
+    report, failed = teardown.run(found, compute=compute)
+    assert failed == {}
+    assert [kind for _, kind, _, _ in report] == [
+        kind for layer in teardown.layers(found) for kind in layer]
+    # the default routes go with the network in GCE, they were never asked for
+    staging = [resource.key for resource in _cluster('staging', '10.201.0.0/16', prefix='staging-')]
+    assert sorted(compute.resources) == sorted(staging + ['routes/default-route-1f2e', 'routes/default-route-9c4d'])
+    assert teardown.discover('kubernetes-the-hard-way', 'us-west1', compute=compute) == {}
+
+
+def test_a_failed_delete_skips_what_waits_for_it(compute):
+    found = teardown.discover('kubernetes-the-hard-way', 'us-west1', compute=compute)
+    # a forwarding rule nobody listed still holds the target pool
+    compute.resources['forwarding-rules/manual'] = Resource(
+        'forwarding-rules', 'manual', deps=['target-pools/kubernetes-the-hard-way-target-pool'])
+    report, failed = teardown.run(found, compute=compute)
+    assert failed['target-pools'].startswith('in use by forwarding-rules/manual')
+    assert failed['http-health-checks'].startswith('skipped')
+    assert 'networks' not in failed
+    assert 'http-health-checks/kubernetes-the-hard-way-health-check' in compute.resources
@@ -0,0 +1,47 @@
+import os
+
+import pytest
+
+import templating
+
+
+@pytest.fixture
+def templates(tmp_path, monkeypatch):
+    monkeypatch.setitem(templating.settings, 'module_directory', str(tmp_path / 'modules'))
+    monkeypatch.setattr(templating, '_templates', {})
+    path = tmp_path / 'unit.mako'
+    path.write_text('ExecStart=/bin/${name} --address=${ip}\n')
+    return path
+
+
+def test_a_template_is_compiled_once(templates):
+    template = templating.get(str(templates))
+    assert templating.get(str(templates)) is template
+    assert templating.render(str(templates), name='etcd', ip='10.240.0.10') == 'ExecStart=/bin/etcd --address=10.240.0.10\n'
+    assert os.listdir(templating.settings['module_directory']) == [templating.digest(str(templates))[:16]]
+
+
+def test_a_changed_template_compiles_into_another_module_directory(templates):
+    templating.get(str(templates))
+    templates.write_text('ExecStart=/usr/bin/${name}\n')
+    templating.clear()
+    assert templating.render(str(templates), name='etcd') == 'ExecStart=/usr/bin/etcd\n'
+    assert len(os.listdir(templating.settings['module_directory'])) == 2
+
+
+def test_render_many_writes_every_destination(templates, tmp_path):
+    out = tmp_path / 'out'
+    variants = [(str(out / 'controller-{0}'.format(i) / 'etcd.service'), dict(name='etcd', ip='10.240.0.1{0}'.format(i)))
+                for i in range(3)]
+    written = templating.render_many(str(templates), variants)
+    assert written == [destination for destination, _ in variants]
+    for i, path in enumerate(written):
+        with open(path) as f:
+            assert f.read() == 'ExecStart=/bin/etcd --address=10.240.0.1{0}\n'.format(i)
+    assert len(templating._templates) == 1
+
+
+def test_render_to_a_file_in_the_working_directory(templates, tmp_path, monkeypatch):
+    monkeypatch.chdir(str(tmp_path))
+    assert templating.render_to(str(templates), 'unit.service', name='kubelet', ip='10.240.0.20') == 'unit.service'
+    assert (tmp_path / 'unit.service').read_text() == 'ExecStart=/bin/kubelet --address=10.240.0.20\n'
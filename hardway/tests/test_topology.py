@@ -0,0 +1,129 @@
+import json
+import subprocess
+import sys
+
+import pytest
+
+import topology
+from topology import Topology, TopologyError
+
+
+def test_default_layout():
+    cluster = Topology()
+    assert [node.internal_ip for node in cluster.controllers] == ['10.240.0.10', '10.240.0.11', '10.240.0.12']
+    assert [(node.internal_ip, node.pod_cidr) for node in cluster.workers] == [
+        ('10.240.0.20', '10.200.0.0/24'), ('10.240.0.21', '10.200.1.0/24'), ('10.240.0.22', '10.200.2.0/24')]
+    assert (cluster.api_service_ip, cluster.dns_service_ip) == ('10.32.0.1', '10.32.0.10')
+    assert cluster.api_server_sans('203.0.113.7') == [
+        '10.32.0.1', '10.240.0.10', '10.240.0.11', '10.240.0.12', '203.0.113.7', '127.0.0.1', 'kubernetes.default']
+    assert cluster.etcd_servers() == 'https://10.240.0.10:2379,https://10.240.0.11:2379,https://10.240.0.12:2379'
+    assert cluster.route_name(cluster.workers[2]) == 'kubernetes-route-10-200-2-0-24'
+
+
+def test_layout_past_ten_nodes():
+    cluster = Topology(controllers=12, workers=30, controller_offset=2, worker_offset=100)
+    assert cluster.controllers[11].internal_ip == '10.240.0.13'
+    assert (cluster.workers[29].internal_ip, cluster.workers[29].pod_cidr) == ('10.240.0.129', '10.200.29.0/24')
+    assert len(set(node.internal_ip for node in cluster.nodes)) == 42
+    assert len(set(node.pod_cidr for node in cluster.workers)) == 30
+
+
+def test_layout_across_octets():
+    cluster = Topology(workers=1000, node_cidr='10.240.0.0/20', pod_prefix=26)
+    assert cluster.workers[299].internal_ip == '10.240.1.63'
+    assert cluster.workers[999].internal_ip == '10.240.3.251'
+    assert cluster.workers[5].pod_cidr == '10.200.1.64/26'
+    assert cluster.workers[999].pod_cidr == '10.200.249.192/26'
+    pods = [node.pod_cidr for node in cluster.workers]
+    assert len(set(pods)) == 1000
+
+
+def test_the_last_addresses_fit():
+    # 10.240.0.254 and .255 are GCE's, .253 is the last a node can have
+    cluster = Topology(workers=234)
+    assert cluster.workers[-1].internal_ip == '10.240.0.253'
+
+
+@pytest.mark.parametrize('options, message', [
+    ({'workers': 235}, '235 workers starting at offset 20 do not fit in 10.240.0.0/24'),
+    ({'controller_offset': 1}, '3 controllers starting at offset 1 do not fit'),
+    ({'controllers': 11}, 'controller addresses 10-20 overlap worker addresses 20-22'),
+    ({'worker_offset': 11}, 'controller addresses 10-12 overlap worker addresses 11-13'),
+    ({'workers': 257, 'node_cidr': '10.240.0.0/16'},
+     '10.200.0.0/16 has room for 256 /24 pod CIDRs, 257 workers need one each'),
+    ({'pod_prefix': 8}, 'pod_prefix /8 does not fit in 10.200.0.0/16'),
+    ({'pod_prefix': 33}, 'pod_prefix /33 does not fit'),
+    ({'service_cidr': '10.200.5.0/24'}, 'node, pod and service CIDRs must not overlap'),
+    ({'pod_cidr': '10.0.0.0/8'}, 'node, pod and service CIDRs must not overlap'),
+    ({'controllers': 0}, 'a cluster needs at least one controller'),
+    ({'workers': -1}, 'worker count can not be negative'),
+    ({'nodes': 3}, 'unknown topology settings: nodes'),
+])
+def test_bad_layouts_are_rejected(options, message):
+    with pytest.raises(TopologyError) as error:
+        Topology(**options)
+    assert message in str(error.value)
+
+
+def test_load_names_the_file(tmp_path):
+    path = tmp_path / 'big.yaml'
+    path.write_text('workers: 300\n')
+    with pytest.raises(TopologyError) as error:
+        topology.load(str(path))
+    assert str(error.value).startswith(str(path) + ': 300 workers')
+
+
+def test_the_cluster_name_reaches_every_resource(sandbox):
+    (sandbox / 'cluster.yaml').write_text('name: staging\nworkers: 2\n')
+    code = '''
+import json, facts, inventory, fabfile as f
+cluster = f.topology.current()
+resources = (f._network_resources(cluster.name, str(cluster.node_network), cluster.subnet) +
+             f._firewall_resources(cluster.name) + f._address_resources(cluster.name, 'us-west1') +
+             f._instance_resources(cluster.nodes, 'worker') + f._route_resources())
+print(json.dumps({
+    'resources': [[r.key, r.args] + r.deps for r in resources],
+    'network': facts._network(), 'tag': inventory._tag(),
+    'kubeconfig': f._config_spec('admin', 'admin', '127.0.0.1').cluster,
+}))
+'''
+    output = subprocess.check_output([sys.executable, '-W', 'ignore', '-c', code], cwd=str(sandbox))
+    found = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+    assert 'kubernetes-the-hard-way' not in json.dumps(found)
+    assert (found['network'], found['tag'], found['kubeconfig']) == ('staging', 'staging', 'staging')
+    keys = [resource[0] for resource in found['resources']]
+    assert 'networks/staging' in keys and 'addresses/staging' in keys
+    assert {'firewall-rules/staging-allow-internal', 'firewall-rules/staging-allow-external'} <= set(keys)
+    assert all('--tags staging,' in args for key, args in [r[:2] for r in found['resources']]
+               if key.startswith('instances/'))
+    assert all('--network staging ' in args for key, args in [r[:2] for r in found['resources']]
+               if key.startswith(('routes/', 'firewall-rules/', 'networks-subnets/')))
+
+
+def test_teardown_finds_the_load_balancer_setup_creates(sandbox):
+    (sandbox / 'cluster.yaml').write_text('name: staging\nworkers: 1\n')
+    code = '''
+import json, facts, teardown, fabfile as f
+commands = []
+f.local = commands.append
+facts.public_ip = lambda: '203.0.113.7'
+facts.region = lambda: 'us-west1'
+f.setup_lb()
+print(json.dumps({'commands': commands, 'targets': teardown.targets('staging', 'us-west1')}))
+'''
+    output = subprocess.check_output([sys.executable, '-W', 'ignore', '-c', code], cwd=str(sandbox))
+    found = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+    created = dict((command.split()[2], command.split()[4]) for command in found['commands']
+                   if command.split()[3] == 'create')
+    assert created == {
+        'http-health-checks': 'staging-health-check',
+        'firewall-rules': 'staging-allow-health-check',
+        'target-pools': 'staging-target-pool',
+        'forwarding-rules': 'staging-forwarding-rule',
+    }
+    filters = dict((kind, filter) for kind, filter, flags in found['targets'])
+    for kind in ('http-health-checks', 'target-pools', 'forwarding-rules'):
+        assert filters[kind] == 'name=' + created[kind]
+    assert not any(old in json.dumps(found) for old in
+                   ('kubernetes-the-hard-way', 'kubernetes-target-pool', 'kubernetes-forwarding-rule',
+                    'health-check kubernetes', 'create kubernetes '))
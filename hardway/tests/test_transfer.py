@@ -0,0 +1,81 @@
+import os
+import stat
+import subprocess
+import tarfile
+
+import pytest
+
+import transfer
+from transfer import Entry
+
+
+def _files(tmp_path):
+    src = tmp_path / 'src'
+    src.mkdir()
+    (src / 'kubelet').write_bytes(b'\x7fELF binary')
+    (src / 'ca.pem').write_text('certificate\n')
+    (src / 'key.pem').write_text('secret\n')
+    return src
+
+
+def _manifest(src):
+    return [
+        (str(src / 'kubelet'), '/usr/local/bin/kubelet', 0o755),
+        (str(src / 'ca.pem'), '/var/lib/kubernetes/ca.pem'),
+        Entry(str(src / 'key.pem'), '/var/lib/kubernetes/key.pem', '0600', 'nobody:nogroup'),
+    ]
+
+
+@pytest.mark.parametrize('compress', [True, False])
+def test_archive_members_carry_destination_mode_and_owner(tmp_path, compress):
+    path = transfer.pack(_manifest(_files(tmp_path)), compress=compress)
+    try:
+        assert path.endswith('.tar.gz' if compress else '.tar')
+        with tarfile.open(path) as archive:
+            members = [(m.name, oct(m.mode), m.uname, m.gname, m.isfile()) for m in archive.getmembers()]
+            assert archive.extractfile('usr/local/bin/kubelet').read() == b'\x7fELF binary'
+    finally:
+        os.remove(path)
+    assert members == [
+        ('usr/local/bin/kubelet', '0o755', 'root', 'root', True),
+        ('var/lib/kubernetes/ca.pem', '0o644', 'root', 'root', True),
+        ('var/lib/kubernetes/key.pem', '0o600', 'nobody', 'nogroup', True),
+    ]
+
+
+@pytest.mark.parametrize('compress', [True, False])
+def test_install_command_puts_every_file_in_place(tmp_path, compress):
+    src = _files(tmp_path)
+    root = tmp_path / 'root'
+    (root / 'var/lib').mkdir(parents=True)
+    (root / 'var/lib').chmod(0o711)
+    remote = tmp_path / transfer.remote_name(compress)
+    transfer.pack(_manifest(src), path=str(remote), compress=compress)
+    # the command the host runs, as the user running the tests and into root
+    # instead of /
+    command = transfer.install_command(str(remote)).replace('sudo ', '').replace(' -C / ', ' -C {0} '.format(root))
+    subprocess.check_call(command, shell=True)
+
+    assert not remote.exists()
+    assert (root / 'usr/local/bin/kubelet').read_bytes() == b'\x7fELF binary'
+    assert (root / 'var/lib/kubernetes/ca.pem').read_text() == 'certificate\n'
+    assert stat.S_IMODE((root / 'usr/local/bin/kubelet').stat().st_mode) == 0o755
+    assert stat.S_IMODE((root / 'var/lib/kubernetes/ca.pem').stat().st_mode) == 0o644
+    key = (root / 'var/lib/kubernetes/key.pem').stat()
+    assert stat.S_IMODE(key.st_mode) == 0o600
+    if os.geteuid() == 0:
+        assert (key.st_uid, key.st_gid) == (65534, 65534)
+    # only files are in the archive, so directories already there are left alone
+    assert stat.S_IMODE((root / 'var/lib').stat().st_mode) == 0o711
+
+
+def test_entries_need_absolute_destinations():
+    with pytest.raises(ValueError):
+        Entry('kubelet', 'usr/local/bin/kubelet')
+
+
+def test_manifest_normalizes_tuples():
+    entry, = transfer.manifest([('a', '/etc/a', '0640', 'etcd')])
+    assert (entry.mode, entry.user, entry.group) == (0o640, 'etcd', 'etcd')
+    assert transfer.remote_name(compress=False).endswith('.tar')
+    assert transfer.install_command('x.tar') == 'sudo tar --same-owner --same-permissions -xf x.tar -C / && rm -f x.tar'
@@ -0,0 +1,113 @@
+import pytest
+
+import topology
+import tuning
+from conftest import GOLDEN, check_golden, render_configs
+from tuning import TuningError
+
+API_SERVER = 'controller-0/etc/systemd/system/kube-apiserver.service'
+KUBELET = 'worker-0/var/lib/kubelet/kubelet-config.yaml'
+
+
+@pytest.mark.parametrize('profile', ['auto', 'small', 'medium', 'large'])
+def test_renders_match_golden(sandbox, profile):
+    rendered = render_configs(sandbox, 'f.use_tuning(profile={0!r})'.format(profile))
+    check_golden(rendered, 'tuning/' + profile, [API_SERVER, KUBELET])
+
+
+def test_tuning_file_overrides_the_profile(sandbox):
+    (sandbox / 'tuned.yaml').write_text(
+        'profile: medium\n'
+        'apiserver:\n  max_requests_inflight: 1200\n  watch_cache_sizes: {secrets: 100}\n'
+        'kubelet:\n  max_pods: 60\n  eviction_hard: {memory.available: 300Mi}\n')
+    rendered = render_configs(sandbox, 'f.use_tuning(path="tuned.yaml")')
+    with open('{0}/{1}'.format(rendered, API_SERVER)) as f:
+        unit = f.read()
+    assert '--max-requests-inflight=1200 ' in unit
+    assert '--watch-cache-sizes=endpoints#1000,nodes#500,pods#2000,secrets#100 ' in unit
+    with open('{0}/{1}'.format(rendered, KUBELET)) as f:
+        config = f.read()
+    assert 'maxPods: 60' in config
+    assert '300Mi' in config
+
+
+def _cluster(workers, machine_type='n1-standard-1'):
+    return topology.Topology(workers=workers, machine_type=machine_type, node_cidr='10.240.0.0/20', pod_prefix=26)
+
+
+def test_auto_sizes_to_the_cluster():
+    assert [tuning.size_for(_cluster(n)) for n in (3, 10, 11, 100, 101, 1000)] == [
+        'small', 'small', 'medium', 'medium', 'large', 'large']
+    # 60MB per node, at most half the memory of the machine
+    assert tuning.derive(_cluster(3))['apiserver']['target_ram_mb'] == 360
+    assert tuning.derive(_cluster(200))['apiserver']['target_ram_mb'] == 3840 // 2
+    assert tuning.derive(_cluster(200, 'n1-standard-32'))['apiserver']['target_ram_mb'] == 203 * 60
+
+
+def _profile(section=None, **values):
+    tuned = tuning._copy(tuning.PROFILES['medium'])
+    if section:
+        tuned[section].update(values)
+    return tuned
+
+
+@pytest.mark.parametrize('profile', sorted(tuning.PROFILES))
+def test_profiles_are_valid(profile):
+    tuning.validate(tuning._copy(tuning.PROFILES[profile]))
+
+
+@pytest.mark.parametrize('tuned, message', [
+    (_profile('apiserver', max_requests_inflight=0), 'apiserver.max_requests_inflight must be between 1 and 100000, got 0'),
+    (_profile('apiserver', max_requests_inflight='800'), "apiserver.max_requests_inflight must be int, got '800'"),
+    (_profile('kubelet', max_pods=True), 'kubelet.max_pods must be int, got True'),
+    (_profile('kubelet', max_pods=501), 'kubelet.max_pods must be between 1 and 500, got 501'),
+    (_profile('kubelet', serialize_image_pulls='no'), "kubelet.serialize_image_pulls must be bool, got 'no'"),
+    (_profile('kubelet', kube_api_qbs=5), 'unknown kubelet settings: kube_api_qbs'),
+    (_profile('apiserver', max_mutating_requests_inflight=900), 'max_mutating_requests_inflight is above'),
+    (_profile('kubelet', kube_api_burst=10), 'kube_api_burst must be at least kube_api_qps'),
+    (_profile('kubelet', registry_burst=5), 'registry_burst must be at least registry_pull_qps'),
+    (_profile('apiserver', watch_cache_sizes={'Pods': 10}), "'Pods' is not a resource name"),
+    (_profile('apiserver', watch_cache_sizes={'pods': -1}), 'size must be a whole number >= 0, got -1'),
+    (_profile('kubelet', eviction_hard={'memory.free': '1Gi'}), "unknown eviction signal 'memory.free'"),
+    (_profile('kubelet', eviction_hard={'memory.available': '1GB'}), "'1GB' is not a quantity"),
+])
+def test_validate_rejects_bad_values(tuned, message):
+    with pytest.raises(TuningError) as error:
+        tuning.validate(tuned)
+    assert message in str(error.value)
+
+
+def test_validate_rejects_missing_settings():
+    tuned = _profile()
+    del tuned['kubelet']['max_pods']
+    with pytest.raises(TuningError) as error:
+        tuning.validate(tuned)
+    assert str(error.value) == 'missing kubelet settings: max_pods'
+
+
+def test_bad_files_and_profiles_are_rejected(tmp_path):
+    path = tmp_path / 'tuning.yaml'
+    path.write_text('profile: medium\nscheduler: {}\n')
+    with pytest.raises(TuningError) as error:
+        tuning.load(str(path))
+    assert 'unknown sections scheduler' in str(error.value)
+    with pytest.raises(TuningError):
+        tuning.use(profile='huge')
+
+
+def test_checks_catch_a_render_without_the_profile():
+    tuned = tuning.Tuning('medium', _profile()['apiserver'], _profile()['kubelet'])
+    with open('{0}/tuning/medium/{1}'.format(GOLDEN, API_SERVER)) as f:
+        unit = f.read()
+    tuning.check_api_server(unit, tuned)
+    with pytest.raises(TuningError) as error:
+        tuning.check_api_server(unit.replace('--max-requests-inflight=800', '--max-requests-inflight=400'), tuned)
+    assert "kube-apiserver --max-requests-inflight is '400', the profile wants '800'" in str(error.value)
+    with pytest.raises(TuningError):
+        tuning.check_api_server(unit.replace('  --watch-cache-sizes=', '  --x='), tuned)
+    with open('{0}/tuning/medium/{1}'.format(GOLDEN, KUBELET)) as f:
+        config = f.read()
+    tuning.check_kubelet(config, tuned)
+    with pytest.raises(TuningError) as error:
+        tuning.check_kubelet(config.replace('kubeAPIQPS: 20', 'kubeAPIQPS: 5'), tuned)
+    assert 'kubelet config kubeAPIQPS is 5, the profile wants 20' in str(error.value)
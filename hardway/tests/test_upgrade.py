@@ -0,0 +1,136 @@
+import pytest
+
+import bench
+import upgrade
+import versions
+from upgrade import SimulatedFleet, UpgradeError
+
+
+def _run(fleet, phases, **kwargs):
+    kwargs.setdefault('retries', 10)
+    kwargs.setdefault('delay', 1)
+    return upgrade.run(phases, sleep=fleet.sleep, clock=fleet.clock, **kwargs)
+
+
+def _workers(count):
+    return ['worker-{0}'.format(i) for i in range(count)]
+
+
+def test_batches_follow_batch_size_and_max_unavailable():
+    fleet = SimulatedFleet(_workers(10), upgrade_time=3)
+    report = _run(fleet, [fleet.phase('workers', _workers(10), 'new')], size=4, max_unavailable=3)
+    assert [names for _, names, _, _ in report] == [_workers(10)[0:3], _workers(10)[3:6], _workers(10)[6:9],
+                                                    _workers(10)[9:]]
+    assert fleet.max_down == 3
+    assert set(fleet.versions.values()) == {'new'}
+    # down for 3s, checked every second
+    assert [tries for _, _, _, tries in report] == [4, 4, 4, 4]
+    assert [seconds for _, _, seconds, _ in report] == [3.0, 3.0, 3.0, 3.0]
+
+
+def test_quorum_limit_caps_etcd_batches():
+    assert [upgrade.quorum_limit(n) for n in (1, 2, 3, 4, 5, 7)] == [0, 0, 1, 1, 2, 3]
+    members = ['controller-{0}'.format(i) for i in range(5)]
+    fleet = SimulatedFleet(members, upgrade_time=2)
+    phase = fleet.phase('etcd', members, 'v3.4', limit=upgrade.quorum_limit(5))
+    report = _run(fleet, [phase], size=5, max_unavailable=5)
+    assert [len(names) for _, names, _, _ in report] == [2, 2, 1]
+    assert fleet.max_down == 2
+
+
+def test_a_phase_that_cannot_lose_a_node_goes_one_at_a_time():
+    fleet = SimulatedFleet(['controller-0'], upgrade_time=1)
+    report = _run(fleet, [fleet.phase('etcd', ['controller-0'], 'v3.4', limit=upgrade.quorum_limit(1))],
+                  size=3, max_unavailable=3)
+    assert [names for _, names, _, _ in report] == [['controller-0']]
+
+
+def test_phases_run_in_order():
+    controllers = ['controller-0', 'controller-1', 'controller-2']
+    fleet = SimulatedFleet(controllers + _workers(2), upgrade_time=1)
+    _run(fleet, [fleet.phase('etcd', controllers, 'etcd-new', limit=1),
+                 fleet.phase('control-plane', controllers, 'cp-new', limit=2),
+                 fleet.phase('workers', _workers(2), 'node-new')], size=2, max_unavailable=2)
+    assert fleet.upgraded == controllers + controllers + _workers(2)
+    assert fleet.versions == {'controller-0': 'cp-new', 'controller-1': 'cp-new', 'controller-2': 'cp-new',
+                              'worker-0': 'node-new', 'worker-1': 'node-new'}
+
+
+def test_gate_failure_halts_the_upgrade():
+    fleet = SimulatedFleet(_workers(6), upgrade_time=1, failing=['worker-2'])
+    with pytest.raises(UpgradeError) as error:
+        _run(fleet, [fleet.phase('workers', _workers(6), 'new')], size=2, max_unavailable=2, retries=5)
+    assert 'worker-2, worker-3 still unhealthy after 5 tries: up: worker-2 is down' == str(error.value)
+    # the batches after the failing one were never started
+    assert fleet.upgraded == _workers(4)
+    assert [fleet.versions[name] for name in _workers(6)] == ['new'] * 4 + ['old'] * 2
+
+
+def test_resume_after_a_halt_finishes_the_upgrade():
+    fleet = SimulatedFleet(_workers(6), upgrade_time=1, failing=['worker-2'])
+    phase = fleet.phase('workers', _workers(6), 'new')
+    with pytest.raises(UpgradeError):
+        _run(fleet, [phase], size=2, max_unavailable=2, retries=3)
+    # the node is repaired and the upgrade run again
+    fleet.failing.clear()
+    report = _run(fleet, [phase], size=2, max_unavailable=2, retries=3)
+    assert len(report) == 3
+    assert set(fleet.versions.values()) == {'new'}
+    assert fleet.down() == []
+    assert fleet.max_down == 2
+
+
+def test_wait_for_retries_until_healthy():
+    fleet = SimulatedFleet(['worker-0'], upgrade_time=4)
+    fleet.upgrader('new')(['worker-0'])
+    assert upgrade.wait_for([('up', fleet.healthy)], ['worker-0'], retries=10, delay=2, sleep=fleet.sleep) == 3
+    assert fleet.clock() == 4
+
+
+def test_rolling_upgrade_of_workers_against_the_fakes(cloud):
+    code, output = cloud.run('f.deploy()')
+    assert code == 0, output
+    with bench.Host(cloud.state, 'worker-1') as host:
+        host.stamps[versions.settings['state_dir'] + '/kubernetes-node'][0] = 'v1.9.0'
+    code, output = cloud.run('f.rolling_upgrade(phases="workers")')
+    assert code == 0, output
+    assert 'install -m 0755 /var/cache/hardway/kubelet /usr/local/bin/kubelet.new' in output
+    assert cloud.host('worker-1').restarts == {'kube-proxy': 1, 'kubelet': 1}
+    assert cloud.host('worker-0').restarts == {}
+
+
+def test_a_rerun_keeps_a_rotated_encryption_config(cloud):
+    code, output = cloud.run('f.deploy()')
+    assert code == 0, output
+    # what rotate_encryption_key does around the rewrite, without an API to rewrite through
+    code, output = cloud.run('keyring = f.rotation.Keyring.load(); keyring.promote(keyring.add()); keyring.save(); '
+                             'f._roll_encryption_config(keyring)')
+    assert code == 0, output
+    with open('encryption/encryption-config.yaml', 'rb') as config:
+        rotated = bench._sha256(config.read())
+    with open('versions.yaml', 'a') as manifest:
+        manifest.write('# bumped\n')
+    code, output = cloud.run('f.deploy()')
+    assert code == 0, output
+    assert '[pipeline] setup_controller: running' in output
+    assert not [line for line in output.splitlines() if 'sudo cp ' in line and 'encryption-config' in line]
+    for name in ('controller-0', 'controller-1', 'controller-2'):
+        assert cloud.host(name).files['/var/lib/kubernetes/encryption-config.yaml'] == rotated
+
+
+def test_control_plane_certs_and_kubeconfigs_are_converged(cloud):
+    code, output = cloud.run('f.deploy()')
+    assert code == 0, output
+    for name, path in (('kube-controller-manager.kubeconfig', 'control_manager/kube-controller-manager.kubeconfig'),
+                       ('kube-scheduler.kubeconfig', 'scheduler/kube-scheduler.kubeconfig'),
+                       ('kubernetes-key.pem', 'api_server/kubernetes-key.pem'), ('ca-key.pem', 'ca/ca-key.pem')):
+        with open(path, 'rb') as f:
+            assert cloud.host('controller-0').files['/var/lib/kubernetes/' + name] == bench._sha256(f.read())
+    assert not [line for line in output.splitlines() if line.startswith('[controller-') and 'sudo cp ' in line]
+    # the controller manager's kubeconfig changes: only the controller manager restarts, on every controller
+    with open('control_manager/kube-controller-manager.kubeconfig', 'a') as f:
+        f.write('# renewed\n')
+    code, output = cloud.run('f.deploy()')
+    assert code == 0, output
+    for name in ('controller-0', 'controller-1', 'controller-2'):
+        assert cloud.host(name).restarts == {'kube-controller-manager': 1}
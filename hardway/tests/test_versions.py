@@ -0,0 +1,54 @@
+import os
+import shutil
+import subprocess
+
+import bench
+import versions
+
+
+def test_binaries_are_never_written_in_place():
+    for component in versions.components():
+        for command in component.install:
+            assert 'sudo cp ' not in command, command
+
+
+def test_replace_works_on_a_running_binary(tmp_path):
+    stage = tmp_path / 'stage'
+    bin_dir = tmp_path / 'bin'
+    stage.mkdir()
+    bin_dir.mkdir()
+    running = str(bin_dir / 'sleep')
+    shutil.copy(shutil.which('sleep'), running)
+    shutil.copy(shutil.which('true'), str(stage / 'sleep'))
+    process = subprocess.Popen([running, '30'])
+    try:
+        # what a plain cp over it runs into
+        copy = subprocess.run(['cp', str(stage / 'sleep'), running], stderr=subprocess.PIPE)
+        assert copy.returncode != 0 and b'busy' in copy.stderr
+        command = versions._replace((str(stage / 'sleep'), running)).replace('sudo ', '')
+        subprocess.check_call(command, shell=True)
+        assert open(running, 'rb').read() == open(str(stage / 'sleep'), 'rb').read()
+        assert os.access(running, os.X_OK)
+        assert not os.path.exists(running + '.new')
+    finally:
+        process.kill()
+        process.wait()
+
+
+def _stamp_version(cloud, host_name, component, version):
+    with bench.Host(cloud.state, host_name) as host:
+        host.stamps[versions.settings['state_dir'] + '/' + component][0] = version
+
+
+def test_setup_worker_restarts_upgraded_daemons(cloud):
+    code, output = cloud.run('f.deploy(target="setup_kubelet;setup_kube_proxy")')
+    assert code == 0, output
+    assert cloud.host('worker-0').restarts == {}
+    # as if worker-0 had an older kubernetes-node and runc installed
+    _stamp_version(cloud, 'worker-0', 'kubernetes-node', 'v1.9.0')
+    _stamp_version(cloud, 'worker-0', 'runc', 'v0.1.0')
+    code, output = cloud.run('f.setup_worker()')
+    assert code == 0, output
+    assert 'sudo systemctl try-restart containerd kube-proxy kubelet' in output
+    assert cloud.host('worker-0').restarts == {'containerd': 1, 'kube-proxy': 1, 'kubelet': 1}
+    assert cloud.host('worker-1').restarts == {}
@@ -0,0 +1,211 @@
+"""
+The shape of the cluster: how many controllers and workers, and their
+addresses.
+
+Node count, IPs and CIDRs used to be spelled out in every task
+(``10.240.0.1{0}``, ``10.200.{0}.0/24``, ...), which silently broke past 10
+nodes. A ``Topology`` is loaded from a YAML or JSON file (``cluster.yaml`` by
+default) and allocates node IPs, pod CIDRs and API server SANs for any node
+count with ``ipaddress``. Every address is computed from its index, so laying
+out n nodes is O(n).
+"""
+import ipaddress
+import os
+
+import yaml
+
+settings = {
+    'path': 'cluster.yaml',
+}
+
+DEFAULTS = {
+    'name': 'kubernetes-the-hard-way',
+    'controllers': 3,
+    'workers': 3,
+    'node_cidr': '10.240.0.0/24',
+    'controller_offset': 10,
+    'worker_offset': 20,
+    'pod_cidr': '10.200.0.0/16',
+    'pod_prefix': 24,
+    'service_cidr': '10.32.0.0/24',
+    'subnet': 'kubernetes',
+    'machine_type': 'n1-standard-1',
+    'boot_disk_size': '200GB',
+}
+
+# GCE keeps the first two and the last two addresses of a subnet
+RESERVED_LOW = 2
+RESERVED_HIGH = 2
+
+_current = None
+
+# the pod routes are named ROUTE_PREFIX + pod cidr; GCE adds default and subnet
+# routes to the same network that only go away with it
+ROUTE_PREFIX = 'kubernetes-route-'
+
+
+def resource_names(name):
+    """
+    The names of the firewall rules and load balancer of the cluster called
+    name. They are named after it, so two clusters in one project don't share
+    or delete each other's.
+    """
+    return {
+        'internal-firewall': '{0}-allow-internal'.format(name),
+        'external-firewall': '{0}-allow-external'.format(name),
+        'health-check-firewall': '{0}-allow-health-check'.format(name),
+        'http-health-check': '{0}-health-check'.format(name),
+        'target-pool': '{0}-target-pool'.format(name),
+        'forwarding-rule': '{0}-forwarding-rule'.format(name),
+    }
+
+
+class TopologyError(ValueError):
+    pass
+
+
+class Node(object):
+    def __init__(self, role, index, internal_ip, pod_cidr=None):
+        self.role = role
+        self.index = index
+        self.name = '{0}-{1}'.format(role, index)
+        self.internal_ip = internal_ip
+        self.pod_cidr = pod_cidr
+
+    def __repr__(self):
+        return 'Node({0!r}, internal_ip={1!r}, pod_cidr={2!r})'.format(self.name, self.internal_ip, self.pod_cidr)
+
+
+class Topology(object):
+    def __init__(self, **options):
+        unknown = set(options) - set(DEFAULTS)
+        if unknown:
+            raise TopologyError('unknown topology settings: {0}'.format(', '.join(sorted(unknown))))
+        values = dict(DEFAULTS)
+        values.update(options)
+        self.values = values
+        self.name = values['name']
+        self.subnet = values['subnet']
+        self.machine_type = values['machine_type']
+        self.boot_disk_size = values['boot_disk_size']
+        self.controller_offset = int(values['controller_offset'])
+        self.worker_offset = int(values['worker_offset'])
+        self.controller_count = int(values['controllers'])
+        self.worker_count = int(values['workers'])
+        self.node_network = ipaddress.ip_network(values['node_cidr'])
+        self.pod_network = ipaddress.ip_network(values['pod_cidr'])
+        self.service_network = ipaddress.ip_network(values['service_cidr'])
+        self.pod_prefix = int(values['pod_prefix'])
+        self.validate()
+        self.controllers = [Node('controller', i, self.node_ip(self.controller_offset + i))
+                            for i in range(self.controller_count)]
+        self.workers = [Node('worker', i, self.node_ip(self.worker_offset + i), self.pod_subnet(i))
+                        for i in range(self.worker_count)]
+
+    def validate(self):
+        if self.controller_count < 1:
+            raise TopologyError('a cluster needs at least one controller')
+        if self.worker_count < 0:
+            raise TopologyError('worker count can not be negative')
+        last = self.node_network.num_addresses - 1 - RESERVED_HIGH
+        for role, offset, count in (('controller', self.controller_offset, self.controller_count),
+                                    ('worker', self.worker_offset, self.worker_count)):
+            if count and (offset < RESERVED_LOW or offset + count - 1 > last):
+                raise TopologyError('{0} {1}s starting at offset {2} do not fit in {3}'.format(
+                    count, role, offset, self.node_network))
+        controllers = (self.controller_offset, self.controller_offset + self.controller_count)
+        workers = (self.worker_offset, self.worker_offset + self.worker_count)
+        if self.worker_count and controllers[0] < workers[1] and workers[0] < controllers[1]:
+            raise TopologyError('controller addresses {0}-{1} overlap worker addresses {2}-{3}'.format(
+                controllers[0], controllers[1] - 1, workers[0], workers[1] - 1))
+        if self.pod_prefix < self.pod_network.prefixlen or self.pod_prefix > self.pod_network.max_prefixlen:
+            raise TopologyError('pod_prefix /{0} does not fit in {1}'.format(self.pod_prefix, self.pod_network))
+        available = 2 ** (self.pod_prefix - self.pod_network.prefixlen)
+        if self.worker_count > available:
+            raise TopologyError('{0} has room for {1} /{2} pod CIDRs, {3} workers need one each'.format(
+                self.pod_network, available, self.pod_prefix, self.worker_count))
+        if self.pod_network.overlaps(self.node_network) or self.service_network.overlaps(self.node_network) \
+                or self.service_network.overlaps(self.pod_network):
+            raise TopologyError('node, pod and service CIDRs must not overlap')
+
+    def node_ip(self, offset):
+        return str(self.node_network.network_address + offset)
+
+    def pod_subnet(self, index):
+        size = 2 ** (self.pod_network.max_prefixlen - self.pod_prefix)
+        return '{0}/{1}'.format(self.pod_network.network_address + index * size, self.pod_prefix)
+
+    def fingerprint(self):
+        """
+        The settings the layout was made from, for input hashes
+        """
+        return sorted((key, str(value)) for key, value in self.values.items())
+
+    @property
+    def nodes(self):
+        return self.controllers + self.workers
+
+    @property
+    def api_service_ip(self):
+        """
+        The kubernetes service, first address of the service CIDR
+        """
+        return str(self.service_network.network_address + 1)
+
+    @property
+    def dns_service_ip(self):
+        return str(self.service_network.network_address + 10)
+
+    def api_server_sans(self, public_ip):
+        return ([self.api_service_ip] + [node.internal_ip for node in self.controllers] +
+                [public_ip, '127.0.0.1', 'kubernetes.default'])
+
+    def etcd_servers(self):
+        return ','.join('https://{0}:2379'.format(node.internal_ip) for node in self.controllers)
+
+    def etcd_initial_cluster(self):
+        return ','.join('{0}=https://{1}:2380'.format(node.name, node.internal_ip) for node in self.controllers)
+
+    @property
+    def resource_names(self):
+        return resource_names(self.name)
+
+    def route_name(self, node):
+        return '{0}{1}'.format(ROUTE_PREFIX, node.pod_cidr.replace('.', '-').replace('/', '-'))
+
+    def get(self, name):
+        for node in self.nodes:
+            if node.name == name:
+                return node
+        raise KeyError('no node named {0!r} in the topology'.format(name))
+
+
+def load(path):
+    with open(path) as f:
+        # JSON is valid YAML, so this reads both
+        data = yaml.safe_load(f) or {}
+    try:
+        return Topology(**data)
+    except TopologyError as e:
+        raise TopologyError('{0}: {1}'.format(path, e))
+
+
+def use(path):
+    global _current
+    settings['path'] = path
+    _current = load(path)
+    return _current
+
+
+def current():
+    """
+    The topology of the fab run: the file at settings['path'] if there is one,
+    the three controller, three worker default otherwise
+    """
+    global _current
+    if _current is None:
+        if os.path.exists(settings['path']):
+            _current = load(settings['path'])
+        else:
+            _current = Topology()
+    return _current
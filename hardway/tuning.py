@@ -0,0 +1,335 @@
+"""
+Size the API servers and kubelets to the cluster.
+
+The kube-apiserver unit and the kubelet config only varied by address, so
+request-inflight limits, watch caches, the kubelet's API QPS and burst, image
+pull serialization and eviction thresholds stayed at defaults that throttle a
+cluster past a handful of nodes. A profile (``small``, ``medium``, ``large``,
+or ``auto`` to pick one from the topology's worker count and machine type)
+sets all of them, optionally overridden from ``tuning.yaml``; every value is
+checked against ``SCHEMA`` before anything is rendered, and ``check_api_server``
+and ``check_kubelet`` check that a rendered file carries the profile.
+"""
+import os
+import re
+import shlex
+
+import yaml
+
+import topology
+
+settings = {
+    'path': 'tuning.yaml',
+}
+
+PROFILES = {
+    'small': {
+        'apiserver': {
+            'max_requests_inflight': 400,
+            'max_mutating_requests_inflight': 200,
+            'default_watch_cache_size': 100,
+            'watch_cache_sizes': {},
+            'target_ram_mb': 0,
+        },
+        'kubelet': {
+            'kube_api_qps': 5,
+            'kube_api_burst': 10,
+            'serialize_image_pulls': True,
+            'registry_pull_qps': 5,
+            'registry_burst': 10,
+            'event_record_qps': 5,
+            'max_pods': 110,
+            'eviction_hard': {'memory.available': '100Mi', 'nodefs.available': '10%', 'imagefs.available': '15%'},
+        },
+    },
+    'medium': {
+        'apiserver': {
+            'max_requests_inflight': 800,
+            'max_mutating_requests_inflight': 400,
+            'default_watch_cache_size': 500,
+            'watch_cache_sizes': {'pods': 2000, 'nodes': 500, 'endpoints': 1000},
+            'target_ram_mb': 6000,
+        },
+        'kubelet': {
+            'kube_api_qps': 20,
+            'kube_api_burst': 40,
+            'serialize_image_pulls': False,
+            'registry_pull_qps': 10,
+            'registry_burst': 20,
+            'event_record_qps': 10,
+            'max_pods': 110,
+            'eviction_hard': {'memory.available': '250Mi', 'nodefs.available': '10%', 'imagefs.available': '15%'},
+        },
+    },
+    'large': {
+        'apiserver': {
+            'max_requests_inflight': 3000,
+            'max_mutating_requests_inflight': 1000,
+            'default_watch_cache_size': 1000,
+            'watch_cache_sizes': {'pods': 10000, 'nodes': 2000, 'endpoints': 5000, 'services': 2000},
+            'target_ram_mb': 30000,
+        },
+        'kubelet': {
+            'kube_api_qps': 50,
+            'kube_api_burst': 100,
+            'serialize_image_pulls': False,
+            'registry_pull_qps': 20,
+            'registry_burst': 40,
+            'event_record_qps': 20,
+            'max_pods': 110,
+            'eviction_hard': {'memory.available': '500Mi', 'nodefs.available': '10%', 'imagefs.available': '15%'},
+        },
+    },
+}
+
+# the largest worker count each profile is meant for, smallest first
+SIZES = [('small', 10), ('medium', 100), ('large', None)]
+
+# MB of memory of the machine types, for the API server's cache sizing
+MACHINE_MEMORY_MB = {
+    'n1-standard-1': 3840, 'n1-standard-2': 7680, 'n1-standard-4': 15360,
+    'n1-standard-8': 30720, 'n1-standard-16': 61440, 'n1-standard-32': 122880,
+    'n1-highmem-2': 13312, 'n1-highmem-4': 26624, 'n1-highmem-8': 53248,
+}
+
+# the API server wants about 60MB of cache per node it serves
+RAM_MB_PER_NODE = 60
+
+EVICTION_SIGNALS = ('memory.available', 'nodefs.available', 'nodefs.inodesFree', 'imagefs.available', 'imagefs.inodesFree')
+QUANTITY = re.compile(r'^\d+(\.\d+)?(%|Ki|Mi|Gi|Ti)?$')
+RESOURCE = re.compile(r'^[a-z]+(\.[a-z0-9.-]+)?$')
+
+# setting: (type, minimum, maximum); dicts are checked by _check_map
+SCHEMA = {
+    'apiserver': {
+        'max_requests_inflight': (int, 1, 100000),
+        'max_mutating_requests_inflight': (int, 1, 100000),
+        'default_watch_cache_size': (int, 0, 1000000),
+        'watch_cache_sizes': (dict, None, None),
+        'target_ram_mb': (int, 0, 10000000),
+    },
+    'kubelet': {
+        'kube_api_qps': (int, 1, 10000),
+        'kube_api_burst': (int, 1, 10000),
+        'serialize_image_pulls': (bool, None, None),
+        'registry_pull_qps': (int, 0, 1000),
+        'registry_burst': (int, 1, 1000),
+        'event_record_qps': (int, 0, 10000),
+        'max_pods': (int, 1, 500),
+        'eviction_hard': (dict, None, None),
+    },
+}
+
+_file = None
+
+
+class TuningError(ValueError):
+    pass
+
+
+class Tuning(object):
+    def __init__(self, name, apiserver, kubelet):
+        self.name = name
+        self.apiserver = apiserver
+        self.kubelet = kubelet
+
+    def fingerprint(self):
+        """
+        The tuned values, for input hashes
+        """
+        return [self.name, sorted((k, str(v)) for k, v in self.apiserver.items()),
+                sorted((k, str(v)) for k, v in self.kubelet.items())]
+
+    def api_server_flags(self):
+        """
+        The kube-apiserver command line flags of the profile, as name: value
+        """
+        tuned = self.apiserver
+        flags = {
+            'max-requests-inflight': str(tuned['max_requests_inflight']),
+            'max-mutating-requests-inflight': str(tuned['max_mutating_requests_inflight']),
+            'default-watch-cache-size': str(tuned['default_watch_cache_size']),
+        }
+        if tuned['watch_cache_sizes']:
+            flags['watch-cache-sizes'] = ','.join(
+                '{0}#{1}'.format(resource, size) for resource, size in sorted(tuned['watch_cache_sizes'].items()))
+        if tuned['target_ram_mb']:
+            flags['target-ram-mb'] = str(tuned['target_ram_mb'])
+        return flags
+
+    def kubelet_config(self):
+        """
+        The KubeletConfiguration fields of the profile
+        """
+        tuned = self.kubelet
+        return {
+            'kubeAPIQPS': tuned['kube_api_qps'],
+            'kubeAPIBurst': tuned['kube_api_burst'],
+            'serializeImagePulls': tuned['serialize_image_pulls'],
+            'registryPullQPS': tuned['registry_pull_qps'],
+            'registryBurst': tuned['registry_burst'],
+            'eventRecordQPS': tuned['event_record_qps'],
+            'maxPods': tuned['max_pods'],
+            'evictionHard': dict(tuned['eviction_hard']),
+        }
+
+
+def _check_map(section, key, value):
+    if key == 'watch_cache_sizes':
+        for resource, size in value.items():
+            if not RESOURCE.match(str(resource)):
+                raise TuningError('{0}.{1}: {2!r} is not a resource name'.format(section, key, resource))
+            if not isinstance(size, int) or isinstance(size, bool) or size < 0:
+                raise TuningError('{0}.{1}.{2}: size must be a whole number >= 0, got {3!r}'.format(section, key, resource, size))
+    elif key == 'eviction_hard':
+        for signal, threshold in value.items():
+            if signal not in EVICTION_SIGNALS:
+                raise TuningError('{0}.{1}: unknown eviction signal {2!r}'.format(section, key, signal))
+            if not QUANTITY.match(str(threshold)):
+                raise TuningError('{0}.{1}.{2}: {3!r} is not a quantity like 100Mi or 10%'.format(
+                    section, key, signal, threshold))
+
+
+def validate(tuned):
+    """
+    Raise TuningError unless every setting of every section is known, of the
+    right type and in range, and the settings agree with each other
+    """
+    for section, schema in SCHEMA.items():
+        values = tuned.get(section, {})
+        unknown = set(values) - set(schema)
+        if unknown:
+            raise TuningError('unknown {0} settings: {1}'.format(section, ', '.join(sorted(unknown))))
+        missing = set(schema) - set(values)
+        if missing:
+            raise TuningError('missing {0} settings: {1}'.format(section, ', '.join(sorted(missing))))
+        for key, (kind, minimum, maximum) in sorted(schema.items()):
+            value = values[key]
+            # bool is an int to python, but not to the schema
+            if not isinstance(value, kind) or (kind is int and isinstance(value, bool)):
+                raise TuningError('{0}.{1} must be {2}, got {3!r}'.format(section, key, kind.__name__, value))
+            if kind is dict:
+                _check_map(section, key, value)
+            elif kind is int and not minimum <= value <= maximum:
+                raise TuningError('{0}.{1} must be between {2} and {3}, got {4}'.format(
+                    section, key, minimum, maximum, value))
+    apiserver, kubelet = tuned['apiserver'], tuned['kubelet']
+    if apiserver['max_mutating_requests_inflight'] > apiserver['max_requests_inflight']:
+        raise TuningError('apiserver.max_mutating_requests_inflight is above max_requests_inflight')
+    if kubelet['kube_api_burst'] < kubelet['kube_api_qps']:
+        raise TuningError('kubelet.kube_api_burst must be at least kube_api_qps')
+    if kubelet['registry_burst'] < kubelet['registry_pull_qps']:
+        raise TuningError('kubelet.registry_burst must be at least registry_pull_qps')
+
+
+def size_for(cluster):
+    for name, workers in SIZES:
+        if workers is None or cluster.worker_count <= workers:
+            return name
+
+
+def derive(cluster):
+    """
+    The profile for the size of cluster, with the API server's cache sized to
+    its node count and kept under half the memory of a controller
+    """
+    tuned = _copy(PROFILES[size_for(cluster)])
+    target = RAM_MB_PER_NODE * len(cluster.nodes)
+    memory = MACHINE_MEMORY_MB.get(cluster.machine_type)
+    if memory:
+        target = min(target, memory // 2)
+    tuned['apiserver']['target_ram_mb'] = target
+    return tuned
+
+
+def _copy(tuned):
+    return dict((section, dict((k, dict(v) if isinstance(v, dict) else v) for k, v in values.items()))
+                for section, values in tuned.items())
+
+
+def load(path):
+    """
+    A tuning file: profile: auto|small|medium|large, then apiserver: and
+    kubelet: settings that override the profile's
+    """
+    with open(path) as f:
+        data = yaml.safe_load(f) or {}
+    unknown = set(data) - set(['profile'] + list(SCHEMA))
+    if unknown:
+        raise TuningError('{0}: unknown sections {1}'.format(path, ', '.join(sorted(unknown))))
+    return data
+
+
+def use(path=None, profile=None):
+    """
+    Tune from the file at path and/or with the named profile instead
+    """
+    global _file
+    if path is not None:
+        settings['path'] = path
+        _file = load(path)
+    if profile is not None:
+        if profile != 'auto' and profile not in PROFILES:
+            raise TuningError('unknown profile {0!r}, use auto or one of {1}'.format(profile, ', '.join(sorted(PROFILES))))
+        _file = dict(_options(), profile=profile)
+    return current()
+
+
+def _options():
+    global _file
+    if _file is None:
+        _file = load(settings['path']) if os.path.exists(settings['path']) else {}
+    return _file
+
+
+def current(cluster=None):
+    """
+    The validated Tuning for cluster (the topology of the fab run by default)
+    """
+    cluster = cluster or topology.current()
+    options = _options()
+    name = options.get('profile', 'auto')
+    if name == 'auto':
+        tuned = derive(cluster)
+        name = 'auto:' + size_for(cluster)
+    elif name in PROFILES:
+        tuned = _copy(PROFILES[name])
+    else:
+        raise TuningError('unknown profile {0!r}'.format(name))
+    for section in SCHEMA:
+        overrides = options.get(section) or {}
+        for key, value in overrides.items():
+            if isinstance(value, dict) and isinstance(tuned[section].get(key), dict):
+                tuned[section][key].update(value)
+            else:
+                tuned[section][key] = value
+    validate(tuned)
+    return Tuning(name, tuned['apiserver'], tuned['kubelet'])
+
+
+def check_api_server(text, tuned):
+    """
+    Raise TuningError unless the kube-apiserver unit text passes every flag
+    of the profile with its value
+    """
+    command = ' '.join(line.rstrip('\\').strip() for line in text.splitlines()
+                       if line.startswith('ExecStart=') or line.startswith('  --'))
+    flags = {}
+    for word in shlex.split(command):
+        if word.startswith('--'):
+            name, _, value = word[2:].partition('=')
+            flags[name] = value
+    for name, value in sorted(tuned.api_server_flags().items()):
+        if flags.get(name) != value:
+            raise TuningError('kube-apiserver --{0} is {1!r}, the profile wants {2!r}'.format(name, flags.get(name), value))
+
+
+def check_kubelet(text, tuned):
+    """
+    Raise TuningError unless the rendered kubelet config has the profile's
+    fields
+    """
+    config = yaml.safe_load(text) or {}
+    for key, value in sorted(tuned.kubelet_config().items()):
+        if config.get(key) != value:
+            raise TuningError('kubelet config {0} is {1!r}, the profile wants {2!r}'.format(key, config.get(key), value))
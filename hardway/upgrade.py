@@ -0,0 +1,155 @@
+"""
+Upgrade the cluster in waves, each gated on health checks.
+
+There was no upgrade path: changing a version meant running the setup tasks
+again by hand, on every node at once. ``run`` goes through phases (etcd
+members, then the rest of the control plane, then workers), upgrades each
+phase in batches of ``batch_size`` nodes, never more than
+``max_unavailable`` (and never so many etcd members that the cluster loses
+quorum), and waits for the phase's health gates to pass before the next
+batch starts. The upgrade and gate callables are plain functions of a batch
+of nodes, so the orchestration runs the same against ``SimulatedFleet`` as
+against a real cluster.
+"""
+import time
+
+import fanout
+
+settings = {
+    'batch_size': 1,
+    'max_unavailable': 1,
+    # a gate gets retries tries, delay seconds apart, to pass
+    'retries': 30,
+    'delay': 5,
+}
+
+
+class UpgradeError(Exception):
+    pass
+
+
+class Phase(object):
+    """
+    Nodes upgraded by upgrade(batch), a batch at a time, and the gates that
+    must pass after each batch. A gate is a (name, check) pair; check(batch)
+    returns a list of problems, empty when healthy. limit caps how many nodes
+    of the phase may be down at once whatever max_unavailable says.
+    """
+    def __init__(self, name, nodes, upgrade, gates=(), limit=None):
+        self.name = name
+        self.nodes = list(nodes)
+        self.upgrade = upgrade
+        self.gates = list(gates)
+        self.limit = limit
+
+
+def quorum_limit(members):
+    """
+    How many members of a cluster of that size can be down with a quorum left
+    """
+    return (members - 1) // 2
+
+
+def batch_size(phase, size=None, max_unavailable=None):
+    size = int(size or settings['batch_size'])
+    max_unavailable = int(max_unavailable or settings['max_unavailable'])
+    allowed = max_unavailable if phase.limit is None else min(max_unavailable, phase.limit)
+    # a phase that can't lose a node still has to be upgraded, one node at a time
+    return max(1, min(size, allowed))
+
+
+def batches(phase, size=None, max_unavailable=None):
+    n = batch_size(phase, size, max_unavailable)
+    return [phase.nodes[i:i + n] for i in range(0, len(phase.nodes), n)]
+
+
+def _name(node):
+    return getattr(node, 'name', node)
+
+
+def wait_for(gates, batch, retries=None, delay=None, sleep=time.sleep):
+    """
+    Check every gate until all pass; returns the number of tries it took.
+    Raises UpgradeError with the last problems when they never do.
+    """
+    retries = int(retries or settings['retries'])
+    delay = float(settings['delay'] if delay is None else delay)
+    problems = []
+    for attempt in range(1, retries + 1):
+        problems = ['{0}: {1}'.format(name, problem) for name, check in gates for problem in check(batch)]
+        if not problems:
+            return attempt
+        if attempt < retries:
+            sleep(delay)
+    raise UpgradeError('{0} still unhealthy after {1} tries: {2}'.format(
+        ', '.join(_name(node) for node in batch), retries, '; '.join(problems)))
+
+
+def run(phases, size=None, max_unavailable=None, retries=None, delay=None, sleep=time.sleep, clock=time.time):
+    """
+    Upgrade every phase in order, batch by batch, stopping at the first batch
+    that fails or doesn't pass its gates. Returns a report of
+    (phase, node names, seconds, gate tries) for every batch.
+    """
+    report = []
+    for phase in phases:
+        if not phase.nodes:
+            continue
+        waves = batches(phase, size, max_unavailable)
+        fanout.log('[upgrade] {0}: {1} nodes in {2} batches of up to {3}'.format(
+            phase.name, len(phase.nodes), len(waves), len(waves[0])))
+        for batch in waves:
+            names = [_name(node) for node in batch]
+            started = clock()
+            phase.upgrade(batch)
+            tries = wait_for(phase.gates, batch, retries, delay, sleep)
+            report.append((phase.name, names, clock() - started, tries))
+            fanout.log('[upgrade] {0}: {1} healthy after {2:.1f}s'.format(phase.name, ', '.join(names), clock() - started))
+    return report
+
+
+class SimulatedFleet(object):
+    """
+    An in-memory cluster to run upgrades against. An upgraded node is down
+    for upgrade_time seconds of the fleet's own clock, which only moves when
+    the orchestrator sleeps; nodes in failing never come back. The most nodes
+    ever down at once is kept in max_down.
+    """
+    def __init__(self, names, version='old', upgrade_time=0, failing=()):
+        self.now = 0.0
+        self.versions = dict((name, version) for name in names)
+        self.down_until = dict((name, 0.0) for name in names)
+        self.upgrade_time = upgrade_time
+        self.failing = set(failing)
+        self.upgraded = []
+        self.max_down = 0
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def down(self):
+        return [name for name, until in sorted(self.down_until.items())
+                if until > self.now or (name in self.failing and name in self.upgraded)]
+
+    def upgrader(self, version):
+        def upgrade(batch):
+            for node in batch:
+                name = _name(node)
+                self.versions[name] = version
+                self.down_until[name] = self.now + self.upgrade_time
+                self.upgraded.append(name)
+            self.max_down = max(self.max_down, len(self.down()))
+        return upgrade
+
+    def healthy(self, batch):
+        """
+        A gate check: the nodes of batch that are still down
+        """
+        down = set(self.down())
+        return ['{0} is down'.format(_name(node)) for node in batch if _name(node) in down]
+
+    def phase(self, name, names, version, limit=None):
+        return Phase(name, names, self.upgrader(version), gates=[('up', self.healthy)], limit=limit)
@@ -0,0 +1,242 @@
+"""
+Which release of every component goes on the cluster, and what is already
+installed on a node.
+
+Versions used to be spelled out in the download URLs of ``kubectl``,
+``setup_etcd``, ``setup_controller`` and ``setup_worker``, and every run
+extracted and copied every binary again. The versions now live in one
+manifest (``versions.yaml``, falling back to ``DEFAULTS``). After installing a
+component a stamp with its version and the sha256 of its binaries is written
+on the node; one remote call prints the stamps and the current hashes, and
+only components whose version changed or whose binaries no longer match
+their stamp are installed again.
+"""
+import os
+import posixpath
+
+import yaml
+
+import artifacts
+
+settings = {
+    'path': 'versions.yaml',
+    'state_dir': '/var/lib/hardway/installed',
+}
+
+DEFAULTS = {
+    'kubernetes': 'v1.10.2',
+    'etcd': 'v3.3.5',
+    'containerd': '1.1.0',
+    'runc': 'v1.0.0-rc5',
+    'runsc': 'latest',
+    'cni_plugins': 'v0.6.0',
+    'crictl': 'v1.0.0-beta.0',
+}
+
+KUBERNETES_RELEASE = 'https://storage.googleapis.com/kubernetes-release/release/{version}/bin'
+
+
+def _replace(*binaries):
+    """
+    Command that puts each (source, destination) binary in place. A running
+    binary can't be written to (ETXTBSY), so it is copied next to it and
+    renamed over it; the daemon keeps the old one until it restarts.
+    """
+    return ' && '.join('sudo install -m 0755 {0} {1}.new && sudo mv -f {1}.new {1}'.format(source, destination)
+                       for source, destination in binaries)
+
+
+# name, manifest key, roles, release URLs, install commands and the binaries
+# they put in place. URLs and commands are formatted with version and stage,
+# the directory pushed artifacts land in on the node.
+COMPONENTS = [
+    ('kubectl', 'kubernetes', ('operator',),
+     [KUBERNETES_RELEASE + '/darwin/amd64/kubectl'],
+     [],
+     ['/usr/local/bin/kubectl']),
+    ('etcd', 'etcd', ('controller',),
+     ['https://github.com/coreos/etcd/releases/download/{version}/etcd-{version}-linux-amd64.tar.gz'],
+     ['sudo tar -xf {stage}/etcd-{version}-linux-amd64.tar.gz -C {stage} && '
+      'sudo mv {stage}/etcd-{version}-linux-amd64/etcd* /usr/local/bin/'],
+     ['/usr/local/bin/etcd', '/usr/local/bin/etcdctl']),
+    ('kubernetes-control-plane', 'kubernetes', ('controller',),
+     [KUBERNETES_RELEASE + '/linux/amd64/kube-apiserver',
+      KUBERNETES_RELEASE + '/linux/amd64/kube-controller-manager',
+      KUBERNETES_RELEASE + '/linux/amd64/kube-scheduler',
+      KUBERNETES_RELEASE + '/linux/amd64/kubectl'],
+     [_replace(*[('{stage}/' + name, '/usr/local/bin/' + name)
+                 for name in ('kube-apiserver', 'kube-controller-manager', 'kube-scheduler', 'kubectl')])],
+     ['/usr/local/bin/kube-apiserver', '/usr/local/bin/kube-controller-manager',
+      '/usr/local/bin/kube-scheduler', '/usr/local/bin/kubectl']),
+    ('kubernetes-node', 'kubernetes', ('worker',),
+     [KUBERNETES_RELEASE + '/linux/amd64/kubectl',
+      KUBERNETES_RELEASE + '/linux/amd64/kube-proxy',
+      KUBERNETES_RELEASE + '/linux/amd64/kubelet'],
+     [_replace(*[('{stage}/' + name, '/usr/local/bin/' + name) for name in ('kubectl', 'kube-proxy', 'kubelet')])],
+     ['/usr/local/bin/kubectl', '/usr/local/bin/kube-proxy', '/usr/local/bin/kubelet']),
+    ('crictl', 'crictl', ('worker',),
+     ['https://github.com/kubernetes-incubator/cri-tools/releases/download/{version}/crictl-{version}-linux-amd64.tar.gz'],
+     ['sudo tar -xf {stage}/crictl-{version}-linux-amd64.tar.gz -C /usr/local/bin/'],
+     ['/usr/local/bin/crictl']),
+    # the kubernetes-the-hard-way bucket only has the one, unversioned build
+    ('runsc', 'runsc', ('worker',),
+     ['https://storage.googleapis.com/kubernetes-the-hard-way/runsc'],
+     [_replace(('{stage}/runsc', '/usr/local/bin/runsc'))],
+     ['/usr/local/bin/runsc']),
+    ('runc', 'runc', ('worker',),
+     ['https://github.com/opencontainers/runc/releases/download/{version}/runc.amd64'],
+     [_replace(('{stage}/runc.amd64', '/usr/local/bin/runc'))],
+     ['/usr/local/bin/runc']),
+    ('cni-plugins', 'cni_plugins', ('worker',),
+     ['https://github.com/containernetworking/plugins/releases/download/{version}/cni-plugins-amd64-{version}.tgz'],
+     ['sudo mkdir -p /opt/cni/bin && sudo tar -xf {stage}/cni-plugins-amd64-{version}.tgz -C /opt/cni/bin/'],
+     ['/opt/cni/bin/bridge', '/opt/cni/bin/host-local', '/opt/cni/bin/loopback']),
+    ('containerd', 'containerd', ('worker',),
+     ['https://github.com/containerd/containerd/releases/download/v{version}/containerd-{version}.linux-amd64.tar.gz'],
+     ['sudo tar -xf {stage}/containerd-{version}.linux-amd64.tar.gz -C /'],
+     ['/bin/containerd', '/bin/containerd-shim', '/bin/ctr']),
+]
+
+# the services that run a component's binaries, restarted when it is upgraded
+SERVICES = {
+    'etcd': ['etcd'],
+    'kubernetes-control-plane': ['kube-apiserver', 'kube-controller-manager', 'kube-scheduler'],
+    'kubernetes-node': ['kubelet', 'kube-proxy'],
+    'containerd': ['containerd'],
+    'runc': ['containerd'],
+    'runsc': ['containerd'],
+}
+
+_current = None
+
+
+class Component(object):
+    """
+    One component at the version the manifest asks for
+    """
+    def __init__(self, name, version, roles, urls, install, binaries):
+        self.name = name
+        self.version = version
+        self.roles = roles
+        values = dict(version=version, stage=artifacts.settings['remote_dir'])
+        self.urls = [url.format(**values) for url in urls]
+        self.install = [command.format(**values) for command in install]
+        self.binaries = list(binaries)
+
+    @property
+    def services(self):
+        return SERVICES.get(self.name, [])
+
+    def __repr__(self):
+        return 'Component({0!r}, {1!r})'.format(self.name, self.version)
+
+    @property
+    def stamp_path(self):
+        return posixpath.join(settings['state_dir'], self.name)
+
+    def stamp_command(self):
+        """
+        Record the version and the hashes of the binaries just installed
+        """
+        return 'sudo mkdir -p {0} && {{ echo "version {1}"; sha256sum {2}; }} | sudo tee {3} >/dev/null'.format(
+            settings['state_dir'], self.version, ' '.join(self.binaries), self.stamp_path)
+
+    def installed(self, stamps, current):
+        """
+        Whether the stamp on the node is for this version and every binary
+        still has the hash the stamp recorded
+        """
+        stamp = stamps.get(self.name)
+        if stamp is None or stamp[0] != self.version:
+            return False
+        return all(path in stamp[1] and current.get(path) == stamp[1][path] for path in self.binaries)
+
+
+def load(path):
+    manifest = dict(DEFAULTS)
+    with open(path) as f:
+        data = yaml.safe_load(f) or {}
+    unknown = set(data) - set(DEFAULTS)
+    if unknown:
+        raise ValueError('{0}: unknown components {1}'.format(path, ', '.join(sorted(unknown))))
+    manifest.update((key, str(value)) for key, value in data.items())
+    return manifest
+
+
+def use(path):
+    global _current
+    settings['path'] = path
+    _current = load(path)
+    return _current
+
+
+def current():
+    """
+    The manifest of the fab run: the file at settings['path'] if there is one,
+    DEFAULTS otherwise
+    """
+    global _current
+    if _current is None:
+        _current = load(settings['path']) if os.path.exists(settings['path']) else dict(DEFAULTS)
+    return _current
+
+
+def components(role=None):
+    manifest = current()
+    return [Component(name, manifest[key], roles, urls, install, binaries)
+            for name, key, roles, urls, install, binaries in COMPONENTS
+            if role is None or role in roles]
+
+
+def get(name):
+    for component in components():
+        if component.name == name:
+            return component
+    raise KeyError('no component named {0!r}'.format(name))
+
+
+def urls(role=None):
+    return sorted(set(url for component in components(role) for url in component.urls))
+
+
+def probe_command(components):
+    """
+    One command that prints every stamp and the current hash of every binary
+    """
+    binaries = sorted(set(path for component in components for path in component.binaries))
+    return ('for f in {0}/*; do [ -f "$f" ] && echo "== $f" && cat "$f"; done; '
+            'echo "== current"; sha256sum {1} 2>/dev/null; true').format(settings['state_dir'], ' '.join(binaries))
+
+
+def parse_probe(output):
+    """
+    ({component: (version, {binary: sha256})}, {binary: sha256}) from the
+    output of probe_command
+    """
+    stamps = {}
+    current = {}
+    section = None
+    for line in output.splitlines():
+        line = line.strip()
+        if line.startswith('== '):
+            path = line[3:]
+            section = None if path == 'current' else posixpath.basename(path)
+            if section is not None:
+                stamps[section] = (None, {})
+        elif line.startswith('version ') and section is not None:
+            stamps[section] = (line.split(None, 1)[1], stamps[section][1])
+        elif line:
+            fields = line.split()
+            if len(fields) != 2:
+                continue
+            digest, path = fields
+            (stamps[section][1] if section is not None else current)[path] = digest
+    return stamps, current
+
+
+def pending(components, output):
+    """
+    The components that need installing, given the output of probe_command
+    """
+    stamps, current = parse_probe(output)
+    return [component for component in components if not component.installed(stamps, current)]